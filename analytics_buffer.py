@@ -0,0 +1,173 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from config import ANALYTICS_FLUSH_INTERVAL_MS, ANALYTICS_FLUSH_ROWS, ANALYTICS_BUFFER_MAX
+from db_pool import db_pool, SQLitePool
+from logger import get_logger
+
+logger = get_logger('database')
+
+
+class AnalyticsBuffer:
+    """Буфер аналитических событий: запись без ожидания, сброс пачками через executemany.
+
+    Если запись пачки не удалась, события возвращаются в начало буфера (в
+    пределах max_pending) и повторяются при следующем сбросе; после
+    max_attempts неудачных сбросов событие отбрасывается.
+    """
+
+    def __init__(self, pool: SQLitePool, flush_interval: float = 0.5, flush_rows: int = 200, max_pending: int = 10000,
+                 max_attempts: int = 3):
+        self.pool = pool
+        self.flush_interval = flush_interval
+        self.flush_rows = max(1, flush_rows)
+        self.max_pending = max(1, max_pending)
+        self.max_attempts = max(1, max_attempts)
+        # (SQL, параметры, время постановки, число неудачных сбросов)
+        self._pending: Deque[Tuple[str, tuple, float, int]] = deque()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._stopping = False
+        self._stats = {
+            'recorded': 0,
+            'flushed': 0,
+            'dropped': 0,
+            'failed': 0,
+            'requeued': 0,
+            'flushes': 0,
+            'last_flush_lag': 0.0,
+            'max_flush_lag': 0.0,
+        }
+
+    def _bind_loop(self) -> None:
+        """Создаёт примитивы и фоновую задачу сброса для текущего event loop."""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+            self._flush_lock = asyncio.Lock()
+            self._task = None
+        if not self._stopping and (self._task is None or self._task.done()):
+            self._task = loop.create_task(self._flush_loop())
+
+    def record(self, statement: str, params: tuple) -> bool:
+        """Ставит событие в буфер без ожидания; возвращает False, если буфер переполнен."""
+        self._bind_loop()
+        if len(self._pending) >= self.max_pending:
+            self._stats['dropped'] += 1
+            if self._stats['dropped'] % 100 == 1:
+                logger.warning(f"Буфер аналитики переполнен ({self.max_pending}), событие отброшено")
+            return False
+        self._pending.append((statement, params, time.monotonic(), 0))
+        self._stats['recorded'] += 1
+        if len(self._pending) >= self.flush_rows:
+            self._wakeup.set()
+        return True
+
+    async def _flush_loop(self) -> None:
+        """Фоновая задача: сбрасывает буфер по таймеру или по накоплению строк."""
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка фонового сброса буфера аналитики: {e}", exc_info=True)
+
+    async def flush(self) -> int:
+        """Записывает накопленные события одной транзакцией; возвращает число строк."""
+        if not self._pending:
+            return 0
+        self._bind_loop()
+        async with self._flush_lock:
+            events = []
+            while self._pending and len(events) < self.max_pending:
+                events.append(self._pending.popleft())
+            if not events:
+                return 0
+
+            lag = time.monotonic() - events[0][2]
+            groups: Dict[str, List[Tuple[str, tuple, float, int]]] = {}
+            for event in events:
+                groups.setdefault(event[0], []).append(event)
+
+            def insert(statement: str, rows: List[tuple]):
+                async def job(conn):
+                    await conn.executemany(statement, rows)
+                return job
+
+            # Каждый вид событий — отдельное задание писателя: все попадают в одну
+            # транзакцию, но ошибка одного вида не откатывает остальные
+            results = await asyncio.gather(*(
+                self.pool.submit_write(insert(statement, [event[1] for event in group]))
+                for statement, group in groups.items()
+            ), return_exceptions=True)
+
+            written = 0
+            for group, result in zip(groups.values(), results):
+                if isinstance(result, Exception):
+                    logger.error(f"Не удалось записать {len(group)} событий аналитики: {result}", exc_info=result)
+                    self._requeue(group)
+                else:
+                    written += len(group)
+            if not written:
+                return 0
+
+            self._stats['flushed'] += written
+            self._stats['flushes'] += 1
+            self._stats['last_flush_lag'] = lag
+            if lag > self._stats['max_flush_lag']:
+                self._stats['max_flush_lag'] = lag
+            return written
+
+    def _requeue(self, events: List[Tuple[str, tuple, float, int]]) -> None:
+        """Возвращает неудачную пачку в начало буфера, сохраняя порядок событий."""
+        retry = [(statement, params, queued_at, attempts + 1)
+                 for statement, params, queued_at, attempts in events if attempts + 1 < self.max_attempts]
+        room = max(0, self.max_pending - len(self._pending))
+        requeued = retry[:room]
+        self._pending.extendleft(reversed(requeued))
+        self._stats['requeued'] += len(requeued)
+        self._stats['failed'] += len(events) - len(requeued)
+
+    async def stop(self) -> None:
+        """Останавливает фоновый сброс и записывает оставшиеся события."""
+        self._stopping = True
+        if self._task is not None and not self._task.done():
+            self._wakeup.set()
+            try:
+                await self._task
+            except Exception:
+                pass
+        self._task = None
+        while self._pending:
+            if not await self.flush():
+                break
+        logger.info(f"Буфер аналитики остановлен, записано событий: {self._stats['flushed']}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Возвращает счётчики буфера: очередь, задержку сброса и потери."""
+        stats = dict(self._stats)
+        stats['pending'] = len(self._pending)
+        stats['pending_lag'] = time.monotonic() - self._pending[0][2] if self._pending else 0.0
+        return stats
+
+
+analytics_buffer = AnalyticsBuffer(
+    db_pool,
+    flush_interval=ANALYTICS_FLUSH_INTERVAL_MS / 1000,
+    flush_rows=ANALYTICS_FLUSH_ROWS,
+    max_pending=ANALYTICS_BUFFER_MAX,
+)
+
+
+def get_analytics_stats() -> Dict[str, Any]:
+    """Метрики буфера аналитики."""
+    return analytics_buffer.get_stats()
@@ -0,0 +1,192 @@
+import asyncio
+import io
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.dates as mdates
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import seaborn as sns
+
+from config import CHART_WORKERS, CHART_CACHE_TTL_SECONDS
+from database import get_daily_payment_totals, get_daily_registration_counts, get_daily_generation_units
+from generation_config import IMAGE_GENERATION_MODELS
+from logger import get_logger
+
+logger = get_logger('main')
+
+CHARTS = ('payments', 'registrations', 'generations')
+
+
+def _render_chart(spec: Dict[str, Any]) -> bytes:
+    """Рисует график по готовым дневным рядам (выполняется в отдельном процессе).
+
+    Используется объектный API matplotlib: своя Figure и холст Agg на каждый
+    вызов, без глобального состояния pyplot.
+    """
+    days = [datetime.strptime(day, '%Y-%m-%d').date() for day in spec['days']]
+    with sns.axes_style('whitegrid'):
+        fig = Figure(figsize=(12, 6))
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot()
+
+    series = spec['series']
+    if spec['kind'] == 'area':
+        values = next(iter(series.values()))
+        ax.plot(days, values, color='#4CAF50', linewidth=2, marker='o')
+        ax.fill_between(days, values, color=(76 / 255, 175 / 255, 80 / 255, 0.2))
+    elif spec['kind'] == 'bar':
+        values = next(iter(series.values()))
+        ax.bar(days, values, color='#2196F3', edgecolor='#1976D2')
+    else:
+        colors = sns.color_palette('husl', len(series))
+        for color, (label, values) in zip(colors, series.items()):
+            ax.plot(days, values, label=label, color=color, linewidth=2)
+        if series:
+            ax.legend(title='Модели', bbox_to_anchor=(1.05, 1), loc='upper left')
+
+    ax.set_title(spec['title'], fontsize=14, pad=10)
+    ax.set_xlabel('Дата', fontsize=12)
+    ax.set_ylabel(spec['ylabel'], fontsize=12)
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
+    ax.xaxis.set_major_locator(mdates.DayLocator(interval=spec.get('tick_interval', 1)))
+    for label in ax.get_xticklabels():
+        label.set_rotation(45)
+        label.set_horizontalalignment('right')
+    fig.tight_layout()
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', dpi=100)
+    return buffer.getvalue()
+
+
+def _model_name(model_id: str) -> str:
+    return next(
+        (m_data.get('name', model_id) for m_data in IMAGE_GENERATION_MODELS.values() if m_data.get('id') == model_id),
+        model_id
+    )
+
+
+class ChartService:
+    """Графики админ-панели.
+
+    Данные агрегируются по дням в SQL (GROUP BY DATE(created_at)), график
+    рисуется в пуле процессов, поэтому event loop не блокируется. Готовые PNG
+    кэшируются по (график, дата): повторный просмотр в тот же день отдаётся
+    из памяти, пока не истечёт ttl.
+    """
+
+    def __init__(self, workers: int, cache_ttl: float):
+        self.workers = workers
+        self.cache_ttl = cache_ttl
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._cache: Dict[Tuple[str, str, int], Tuple[float, Optional[bytes]]] = {}
+        self._in_flight: Dict[Tuple[str, str, int], asyncio.Task] = {}
+        self._stats = {'rendered': 0, 'cache_hits': 0, 'errors': 0}
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    async def render(self, chart: str, days: int = 30) -> Optional[bytes]:
+        """PNG графика за последние days дней или None, если данных нет."""
+        if chart not in CHARTS:
+            raise ValueError(f"Неизвестный график: {chart}")
+        today = date.today().isoformat()
+        key = (chart, today, days)
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            self._stats['cache_hits'] += 1
+            return cached[1]
+
+        # Одновременные запросы одного графика ждут одну отрисовку
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._build(chart, days))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        png = await asyncio.shield(task)
+
+        # Кэш прошлых дней больше не понадобится
+        for stale in [k for k in self._cache if k[1] != today]:
+            del self._cache[stale]
+        self._cache[key] = (time.monotonic() + self.cache_ttl, png)
+        return png
+
+    async def _build(self, chart: str, days: int) -> Optional[bytes]:
+        end = date.today()
+        start = end - timedelta(days=days)
+        spec = await self._load(chart, start, end)
+        if spec is None:
+            return None
+        loop = asyncio.get_running_loop()
+        try:
+            try:
+                png = await loop.run_in_executor(self._get_executor(), _render_chart, spec)
+            except BrokenProcessPool:
+                logger.warning("Пул отрисовки графиков сломан, пересоздаю")
+                self._executor = None
+                png = await loop.run_in_executor(self._get_executor(), _render_chart, spec)
+        except Exception:
+            self._stats['errors'] += 1
+            raise
+        self._stats['rendered'] += 1
+        logger.info(f"График {chart} за {start} - {end} отрисован: {len(png)} байт")
+        return png
+
+    async def _load(self, chart: str, start: date, end: date) -> Optional[Dict[str, Any]]:
+        """Дневные ряды для графика; None, если рисовать нечего."""
+        day_list = [(start + timedelta(days=i)).isoformat() for i in range((end - start).days + 1)]
+        index = {day: i for i, day in enumerate(day_list)}
+        start_str, end_str = start.isoformat(), end.isoformat()
+        period = f"за последние {len(day_list) - 1} дней"
+
+        if chart == 'payments':
+            amounts = [0.0] * len(day_list)
+            for day, total in await get_daily_payment_totals(start_str, end_str):
+                if day in index:
+                    amounts[index[day]] = float(total or 0)
+            if not any(amounts):
+                return None
+            return {'kind': 'area', 'days': day_list, 'series': {'Платежи': amounts}, 'tick_interval': 5,
+                    'title': f"Динамика платежей {period}", 'ylabel': "Сумма (RUB)"}
+
+        if chart == 'registrations':
+            counts = [0] * len(day_list)
+            for day, count in await get_daily_registration_counts(start_str, end_str):
+                if day in index:
+                    counts[index[day]] = count
+            return {'kind': 'bar', 'days': day_list, 'series': {'Регистрации': counts},
+                    'title': f"Динамика регистраций {period}", 'ylabel': "Количество регистраций"}
+
+        series: Dict[str, List[int]] = {}
+        for day, model_id, units in await get_daily_generation_units(start_str, end_str):
+            if day in index:
+                series.setdefault(_model_name(model_id), [0] * len(day_list))[index[day]] += units or 0
+        return {'kind': 'lines', 'days': day_list, 'series': series,
+                'title': f"Динамика генераций {period}", 'ylabel': "Количество генераций"}
+
+    def shutdown(self) -> None:
+        self._cache.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self._stats)
+        stats['cached'] = len(self._cache)
+        return stats
+
+
+chart_service = ChartService(workers=CHART_WORKERS, cache_ttl=CHART_CACHE_TTL_SECONDS)
+
+
+def get_chart_stats() -> Dict[str, Any]:
+    """Метрики сервиса графиков."""
+    return chart_service.get_stats()
@@ -16,6 +16,12 @@ SECRET_KEY = os.getenv('SECRET_KEY')
 YOOKASSA_SECRET_KEY = SECRET_KEY  # Алиас для совместимости
 YOOKASSA_TEST_TOKEN = os.getenv('YOOKASSA_TEST_TOKEN')
 REPLICATE_USERNAME_OR_ORG_NAME = os.getenv('REPLICATE_USERNAME_OR_ORG_NAME', 'axidiagensy')
+REPLICATE_HTTP_CONNECTIONS = int(os.getenv('REPLICATE_HTTP_CONNECTIONS', '100'))
+REPLICATE_POLL_MIN_INTERVAL = float(os.getenv('REPLICATE_POLL_MIN_INTERVAL', '0.5'))
+REPLICATE_POLL_MAX_INTERVAL = float(os.getenv('REPLICATE_POLL_MAX_INTERVAL', '5'))
+# Webhook завершения предсказаний (необязательно), например https://pixelpieai.ru/replicate/webhook
+REPLICATE_WEBHOOK_URL = os.getenv('REPLICATE_WEBHOOK_URL', '')
+REPLICATE_WEBHOOK_SECRET = os.getenv('REPLICATE_WEBHOOK_SECRET', '')
 REDIS = os.getenv('REDIS_URL')
 
 # Алиасы для совместимости
@@ -35,7 +41,47 @@ MAX_FILE_SIZE_BYTES = MAX_FILE_SIZE_MB * 1024 * 1024
 
 # === НАСТРОЙКИ ПРОИЗВОДИТЕЛЬНОСТИ ===
 CACHE_TTL_SECONDS = int(os.getenv('CACHE_TTL_SECONDS', '300'))
+CACHE_LOCAL_MAX_ITEMS = int(os.getenv('CACHE_LOCAL_MAX_ITEMS', '5000'))
+RESULT_CACHE_TTL_SECONDS = int(os.getenv('RESULT_CACHE_TTL_SECONDS', str(7 * 24 * 3600)))  # file_id результатов генераций
+PROMPT_ASSIST_CACHE_TTL_SECONDS = int(os.getenv('PROMPT_ASSIST_CACHE_TTL_SECONDS', str(3 * 24 * 3600)))  # промпты Llama
+PAYMENT_LINK_TTL_SECONDS = int(os.getenv('PAYMENT_LINK_TTL_SECONDS', '600'))  # Ссылка на оплату переиспользуется до проверки платежа
 DATABASE_PATH = os.getenv('DATABASE_PATH', 'users.db')
+DB_POOL_READERS = int(os.getenv('DB_POOL_READERS', '4'))
+DB_POOL_ACQUIRE_TIMEOUT = float(os.getenv('DB_POOL_ACQUIRE_TIMEOUT', '30'))
+DB_WRITE_BATCH_SIZE = int(os.getenv('DB_WRITE_BATCH_SIZE', '100'))
+ANALYTICS_FLUSH_INTERVAL_MS = int(os.getenv('ANALYTICS_FLUSH_INTERVAL_MS', '500'))
+ANALYTICS_FLUSH_ROWS = int(os.getenv('ANALYTICS_FLUSH_ROWS', '200'))
+ANALYTICS_BUFFER_MAX = int(os.getenv('ANALYTICS_BUFFER_MAX', '10000'))
+ONBOARDING_SEND_RATE = float(os.getenv('ONBOARDING_SEND_RATE', '25'))
+ONBOARDING_SEND_CONCURRENCY = int(os.getenv('ONBOARDING_SEND_CONCURRENCY', '10'))
+ONBOARDING_JOB_MAX_ATTEMPTS = int(os.getenv('ONBOARDING_JOB_MAX_ATTEMPTS', '4'))
+ONBOARDING_RETRY_DELAY_SECONDS = int(os.getenv('ONBOARDING_RETRY_DELAY_SECONDS', '600'))  # Удваивается с каждой попыткой
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '28'))  # Глобальный лимит Telegram ~30 сообщений/сек
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '20'))
+BROADCAST_PAGE_SIZE = int(os.getenv('BROADCAST_PAGE_SIZE', '500'))
+GENERATION_MIN_WORKERS = int(os.getenv('GENERATION_MIN_WORKERS', '4'))
+GENERATION_MAX_WORKERS = int(os.getenv('GENERATION_MAX_WORKERS', '40'))
+GENERATION_QUEUE_MAX_DEPTH = int(os.getenv('GENERATION_QUEUE_MAX_DEPTH', '800'))
+GENERATION_QUEUE_DRAIN_SECONDS = float(os.getenv('GENERATION_QUEUE_DRAIN_SECONDS', '60'))  # За сколько секунд разбирать очередь
+GENERATION_JOB_MAX_ATTEMPTS = int(os.getenv('GENERATION_JOB_MAX_ATTEMPTS', '2'))
+GENERATION_BUFFER_MAX_MB = int(os.getenv('GENERATION_BUFFER_MAX_MB', '256'))  # Сверх этого результаты пишутся на диск
+GENERATION_SEND_BY_URL = os.getenv('GENERATION_SEND_BY_URL', 'False').lower() == 'true'  # Telegram сам скачивает результат с Replicate
+TRACKER_MAX_ACTIVE = int(os.getenv('TRACKER_MAX_ACTIVE', '500'))  # Сколько видео/обучений отслеживать одновременно
+TRACKER_MAX_CALLBACKS = int(os.getenv('TRACKER_MAX_CALLBACKS', '10'))  # Одновременные скачивания/уведомления по завершении
+YOOKASSA_HTTP_CONNECTIONS = int(os.getenv('YOOKASSA_HTTP_CONNECTIONS', '20'))
+YOOKASSA_MAX_CONCURRENCY = int(os.getenv('YOOKASSA_MAX_CONCURRENCY', '10'))  # Одновременные запросы к API YooKassa
+YOOKASSA_TIMEOUT_SECONDS = float(os.getenv('YOOKASSA_TIMEOUT_SECONDS', '30'))
+PAYMENT_EVENT_BATCH_SIZE = int(os.getenv('PAYMENT_EVENT_BATCH_SIZE', '10'))  # Сколько событий оплаты обрабатывать за раз
+PAYMENT_EVENT_MAX_ATTEMPTS = int(os.getenv('PAYMENT_EVENT_MAX_ATTEMPTS', '5'))
+TRAINING_PHOTO_WORKERS = int(os.getenv('TRAINING_PHOTO_WORKERS', '2'))  # Процессы для проверки и сжатия фото обучения
+TRAINING_PHOTO_MAX_SIDE = int(os.getenv('TRAINING_PHOTO_MAX_SIDE', '1536'))
+TRAINING_PHOTO_MIN_SIDE = int(os.getenv('TRAINING_PHOTO_MIN_SIDE', '256'))
+CHART_WORKERS = int(os.getenv('CHART_WORKERS', '1'))  # Процессы для отрисовки графиков админки
+CHART_CACHE_TTL_SECONDS = int(os.getenv('CHART_CACHE_TTL_SECONDS', '600'))
+REPORT_WORKERS = int(os.getenv('REPORT_WORKERS', '1'))  # Процессы для выгрузки XLSX-отчётов
+REPORT_PAGE_SIZE = int(os.getenv('REPORT_PAGE_SIZE', '2000'))  # Строк за одно чтение из SQLite
+REPORT_WIDTH_SAMPLE_ROWS = int(os.getenv('REPORT_WIDTH_SAMPLE_ROWS', '500'))  # По скольким строкам считать ширину колонок
+REPORT_PROGRESS_INTERVAL = float(os.getenv('REPORT_PROGRESS_INTERVAL', '3'))
 BACKUP_ENABLED = os.getenv('BACKUP_ENABLED', 'True').lower() == 'true'
 BACKUP_INTERVAL_HOURS = int(os.getenv('BACKUP_INTERVAL_HOURS', '24'))
 
@@ -336,7 +382,21 @@ __all__ = [
     'TOKEN', 'ADMIN_IDS', 'DATABASE_PATH', 'BOT_URL', 'WEBHOOK_URL',
     'YOOKASSA_SHOP_ID', 'SECRET_KEY', 'YOOKASSA_RETURN_URL', 'YOOKASSA_ENABLED',
     'REPLICATE_API_TOKEN', 'REPLICATE_USERNAME_OR_ORG_NAME',
-    'TARIFFS', 'MAX_FILE_SIZE_BYTES', 'CACHE_TTL_SECONDS', 'BACKUP_ENABLED',
+    'REPLICATE_HTTP_CONNECTIONS', 'REPLICATE_POLL_MIN_INTERVAL', 'REPLICATE_POLL_MAX_INTERVAL',
+    'REPLICATE_WEBHOOK_URL', 'REPLICATE_WEBHOOK_SECRET',
+    'TARIFFS', 'MAX_FILE_SIZE_BYTES', 'CACHE_TTL_SECONDS', 'CACHE_LOCAL_MAX_ITEMS', 'RESULT_CACHE_TTL_SECONDS', 'PROMPT_ASSIST_CACHE_TTL_SECONDS', 'PAYMENT_LINK_TTL_SECONDS', 'BACKUP_ENABLED',
+    'DB_POOL_READERS', 'DB_POOL_ACQUIRE_TIMEOUT', 'DB_WRITE_BATCH_SIZE',
+    'ANALYTICS_FLUSH_INTERVAL_MS', 'ANALYTICS_FLUSH_ROWS', 'ANALYTICS_BUFFER_MAX',
+    'ONBOARDING_SEND_RATE', 'ONBOARDING_SEND_CONCURRENCY', 'ONBOARDING_JOB_MAX_ATTEMPTS', 'ONBOARDING_RETRY_DELAY_SECONDS',
+    'BROADCAST_RATE', 'BROADCAST_CONCURRENCY', 'BROADCAST_PAGE_SIZE',
+    'GENERATION_MIN_WORKERS', 'GENERATION_MAX_WORKERS', 'GENERATION_QUEUE_MAX_DEPTH',
+    'GENERATION_QUEUE_DRAIN_SECONDS', 'GENERATION_JOB_MAX_ATTEMPTS', 'GENERATION_BUFFER_MAX_MB',
+    'GENERATION_SEND_BY_URL', 'TRACKER_MAX_ACTIVE', 'TRACKER_MAX_CALLBACKS',
+    'YOOKASSA_HTTP_CONNECTIONS', 'YOOKASSA_MAX_CONCURRENCY', 'YOOKASSA_TIMEOUT_SECONDS',
+    'PAYMENT_EVENT_BATCH_SIZE', 'PAYMENT_EVENT_MAX_ATTEMPTS',
+    'TRAINING_PHOTO_WORKERS', 'TRAINING_PHOTO_MAX_SIDE', 'TRAINING_PHOTO_MIN_SIDE',
+    'CHART_WORKERS', 'CHART_CACHE_TTL_SECONDS',
+    'REPORT_WORKERS', 'REPORT_PAGE_SIZE', 'REPORT_WIDTH_SAMPLE_ROWS', 'REPORT_PROGRESS_INTERVAL',
     'BACKUP_INTERVAL_HOURS', 'ADMIN_PANEL_BUTTON_NAMES', 'WELCOME_MESSAGE',
     'HELP_TEXT', 'MAX_CONCURRENT_GENERATIONS', 'validate_config',
     'REFERRAL_BONUS_PHOTOS', 'REFERRAL_BONUS_FOR_REFERRER', 'NOTIFICATION_HOUR',
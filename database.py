@@ -6,17 +6,21 @@ import time
 import os
 import pytz
 import shutil
+import struct
 from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
 from datetime import datetime, timedelta, timezone
 from decimal import Decimal
-from typing import List, Tuple, Optional, Dict, Any
+from typing import List, Tuple, Optional, Dict, Any, NamedTuple
 from functools import wraps
 import asyncio
-from config import REDIS, ADMIN_IDS, TARIFFS, CACHE_TTL_SECONDS, DATABASE_PATH, BACKUP_ENABLED, BACKUP_INTERVAL_HOURS
+from config import REDIS, ADMIN_IDS, TARIFFS, CACHE_TTL_SECONDS, CACHE_LOCAL_MAX_ITEMS, RESULT_CACHE_TTL_SECONDS, PROMPT_ASSIST_CACHE_TTL_SECONDS, PAYMENT_LINK_TTL_SECONDS, BACKUP_ENABLED, BACKUP_INTERVAL_HOURS
+from tariffs import tariff_registry
 from generation_config import REPLICATE_COSTS
 # Импорт будет сделан внутри функций для избежания циклического импорта
-from redis_caсhe import RedisUserCache, RedisActiveModelCache, RedisGenParamsCache
+from redis_caсhe import RedisUserCache, RedisActiveModelCache, RedisGenParamsCache, RedisResultCache, RedisPromptAssistCache, RedisPaymentLinkCache
+from db_pool import db_pool
+from analytics_buffer import analytics_buffer
 import redis.asyncio as redis
 
 
@@ -33,18 +37,140 @@ if REDIS is not None:
         logger.warning(f"Ошибка инициализации Redis клиента: {e}")
         redis_client = None
 
-# Создаем кеши только если Redis доступен
-if redis_client is not None:
-    user_cache = RedisUserCache(redis_client)
-    active_model_cache = RedisActiveModelCache(redis_client)
-    gen_params_cache = RedisGenParamsCache(redis_client)
-else:
-    user_cache = None
-    active_model_cache = None
-    gen_params_cache = None
-
-def invalidate_cache(user_id_param: str = 'user_id'):
-    """Декоратор для автоматической инвалидации кэша после изменения данных"""
+class UserSnapshot(NamedTuple):
+    """Снимок профиля пользователя, возвращаемый check_database_user."""
+    generations_left: int = 0
+    avatar_left: int = 0
+    has_trained_model: int = 0
+    username: Optional[str] = None
+    is_notified: int = 0
+    first_purchase: int = 1
+    email: Optional[str] = None
+    active_avatar_id: Optional[int] = None
+    first_name: Optional[str] = None
+    is_blocked: int = 0
+    created_at: Optional[str] = None
+    welcome_message_sent: int = 0
+    last_reminder_type: Optional[str] = None
+    last_reminder_sent: Optional[str] = None
+
+    # Версия формата, числовые поля, признак и значение active_avatar_id
+    _HEAD = struct.Struct('<B7iBq')
+    _STR_LEN = struct.Struct('<H')
+    _NONE_LEN = 0xFFFF
+    _FORMAT_VERSION = 1
+
+    @classmethod
+    def dumps(cls, snapshot: 'UserSnapshot') -> bytes:
+        """Компактная бинарная сериализация для кэша."""
+        parts = [cls._HEAD.pack(
+            cls._FORMAT_VERSION,
+            snapshot.generations_left, snapshot.avatar_left, snapshot.has_trained_model,
+            snapshot.is_notified, snapshot.first_purchase, snapshot.is_blocked, snapshot.welcome_message_sent,
+            snapshot.active_avatar_id is not None, snapshot.active_avatar_id or 0
+        )]
+        for value in (snapshot.username, snapshot.email, snapshot.first_name,
+                      snapshot.created_at, snapshot.last_reminder_type, snapshot.last_reminder_sent):
+            if value is None:
+                parts.append(cls._STR_LEN.pack(cls._NONE_LEN))
+            else:
+                raw = str(value).encode('utf-8')[:cls._NONE_LEN - 1]
+                parts.append(cls._STR_LEN.pack(len(raw)))
+                parts.append(raw)
+        return b''.join(parts)
+
+    @classmethod
+    def loads(cls, raw: bytes) -> 'UserSnapshot':
+        """Восстанавливает снимок из бинарного представления."""
+        (version, generations_left, avatar_left, has_trained_model, is_notified, first_purchase,
+         is_blocked, welcome_message_sent, has_avatar, active_avatar_id) = cls._HEAD.unpack_from(raw, 0)
+        if version != cls._FORMAT_VERSION:
+            raise ValueError(f"Неизвестная версия формата UserSnapshot: {version}")
+        offset = cls._HEAD.size
+        strings = []
+        for _ in range(6):
+            (length,) = cls._STR_LEN.unpack_from(raw, offset)
+            offset += cls._STR_LEN.size
+            if length == cls._NONE_LEN:
+                strings.append(None)
+            else:
+                strings.append(raw[offset:offset + length].decode('utf-8'))
+                offset += length
+        username, email, first_name, created_at, last_reminder_type, last_reminder_sent = strings
+        return cls(
+            generations_left, avatar_left, has_trained_model, username, is_notified, first_purchase,
+            email, active_avatar_id if has_avatar else None, first_name, is_blocked, created_at,
+            welcome_message_sent, last_reminder_type, last_reminder_sent
+        )
+
+
+# Без Redis кеши работают как локальные (только L1 в памяти процесса)
+user_cache = RedisUserCache(redis_client, ttl=CACHE_TTL_SECONDS, local_size=CACHE_LOCAL_MAX_ITEMS, codec=UserSnapshot)
+active_model_cache = RedisActiveModelCache(redis_client, ttl=CACHE_TTL_SECONDS, local_size=CACHE_LOCAL_MAX_ITEMS)
+gen_params_cache = RedisGenParamsCache(redis_client, ttl=CACHE_TTL_SECONDS, local_size=CACHE_LOCAL_MAX_ITEMS)
+result_cache = RedisResultCache(redis_client, ttl=RESULT_CACHE_TTL_SECONDS, local_size=CACHE_LOCAL_MAX_ITEMS)
+prompt_assist_cache = RedisPromptAssistCache(redis_client, ttl=PROMPT_ASSIST_CACHE_TTL_SECONDS, local_size=CACHE_LOCAL_MAX_ITEMS)
+payment_link_cache = RedisPaymentLinkCache(redis_client, ttl=PAYMENT_LINK_TTL_SECONDS, local_size=CACHE_LOCAL_MAX_ITEMS)
+
+_USER_COLUMNS = '''generations_left, avatar_left, has_trained_model, username, is_notified,
+                   first_purchase, email, active_avatar_id, first_name, is_blocked, created_at,
+                   welcome_message_sent, last_reminder_type, last_reminder_sent'''
+_USER_ROW_SQL = f'''SELECT {_USER_COLUMNS} FROM users WHERE user_id = ?'''
+
+
+async def _load_user_row(conn, user_id: int) -> Optional[UserSnapshot]:
+    """Читает строку пользователя в формате кэша check_database_user."""
+    cursor = await conn.execute(_USER_ROW_SQL, (user_id,))
+    result = await cursor.fetchone()
+    await cursor.close()
+    return _user_snapshot(result) if result else None
+
+
+def _user_snapshot(result) -> UserSnapshot:
+    """Строка из _USER_COLUMNS (SELECT или RETURNING) в снимок кэша."""
+    return UserSnapshot(
+        result[0] or 0,
+        result[1] or 0,
+        int(result[2] or 0),
+        result[3],
+        int(result[4] or 0),
+        1 if result[5] is None else int(result[5]),
+        result[6],
+        result[7],
+        result[8],
+        int(result[9] or 0),
+        result[10],
+        int(result[11] or 0),
+        result[12],
+        result[13]
+    )
+
+
+async def refresh_user_cache(user_id: int) -> None:
+    """Записывает актуальную строку пользователя в кэш после изменения (write-through)."""
+    if user_cache is None:
+        return
+    try:
+        # Новая версия отсекает чтения, начатые до изменения
+        version = await user_cache.bump_version(user_id)
+        connection = db_pool.writer() if db_pool.holds_writer() else db_pool.reader()
+        async with connection as conn:
+            data = await _load_user_row(conn, user_id)
+        if data is not None:
+            await user_cache.set(user_id, data, version=version)
+        else:
+            await user_cache.delete(user_id)
+    except Exception as e:
+        logger.warning(f"Ошибка обновления кеша для user_id={user_id}: {e}")
+
+
+def get_user_cache_stats() -> Dict[str, Any]:
+    """Метрики кэша пользователей: попадания, промахи, устаревшие записи."""
+    return user_cache.get_stats() if user_cache is not None else {}
+
+
+def write_through_cache(user_id_param: str = 'user_id'):
+    """Декоратор: после изменения данных записывает свежую строку пользователя в кэш"""
     def decorator(func):
         @wraps(func)
         async def wrapper(*args, **kwargs):
@@ -57,52 +183,17 @@ def invalidate_cache(user_id_param: str = 'user_id'):
                     if idx < len(args):
                         user_id = args[idx]
 
-            if user_id and user_cache is not None:
-                try:
-                    await user_cache.delete(user_id)
-                except Exception as e:
-                    logger.warning(f"Ошибка при удалении кеша для user_id={user_id}: {e}")
+            if user_id:
+                await refresh_user_cache(user_id)
 
             return result
         return wrapper
     return decorator
 
-def retry_on_locked(max_attempts: int = 10, initial_delay: float = 0.5):
-    """Декоратор для повторных попыток при ошибке блокировки базы данных"""
-    def decorator(func):
-        @wraps(func)
-        async def wrapper(*args, **kwargs):
-            for attempt in range(max_attempts):
-                try:
-                    return await func(*args, **kwargs)
-                except aiosqlite.OperationalError as e:
-                    if "database is locked" in str(e) and attempt < max_attempts - 1:
-                        delay = initial_delay * (2 ** attempt)
-                        logger.warning(
-                            f"База данных заблокирована в {func.__name__}, попытка {attempt + 1}/{max_attempts}. "
-                            f"Повтор через {delay:.2f}с... ⏳"
-                        )
-                        try:
-                            async with aiosqlite.connect(DATABASE_PATH, timeout=5) as conn:
-                                c = await conn.cursor()
-                                await c.execute("PRAGMA busy_timeout = 30000")  # Увеличен таймаут
-                                await c.execute("SELECT COUNT(*) FROM sqlite_master")
-                                logger.debug(f"Диагностика: база доступна, попытка {attempt + 1}")
-                        except Exception as diag_e:
-                            logger.error(f"Диагностика не удалась: {diag_e}")
-                        await asyncio.sleep(delay)
-                    else:
-                        logger.error(f"Исчерпаны попытки в {func.__name__}: {e} 🚫")
-                        raise
-            raise aiosqlite.OperationalError("Достигнуто максимальное количество попыток при ошибке блокировки 🚫")
-        return wrapper
-    return decorator
-
 async def migrate_referral_stats_table(bot: Bot = None):
     """Миграция таблицы referral_stats для добавления столбца total_reward_photos."""
     try:
-        async with aiosqlite.connect(DATABASE_PATH, timeout=15) as conn:
-            await conn.execute("PRAGMA busy_timeout = 30000")
+        async with db_pool.writer() as conn:
             c = await conn.cursor()
 
             # Сначала создаем таблицу referral_stats, если она не существует
@@ -158,8 +249,7 @@ async def migrate_referral_stats_table(bot: Bot = None):
 async def init_db(bot: Bot = None) -> None:
     """Инициализирует базу данных, создавая все необходимые таблицы с индексами и выполняя миграции."""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
-            await conn.execute('PRAGMA foreign_keys = ON')
+        async with db_pool.writer() as conn:
             c = await conn.cursor()
 
             # Выполняем миграции таблиц
@@ -351,6 +441,16 @@ async def init_db(bot: Bot = None) -> None:
                                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                              )''')
 
+            # Контрольные точки рассылки: позволяют продолжить её после перезапуска
+            await c.execute("PRAGMA table_info(scheduled_broadcasts)")
+            broadcast_columns = [col[1] for col in await c.fetchall()]
+            for column, definition in (('last_user_id', 'INTEGER DEFAULT 0'),
+                                       ('sent_count', 'INTEGER DEFAULT 0'),
+                                       ('failed_count', 'INTEGER DEFAULT 0')):
+                if column not in broadcast_columns:
+                    await c.execute(f"ALTER TABLE scheduled_broadcasts ADD COLUMN {column} {definition}")
+                    logger.info(f"Добавлен столбец {column} в таблицу scheduled_broadcasts")
+
             await c.execute('''CREATE TABLE IF NOT EXISTS broadcast_buttons (
                                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                                 broadcast_id INTEGER NOT NULL,
@@ -360,6 +460,71 @@ async def init_db(bot: Bot = None) -> None:
                                 FOREIGN KEY (broadcast_id) REFERENCES scheduled_broadcasts(id) ON DELETE CASCADE
                              )''')
 
+            await c.execute('''CREATE TABLE IF NOT EXISTS onboarding_jobs (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                user_id INTEGER NOT NULL,
+                                message_type TEXT NOT NULL,
+                                run_at TEXT NOT NULL,
+                                status TEXT DEFAULT 'pending',
+                                attempts INTEGER DEFAULT 0,
+                                last_error TEXT,
+                                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                                UNIQUE (user_id, message_type),
+                                FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+                             )''')
+
+            await c.execute('''CREATE TABLE IF NOT EXISTS generation_jobs (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                user_id INTEGER NOT NULL,
+                                recipient_id INTEGER NOT NULL,
+                                bot_id INTEGER NOT NULL,
+                                chat_id INTEGER NOT NULL,
+                                state_user_id INTEGER NOT NULL,
+                                payload TEXT NOT NULL,
+                                num_outputs INTEGER NOT NULL,
+                                photos INTEGER DEFAULT 0,
+                                status TEXT DEFAULT 'queued',
+                                attempts INTEGER DEFAULT 0,
+                                debited INTEGER DEFAULT 0,
+                                refunded INTEGER DEFAULT 0,
+                                last_error TEXT,
+                                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                                started_at TIMESTAMP,
+                                finished_at TIMESTAMP
+                             )''')
+
+            # Сырые события webhook YooKassa: уникальность payment_id отсекает повторные доставки
+            await c.execute('''CREATE TABLE IF NOT EXISTS payment_events (
+                                payment_id TEXT PRIMARY KEY,
+                                event TEXT NOT NULL,
+                                payload TEXT NOT NULL,
+                                status TEXT DEFAULT 'queued',
+                                attempts INTEGER DEFAULT 0,
+                                last_error TEXT,
+                                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                                started_at TIMESTAMP,
+                                finished_at TIMESTAMP
+                             )''')
+
+            await c.execute('''CREATE TABLE IF NOT EXISTS payment_logs (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                user_id INTEGER NOT NULL,
+                                payment_id TEXT NOT NULL UNIQUE,
+                                amount REAL NOT NULL,
+                                payment_info TEXT,
+                                created_at TEXT NOT NULL,
+                                FOREIGN KEY (user_id) REFERENCES users (user_id)
+                             )''')
+
+            await c.execute('''CREATE TABLE IF NOT EXISTS user_payment_stats (
+                                user_id INTEGER PRIMARY KEY,
+                                total_payments INTEGER DEFAULT 0,
+                                total_amount REAL DEFAULT 0.0,
+                                first_payment_date TEXT,
+                                last_payment_date TEXT,
+                                FOREIGN KEY (user_id) REFERENCES users (user_id)
+                             )''')
+
             await c.execute('''CREATE TABLE IF NOT EXISTS fixes (
                                 fix_name TEXT PRIMARY KEY,
                                 applied INTEGER DEFAULT 0,
@@ -376,6 +541,8 @@ async def init_db(bot: Bot = None) -> None:
                 ('idx_trainedmodels_prediction', 'user_trainedmodels(prediction_id)'),
                 ('idx_payments_user', 'payments(user_id)'),
                 ('idx_payments_created', 'payments(created_at)'),
+                ('idx_payments_user_status', 'payments(user_id, status)'),
+                ('idx_users_created', 'users(created_at)'),
                 ('idx_generation_log_user', 'generation_log(user_id)'),
                 ('idx_generation_log_created', 'generation_log(created_at)'),
                 ('idx_generation_log_type', 'generation_log(generation_type)'),
@@ -391,7 +558,10 @@ async def init_db(bot: Bot = None) -> None:
                 ('idx_referral_rewards_referrer', 'referral_rewards(referrer_id)'),
                 ('idx_referral_rewards_referred', 'referral_rewards(referred_user_id)'),
                 ('idx_referral_stats_user', 'referral_stats(user_id)'),
-                ('idx_broadcast_buttons_broadcast', 'broadcast_buttons(broadcast_id)')
+                ('idx_broadcast_buttons_broadcast', 'broadcast_buttons(broadcast_id)'),
+                ('idx_onboarding_jobs_due', 'onboarding_jobs(status, run_at)'),
+                ('idx_generation_jobs_status', 'generation_jobs(status, user_id)'),
+                ('idx_payment_events_status', 'payment_events(status, created_at)')
             ]
 
             for index_name, index_def in indices:
@@ -441,13 +611,11 @@ async def init_db(bot: Bot = None) -> None:
                     logger.error(f"Не удалось уведомить админа {admin_id}: {e_notify}")
         raise
 
-@retry_on_locked(max_attempts=15, initial_delay=0.5)
 async def save_broadcast_button(broadcast_id: int, button_text: str, callback_data: str, conn=None) -> bool:
     """Сохраняет кнопку рассылки в базу данных."""
     try:
         if conn is None:
-            async with aiosqlite.connect(DATABASE_PATH, timeout=15) as conn:
-                await conn.execute("PRAGMA busy_timeout = 30000")  # Увеличен таймаут
+            async with db_pool.writer() as conn:
                 c = await conn.cursor()
                 # Проверяем существование таблицы
                 await c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='broadcast_buttons'")
@@ -483,12 +651,10 @@ async def save_broadcast_button(broadcast_id: int, button_text: str, callback_da
         logger.error(f"Неизвестная ошибка сохранения кнопки для broadcast_id={broadcast_id}: {e}", exc_info=True)
         return False
 
-@retry_on_locked(max_attempts=15, initial_delay=0.5)
 async def get_broadcast_buttons(broadcast_id: int) -> List[Dict[str, str]]:
     """Получает список кнопок для указанной рассылки."""
     try:
-        async with aiosqlite.connect(DATABASE_PATH, timeout=15) as conn:
-            await conn.execute("PRAGMA busy_timeout = 30000")  # Увеличен таймаут
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
             # Проверяем существование таблицы
@@ -550,7 +716,7 @@ async def backup_database() -> bool:
         backup_path = os.path.join(backup_dir, f"users_backup_{timestamp}.db")
 
         # Безопасное копирование с использованием SQLite BACKUP API
-        async with aiosqlite.connect(DATABASE_PATH) as source_conn:
+        async with db_pool.reader() as source_conn:
             # Создаем временное соединение для бэкапа
             async with aiosqlite.connect(backup_path) as backup_conn:
                 # Используем SQLite BACKUP API для безопасного копирования
@@ -669,13 +835,11 @@ async def add_user(user_id: int, first_name: str, username: str, email: str = ""
         logger.error(f"Ошибка добавления пользователя {user_id}: {e}", exc_info=True)
         return False
 
-@retry_on_locked(max_attempts=10, initial_delay=0.5)
-@invalidate_cache()
+@write_through_cache()
 async def add_user_without_subscription(user_id: int, username: str, first_name: str, referrer_id: Optional[int] = None, utm_source: Optional[str] = None) -> None:
     """Добавляет нового пользователя или обновляет существующего."""
     try:
-        async with aiosqlite.connect(DATABASE_PATH, timeout=10) as conn:
-            await conn.execute("PRAGMA busy_timeout = 5000")
+        async with db_pool.writer() as conn:
             c = await conn.cursor()
 
             # Проверка существующего пользователя
@@ -779,7 +943,7 @@ async def add_user_without_subscription(user_id: int, username: str, first_name:
 async def get_users_for_welcome_message() -> List[Dict[str, Any]]:
     """Получает пользователей, зарегистрированных более часа назад, без платежей и без отправленного приветственного сообщения."""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
 
@@ -813,7 +977,7 @@ async def get_users_for_welcome_message() -> List[Dict[str, Any]]:
 async def get_users_for_reminders() -> List[Dict[str, Any]]:
     """Получает пользователей для отправки напоминаний по дням."""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
 
@@ -844,11 +1008,174 @@ async def get_users_for_reminders() -> List[Dict[str, Any]]:
         logger.error(f"Ошибка получения пользователей для напоминаний: {e}", exc_info=True)
         return []
 
-@invalidate_cache()
+# Кандидаты воронки: не заблокированы, зарегистрированы после даты отсечения, без успешных оплат
+_ONBOARDING_CANDIDATES_SQL = """
+    FROM users u
+    WHERE u.is_blocked = 0
+    AND u.created_at IS NOT NULL
+    AND u.created_at >= :cutoff
+    AND NOT EXISTS (
+        SELECT 1 FROM payments p WHERE p.user_id = u.user_id AND p.status = 'succeeded'
+    )
+"""
+
+_DUE_WELCOME_SQL = """
+    SELECT u.user_id, u.username, u.first_name, 'welcome' AS message_type
+""" + _ONBOARDING_CANDIDATES_SQL + """
+    AND u.welcome_message_sent = 0
+    AND u.first_purchase = 1
+    AND u.created_at <= :registered_before
+    AND NOT EXISTS (
+        SELECT 1 FROM onboarding_jobs j
+        WHERE j.user_id = u.user_id AND j.message_type = 'welcome' AND j.status IN ('pending', 'running')
+    )
+"""
+
+_DUE_REMINDERS_SQL = """
+    SELECT user_id, username, first_name, message_type FROM (
+        SELECT u.user_id, u.username, u.first_name, u.last_reminder_type,
+            CASE CAST(julianday(:today) - julianday(date(u.created_at)) AS INTEGER)
+                WHEN 1 THEN 'reminder_day2'
+                WHEN 2 THEN 'reminder_day3'
+                WHEN 3 THEN 'reminder_day4'
+                ELSE CASE WHEN julianday(:today) - julianday(date(u.created_at)) >= 4
+                          THEN 'reminder_day5' END
+            END AS message_type
+""" + _ONBOARDING_CANDIDATES_SQL + """
+    )
+    WHERE message_type IS NOT NULL
+    AND IFNULL(last_reminder_type, '') != message_type
+"""
+
+async def get_due_onboarding_messages(kind: str, now: datetime, cutoff_date: str = "2025-07-11") -> List[Dict[str, Any]]:
+    """Одним запросом возвращает пользователей, которым пора отправить приветствие (kind='welcome') или напоминание (kind='reminder').
+
+    now — текущее время по МСК; created_at хранится в том же формате '%Y-%m-%d %H:%M:%S'.
+    """
+    if kind == 'welcome':
+        statement = _DUE_WELCOME_SQL
+        params = {
+            'cutoff': cutoff_date,
+            'registered_before': (now - timedelta(hours=1)).strftime('%Y-%m-%d %H:%M:%S'),
+        }
+    elif kind == 'reminder':
+        statement = _DUE_REMINDERS_SQL
+        params = {'cutoff': cutoff_date, 'today': now.strftime('%Y-%m-%d')}
+    else:
+        raise ValueError(f"Неизвестный тип сообщений онбординга: {kind}")
+
+    try:
+        async with db_pool.reader() as conn:
+            conn.row_factory = aiosqlite.Row
+            c = await conn.cursor()
+            await c.execute(statement, params)
+            return [
+                {
+                    'user_id': row['user_id'],
+                    'username': row['username'],
+                    'first_name': row['first_name'],
+                    'message_type': row['message_type']
+                }
+                for row in await c.fetchall()
+            ]
+    except Exception as e:
+        logger.error(f"Ошибка получения пользователей для сообщений онбординга ({kind}): {e}", exc_info=True)
+        return []
+
+@write_through_cache()
+async def mark_onboarding_message_sent(user_id: int, message_type: str, sent_at: str) -> None:
+    """Отмечает отправку сообщения онбординга (через очередь записи)."""
+    if message_type == "welcome":
+        statement = "UPDATE users SET welcome_message_sent = 1, last_reminder_type = ?, last_reminder_sent = ? WHERE user_id = ?"
+    else:
+        statement = "UPDATE users SET last_reminder_type = ?, last_reminder_sent = ? WHERE user_id = ?"
+
+    async def job(conn):
+        await conn.execute(statement, (message_type, sent_at, user_id))
+
+    await db_pool.submit_write(job)
+
+async def enqueue_onboarding_job(user_id: int, message_type: str, run_at: datetime) -> bool:
+    """Сохраняет отложенное сообщение онбординга; повторная постановка того же типа игнорируется."""
+    run_at_str = run_at.strftime('%Y-%m-%d %H:%M:%S')
+
+    async def job(conn):
+        cursor = await conn.execute(
+            "INSERT OR IGNORE INTO onboarding_jobs (user_id, message_type, run_at) VALUES (?, ?, ?)",
+            (user_id, message_type, run_at_str)
+        )
+        return cursor.rowcount > 0
+
+    try:
+        return await db_pool.submit_write(job)
+    except Exception as e:
+        logger.error(f"Ошибка постановки задания {message_type} для user_id={user_id}: {e}", exc_info=True)
+        return False
+
+async def claim_due_onboarding_jobs(now: datetime, limit: int = 500) -> List[Dict[str, Any]]:
+    """Забирает задания онбординга, срок которых наступил, переводя их в статус running."""
+    params = (now.strftime('%Y-%m-%d %H:%M:%S'), limit)
+
+    async def job(conn):
+        cursor = await conn.execute("""
+            UPDATE onboarding_jobs
+            SET status = 'running', attempts = attempts + 1
+            WHERE id IN (
+                SELECT id FROM onboarding_jobs
+                WHERE status = 'pending' AND run_at <= ?
+                ORDER BY run_at
+                LIMIT ?
+            )
+            RETURNING id, user_id, message_type, attempts
+        """, params)
+        return await cursor.fetchall()
+
+    try:
+        rows = await db_pool.submit_write(job)
+        return [{'id': row[0], 'user_id': row[1], 'message_type': row[2], 'attempts': row[3]} for row in rows]
+    except Exception as e:
+        logger.error(f"Ошибка получения заданий онбординга: {e}", exc_info=True)
+        return []
+
+async def finish_onboarding_job(job_id: int, error: Optional[str] = None, retry_at: Optional[datetime] = None) -> None:
+    """Отмечает задание онбординга выполненным; при ошибке переносит на retry_at или, без него, отмечает failed."""
+    async def job(conn):
+        if error and retry_at is not None:
+            await conn.execute(
+                "UPDATE onboarding_jobs SET status = 'pending', run_at = ?, last_error = ? WHERE id = ?",
+                (retry_at.strftime('%Y-%m-%d %H:%M:%S'), error, job_id)
+            )
+        else:
+            await conn.execute(
+                "UPDATE onboarding_jobs SET status = ?, last_error = ? WHERE id = ?",
+                ('failed' if error else 'done', error, job_id)
+            )
+
+    try:
+        await db_pool.submit_write(job)
+    except Exception as e:
+        logger.error(f"Ошибка обновления задания онбординга id={job_id}: {e}", exc_info=True)
+
+async def requeue_running_onboarding_jobs() -> int:
+    """Возвращает в очередь задания, прерванные перезапуском бота."""
+    async def job(conn):
+        cursor = await conn.execute("UPDATE onboarding_jobs SET status = 'pending' WHERE status = 'running'")
+        return cursor.rowcount
+
+    try:
+        count = await db_pool.submit_write(job)
+        if count:
+            logger.info(f"Возвращено в очередь {count} заданий онбординга")
+        return count
+    except Exception as e:
+        logger.error(f"Ошибка восстановления заданий онбординга: {e}", exc_info=True)
+        return 0
+
+@write_through_cache()
 async def mark_welcome_message_sent(user_id: int) -> bool:
     """Отмечает, что приветственное сообщение было отправлено пользователю."""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.writer() as conn:
             c = await conn.cursor()
 
             await c.execute("""
@@ -870,11 +1197,10 @@ async def mark_welcome_message_sent(user_id: int) -> bool:
         logger.error(f"Ошибка отметки отправки приветственного сообщения для user_id={user_id}: {e}", exc_info=True)
         return False
 
-@retry_on_locked(max_attempts=10, initial_delay=0.5)
 async def add_user_resources(user_id: int, photos: int, avatars: int) -> bool:
     """Добавляет ресурсы пользователю (фото и аватары)"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.writer() as conn:
             c = await conn.cursor()
 
             await c.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,))
@@ -894,11 +1220,7 @@ async def add_user_resources(user_id: int, photos: int, avatars: int) -> bool:
 
             if c.rowcount > 0:
                 logger.info(f"Ресурсы добавлены пользователю {user_id}: +{photos} фото, +{avatars} аватаров")
-                if user_cache is not None:
-                    try:
-                        await user_cache.delete(user_id)
-                    except Exception as e:
-                        logger.warning(f"Ошибка удаления кеша для user_id={user_id}: {e}")
+                await refresh_user_cache(user_id)
                 return True
 
             return False
@@ -910,7 +1232,7 @@ async def add_user_resources(user_id: int, photos: int, avatars: int) -> bool:
 async def get_user_info(user_id: int) -> Optional[Dict[str, Any]]:
     """Получает полную информацию о пользователе"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
 
@@ -934,7 +1256,7 @@ async def get_user_info(user_id: int) -> Optional[Dict[str, Any]]:
 async def get_user_by_username(username: str) -> Optional[Dict[str, Any]]:
     """Получает полную информацию о пользователе по username"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
 
@@ -958,11 +1280,10 @@ async def get_user_by_username(username: str) -> Optional[Dict[str, Any]]:
         logger.error(f"Ошибка получения информации о пользователе по username {username}: {e}", exc_info=True)
         return None
 
-@retry_on_locked(max_attempts=10, initial_delay=0.5)
 async def add_payment_log(user_id: int, payment_id: str, amount: float, payment_info: Dict[str, Any]) -> bool:
     """Добавляет запись о платеже в логи"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.writer() as conn:
             c = await conn.cursor()
 
             await c.execute("""
@@ -998,11 +1319,10 @@ async def add_payment_log(user_id: int, payment_id: str, amount: float, payment_
         logger.error(f"Ошибка записи платежа в логи: {e}", exc_info=True)
         return False
 
-@retry_on_locked(max_attempts=10, initial_delay=0.5)
 async def update_user_payment_stats(user_id: int, payment_amount: float) -> bool:
     """Обновляет статистику платежей пользователя"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.writer() as conn:
             c = await conn.cursor()
 
             await c.execute("""
@@ -1054,7 +1374,7 @@ async def update_user_payment_stats(user_id: int, payment_amount: float) -> bool
 async def get_user_payment_count(user_id: int) -> int:
     """Получает количество платежей пользователя"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             c = await conn.cursor()
 
             await c.execute("""
@@ -1083,7 +1403,7 @@ async def get_user_payment_count(user_id: int) -> int:
 async def get_referrer_info(user_id: int) -> Optional[Dict[str, Any]]:
     """Получает информацию о реферере пользователя"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
 
@@ -1108,13 +1428,11 @@ async def get_referrer_info(user_id: int) -> Optional[Dict[str, Any]]:
         logger.error(f"Ошибка получения информации о реферере для user_id={user_id}: {e}", exc_info=True)
         return None
 
-@retry_on_locked(max_attempts=10, initial_delay=0.5)
-@invalidate_cache()
+@write_through_cache()
 async def add_referral_reward(referrer_id: int, referred_user_id: int, reward_amount: float) -> bool:
     """Добавляет реферальное вознаграждение в виде фото."""
     try:
-        async with aiosqlite.connect(DATABASE_PATH, timeout=15) as conn:
-            await conn.execute("PRAGMA busy_timeout = 30000")
+        async with db_pool.writer() as conn:
             c = await conn.cursor()
 
             await c.execute('''CREATE TABLE IF NOT EXISTS referral_rewards (
@@ -1169,11 +1487,7 @@ async def add_referral_reward(referrer_id: int, referred_user_id: int, reward_am
             logger.info(f"Реферальное вознаграждение добавлено: referrer_id={referrer_id}, "
                        f"referred_user_id={referred_user_id}, photos={reward_amount}")
 
-            if user_cache is not None:
-                try:
-                    await user_cache.delete(referrer_id)
-                except Exception as e:
-                    logger.warning(f"Ошибка удаления кеша для referrer_id={referrer_id}: {e}")
+            await refresh_user_cache(referrer_id)
             return True
 
     except Exception as e:
@@ -1183,7 +1497,7 @@ async def add_referral_reward(referrer_id: int, referred_user_id: int, reward_am
 async def get_user_detailed_stats(user_id: int) -> Dict[str, Any]:
     """Получает детальную статистику пользователя для админки"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
 
@@ -1249,7 +1563,7 @@ async def get_user_detailed_stats(user_id: int) -> Dict[str, Any]:
 
 async def get_paid_users() -> List[int]:
     """Возвращает список ID пользователей, совершивших хотя бы один платёж."""
-    async with aiosqlite.connect(DATABASE_PATH) as conn:
+    async with db_pool.reader() as conn:
         c = await conn.cursor()
         await c.execute("""
             SELECT DISTINCT user_id
@@ -1260,7 +1574,7 @@ async def get_paid_users() -> List[int]:
 
 async def get_non_paid_users() -> List[int]:
     """Возвращает список ID пользователей, не совершивших платежей."""
-    async with aiosqlite.connect(DATABASE_PATH) as conn:
+    async with db_pool.reader() as conn:
         c = await conn.cursor()
         await c.execute("""
             SELECT user_id
@@ -1276,7 +1590,7 @@ async def get_non_paid_users() -> List[int]:
 async def debug_user_payment_state(user_id: int) -> Dict[str, Any]:
     """Отладочная функция для проверки состояния платежей пользователя."""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
 
@@ -1320,7 +1634,7 @@ async def debug_user_payment_state(user_id: int) -> Dict[str, Any]:
 async def get_referrer(referred_id: int) -> Optional[int]:
     """Получает ID реферера для пользователя"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
 
@@ -1337,14 +1651,12 @@ async def get_referrer(referred_id: int) -> Optional[int]:
         logger.error(f"Ошибка получения реферера для referred_id={referred_id}: {e}", exc_info=True)
         return None
 
-@retry_on_locked(max_attempts=10, initial_delay=0.5)
-@invalidate_cache('referrer_id')
-@invalidate_cache('referred_id')
+@write_through_cache('referrer_id')
+@write_through_cache('referred_id')
 async def update_referral_status(referrer_id: int, referred_id: int, status: str) -> bool:
     """Обновляет статус реферальной связи."""
     try:
-        async with aiosqlite.connect(DATABASE_PATH, timeout=15) as conn:
-            await conn.execute("PRAGMA busy_timeout = 30000")  # Увеличен таймаут
+        async with db_pool.writer() as conn:
             c = await conn.cursor()
 
             completed_at = 'CURRENT_TIMESTAMP' if status == 'completed' else 'NULL'
@@ -1368,112 +1680,70 @@ async def update_referral_status(referrer_id: int, referred_id: int, status: str
 async def add_rating(user_id: int, generation_type: str, model_key: str, rating: int) -> None:
     """Добавляет оценку от пользователя"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
-            c = await conn.cursor()
+        details_json = json.dumps({
+            'generation_type': generation_type,
+            'model_key': model_key,
+            'rating': rating
+        }, ensure_ascii=False)
 
-            await c.execute('''INSERT INTO user_ratings (user_id, generation_type, model_key, rating)
+        async def job(conn):
+            await conn.execute('''INSERT INTO user_ratings (user_id, generation_type, model_key, rating)
                               VALUES (?, ?, ?, ?)''',
                             (user_id, generation_type, model_key, rating))
+            await conn.execute(
+                '''INSERT INTO user_actions (user_id, action, details, created_at)
+                   VALUES (?, 'rate_generation', ?, CURRENT_TIMESTAMP)''',
+                (user_id, details_json)
+            )
 
-            await conn.commit()
-            logger.info(f"Оценка {rating} добавлена для user_id={user_id}, type={generation_type}")
-
-            await log_user_action(user_id, 'rate_generation', {
-                'generation_type': generation_type,
-                'model_key': model_key,
-                'rating': rating
-            })
+        await db_pool.submit_write(job)
+        logger.info(f"Оценка {rating} добавлена для user_id={user_id}, type={generation_type}")
 
     except Exception as e:
         logger.error(f"Ошибка добавления оценки для user_id={user_id}: {e}", exc_info=True)
         raise
 
-async def check_database_user(user_id: int) -> Tuple[int, int, int, Optional[str], int, int, Optional[str], Optional[int], Optional[str], int, Optional[str], int, Optional[str], Optional[str]]:
-    """Проверяет подписку пользователя и возвращает данные, включая welcome_message_sent, last_reminder_type и last_reminder_sent."""
-    if user_cache is not None:
-        try:
-            cached_data = await user_cache.get(user_id)
-            if cached_data and len(cached_data) >= 14:  # Обновляем проверку на 14 элементов
-                logger.debug(f"Кэш использован для check_database_user user_id={user_id}: {cached_data}")
-                return cached_data
-        except Exception as e:
-            logger.warning(f"Ошибка получения кеша для user_id={user_id}: {e}")
+async def check_database_user(user_id: int) -> UserSnapshot:
+    """Проверяет подписку пользователя и возвращает снимок профиля, включая welcome_message_sent, last_reminder_type и last_reminder_sent."""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
-            conn.row_factory = aiosqlite.Row
-            c = await conn.cursor()
-            await c.execute('''SELECT generations_left, avatar_left, has_trained_model, username, is_notified,
-                              first_purchase, email, active_avatar_id, first_name, is_blocked, created_at,
-                              welcome_message_sent, last_reminder_type, last_reminder_sent
-                              FROM users WHERE user_id = ?''',
-                            (user_id,))
-            result = await c.fetchone()
-            if result:
-                data = (
-                    result['generations_left'] or 0,
-                    result['avatar_left'] or 0,
-                    int(result['has_trained_model'] or 0),
-                    result['username'],
-                    int(result['is_notified'] or 0),
-                    int(result['first_purchase'] or 1),
-                    result['email'],
-                    result['active_avatar_id'],
-                    result['first_name'],
-                    int(result['is_blocked'] or 0),
-                    result['created_at'],
-                    int(result['welcome_message_sent'] or 0),
-                    result['last_reminder_type'],
-                    result['last_reminder_sent']
-                )
-                if user_cache is not None:
-                    try:
-                        await user_cache.set(user_id, data)
-                    except Exception as e:
-                        logger.warning(f"Ошибка сохранения кеша для user_id={user_id}: {e}")
-                logger.debug(f"Данные подписки для user_id={user_id}: {data}")
-                return data
+        cached_data = await user_cache.get(user_id)
+        if isinstance(cached_data, UserSnapshot):
+            logger.debug(f"Кэш использован для check_database_user user_id={user_id}: {cached_data}")
+            return cached_data
+    except Exception as e:
+        logger.warning(f"Ошибка получения кеша для user_id={user_id}: {e}")
+    try:
+        version = await user_cache.current_version(user_id)
+        async with db_pool.reader() as conn:
+            data = await _load_user_row(conn, user_id)
+        if data is None:
             logger.warning(f"Пользователь user_id={user_id} не найден, возвращаются значения по умолчанию")
-            data = (0, 0, 0, None, 0, 1, None, None, None, 0, None, 0, None, None)
-            if user_cache is not None:
-                try:
-                    await user_cache.set(user_id, data)
-                except Exception as e:
-                    logger.warning(f"Ошибка сохранения кеша для user_id={user_id}: {e}")
-            return data
+            data = UserSnapshot()
+        else:
+            logger.debug(f"Данные подписки для user_id={user_id}: {data}")
+        try:
+            await user_cache.set(user_id, data, version=version)
+        except Exception as e:
+            logger.warning(f"Ошибка сохранения кеша для user_id={user_id}: {e}")
+        return data
     except Exception as e:
         logger.error(f"Ошибка в check_database_user для user_id={user_id}: {str(e)}", exc_info=True)
-        data = (0, 0, 0, None, 0, 1, None, None, None, 0, None, 0, None, None)
-        if user_cache is not None:
-            try:
-                await user_cache.set(user_id, data)
-            except Exception as e:
-                logger.warning(f"Ошибка сохранения кеша для user_id={user_id}: {e}")
-        return data
+        return UserSnapshot()
 
-@invalidate_cache()
+@write_through_cache()
 async def update_user_credits(user_id: int, action: str, amount: int = 1, email: Optional[str] = None) -> bool:
     """Обновляет ресурсы пользователя"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.writer() as conn:
             c = await conn.cursor()
 
-            await c.execute("SELECT generations_left, avatar_left FROM users WHERE user_id = ?", (user_id,))
-            current_resources = await c.fetchone()
-
-            if not current_resources:
-                logger.warning(f"Попытка обновить ресурсы для несуществующего user_id={user_id}")
-                return False
-
-            generations_left, avatar_left = current_resources
-
             if action == "decrement_photo":
-                if generations_left >= amount:
-                    await c.execute('''UPDATE users
-                                      SET generations_left = generations_left - ?, updated_at = CURRENT_TIMESTAMP
-                                      WHERE user_id = ?''',
-                                    (amount, user_id))
-                else:
-                    logger.warning(f"Недостаточно фото для списания у user_id={user_id}: есть {generations_left}, нужно {amount}")
+                await c.execute('''UPDATE users
+                                  SET generations_left = generations_left - ?, updated_at = CURRENT_TIMESTAMP
+                                  WHERE user_id = ? AND generations_left >= ?''',
+                                (amount, user_id, amount))
+                if c.rowcount == 0:
+                    logger.warning(f"Недостаточно фото для списания у user_id={user_id} или пользователь не найден, нужно {amount}")
                     return False
 
             elif action == "increment_photo":
@@ -1483,13 +1753,12 @@ async def update_user_credits(user_id: int, action: str, amount: int = 1, email:
                                 (amount, user_id))
 
             elif action == "decrement_avatar":
-                if avatar_left >= amount:
-                    await c.execute('''UPDATE users
-                                      SET avatar_left = avatar_left - ?, updated_at = CURRENT_TIMESTAMP
-                                      WHERE user_id = ?''',
-                                    (amount, user_id))
-                else:
-                    logger.warning(f"Недостаточно аватаров для списания у user_id={user_id}: есть {avatar_left}, нужно {amount}")
+                await c.execute('''UPDATE users
+                                  SET avatar_left = avatar_left - ?, updated_at = CURRENT_TIMESTAMP
+                                  WHERE user_id = ? AND avatar_left >= ?''',
+                                (amount, user_id, amount))
+                if c.rowcount == 0:
+                    logger.warning(f"Недостаточно аватаров для списания у user_id={user_id} или пользователь не найден, нужно {amount}")
                     return False
 
             elif action == "increment_avatar":
@@ -1550,12 +1819,526 @@ async def update_user_credits(user_id: int, action: str, amount: int = 1, email:
         logger.error(f"Ошибка обновления ресурсов для user_id={user_id}: {e}", exc_info=True)
         return False
 
-@retry_on_locked(max_attempts=10, initial_delay=0.5)
-@invalidate_cache()
+async def _next_cache_version(user_id: int) -> Optional[int]:
+    """Новая версия кэша пользователя; вызывается внутри задания записи.
+
+    Задания выполняются писателем по одному, поэтому версии идут в том же
+    порядке, что и изменения в БД: результат более раннего изменения не
+    перезапишет в кэше более позднее.
+    """
+    if user_cache is None:
+        return None
+    try:
+        return await user_cache.bump_version(user_id)
+    except Exception as e:
+        logger.warning(f"Ошибка получения версии кеша для user_id={user_id}: {e}")
+        return None
+
+
+async def _store_user_snapshot(user_id: int, snapshot: UserSnapshot, version: Optional[int]) -> None:
+    """Записывает строку, возвращённую изменением (RETURNING), в кэш под версией этого изменения."""
+    if user_cache is None or version is None:
+        return
+    try:
+        await user_cache.set(user_id, snapshot, version=version)
+    except Exception as e:
+        logger.warning(f"Ошибка обновления кеша баланса для user_id={user_id}: {e}")
+
+
+async def _update_user_returning(conn, user_id: int, sql: str, params: tuple) -> Optional[Tuple[UserSnapshot, Optional[int]]]:
+    """Выполняет UPDATE users … RETURNING строки и берёт версию кэша в той же транзакции."""
+    cursor = await conn.execute(f"{sql} RETURNING {_USER_COLUMNS}", params)
+    row = await cursor.fetchone()
+    await cursor.close()
+    if row is None:
+        return None
+    return _user_snapshot(row), await _next_cache_version(user_id)
+
+
+async def _debit_job(conn, user_id: int, photos: int, avatars: int) -> Optional[Tuple[UserSnapshot, Optional[int]]]:
+    """Условное списание одним UPDATE … RETURNING; None, если ресурсов не хватает."""
+    return await _update_user_returning(
+        conn, user_id,
+        '''UPDATE users
+           SET generations_left = generations_left - ?, avatar_left = avatar_left - ?, updated_at = CURRENT_TIMESTAMP
+           WHERE user_id = ? AND generations_left >= ? AND avatar_left >= ?''',
+        (photos, avatars, user_id, photos, avatars)
+    )
+
+
+async def debit_user_resources(user_id: int, photos: int = 0, avatars: int = 0) -> Optional[Tuple[int, int]]:
+    """Атомарно списывает фото и аватары; возвращает новый баланс или None при нехватке ресурсов."""
+    if photos < 0 or avatars < 0:
+        raise ValueError("Количество списываемых ресурсов не может быть отрицательным")
+    try:
+        updated = await db_pool.submit_write(lambda conn: _debit_job(conn, user_id, photos, avatars))
+    except Exception as e:
+        logger.error(f"Ошибка списания ресурсов для user_id={user_id}: {e}", exc_info=True)
+        return None
+
+    if updated is None:
+        logger.warning(f"Недостаточно ресурсов для списания у user_id={user_id}: фото {photos}, аватары {avatars}")
+        # Кэш мог показать устаревший баланс — записываем актуальный
+        await refresh_user_cache(user_id)
+        return None
+
+    snapshot, version = updated
+    await _store_user_snapshot(user_id, snapshot, version)
+    balance = (snapshot.generations_left, snapshot.avatar_left)
+    logger.info(f"Списано у user_id={user_id}: фото {photos}, аватары {avatars}; остаток {balance[0]}/{balance[1]}")
+    return balance
+
+
+async def credit_user_resources(user_id: int, photos: int = 0, avatars: int = 0) -> Optional[Tuple[int, int]]:
+    """Атомарно начисляет фото и аватары; возвращает новый баланс или None, если пользователь не найден."""
+    async def job(conn):
+        return await _update_user_returning(
+            conn, user_id,
+            '''UPDATE users
+               SET generations_left = generations_left + ?, avatar_left = avatar_left + ?, updated_at = CURRENT_TIMESTAMP
+               WHERE user_id = ?''',
+            (photos, avatars, user_id)
+        )
+
+    try:
+        updated = await db_pool.submit_write(job)
+    except Exception as e:
+        logger.error(f"Ошибка начисления ресурсов для user_id={user_id}: {e}", exc_info=True)
+        return None
+
+    if updated is None:
+        logger.warning(f"Попытка начислить ресурсы несуществующему user_id={user_id}")
+        return None
+
+    snapshot, version = updated
+    await _store_user_snapshot(user_id, snapshot, version)
+    balance = (snapshot.generations_left, snapshot.avatar_left)
+    logger.info(f"Начислено user_id={user_id}: фото {photos}, аватары {avatars}; баланс {balance[0]}/{balance[1]}")
+    return balance
+
+
+async def enqueue_generation_job(user_id: int, recipient_id: int, state_key: Tuple[int, int, int],
+                                 payload: Dict[str, Any], num_outputs: int, photos: int,
+                                 max_depth: int) -> Optional[Tuple[int, int]]:
+    """Ставит генерацию в очередь; возвращает (id задания, глубина очереди) или None, если очередь заполнена."""
+    bot_id, chat_id, state_user_id = state_key
+    params = (user_id, recipient_id, bot_id, chat_id, state_user_id,
+              json.dumps(payload, ensure_ascii=False), num_outputs, photos, max_depth)
+
+    async def job(conn):
+        cursor = await conn.execute("""
+            INSERT INTO generation_jobs (user_id, recipient_id, bot_id, chat_id, state_user_id, payload, num_outputs, photos)
+            SELECT ?, ?, ?, ?, ?, ?, ?, ?
+            WHERE (SELECT COUNT(*) FROM generation_jobs WHERE status = 'queued') < ?
+            RETURNING id
+        """, params)
+        row = await cursor.fetchone()
+        await cursor.close()
+        if row is None:
+            return None
+        cursor = await conn.execute("SELECT COUNT(*) FROM generation_jobs WHERE status = 'queued'")
+        depth = (await cursor.fetchone())[0]
+        await cursor.close()
+        return row[0], depth
+
+    try:
+        return await db_pool.submit_write(job)
+    except Exception as e:
+        logger.error(f"Ошибка постановки генерации в очередь для user_id={user_id}: {e}", exc_info=True)
+        return None
+
+async def claim_generation_jobs(limit: int) -> List[Dict[str, Any]]:
+    """Забирает до limit заданий: по одному на пользователя и только у тех, у кого ничего не выполняется."""
+    async def job(conn):
+        cursor = await conn.execute("""
+            UPDATE generation_jobs
+            SET status = 'running', attempts = attempts + 1, started_at = CURRENT_TIMESTAMP
+            WHERE id IN (
+                SELECT MIN(id) FROM generation_jobs
+                WHERE status = 'queued'
+                  AND user_id NOT IN (SELECT user_id FROM generation_jobs WHERE status = 'running')
+                GROUP BY user_id
+                ORDER BY MIN(id)
+                LIMIT ?
+            )
+            RETURNING id, user_id, recipient_id, bot_id, chat_id, state_user_id, payload, num_outputs,
+                      (julianday(started_at) - julianday(created_at)) * 86400
+        """, (limit,))
+        return await cursor.fetchall()
+
+    try:
+        rows = await db_pool.submit_write(job)
+    except Exception as e:
+        logger.error(f"Ошибка получения заданий генерации: {e}", exc_info=True)
+        return []
+    return [
+        {
+            'id': row[0], 'user_id': row[1], 'recipient_id': row[2],
+            'state_key': (row[3], row[4], row[5]), 'payload': json.loads(row[6]),
+            'num_outputs': row[7], 'waited': max(0.0, row[8] or 0.0)
+        }
+        for row in sorted(rows, key=lambda r: r[0])
+    ]
+
+async def debit_generation_job(job_id: int, user_id: int, photos: int) -> Optional[Tuple[int, int]]:
+    """Списывает фото за задание один раз: повторный запуск задания не списывает повторно."""
+    async def job(conn):
+        cursor = await conn.execute("SELECT debited FROM generation_jobs WHERE id = ?", (job_id,))
+        row = await cursor.fetchone()
+        await cursor.close()
+        if row and row[0]:
+            # Уже списано: баланс не менялся, версия кэша не нужна
+            snapshot = await _load_user_row(conn, user_id)
+            return (snapshot, None) if snapshot else None
+        updated = await _debit_job(conn, user_id, photos, 0)
+        if updated is not None:
+            await conn.execute("UPDATE generation_jobs SET debited = 1, photos = ? WHERE id = ?", (photos, job_id))
+        return updated
+
+    try:
+        updated = await db_pool.submit_write(job)
+    except Exception as e:
+        logger.error(f"Ошибка списания за задание генерации id={job_id}: {e}", exc_info=True)
+        return None
+
+    if updated is None:
+        logger.warning(f"Недостаточно ресурсов для задания генерации id={job_id}, user_id={user_id}: фото {photos}")
+        await refresh_user_cache(user_id)
+        return None
+    snapshot, version = updated
+    await _store_user_snapshot(user_id, snapshot, version)
+    return snapshot.generations_left, snapshot.avatar_left
+
+async def refund_generation_job(job_id: int) -> bool:
+    """Возвращает списанные за задание фото; повторный вызов ничего не делает."""
+    async def job(conn):
+        cursor = await conn.execute(
+            "UPDATE generation_jobs SET refunded = 1 WHERE id = ? AND debited = 1 AND refunded = 0 RETURNING user_id, photos",
+            (job_id,)
+        )
+        row = await cursor.fetchone()
+        await cursor.close()
+        if row is None:
+            return None
+        updated = await _update_user_returning(
+            conn, row[0],
+            '''UPDATE users
+               SET generations_left = generations_left + ?, updated_at = CURRENT_TIMESTAMP
+               WHERE user_id = ?''',
+            (row[1], row[0])
+        )
+        return row[0], row[1], updated
+
+    try:
+        result = await db_pool.submit_write(job)
+    except Exception as e:
+        logger.error(f"Ошибка возврата за задание генерации id={job_id}: {e}", exc_info=True)
+        return False
+
+    if result is None:
+        return False
+    user_id, photos, updated = result
+    if updated:
+        await _store_user_snapshot(user_id, *updated)
+    logger.info(f"Возвращено {photos} фото user_id={user_id} за задание генерации id={job_id}")
+    return True
+
+async def finish_generation_job(job_id: int, error: Optional[str] = None) -> None:
+    """Отмечает задание генерации выполненным (или упавшим с ошибкой)."""
+    async def job(conn):
+        await conn.execute(
+            "UPDATE generation_jobs SET status = ?, last_error = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+            ('failed' if error else 'done', error, job_id)
+        )
+
+    try:
+        await db_pool.submit_write(job)
+    except Exception as e:
+        logger.error(f"Ошибка обновления задания генерации id={job_id}: {e}", exc_info=True)
+
+async def requeue_running_generation_jobs(max_attempts: int) -> List[int]:
+    """Возвращает в очередь задания, прерванные перезапуском; исчерпавшие попытки помечает failed и возвращает их id."""
+    async def job(conn):
+        cursor = await conn.execute("""
+            UPDATE generation_jobs
+            SET status = 'failed', last_error = 'interrupted', finished_at = CURRENT_TIMESTAMP
+            WHERE status = 'running' AND attempts >= ?
+            RETURNING id
+        """, (max_attempts,))
+        exhausted = [row[0] for row in await cursor.fetchall()]
+        cursor = await conn.execute("UPDATE generation_jobs SET status = 'queued' WHERE status = 'running'")
+        return cursor.rowcount, exhausted
+
+    try:
+        requeued, exhausted = await db_pool.submit_write(job)
+    except Exception as e:
+        logger.error(f"Ошибка восстановления заданий генерации: {e}", exc_info=True)
+        return []
+    if requeued or exhausted:
+        logger.info(f"Задания генерации после перезапуска: в очередь {requeued}, исчерпали попытки {len(exhausted)}")
+    return exhausted
+
+async def get_generation_queue_depth() -> Tuple[int, int, float]:
+    """Число заданий в очереди и в работе, возраст самого старого ожидающего (сек)."""
+    async with db_pool.reader() as conn:
+        cursor = await conn.execute("""
+            SELECT
+                SUM(status = 'queued'),
+                SUM(status = 'running'),
+                MAX(CASE WHEN status = 'queued' THEN (julianday('now') - julianday(created_at)) * 86400 END)
+            FROM generation_jobs
+            WHERE status IN ('queued', 'running')
+        """)
+        row = await cursor.fetchone()
+        await cursor.close()
+    return int(row[0] or 0), int(row[1] or 0), float(row[2] or 0.0)
+
+async def save_payment_event(payment_id: str, event: str, payload: str) -> bool:
+    """Сохраняет событие webhook; False, если событие с этим payment_id уже было."""
+    async def job(conn):
+        cursor = await conn.execute("""
+            INSERT INTO payment_events (payment_id, event, payload) VALUES (?, ?, ?)
+            ON CONFLICT(payment_id) DO NOTHING
+            RETURNING payment_id
+        """, (payment_id, event, payload))
+        row = await cursor.fetchone()
+        await cursor.close()
+        return row is not None
+
+    return await db_pool.submit_write(job)
+
+async def claim_payment_events(limit: int) -> List[Dict[str, Any]]:
+    """Забирает до limit необработанных событий оплаты в порядке поступления."""
+    async def job(conn):
+        cursor = await conn.execute("""
+            UPDATE payment_events
+            SET status = 'running', attempts = attempts + 1, started_at = CURRENT_TIMESTAMP
+            WHERE payment_id IN (
+                SELECT payment_id FROM payment_events WHERE status = 'queued' ORDER BY created_at LIMIT ?
+            )
+            RETURNING payment_id, event, payload, attempts
+        """, (limit,))
+        return await cursor.fetchall()
+
+    try:
+        rows = await db_pool.submit_write(job)
+    except Exception as e:
+        logger.error(f"Ошибка получения событий оплаты: {e}", exc_info=True)
+        return []
+    return [
+        {'payment_id': row[0], 'event': row[1], 'payload': json.loads(row[2]), 'attempts': row[3]}
+        for row in rows
+    ]
+
+async def finish_payment_event(payment_id: str, status: str = 'done', error: Optional[str] = None,
+                               max_attempts: Optional[int] = None) -> str:
+    """Отмечает событие оплаты обработанным; при ошибке возвращает в очередь, пока не исчерпаны попытки.
+
+    Возвращает итоговый статус события.
+    """
+    async def job(conn):
+        cursor = await conn.execute("""
+            UPDATE payment_events
+            SET status = CASE WHEN ? = 'failed' AND attempts < ? THEN 'queued' ELSE ? END,
+                last_error = ?,
+                finished_at = CURRENT_TIMESTAMP
+            WHERE payment_id = ?
+            RETURNING status
+        """, (status, max_attempts or 0, status, error, payment_id))
+        row = await cursor.fetchone()
+        await cursor.close()
+        return row[0] if row else status
+
+    try:
+        return await db_pool.submit_write(job)
+    except Exception as e:
+        logger.error(f"Ошибка обновления события оплаты {payment_id}: {e}", exc_info=True)
+        return status
+
+async def requeue_running_payment_events() -> int:
+    """Возвращает в очередь события оплаты, прерванные перезапуском."""
+    async def job(conn):
+        cursor = await conn.execute("UPDATE payment_events SET status = 'queued' WHERE status = 'running'")
+        return cursor.rowcount
+
+    try:
+        requeued = await db_pool.submit_write(job)
+    except Exception as e:
+        logger.error(f"Ошибка восстановления событий оплаты: {e}", exc_info=True)
+        return 0
+    if requeued:
+        logger.info(f"События оплаты после перезапуска возвращены в очередь: {requeued}")
+    return requeued
+
+async def get_payment_events_depth() -> int:
+    """Число событий оплаты, ожидающих обработки."""
+    async with db_pool.reader() as conn:
+        cursor = await conn.execute("SELECT COUNT(*) FROM payment_events WHERE status IN ('queued', 'running')")
+        row = await cursor.fetchone()
+        await cursor.close()
+    return int(row[0] or 0)
+
+async def apply_payment(user_id: int, plan_key: str, payment_amount: float, payment_id: str) -> Optional[Dict[str, Any]]:
+    """Проводит платёж одной транзакцией: платёж, начисление, реферальный бонус, логи и статистика.
+
+    Повтор определяется вставкой в payments (payment_id — первичный ключ): для уже
+    проведённого платежа возвращает None. Событие webhook отмечается обработанным
+    в той же транзакции. Возвращает данные для уведомлений.
+    """
+    tariff_info = TARIFFS.get(plan_key, {})
+    referral_photos_for_plan = await convert_amount_to_photos(payment_amount, plan_key)
+
+    async def job(conn):
+        now = _utc_timestamp()
+        cursor = await conn.execute("""
+            INSERT INTO payments (payment_id, user_id, plan, amount, status, created_at)
+            VALUES (?, ?, ?, ?, 'succeeded', CURRENT_TIMESTAMP)
+            ON CONFLICT(payment_id) DO NOTHING
+            RETURNING payment_id
+        """, (payment_id, user_id, plan_key, payment_amount))
+        inserted = await cursor.fetchone()
+        await cursor.close()
+        if inserted is None:
+            await conn.execute(
+                "UPDATE payment_events SET status = 'duplicate', finished_at = CURRENT_TIMESTAMP WHERE payment_id = ?",
+                (payment_id,)
+            )
+            return None
+
+        cursor = await conn.execute(
+            "SELECT avatar_left, referrer_id FROM users WHERE user_id = ?", (user_id,)
+        )
+        user_row = await cursor.fetchone()
+        await cursor.close()
+        if user_row is None:
+            raise ValueError(f"Пользователь user_id={user_id} не найден")
+        initial_avatars, referrer_id = user_row
+
+        cursor = await conn.execute(
+            "SELECT COUNT(*) FROM payments WHERE user_id = ? AND status = 'succeeded' AND payment_id != ?",
+            (user_id, payment_id)
+        )
+        payment_count = (await cursor.fetchone())[0]
+        await cursor.close()
+        is_first_purchase = payment_count == 0
+
+        photos_added = tariff_info.get('photos', 0)
+        avatars_added = tariff_info.get('avatars', 0)
+        bonus_avatar = is_first_purchase and plan_key != 'аватар'
+        if bonus_avatar:
+            avatars_added += 1
+
+        cursor = await conn.execute("""
+            UPDATE users
+            SET generations_left = generations_left + ?, avatar_left = avatar_left + ?,
+                first_purchase = 0, updated_at = CURRENT_TIMESTAMP
+            WHERE user_id = ?
+            RETURNING generations_left, avatar_left, username, first_name
+        """, (photos_added, avatars_added, user_id))
+        generations_left, avatar_left, username, first_name = await cursor.fetchone()
+        await cursor.close()
+
+        referral_photos = 0
+        if referrer_id:
+            # Восстанавливаем реферальную связь, если её запись потерялась
+            await conn.execute(
+                "INSERT OR IGNORE INTO referrals (referrer_id, referred_id, status, created_at) VALUES (?, ?, 'pending', ?)",
+                (referrer_id, user_id, now)
+            )
+            if is_first_purchase and referral_photos_for_plan > 0:
+                cursor = await conn.execute("""
+                    UPDATE users SET generations_left = generations_left + ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE user_id = ?
+                    RETURNING user_id
+                """, (referral_photos_for_plan, referrer_id))
+                referrer_found = await cursor.fetchone()
+                await cursor.close()
+                if referrer_found:
+                    referral_photos = referral_photos_for_plan
+                    await conn.execute(
+                        "INSERT INTO referral_rewards (referrer_id, referred_user_id, reward_photos, created_at) VALUES (?, ?, ?, ?)",
+                        (referrer_id, user_id, referral_photos, now)
+                    )
+                    await conn.execute("""
+                        INSERT INTO referral_stats (user_id, total_referrals, total_reward_photos, updated_at)
+                        VALUES (?, 1, ?, ?)
+                        ON CONFLICT(user_id) DO UPDATE SET
+                            total_referrals = total_referrals + 1,
+                            total_reward_photos = total_reward_photos + excluded.total_reward_photos,
+                            updated_at = excluded.updated_at
+                    """, (referrer_id, referral_photos, now))
+                    await conn.execute(
+                        "UPDATE referrals SET status = 'completed', completed_at = CURRENT_TIMESTAMP WHERE referrer_id = ? AND referred_id = ?",
+                        (referrer_id, user_id)
+                    )
+                else:
+                    logger.warning(f"Реферер user_id={referrer_id} не найден для user_id={user_id}")
+
+        payment_info = {
+            'tariff_key': plan_key,
+            'photos_added': photos_added,
+            'avatars_added': avatars_added,
+            'is_first_purchase': is_first_purchase,
+            'bonus_avatar': bonus_avatar
+        }
+        await conn.execute(
+            "INSERT OR IGNORE INTO payment_logs (user_id, payment_id, amount, payment_info, created_at) VALUES (?, ?, ?, ?, ?)",
+            (user_id, payment_id, payment_amount, json.dumps(payment_info, ensure_ascii=False), f"{now} UTC")
+        )
+        await conn.execute("""
+            INSERT INTO user_payment_stats (user_id, total_payments, total_amount, first_payment_date, last_payment_date)
+            VALUES (?, 1, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                total_payments = total_payments + 1,
+                total_amount = total_amount + excluded.total_amount,
+                last_payment_date = excluded.last_payment_date
+        """, (user_id, payment_amount, f"{now} UTC", f"{now} UTC"))
+        await log_user_action(user_id, 'payment_processed', {
+            'payment_id': payment_id,
+            'plan': plan_key,
+            'amount': payment_amount,
+            'photos_added': photos_added,
+            'avatars_added': avatars_added,
+            'is_first_purchase': is_first_purchase,
+            'bonus_avatar': bonus_avatar,
+            'referral_photos': referral_photos
+        }, conn=conn)
+        await conn.execute(
+            "UPDATE payment_events SET status = 'done', last_error = NULL, finished_at = CURRENT_TIMESTAMP WHERE payment_id = ?",
+            (payment_id,)
+        )
+        return {
+            'is_first_purchase': is_first_purchase,
+            'payment_count': payment_count,
+            'photos_added': photos_added,
+            'avatars_added': avatars_added,
+            'bonus_avatar': bonus_avatar,
+            'initial_avatars': initial_avatars,
+            'generations_left': generations_left,
+            'avatar_left': avatar_left,
+            'username': username,
+            'first_name': first_name,
+            'referrer_id': referrer_id,
+            'referral_photos': referral_photos,
+        }
+
+    result = await db_pool.submit_write(job)
+    if result is not None:
+        await refresh_user_cache(user_id)
+        if result['referral_photos']:
+            await refresh_user_cache(result['referrer_id'])
+        logger.info(
+            f"Платёж {payment_id} проведён для user_id={user_id}: план '{plan_key}', "
+            f"+{result['photos_added']} фото, +{result['avatars_added']} аватар(ов), "
+            f"первая покупка: {result['is_first_purchase']}, реферальный бонус: {result['referral_photos']}"
+        )
+    return result
+
+@write_through_cache()
 async def update_user_balance(user_id: int, photos: int, avatars: int, operation: str = 'add') -> bool:
     """Обновляет баланс пользователя (фото и аватары)"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.writer() as conn:
             c = await conn.cursor()
 
             await c.execute("SELECT generations_left, avatar_left FROM users WHERE user_id = ?", (user_id,))
@@ -1595,7 +2378,7 @@ async def update_user_balance(user_id: int, photos: int, avatars: int, operation
 async def get_user_activity_metrics(start_date: str, end_date: str) -> List[Tuple[int, str, int, int, int, int]]:
     """Получает статистику активности пользователей за указанный период"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
 
@@ -1639,7 +2422,7 @@ async def get_user_activity_metrics(start_date: str, end_date: str) -> List[Tupl
 async def get_referral_stats() -> Dict[str, Any]:
     """Получает статистику реферальной программы"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
 
@@ -1670,7 +2453,7 @@ async def get_referral_stats() -> Dict[str, Any]:
 async def get_user_logs(user_id: int, limit: int = 50) -> List[Tuple[str, str, str]]:
     """Получает логи действий пользователя"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
 
@@ -1688,11 +2471,123 @@ async def get_user_logs(user_id: int, limit: int = 50) -> List[Tuple[str, str, s
         logger.error(f"Ошибка получения логов для user_id={user_id}: {e}", exc_info=True)
         return []
 
+# Группы получателей рассылки; restricted — неоплативший пользователь без ресурсов
+_BROADCAST_GROUP_FILTERS = {
+    'all': "",
+    'paid': "AND EXISTS (SELECT 1 FROM payments p WHERE p.user_id = u.user_id AND p.status = 'succeeded')",
+    'non_paid': "AND NOT EXISTS (SELECT 1 FROM payments p WHERE p.user_id = u.user_id AND p.status = 'succeeded')",
+}
+
+async def count_broadcast_recipients(target_group: str = 'all') -> int:
+    """Количество получателей рассылки для группы."""
+    group_filter = _BROADCAST_GROUP_FILTERS.get(target_group, "")
+    async with db_pool.reader() as conn:
+        c = await conn.cursor()
+        await c.execute(f"SELECT COUNT(*) FROM users u WHERE 1 = 1 {group_filter}")
+        return (await c.fetchone())[0]
+
+async def iter_broadcast_recipients(target_group: str = 'all', after_user_id: int = 0, page_size: int = 500):
+    """Постранично отдаёт получателей рассылки [(user_id, restricted), ...] по возрастанию user_id.
+
+    Каждая страница читается отдельным коротким запросом (keyset-пагинация),
+    поэтому соединение не удерживается на время отправки.
+    """
+    group_filter = _BROADCAST_GROUP_FILTERS.get(target_group, "")
+    statement = f"""
+        SELECT u.user_id,
+               u.first_purchase = 1
+               AND IFNULL(u.generations_left, 0) <= 0
+               AND IFNULL(u.avatar_left, 0) <= 0
+               AND NOT EXISTS (SELECT 1 FROM payments p WHERE p.user_id = u.user_id AND p.status = 'succeeded')
+               AS restricted
+        FROM users u
+        WHERE u.user_id > ? {group_filter}
+        ORDER BY u.user_id
+        LIMIT ?
+    """
+    last_user_id = after_user_id
+    while True:
+        async with db_pool.reader() as conn:
+            c = await conn.cursor()
+            await c.execute(statement, (last_user_id, page_size))
+            rows = await c.fetchall()
+        if not rows:
+            return
+        yield [(row[0], bool(row[1])) for row in rows]
+        if len(rows) < page_size:
+            return
+        last_user_id = rows[-1][0]
+
+async def save_broadcast_checkpoint(broadcast_id: int, last_user_id: int, sent_count: int, failed_count: int, status: Optional[str] = None) -> None:
+    """Сохраняет прогресс рассылки (и при необходимости её статус)."""
+    async def job(conn):
+        if status:
+            await conn.execute(
+                "UPDATE scheduled_broadcasts SET last_user_id = ?, sent_count = ?, failed_count = ?, status = ? WHERE id = ?",
+                (last_user_id, sent_count, failed_count, status, broadcast_id)
+            )
+        else:
+            await conn.execute(
+                "UPDATE scheduled_broadcasts SET last_user_id = ?, sent_count = ?, failed_count = ? WHERE id = ?",
+                (last_user_id, sent_count, failed_count, broadcast_id)
+            )
+
+    try:
+        await db_pool.submit_write(job)
+    except Exception as e:
+        logger.error(f"Ошибка сохранения прогресса рассылки ID {broadcast_id}: {e}", exc_info=True)
+
+async def get_broadcast_checkpoint(broadcast_id: int) -> Tuple[int, int, int]:
+    """Возвращает сохранённый прогресс рассылки: (last_user_id, sent_count, failed_count)."""
+    async with db_pool.reader() as conn:
+        c = await conn.cursor()
+        await c.execute(
+            "SELECT IFNULL(last_user_id, 0), IFNULL(sent_count, 0), IFNULL(failed_count, 0) FROM scheduled_broadcasts WHERE id = ?",
+            (broadcast_id,)
+        )
+        row = await c.fetchone()
+        return tuple(row) if row else (0, 0, 0)
+
+async def set_broadcast_status(broadcast_id: int, status: str) -> None:
+    """Обновляет статус рассылки."""
+    async def job(conn):
+        await conn.execute("UPDATE scheduled_broadcasts SET status = ? WHERE id = ?", (status, broadcast_id))
+
+    await db_pool.submit_write(job)
+
+async def get_interrupted_broadcasts() -> List[Dict[str, Any]]:
+    """Рассылки, прерванные перезапуском бота (статус running)."""
+    try:
+        async with db_pool.reader() as conn:
+            conn.row_factory = aiosqlite.Row
+            c = await conn.cursor()
+            await c.execute(
+                "SELECT id, scheduled_time, status, broadcast_data FROM scheduled_broadcasts WHERE status = 'running' ORDER BY id"
+            )
+            rows = await c.fetchall()
+        result = []
+        for row in rows:
+            try:
+                broadcast_data = json.loads(row['broadcast_data']) if row['broadcast_data'] else {}
+            except json.JSONDecodeError as e:
+                logger.error(f"Ошибка декодирования JSON для broadcast_id={row['id']}: {e}")
+                continue
+            result.append({
+                'id': row['id'],
+                'scheduled_time': row['scheduled_time'],
+                'status': row['status'],
+                'broadcast_data': broadcast_data
+            })
+        return result
+    except Exception as e:
+        logger.error(f"Ошибка получения прерванных рассылок: {e}", exc_info=True)
+        return []
+
 async def get_scheduled_broadcasts(bot: Bot = None) -> List[Dict]:
 
     from handlers.utils import safe_escape_markdown, send_message_with_fallback
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
             msk_tz = pytz.timezone('Europe/Moscow')
@@ -1785,11 +2680,12 @@ async def get_scheduled_broadcasts(bot: Bot = None) -> List[Dict]:
                 current_time_dt = datetime.now(msk_tz)
                 if not last_warning or (current_time_dt - last_warning).total_seconds() >= 1200:
                     logger.warning(f"Запланированные рассылки есть, но не найдены из-за времени: {[(row['id'], row['scheduled_time']) for row in all_rows if row['status'] == 'pending']}")
-                    await c.execute(
-                        "INSERT OR REPLACE INTO bot_config (key, value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)",
-                        ('last_broadcast_warning_time', current_time_dt.strftime('%Y-%m-%d %H:%M:%S'))
-                    )
-                    await conn.commit()
+                    async with db_pool.writer() as write_conn:
+                        await write_conn.execute(
+                            "INSERT OR REPLACE INTO bot_config (key, value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)",
+                            ('last_broadcast_warning_time', current_time_dt.strftime('%Y-%m-%d %H:%M:%S'))
+                        )
+                        await write_conn.commit()
 
                     for admin_id in ADMIN_IDS:
                         try:
@@ -1822,195 +2718,7 @@ async def get_scheduled_broadcasts(bot: Bot = None) -> List[Dict]:
                     logger.error(f"Не удалось уведомить админа {admin_id}: {e_notify}")
         return []
 
-@retry_on_locked(max_attempts=15, initial_delay=0.5)
-@invalidate_cache()
-async def add_resources_on_payment(user_id: int, plan_key: str, payment_amount: float, payment_id_yookassa: str, bot: Bot = None, is_first_purchase: bool = None) -> bool:
-    """Добавляет ресурсы пользователю после оплаты."""
-    try:
-        from handlers.utils import safe_escape_markdown, send_message_with_fallback
-        async with aiosqlite.connect(DATABASE_PATH, timeout=15) as conn:
-            await conn.execute("PRAGMA busy_timeout = 30000")
-            c = await conn.cursor()
-
-            user_data = await check_database_user(user_id)
-            if not user_data:
-                logger.error(f"Пользователь user_id={user_id} не найден")
-                return False
-
-            generations_left = user_data[0]
-            avatar_left = user_data[1]
-
-            # Если is_first_purchase не передан явно, определяем его
-            if is_first_purchase is None:
-                # Проверяем реальное количество платежей
-                await c.execute("""
-                    SELECT COUNT(*) FROM payments
-                    WHERE user_id = ? AND status = 'succeeded' AND payment_id != ?
-                """, (user_id, payment_id_yookassa))
-                payment_count = (await c.fetchone())[0]
-                is_first_purchase = (payment_count == 0)
-                logger.info(f"Определено is_first_purchase={is_first_purchase} для user_id={user_id}, предыдущих платежей: {payment_count}")
-
-            referrer_info = await get_referrer_info(user_id)
-            referrer_id = referrer_info['referrer_id'] if referrer_info else None
-            logger.debug(f"add_resources_on_payment: user_id={user_id}, is_first_purchase={is_first_purchase}, referrer_id={referrer_id}")
-
-            tariff_info = TARIFFS.get(plan_key, {})
-            photos_to_add = tariff_info.get('photos', 0)
-            avatars_to_add = tariff_info.get('avatars', 0)
-
-            bonus_avatar = False
-
-            # Бонусный аватар только при первой покупке любого пакета (кроме пакета "аватар")
-            if is_first_purchase and plan_key != 'аватар':
-                avatars_to_add += 1
-                bonus_avatar = True
-                logger.info(f"Добавлен бонусный аватар для user_id={user_id} (первая покупка)")
-            else:
-                logger.info(f"Бонусный аватар НЕ добавлен для user_id={user_id}: is_first_purchase={is_first_purchase}, plan_key={plan_key}")
-
-            new_generations = generations_left + photos_to_add
-            new_avatars = avatar_left + avatars_to_add
-
-            await c.execute('''UPDATE users
-                              SET generations_left = ?, avatar_left = ?, first_purchase = 0, updated_at = CURRENT_TIMESTAMP
-                              WHERE user_id = ?''',
-                           (new_generations, new_avatars, user_id))
-
-            await c.execute('''INSERT INTO payments (payment_id, user_id, plan, amount, status, created_at)
-                              VALUES (?, ?, ?, ?, 'succeeded', CURRENT_TIMESTAMP)
-                              ON CONFLICT(payment_id) DO NOTHING''',
-                           (payment_id_yookassa, user_id, plan_key, payment_amount))
-
-            # Реферальный бонус для реферера (не для самого пользователя)
-            referral_photos = 0
-            if is_first_purchase and referrer_id:
-                await c.execute("SELECT user_id FROM users WHERE user_id = ?", (referrer_id,))
-                if await c.fetchone():
-                    referral_photos = await convert_amount_to_photos(payment_amount, plan_key)
-                    if referral_photos > 0:
-                        await c.execute('''UPDATE users
-                                          SET generations_left = generations_left + ?, updated_at = CURRENT_TIMESTAMP
-                                          WHERE user_id = ?''',
-                                       (referral_photos, referrer_id))
-                        current_timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
-                        await c.execute('''INSERT INTO referral_rewards (referrer_id, referred_user_id, reward_photos, created_at)
-                                          VALUES (?, ?, ?, ?)''',
-                                       (referrer_id, user_id, referral_photos, current_timestamp))
-                        await c.execute('''INSERT OR REPLACE INTO referral_stats (user_id, total_referrals, total_reward_photos, updated_at)
-                                          VALUES (?,
-                                                  COALESCE((SELECT total_referrals FROM referral_stats WHERE user_id = ?), 0) + 1,
-                                                  COALESCE((SELECT total_reward_photos FROM referral_stats WHERE user_id = ?), 0) + ?,
-                                                  ?)''',
-                                       (referrer_id, referrer_id, referrer_id, referral_photos, current_timestamp))
-                        await c.execute('''UPDATE referrals
-                                          SET status = 'completed', completed_at = CURRENT_TIMESTAMP
-                                          WHERE referrer_id = ? AND referred_id = ?''',
-                                       (referrer_id, user_id))
-                        logger.info(f"Реферальный бонус начислен: referrer_id={referrer_id}, referred_id={user_id}, {referral_photos} фото")
-                    else:
-                        logger.warning(f"Реферальный бонус не начислен для referrer_id={referrer_id}: нет фото для начисления (тариф '{plan_key}')")
-                else:
-                    logger.warning(f"Реферер user_id={referrer_id} не найден для user_id={user_id}")
-
-            await log_user_action(user_id, 'payment_processed', {
-                'payment_id': payment_id_yookassa,
-                'plan': plan_key,
-                'amount': payment_amount,
-                'photos_added': photos_to_add,
-                'avatars_added': avatars_to_add,
-                'is_first_purchase': is_first_purchase,
-                'bonus_avatar': bonus_avatar,
-                'referral_photos': referral_photos
-            }, conn=conn)
-
-            await conn.commit()
-
-            # Обновляем статистику платежей после завершения основной транзакции
-            try:
-                await update_user_payment_stats(user_id, payment_amount)
-            except Exception as e:
-                logger.warning(f"Не удалось обновить статистику платежей для user_id={user_id}: {e}")
-
-            logger.info(
-                f"Ресурсы добавлены для user_id={user_id} по плану '{plan_key}'. "
-                f"Баланс: {new_generations} фото (было {generations_left}, добавлено {photos_to_add}), "
-                f"{new_avatars} аватар (было {avatar_left}, добавлено {avatars_to_add}). "
-                f"Первая покупка: {is_first_purchase}. "
-                f"Начислено аватаров: {avatars_to_add} (включая бонус: {bonus_avatar}). "
-                f"Реферальный бонус для реферера: {referral_photos} фото."
-            )
-
-            if bot:
-                logger.info(f"🔔 Начинаем отправку уведомления пользователю {user_id} о платеже")
-                try:
-                    # Сообщение пользователю
-                    tariff_display = TARIFFS.get(plan_key, {}).get('display', plan_key)
-                    message_parts = [
-                        "🎉 Оплата успешно обработана!",
-                        f"📦 Тариф: {tariff_display}",
-                        f"✅ Начислено: {photos_to_add} печенек {avatars_to_add - (1 if bonus_avatar else 0)} аватар(ов)"
-                    ]
-
-                    if bonus_avatar:
-                        message_parts.append("🎁 +1 аватар в подарок за первую покупку!")
-
-                    message_parts.extend([
-                        f"💎 Текущий баланс: {new_generations} печенек, {new_avatars} аватар(ов)"
-                    ])
-
-                    if referral_photos > 0:
-                        message_parts.append("🎁 Реферальный бонус начислен вашему другу!")
-
-                    message_text = safe_escape_markdown("\n".join(message_parts), version=2)
-                    logger.info(f"🔔 Отправляем уведомление пользователю {user_id}: {message_text[:100]}...")
-
-                    await send_message_with_fallback(
-                        bot, user_id,
-                        message_text,
-                        parse_mode=ParseMode.MARKDOWN_V2
-                    )
-                    logger.info(f"✅ Уведомление пользователю {user_id} отправлено успешно")
-                except Exception as e:
-                    logger.error(f"❌ Ошибка отправки уведомления пользователю {user_id}: {e}", exc_info=True)
-            else:
-                logger.warning(f"⚠️ Bot instance не передан, уведомление пользователю {user_id} НЕ отправлено")
-
-                # Уведомление рефереру
-                if referral_photos > 0 and referrer_id:
-                    try:
-                        referrer_data = await get_user_info(referrer_id)
-                        if referrer_data:
-                            message_text = safe_escape_markdown(
-                                f"🎁 Ваш друг оплатил подписку! Вам начислено {referral_photos} печенек за реферала!\n"
-                                f"💎 Текущий баланс: {referrer_data['generations_left'] + referral_photos} печенек",
-                                version=2
-                            )
-                            await send_message_with_fallback(
-                                bot, referrer_id,
-                                message_text,
-                                parse_mode=ParseMode.MARKDOWN_V2
-                            )
-                    except Exception as e:
-                        logger.error(f"Ошибка отправки уведомления рефереру {referrer_id}: {e}")
-
-            return True
-
-    except Exception as e:
-        logger.error(f"Ошибка добавления ресурсов для user_id={user_id}: {e}", exc_info=True)
-        if bot:
-            for admin_id in ADMIN_IDS:
-                try:
-                    await send_message_with_fallback(
-                        bot, admin_id,
-                        safe_escape_markdown(f"🚨 Ошибка обработки платежа для user_id={user_id}, payment_id={payment_id_yookassa}: {str(e)}", version=2),
-                        parse_mode=ParseMode.MARKDOWN_V2
-                    )
-                except Exception as e_notify:
-                    logger.error(f"Не удалось уведомить админа {admin_id}: {e_notify}")
-        return False
-
-@invalidate_cache()
+@write_through_cache()
 async def save_user_trainedmodel(user_id: int, prediction_id: str, trigger_word: str,
                                 photo_paths_list: List[str], avatar_name: Optional[str] = None,
                                 training_step: str = "initial_save", conn=None) -> int:
@@ -2019,8 +2727,7 @@ async def save_user_trainedmodel(user_id: int, prediction_id: str, trigger_word:
         photo_paths_str = json.dumps(photo_paths_list) if photo_paths_list else None
 
         if conn is None:
-            async with aiosqlite.connect(DATABASE_PATH, timeout=10) as conn:
-                await conn.execute("PRAGMA busy_timeout = 10000")
+            async with db_pool.writer() as conn:
                 c = await conn.cursor()
 
                 await c.execute("SELECT avatar_id FROM user_trainedmodels WHERE prediction_id = ?", (prediction_id,))
@@ -2095,14 +2802,14 @@ async def save_user_trainedmodel(user_id: int, prediction_id: str, trigger_word:
         logger.error(f"Ошибка сохранения модели для user_id={user_id}: {e}", exc_info=True)
         raise
 
-@invalidate_cache()
+@write_through_cache()
 async def update_trainedmodel_status(avatar_id: int, model_id: Optional[str] = None,
                                    model_version: Optional[str] = None,
                                    status: Optional[str] = None,
                                    prediction_id: Optional[str] = None):
     """Обновляет статус и данные обученной модели"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.writer() as conn:
             c = await conn.cursor()
 
             fields_to_update = []
@@ -2166,7 +2873,7 @@ async def update_trainedmodel_status(avatar_id: int, model_id: Optional[str] = N
 async def get_user_trainedmodels(user_id: int) -> List[Tuple]:
     """Получает все обученные модели пользователя"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
 
@@ -2201,7 +2908,7 @@ async def get_user_trainedmodels(user_id: int) -> List[Tuple]:
 async def get_active_trainedmodel(user_id: int) -> Optional[Tuple]:
     """Получает активную обученную модель пользователя"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
 
@@ -2255,11 +2962,11 @@ async def get_active_trainedmodel(user_id: int) -> Optional[Tuple]:
         logger.error(f"Ошибка получения активной модели для user_id={user_id}: {e}", exc_info=True)
         return None
 
-@invalidate_cache()
+@write_through_cache()
 async def delete_trained_model(user_id: int, avatar_id: int) -> bool:
     """Удаляет обученную модель пользователя"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.writer() as conn:
             c = await conn.cursor()
 
             await c.execute("SELECT active_avatar_id FROM users WHERE user_id = ?", (user_id,))
@@ -2297,7 +3004,7 @@ async def get_all_users_stats(page: int = 1, page_size: int = 10) -> Tuple[List[
     try:
         offset = (page - 1) * page_size
 
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
 
@@ -2325,7 +3032,7 @@ async def get_all_users_stats(page: int = 1, page_size: int = 10) -> Tuple[List[
 async def search_users_by_query(query: str) -> List[Tuple]:
     """Поиск пользователей по запросу"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
 
@@ -2358,7 +3065,7 @@ async def search_users_by_query(query: str) -> List[Tuple]:
 async def save_video_task(user_id: int, prediction_id: str, model_key: str, video_path: str, status: str, style_name: str = 'custom') -> int:
     """Сохраняет задачу видеогенерации в базу данных."""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.writer() as conn:
             c = await conn.cursor()
             # Проверяем наличие столбца style_name
             await c.execute("PRAGMA table_info(video_tasks)")
@@ -2390,7 +3097,7 @@ async def update_video_task_status(task_id: int, status: str, video_path: Option
                                  prediction_id: Optional[str] = None):
     """Обновляет статус задачи генерации видео"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.writer() as conn:
             c = await conn.cursor()
 
             fields_to_update = ["status = ?"]
@@ -2420,7 +3127,7 @@ async def update_video_task_status(task_id: int, status: str, video_path: Option
 async def get_user_video_tasks(user_id: int) -> List[Tuple]:
     """Получает все видео-задачи пользователя"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
 
@@ -2439,7 +3146,7 @@ async def get_user_video_tasks(user_id: int) -> List[Tuple]:
 async def get_user_payments(user_id: int, limit: Optional[int] = None) -> List[Tuple]:
     """Получает историю успешных платежей пользователя с опциональным ограничением количества записей."""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
 
@@ -2474,29 +3181,24 @@ async def log_generation(user_id: int, generation_type: str, replicate_model_id:
         else:
             total_cost = Decimal(str(units_generated)) * Decimal(str(cost_per_unit))
 
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
-            c = await conn.cursor()
-
-            await c.execute('''INSERT INTO generation_log (
-                               user_id, generation_type, replicate_model_id, units_generated,
-                               cost_per_unit, total_cost, style, ratio
-                           ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-                           (user_id, generation_type, replicate_model_id,
-                            units_generated, float(cost_per_unit), float(total_cost), style, ratio))
-
-            await conn.commit()
+        created_at = _utc_timestamp()
+        analytics_buffer.record(_INSERT_GENERATION_LOG_SQL, (
+            user_id, generation_type, replicate_model_id, units_generated,
+            float(cost_per_unit), float(total_cost), style, ratio, created_at
+        ))
+        analytics_buffer.record(_INSERT_USER_ACTION_SQL, (
+            user_id, 'generate_image', json.dumps({
+                'generation_type': generation_type,
+                'model_id': replicate_model_id,
+                'units': units_generated,
+                'cost': float(total_cost)
+            }, ensure_ascii=False), None, None, created_at
+        ))
 
         logger.info(f"Генерация записана: user_id={user_id}, type={generation_type}, model={replicate_model_id}, "
                   f"units={units_generated}, cost_pu={cost_per_unit:.6f}, total_cost={total_cost:.6f}, "
                   f"style={style}, ratio={ratio}")
 
-        await log_user_action(user_id, 'generate_image', {
-            'generation_type': generation_type,
-            'model_id': replicate_model_id,
-            'units': units_generated,
-            'cost': float(total_cost)
-        })
-
     except Exception as e:
         logger.error(f"Ошибка логирования генерации для user_id={user_id}: {e}", exc_info=True)
         raise
@@ -2504,7 +3206,7 @@ async def log_generation(user_id: int, generation_type: str, replicate_model_id:
 async def get_user_generation_stats(user_id: int) -> Dict[str, int]:
     """Получает статистику генераций пользователя"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
 
@@ -2525,7 +3227,7 @@ async def get_generation_cost_log(start_date_str: Optional[str] = None,
                                     end_date_str: Optional[str] = None) -> List[Tuple]:
     """Получает лог генераций для подсчета расходов"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
 
@@ -2559,7 +3261,7 @@ async def get_generation_cost_log(start_date_str: Optional[str] = None,
 async def get_total_remaining_photos() -> int:
     """Получает общий остаток фото у всех пользователей"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             c = await conn.cursor()
 
             await c.execute("SELECT SUM(generations_left) FROM users")
@@ -2574,7 +3276,7 @@ async def get_total_remaining_photos() -> int:
 async def get_user_avatars(user_id: int) -> List[Tuple]:
     """Получает краткую информацию об аватарах пользователя"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
 
@@ -2592,31 +3294,29 @@ async def get_user_avatars(user_id: int) -> List[Tuple]:
 
 
 
-@retry_on_locked(max_attempts=10, initial_delay=0.5)
+_INSERT_USER_ACTION_SQL = '''INSERT INTO user_actions
+                             (user_id, action, details, style, ratio, created_at)
+                             VALUES (?, ?, ?, ?, ?, ?)'''
+
+_INSERT_GENERATION_LOG_SQL = '''INSERT INTO generation_log (
+                                user_id, generation_type, replicate_model_id, units_generated,
+                                cost_per_unit, total_cost, style, ratio, created_at
+                              ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+
+
+def _utc_timestamp() -> str:
+    """Текущее время UTC в формате CURRENT_TIMESTAMP SQLite."""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
 async def log_user_action(user_id: int, action: str, details: Dict[str, Any] = None, conn=None):
     """Логирует действие пользователя в таблицу user_actions."""
     try:
+        params = (user_id, action, json.dumps(details or {}, ensure_ascii=False), None, None, _utc_timestamp())
         if conn is None:
-            async with aiosqlite.connect(DATABASE_PATH, timeout=10) as conn:
-                await conn.execute("PRAGMA busy_timeout = 10000")
-                c = await conn.cursor()
-                details_json = json.dumps(details or {}, ensure_ascii=False)
-                await c.execute(
-                    '''INSERT INTO user_actions
-                       (user_id, action, details, created_at)
-                       VALUES (?, ?, ?, CURRENT_TIMESTAMP)''',
-                    (user_id, action, details_json)
-                )
-                await conn.commit()
+            analytics_buffer.record(_INSERT_USER_ACTION_SQL, params)
         else:
-            c = await conn.cursor()
-            details_json = json.dumps(details or {}, ensure_ascii=False)
-            await c.execute(
-                '''INSERT INTO user_actions
-                   (user_id, action, details, created_at)
-                   VALUES (?, ?, ?, CURRENT_TIMESTAMP)''',
-                (user_id, action, details_json)
-            )
+            await conn.execute(_INSERT_USER_ACTION_SQL, params)
         logger.debug(f"Действие пользователя записано: user_id={user_id}, action={action} ✅")
     except aiosqlite.OperationalError as e:
         logger.error(f"Ошибка логирования действия user_id={user_id}: {e} 🚫")
@@ -2631,7 +3331,7 @@ async def get_user_actions_stats(user_id: Optional[int] = None,
                                end_date: Optional[datetime] = None) -> List[Dict[str, Any]]:
     """Получает статистику действий пользователей"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
 
@@ -2687,7 +3387,7 @@ async def get_user_actions_stats(user_id: Optional[int] = None,
 async def get_user_rating_and_registration(user_id: int) -> Tuple[Optional[float], Optional[int], Optional[str]]:
     """Получает средний рейтинг, количество оценок и дату регистрации пользователя"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
 
@@ -2740,11 +3440,11 @@ async def get_user_rating_and_registration(user_id: int) -> Tuple[Optional[float
         logger.error(f"Ошибка получения рейтинга, количества оценок и даты регистрации для user_id={user_id}: {e}", exc_info=True)
         return None, None, None
 
-@invalidate_cache()
+@write_through_cache()
 async def delete_user_activity(user_id: int) -> bool:
     """Удаляет пользователя и все связанные с ним данные из всех таблиц."""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.writer() as conn:
             c = await conn.cursor()
 
             await c.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,))
@@ -2791,12 +3491,12 @@ async def delete_user_activity(user_id: int) -> bool:
         logger.error(f"Ошибка удаления пользователя user_id={user_id}: {e}", exc_info=True)
         raise
 
-@invalidate_cache()
+@write_through_cache()
 async def block_user_access(user_id: int, block: bool = True, block_reason: Optional[str] = None) -> bool:
     """Блокирует или разблокирует пользователя с указанием причины."""
     action = "блокировки" if block else "разблокировки"
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.writer() as conn:
             c = await conn.cursor()
 
             await c.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,))
@@ -2831,12 +3531,12 @@ async def is_user_blocked(user_id: int) -> bool:
         if user_cache is not None:
             try:
                 cached_data = await user_cache.get(user_id)
-                if cached_data and "is_blocked" in cached_data:
-                    return bool(cached_data["is_blocked"]) # is_blocked
+                if isinstance(cached_data, UserSnapshot):
+                    return bool(cached_data.is_blocked)
             except Exception as e:
                 logger.warning(f"Ошибка получения кеша для user_id={user_id}: {e}")
 
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
 
@@ -2859,7 +3559,7 @@ async def is_user_blocked(user_id: int) -> bool:
 async def get_payments_by_date(start_date: Optional[str] = None, end_date: Optional[str] = None) -> List[Tuple]:
     """Получает платежи за указанный период, возвращая время в МСК."""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
 
@@ -2921,7 +3621,7 @@ async def get_payments_by_date(start_date: Optional[str] = None, end_date: Optio
 async def check_referral_integrity(user_id: int) -> bool:
     """Проверяет целостность реферальной связи для пользователя."""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.writer() as conn:
             c = await conn.cursor()
             await c.execute("SELECT referrer_id FROM users WHERE user_id = ?", (user_id,))
             referrer_id_row = await c.fetchone()
@@ -2956,7 +3656,7 @@ async def check_referral_integrity(user_id: int) -> bool:
 async def get_registrations_by_date(start_date: str, end_date: str = None) -> List[Tuple]:
     """Получает данные о пользователях, зарегистрированных в указанный день или период."""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
 
@@ -2997,6 +3697,65 @@ async def get_registrations_by_date(start_date: str, end_date: str = None) -> Li
         logger.error(f"Ошибка получения регистраций за {start_date} - {end_date or start_date}: {e}", exc_info=True)
         return []
 
+async def _daily_aggregate(query: str, start_date: str, end_date: str) -> List[Tuple]:
+    """Выполняет агрегирующий по дням запрос за период [start_date, end_date] включительно.
+
+    Границы сравниваются с created_at напрямую, чтобы работал индекс по created_at.
+    """
+    end_exclusive = (datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+    async with db_pool.reader() as conn:
+        c = await conn.cursor()
+        await c.execute(query, (start_date, end_exclusive))
+        return [tuple(row) for row in await c.fetchall()]
+
+async def get_daily_payment_totals(start_date: str, end_date: str) -> List[Tuple[str, float]]:
+    """Сумма платежей по дням: [(YYYY-MM-DD, сумма)]."""
+    try:
+        return await _daily_aggregate(
+            """
+            SELECT DATE(created_at) AS day, SUM(amount)
+            FROM payments
+            WHERE created_at >= ? AND created_at < ?
+            GROUP BY day
+            """,
+            start_date, end_date
+        )
+    except Exception as e:
+        logger.error(f"Ошибка агрегации платежей за {start_date} - {end_date}: {e}", exc_info=True)
+        return []
+
+async def get_daily_registration_counts(start_date: str, end_date: str) -> List[Tuple[str, int]]:
+    """Число регистраций по дням: [(YYYY-MM-DD, количество)]."""
+    try:
+        return await _daily_aggregate(
+            """
+            SELECT DATE(created_at) AS day, COUNT(*)
+            FROM users
+            WHERE created_at >= ? AND created_at < ?
+            GROUP BY day
+            """,
+            start_date, end_date
+        )
+    except Exception as e:
+        logger.error(f"Ошибка агрегации регистраций за {start_date} - {end_date}: {e}", exc_info=True)
+        return []
+
+async def get_daily_generation_units(start_date: str, end_date: str) -> List[Tuple[str, str, int]]:
+    """Число сгенерированных единиц по дням и моделям: [(YYYY-MM-DD, model_id, количество)]."""
+    try:
+        return await _daily_aggregate(
+            """
+            SELECT DATE(created_at) AS day, replicate_model_id, SUM(units_generated)
+            FROM generation_log
+            WHERE created_at >= ? AND created_at < ?
+            GROUP BY day, replicate_model_id
+            """,
+            start_date, end_date
+        )
+    except Exception as e:
+        logger.error(f"Ошибка агрегации генераций за {start_date} - {end_date}: {e}", exc_info=True)
+        return []
+
 async def check_user_resources(bot, user_id: int, required_photos: int = 0, required_avatars: int = 0) -> bool:
     from handlers.utils import safe_escape_markdown as escape_md, send_message_with_fallback
     try:
@@ -3010,9 +3769,9 @@ async def check_user_resources(bot, user_id: int, required_photos: int = 0, requ
             )
             return False
 
-        available_photos = user_data[0]  # generations_left
-        available_avatars = user_data[1]  # avatar_left
-        is_blocked = user_data[9]  # is_blocked
+        available_photos = user_data.generations_left
+        available_avatars = user_data.avatar_left
+        is_blocked = user_data.is_blocked
 
         if is_blocked:
             logger.info(f"Пользователь user_id={user_id} заблокирован, доступ к ресурсам запрещен")
@@ -3054,6 +3813,8 @@ async def convert_amount_to_photos(amount: float, tariff_key: Optional[str] = No
             logger.error("Конфигурация TARIFFS пуста, невозможно определить количество фото")
             return 0
 
+        if not tariff_key or tariff_key not in TARIFFS:
+            tariff_key = tariff_registry.key_for_amount(amount) or tariff_key
         if tariff_key and tariff_key in TARIFFS:
             photos = TARIFFS[tariff_key].get('photos', 0)
             referral_photos = max(int(photos * 0.10), 0)  # 10% от количества фото в тарифе, округление вниз
@@ -3069,7 +3830,7 @@ async def convert_amount_to_photos(amount: float, tariff_key: Optional[str] = No
 async def reset_user_model(user_id: int) -> bool:
     """Сбрасывает все обученные модели пользователя"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.writer() as conn:
             c = await conn.cursor()
 
             await c.execute('''UPDATE users
@@ -3084,8 +3845,7 @@ async def reset_user_model(user_id: int) -> bool:
             await conn.commit()
 
             logger.info(f"Все модели сброшены для user_id={user_id}")
-            if user_cache is not None:
-                await user_cache.delete(user_id)
+            await refresh_user_cache(user_id)
             return True
 
     except Exception as e:
@@ -3095,7 +3855,7 @@ async def reset_user_model(user_id: int) -> bool:
 async def get_broadcasts_with_buttons() -> List[Dict[str, Any]]:
     """Получает список рассылок, у которых есть кнопки в таблице broadcast_buttons."""
     try:
-        async with aiosqlite.connect(DATABASE_PATH, timeout=15) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
             await c.execute('''
@@ -3131,7 +3891,7 @@ async def get_broadcasts_with_buttons() -> List[Dict[str, Any]]:
 async def is_old_user(user_id: int, cutoff_date: str = "2025-07-11") -> bool:
     """Проверяет, является ли пользователь старым (зарегистрирован до указанной даты)"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
             await c.execute(
@@ -3158,11 +3918,11 @@ async def is_old_user(user_id: int, cutoff_date: str = "2025-07-11") -> bool:
         logger.error(f"Ошибка проверки возраста пользователя {user_id}: {e}", exc_info=True)
         return False
 
-@invalidate_cache()
+@write_through_cache()
 async def update_user_utm_source(user_id: int, utm_source: str) -> bool:
     """Обновляет UTM источник для пользователя"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.writer() as conn:
             await conn.execute(
                 "UPDATE users SET utm_source = ?, updated_at = CURRENT_TIMESTAMP WHERE user_id = ?",
                 (utm_source, user_id)
@@ -3177,7 +3937,7 @@ async def update_user_utm_source(user_id: int, utm_source: str) -> bool:
 async def get_user_utm_source(user_id: int) -> Optional[str]:
     """Получает UTM источник пользователя"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
             await c.execute(
@@ -3190,32 +3950,15 @@ async def get_user_utm_source(user_id: int) -> Optional[str]:
         logger.error(f"Ошибка получения UTM источника для user_id={user_id}: {e}", exc_info=True)
         return None
 
-@retry_on_locked(max_attempts=10, initial_delay=0.5)
 async def log_user_action_with_style_ratio(user_id: int, action: str, details: Dict[str, Any] = None,
                                           style: Optional[str] = None, ratio: Optional[str] = None, conn=None):
     """Логирует действие пользователя с дополнительными полями style и ratio"""
     try:
+        params = (user_id, action, json.dumps(details or {}, ensure_ascii=False), style, ratio, _utc_timestamp())
         if conn is None:
-            async with aiosqlite.connect(DATABASE_PATH, timeout=10) as conn:
-                await conn.execute("PRAGMA busy_timeout = 10000")
-                c = await conn.cursor()
-                details_json = json.dumps(details or {}, ensure_ascii=False)
-                await c.execute(
-                    '''INSERT INTO user_actions
-                       (user_id, action, details, style, ratio, created_at)
-                       VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)''',
-                    (user_id, action, details_json, style, ratio)
-                )
-                await conn.commit()
+            analytics_buffer.record(_INSERT_USER_ACTION_SQL, params)
         else:
-            c = await conn.cursor()
-            details_json = json.dumps(details or {}, ensure_ascii=False)
-            await c.execute(
-                '''INSERT INTO user_actions
-                   (user_id, action, details, style, ratio, created_at)
-                   VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)''',
-                (user_id, action, details_json, style, ratio)
-            )
+            await conn.execute(_INSERT_USER_ACTION_SQL, params)
         logger.debug(f"Действие пользователя с style/ratio записано: user_id={user_id}, action={action}, style={style}, ratio={ratio} ✅")
     except aiosqlite.OperationalError as e:
         logger.error(f"Ошибка логирования действия с style/ratio user_id={user_id}: {e} 🚫")
@@ -3232,7 +3975,7 @@ async def get_user_actions_with_style_ratio(user_id: Optional[int] = None,
                                            end_date: Optional[datetime] = None) -> List[Dict[str, Any]]:
     """Получает статистику действий пользователей с фильтрацией по style и ratio"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
 
@@ -3298,7 +4041,7 @@ async def get_user_actions_with_style_ratio(user_id: Optional[int] = None,
 async def get_users_by_utm_source(utm_source: str) -> List[Dict[str, Any]]:
     """Получает всех пользователей с указанным UTM источником"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
             await c.execute(
@@ -3317,7 +4060,7 @@ async def get_users_by_utm_source(utm_source: str) -> List[Dict[str, Any]]:
 async def get_utm_source_statistics() -> Dict[str, int]:
     """Получает статистику по UTM источникам"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
             await c.execute(
@@ -3337,7 +4080,7 @@ async def get_style_ratio_statistics(start_date: Optional[datetime] = None,
                                    end_date: Optional[datetime] = None) -> Dict[str, Dict[str, int]]:
     """Получает статистику использования стилей и соотношений сторон"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
 
@@ -3381,7 +4124,7 @@ async def get_style_ratio_statistics(start_date: Optional[datetime] = None,
 async def get_total_users_count() -> int:
     """Получает общее количество пользователей в базе данных"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             c = await conn.cursor()
             await c.execute("SELECT COUNT(*) FROM users")
             result = await c.fetchone()
@@ -0,0 +1,392 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import aiosqlite
+
+from config import DATABASE_PATH, DB_POOL_READERS, DB_POOL_ACQUIRE_TIMEOUT, DB_WRITE_BATCH_SIZE
+from logger import get_logger
+
+logger = get_logger('database')
+
+# Соединения, уже выданные текущей задаче: повторный вход в reader()/writer()
+# внутри той же задачи возвращает то же соединение и не блокирует пул.
+# Дочерние задачи (create_task, gather) наследуют контекст, но не соединение:
+# пока родитель держит writer(), дочерняя задача не может ни получить writer(),
+# ни вызвать submit_write() — это взаимоблокировка до acquire_timeout, поэтому
+# такой вызов сразу падает с RuntimeError. Передавайте conn в дочерний код явно.
+_held_connections: ContextVar[Optional[Dict[str, Tuple[asyncio.Task, aiosqlite.Connection]]]] = ContextVar(
+    'db_pool_held_connections', default=None
+)
+
+WriteJob = Callable[[aiosqlite.Connection], Awaitable[Any]]
+
+
+def _is_locked_error(error: BaseException) -> bool:
+    return isinstance(error, aiosqlite.OperationalError) and (
+        'locked' in str(error).lower() or 'busy' in str(error).lower()
+    )
+
+
+class SQLitePool:
+    """Пул соединений aiosqlite: фиксированный набор читателей в режиме WAL и один сериализованный писатель."""
+
+    def __init__(self, db_path: str, readers: int = 4, acquire_timeout: float = 30.0, write_batch_size: int = 100,
+                 write_lock_retries: int = 3):
+        self.db_path = db_path
+        self.size = max(1, readers)
+        self.acquire_timeout = acquire_timeout
+        self.write_batch_size = max(1, write_batch_size)
+        self.write_lock_retries = max(1, write_lock_retries)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._idle: Optional[asyncio.Queue] = None
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._writer_lock: Optional[asyncio.Lock] = None
+        self._writer_owner: Optional[asyncio.Task] = None
+        self._write_queue: Optional[asyncio.Queue] = None
+        self._write_task: Optional[asyncio.Task] = None
+        self._opened_readers = 0
+        self._readers_in_use = 0
+        self._reader_waiters = 0
+        self._writer_waiters = 0
+        self._stats = {
+            'reader_acquired': 0,
+            'writer_acquired': 0,
+            'reader_wait_total': 0.0,
+            'writer_wait_total': 0.0,
+            'reader_wait_max': 0.0,
+            'writer_wait_max': 0.0,
+            'acquire_timeouts': 0,
+            'connections_opened': 0,
+            'connections_discarded': 0,
+            'write_jobs': 0,
+            'write_jobs_failed': 0,
+            'write_batches': 0,
+            'write_batch_max': 0,
+            'write_lock_retries': 0,
+        }
+
+    def _bind_loop(self) -> None:
+        """Создаёт примитивы синхронизации для текущего event loop."""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        if self._loop is not None:
+            logger.warning("Пул соединений SQLite переинициализирован для нового event loop")
+        self._loop = loop
+        self._idle = asyncio.Queue()
+        self._writer = None
+        self._writer_lock = asyncio.Lock()
+        self._writer_owner = None
+        self._write_queue = asyncio.Queue()
+        self._write_task = None
+        self._opened_readers = 0
+        self._readers_in_use = 0
+        self._reader_waiters = 0
+        self._writer_waiters = 0
+
+    async def _open(self) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.db_path, timeout=30)
+        await conn.execute("PRAGMA journal_mode = WAL")
+        await conn.execute("PRAGMA busy_timeout = 30000")
+        await conn.execute("PRAGMA synchronous = NORMAL")
+        self._stats['connections_opened'] += 1
+        return conn
+
+    def _record_wait(self, kind: str, started: float) -> None:
+        waited = time.monotonic() - started
+        self._stats[f'{kind}_acquired'] += 1
+        self._stats[f'{kind}_wait_total'] += waited
+        if waited > self._stats[f'{kind}_wait_max']:
+            self._stats[f'{kind}_wait_max'] = waited
+        if waited > 1.0:
+            logger.warning(f"Ожидание {kind}-соединения SQLite заняло {waited:.2f}с")
+
+    async def _acquire_reader(self) -> aiosqlite.Connection:
+        started = time.monotonic()
+        try:
+            conn = self._idle.get_nowait()
+        except asyncio.QueueEmpty:
+            if self._opened_readers < self.size:
+                self._opened_readers += 1
+                try:
+                    conn = await self._open()
+                except Exception:
+                    self._opened_readers -= 1
+                    raise
+            else:
+                self._reader_waiters += 1
+                try:
+                    conn = await asyncio.wait_for(self._idle.get(), timeout=self.acquire_timeout)
+                except asyncio.TimeoutError:
+                    self._stats['acquire_timeouts'] += 1
+                    raise aiosqlite.OperationalError(
+                        f"Не удалось получить соединение чтения за {self.acquire_timeout}с"
+                    )
+                finally:
+                    self._reader_waiters -= 1
+        self._readers_in_use += 1
+        self._record_wait('reader', started)
+        return conn
+
+    async def _release_reader(self, conn: aiosqlite.Connection) -> None:
+        self._readers_in_use -= 1
+        try:
+            conn.row_factory = None
+            if conn.in_transaction:
+                await conn.rollback()
+        except Exception as e:
+            logger.warning(f"Соединение чтения SQLite отброшено: {e}")
+            self._opened_readers -= 1
+            self._stats['connections_discarded'] += 1
+            try:
+                await conn.close()
+            except Exception:
+                pass
+            return
+        self._idle.put_nowait(conn)
+
+    async def _acquire_writer(self) -> aiosqlite.Connection:
+        started = time.monotonic()
+        self._writer_waiters += 1
+        try:
+            await asyncio.wait_for(self._writer_lock.acquire(), timeout=self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self._stats['acquire_timeouts'] += 1
+            raise aiosqlite.OperationalError(
+                f"Не удалось получить соединение записи за {self.acquire_timeout}с"
+            )
+        finally:
+            self._writer_waiters -= 1
+        try:
+            if self._writer is None:
+                self._writer = await self._open()
+        except Exception:
+            self._writer_lock.release()
+            raise
+        self._writer_owner = asyncio.current_task()
+        self._record_wait('writer', started)
+        return self._writer
+
+    async def _release_writer(self, conn: aiosqlite.Connection) -> None:
+        try:
+            conn.row_factory = None
+            if conn.in_transaction:
+                logger.debug("Незавершённая транзакция на соединении записи SQLite, выполняется rollback")
+                await conn.rollback()
+        except Exception as e:
+            logger.warning(f"Соединение записи SQLite отброшено: {e}")
+            self._writer = None
+            self._stats['connections_discarded'] += 1
+            try:
+                await conn.close()
+            except Exception:
+                pass
+        finally:
+            self._writer_owner = None
+            self._writer_lock.release()
+
+    @asynccontextmanager
+    async def _lease(self, kind: str) -> AsyncIterator[aiosqlite.Connection]:
+        self._bind_loop()
+        task = asyncio.current_task()
+        held = _held_connections.get()
+        if held and kind in held and held[kind][0] is task:
+            conn = held[kind][1]
+            row_factory = conn.row_factory
+            try:
+                yield conn
+            finally:
+                conn.row_factory = row_factory
+            return
+
+        if kind == 'writer':
+            self._check_inherited_writer(held, task)
+            conn = await self._acquire_writer()
+        else:
+            conn = await self._acquire_reader()
+        token = _held_connections.set({**(held or {}), kind: (task, conn)})
+        try:
+            yield conn
+        finally:
+            _held_connections.reset(token)
+            if kind == 'writer':
+                await self._release_writer(conn)
+            else:
+                await self._release_reader(conn)
+
+    def _check_inherited_writer(self, held, task) -> None:
+        """Запрещает запись из дочерней задачи, пока родитель держит writer()."""
+        if held and 'writer' in held:
+            owner = held['writer'][0]
+            if owner is not task and owner is self._writer_owner:
+                raise RuntimeError(
+                    "Соединение записи удерживается родительской задачей; "
+                    "дочерняя задача не может получить writer() или вызвать submit_write(), передайте conn явно"
+                )
+
+    def reader(self):
+        """Соединение для чтения из пула (async context manager)."""
+        return self._lease('reader')
+
+    def writer(self):
+        """Единственное соединение для записи; доступ сериализован (async context manager)."""
+        return self._lease('writer')
+
+    def holds_writer(self) -> bool:
+        """Проверяет, удерживает ли текущая задача соединение записи."""
+        held = _held_connections.get()
+        return bool(held and 'writer' in held and held['writer'][0] is asyncio.current_task())
+
+    async def submit_write(self, job: WriteJob) -> Any:
+        """Ставит задание записи в очередь писателя и ждёт его результата.
+
+        Задание получает соединение записи и не должно вызывать commit: писатель
+        объединяет накопившиеся задания в одну транзакцию.
+        """
+        self._bind_loop()
+        if self.holds_writer():
+            # Вызов изнутри writer(): выполняем в транзакции вызывающего кода
+            async with self.writer() as conn:
+                return await job(conn)
+        self._check_inherited_writer(_held_connections.get(), asyncio.current_task())
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.create_task(self._write_worker())
+        future = self._loop.create_future()
+        self._write_queue.put_nowait((job, future))
+        return await future
+
+    async def _write_worker(self) -> None:
+        """Задача-писатель: забирает задания из очереди и выполняет их пачками."""
+        # Контекст унаследован от задачи, вызвавшей submit_write(): чужие соединения не нужны
+        _held_connections.set(None)
+        stopping = False
+        while not stopping:
+            item = await self._write_queue.get()
+            if item is None:
+                return
+            batch = [item]
+            while len(batch) < self.write_batch_size:
+                try:
+                    item = self._write_queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._run_write_batch(batch)
+
+    async def _run_write_batch(self, batch: List[Tuple[WriteJob, asyncio.Future]]) -> None:
+        """Выполняет пачку заданий в одной транзакции; каждое задание изолировано SAVEPOINT.
+
+        Если базу держит другой процесс дольше busy_timeout, вся пачка
+        откатывается и повторяется с паузой (до write_lock_retries раз).
+        """
+        for attempt in range(1, self.write_lock_retries + 1):
+            try:
+                results = await self._execute_write_batch(batch)
+            except Exception as e:
+                if _is_locked_error(e) and attempt < self.write_lock_retries:
+                    delay = 0.5 * 2 ** (attempt - 1)
+                    self._stats['write_lock_retries'] += 1
+                    logger.warning(f"База заблокирована при пакетной записи (попытка {attempt}/{self.write_lock_retries}), повтор через {delay}с")
+                    await asyncio.sleep(delay)
+                    continue
+                logger.error(f"Ошибка пакетной записи ({len(batch)} заданий): {e}", exc_info=True)
+                failed = 0
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                        failed += 1
+                self._stats['write_jobs_failed'] += failed
+                return
+
+            for future, result in results:
+                if not future.done():
+                    future.set_result(result)
+            self._stats['write_jobs'] += len(batch)
+            self._stats['write_batches'] += 1
+            if len(batch) > self._stats['write_batch_max']:
+                self._stats['write_batch_max'] = len(batch)
+            return
+
+    async def _execute_write_batch(self, batch: List[Tuple[WriteJob, asyncio.Future]]) -> List[Tuple[asyncio.Future, Any]]:
+        results: List[Tuple[asyncio.Future, Any]] = []
+        async with self.writer() as conn:
+            # IMMEDIATE: блокировка записи берётся сразу, конфликт с другим процессом виден до выполнения заданий
+            await conn.execute("BEGIN IMMEDIATE")
+            for job, future in batch:
+                if future.done():
+                    continue
+                await conn.execute("SAVEPOINT write_job")
+                try:
+                    result = await job(conn)
+                except Exception as e:
+                    if _is_locked_error(e):
+                        raise  # Откатываем и повторяем всю пачку
+                    await conn.execute("ROLLBACK TO write_job")
+                    await conn.execute("RELEASE write_job")
+                    self._stats['write_jobs_failed'] += 1
+                    future.set_exception(e)
+                    continue
+                await conn.execute("RELEASE write_job")
+                results.append((future, result))
+            await conn.commit()
+        return results
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Возвращает метрики пула: размер, занятость, очереди и время ожидания."""
+        stats = dict(self._stats)
+        stats.update({
+            'readers_size': self.size,
+            'readers_opened': self._opened_readers,
+            'readers_in_use': self._readers_in_use,
+            'readers_idle': self._idle.qsize() if self._idle is not None else 0,
+            'reader_waiters': self._reader_waiters,
+            'writer_busy': bool(self._writer_lock and self._writer_lock.locked()),
+            'writer_waiters': self._writer_waiters,
+            'write_queue_size': self._write_queue.qsize() if self._write_queue is not None else 0,
+            'reader_wait_avg': stats['reader_wait_total'] / stats['reader_acquired'] if stats['reader_acquired'] else 0.0,
+            'writer_wait_avg': stats['writer_wait_total'] / stats['writer_acquired'] if stats['writer_acquired'] else 0.0,
+        })
+        return stats
+
+    async def close(self) -> None:
+        """Закрывает все соединения пула."""
+        if self._write_task is not None and not self._write_task.done():
+            # Дожидаемся выполнения уже поставленных заданий записи
+            self._write_queue.put_nowait(None)
+            await self._write_task
+        self._write_task = None
+        if self._idle is not None:
+            while not self._idle.empty():
+                conn = self._idle.get_nowait()
+                try:
+                    await conn.close()
+                except Exception as e:
+                    logger.warning(f"Ошибка закрытия соединения чтения SQLite: {e}")
+        if self._writer is not None:
+            try:
+                await self._writer.close()
+            except Exception as e:
+                logger.warning(f"Ошибка закрытия соединения записи SQLite: {e}")
+        self._writer = None
+        self._opened_readers = 0
+        self._loop = None
+        logger.info("Пул соединений SQLite закрыт")
+
+
+db_pool = SQLitePool(
+    DATABASE_PATH,
+    readers=DB_POOL_READERS,
+    acquire_timeout=DB_POOL_ACQUIRE_TIMEOUT,
+    write_batch_size=DB_WRITE_BATCH_SIZE,
+)
+
+
+def get_pool_stats() -> Dict[str, Any]:
+    """Метрики общего пула соединений."""
+    return db_pool.get_stats()
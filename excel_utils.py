@@ -1,33 +1,94 @@
 # excel_utils.py
 """Модуль для создания Excel-файлов с данными о платежах и регистрациях."""
 
-import pandas as pd
-from datetime import datetime
 import os
-import logging
-from typing import List, Tuple, Optional
+from itertools import islice
+from typing import Any, Callable, Iterable, List, Optional, Sequence, Tuple
 
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+from openpyxl.utils import get_column_letter
+
+from config import REPORT_WIDTH_SAMPLE_ROWS
 from logger import get_logger
+from tariffs import tariff_registry
 logger = get_logger('main')
 
+MAX_COLUMN_WIDTH = 50
+
+
+def sample_column_widths(headers: Sequence[str], rows: Iterable[Sequence[Any]], max_width: int = MAX_COLUMN_WIDTH) -> List[int]:
+    """Ширина колонок по заголовкам и выборке строк (а не по всем ячейкам листа)."""
+    widths = [len(str(header)) for header in headers]
+    for row in rows:
+        for idx, value in enumerate(row):
+            if value is not None:
+                widths[idx] = max(widths[idx], len(str(value)))
+    return [min(width + 2, max_width) for width in widths]
+
+
+def write_sheet(ws, headers: Sequence[str], rows: Iterable[Sequence[Any]], title: Optional[str] = None,
+                sample_size: int = REPORT_WIDTH_SAMPLE_ROWS,
+                on_rows: Optional[Callable[[int], None]] = None, chunk_size: int = 1000) -> int:
+    """Потоково пишет строки в лист write-only книги; возвращает число строк.
+
+    Ширина колонок считается по первым sample_size строкам: в write-only режиме
+    её нужно задать до первой записи, остальные строки сразу уходят на диск.
+    on_rows вызывается с числом записанных строк каждые chunk_size строк.
+    """
+    rows = iter(rows)
+    sample = list(islice(rows, sample_size))
+    for idx, width in enumerate(sample_column_widths(headers, sample), 1):
+        ws.column_dimensions[get_column_letter(idx)].width = width
+
+    if title:
+        title_cell = WriteOnlyCell(ws, value=title)
+        title_cell.font = Font(bold=True, size=14)
+        ws.append([title_cell])
+        ws.append([])
+    ws.append(list(headers))
+
+    written = 0
+    for row in sample:
+        ws.append(list(row))
+        written += 1
+    if on_rows is not None and written:
+        on_rows(written)
+    for row in rows:
+        ws.append(list(row))
+        written += 1
+        if on_rows is not None and written % chunk_size == 0:
+            on_rows(written)
+    if on_rows is not None and written % chunk_size:
+        on_rows(written)
+    return written
+
+
+def _save_single_sheet(file_path: str, sheet_name: str, title: str, headers: Sequence[str], rows: Iterable[Sequence[Any]]) -> int:
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(sheet_name)
+    count = write_sheet(ws, headers, rows, title=title)
+    wb.save(file_path)
+    return count
+
+
 def create_payments_excel(payments: List[Tuple], filename: str, start_date: str = None, end_date: str = None) -> Optional[str]:
     """Создает Excel-файл с данными о платежах."""
     try:
         columns = ['User ID', 'План', 'Сумма (RUB)', 'ID платежа', 'Дата платежа', 'Username', 'Имя']
-        data = []
-        for payment in payments:
-            user_id, plan, amount, payment_id, payment_date, username, first_name = payment
-            data.append({
-                'User ID': user_id,
-                'План': plan.capitalize() if plan else 'N/A',
-                'Сумма (RUB)': f"{amount:.2f}" if amount else '0.00',
-                'ID платежа': payment_id or 'N/A',
-                'Дата платежа': payment_date.strftime('%Y-%m-%d %H:%M:%S') if payment_date else 'N/A',
-                'Username': f"@{username}" if username and username != 'Без имени' else 'N/A',
-                'Имя': first_name or 'N/A'
-            })
-
-        df = pd.DataFrame(data, columns=columns)
+        rows = (
+            (
+                user_id,
+                tariff_registry.display_name(plan, amount),
+                f"{amount:.2f}" if amount else '0.00',
+                payment_id or 'N/A',
+                payment_date.strftime('%Y-%m-%d %H:%M:%S') if payment_date else 'N/A',
+                f"@{username}" if username and username != 'Без имени' else 'N/A',
+                first_name or 'N/A'
+            )
+            for user_id, plan, amount, payment_id, payment_date, username, first_name in payments
+        )
 
         title = 'Статистика платежей'
         if start_date and end_date:
@@ -37,15 +98,7 @@ def create_payments_excel(payments: List[Tuple], filename: str, start_date: str
 
         os.makedirs('temp', exist_ok=True)
         file_path = os.path.join('temp', filename)
-
-        with pd.ExcelWriter(file_path, engine='xlsxwriter') as writer:
-            df.to_excel(writer, sheet_name='Payments', index=False, startrow=2)
-            worksheet = writer.sheets['Payments']
-            worksheet.write(0, 0, title, writer.book.add_format({'bold': True, 'font_size': 14}))
-
-            for idx, col in enumerate(df.columns):
-                max_len = max(df[col].astype(str).map(len).max(), len(col)) + 2
-                worksheet.set_column(idx, idx, max_len)
+        _save_single_sheet(file_path, 'Payments', title, columns, rows)
 
         logger.info(f"Excel-файл успешно создан: {file_path}")
         return file_path
@@ -58,32 +111,22 @@ def create_registrations_excel(registrations: List[Tuple], filename: str, date:
     """Создает Excel-файл с данными о новых регистрациях."""
     try:
         columns = ['User ID', 'Username', 'Имя', 'Дата регистрации', 'Реферер ID']
-        data = []
-        for registration in registrations:
-            user_id, username, first_name, created_at, referrer_id = registration
-            data.append({
-                'User ID': user_id,
-                'Username': f"@{username}" if username and username != 'Без имени' else 'N/A',
-                'Имя': first_name or 'N/A',
-                'Дата регистрации': created_at.strftime('%Y-%m-%d %H:%M:%S') if created_at else 'N/A',
-                'Реферер ID': referrer_id if referrer_id else 'N/A'
-            })
-
-        df = pd.DataFrame(data, columns=columns)
+        rows = (
+            (
+                user_id,
+                f"@{username}" if username and username != 'Без имени' else 'N/A',
+                first_name or 'N/A',
+                created_at.strftime('%Y-%m-%d %H:%M:%S') if created_at else 'N/A',
+                referrer_id if referrer_id else 'N/A'
+            )
+            for user_id, username, first_name, created_at, referrer_id in registrations
+        )
 
         title = f'Новые регистрации за {date}'
 
         os.makedirs('temp', exist_ok=True)
         file_path = os.path.join('temp', filename)
-
-        with pd.ExcelWriter(file_path, engine='xlsxwriter') as writer:
-            df.to_excel(writer, sheet_name='Registrations', index=False, startrow=2)
-            worksheet = writer.sheets['Registrations']
-            worksheet.write(0, 0, title, writer.book.add_format({'bold': True, 'font_size': 14}))
-
-            for idx, col in enumerate(df.columns):
-                max_len = max(df[col].astype(str).map(len).max(), len(col)) + 2
-                worksheet.set_column(idx, idx, max_len)
+        _save_single_sheet(file_path, 'Registrations', title, columns, rows)
 
         logger.info(f"Excel-файл регистраций успешно создан: {file_path}")
         return file_path
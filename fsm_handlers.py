@@ -26,11 +26,13 @@ from handlers.user.callbacks import (
     handle_confirm_assisted_prompt_callback, handle_rating_callback, handle_confirm_video_generation_callback, handle_custom_prompt_llama_callback
 )
 from generation.videos import handle_video_prompt, handle_video_photo, handle_skip_photo, handle_confirm_video_prompt, handle_edit_video_prompt, handle_edit_video_photo
-from config import ADMIN_IDS, DATABASE_PATH
+from config import ADMIN_IDS
 from keyboards import create_main_menu_keyboard
 # УДАЛЕНО: from bot_counter import cmd_bot_name
 from handlers.admin.broadcast import clear_user_data
 import aiosqlite
+from db_pool import db_pool
+from database import refresh_user_cache
 from states import BotStates, VideoStates
 from generation.training import TrainingStates, handle_confirmation
 
@@ -54,7 +56,7 @@ async def debug_payment(message: Message, state: FSMContext) -> None:
     target_user_id = int(args[0]) if args and args[0].isdigit() else user_id
 
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
 
@@ -137,7 +139,7 @@ async def fix_first_purchase(message: Message, state: FSMContext) -> None:
     target_user_id = int(args[0])
 
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.writer() as conn:
             c = await conn.cursor()
             await c.execute("SELECT first_purchase FROM users WHERE user_id = ?", (target_user_id,))
             current_state = await c.fetchone()
@@ -163,6 +165,7 @@ async def fix_first_purchase(message: Message, state: FSMContext) -> None:
             else:
                 await c.execute("UPDATE users SET first_purchase = ? WHERE user_id = ?", (correct_value, target_user_id))
                 await conn.commit()
+                await refresh_user_cache(target_user_id)
                 await message.answer(
                     f"✅ Исправлено для user_id={target_user_id}\n"
                     f"• Платежей: {payment_count}\n"
@@ -184,7 +187,7 @@ async def fix_all_first_purchase(message: Message, state: FSMContext) -> None:
         return
 
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.writer() as conn:
             c = await conn.cursor()
             await c.execute("""
                 SELECT DISTINCT u.user_id, u.first_purchase, COUNT(p.payment_id) as payment_count
@@ -207,6 +210,8 @@ async def fix_all_first_purchase(message: Message, state: FSMContext) -> None:
                 fixed_count += 1
 
             await conn.commit()
+            for uid, _, _ in users_to_fix:
+                await refresh_user_cache(uid)
 
             await message.answer(
                 f"✅ Исправлено {fixed_count} пользователей:\n"
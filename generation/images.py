@@ -9,25 +9,23 @@ import logging
 import time
 import asyncio
 import random
-from typing import Optional, List, Dict, Tuple
+from types import MappingProxyType
+from typing import Any, Mapping, NamedTuple, Optional, List, Dict, Tuple, Union
 from aiogram import Bot
-from aiogram.types import Message, InputMediaPhoto, InlineKeyboardButton, InlineKeyboardMarkup, FSInputFile
+from aiogram.types import Message, InlineKeyboardButton, InlineKeyboardMarkup, FSInputFile, BufferedInputFile, InputFile
 from aiogram.fsm.context import FSMContext
 from aiogram.enums import ParseMode
 from aiogram.exceptions import TelegramBadRequest
 import tenacity
-import replicate
+from replicate_client import replicate_client
 from replicate.exceptions import ReplicateError
 from deep_translator import GoogleTranslator
 from copy import deepcopy
 
-from redis_caсhe import RedisActiveModelCache, RedisGenParamsCache, RedisUserCooldown
-from config import REDIS
+from redis_caсhe import RedisUserCooldown
+from database import redis_client, active_model_cache as redis_active_model_cache
 
-redis = REDIS
-redis_user_cooldown = RedisUserCooldown(redis, cooldown_seconds=3)
-redis_active_model_cache = RedisActiveModelCache(redis)
-redis_gen_params_cache = RedisGenParamsCache(redis)
+redis_user_cooldown = RedisUserCooldown(redis_client, cooldown_seconds=3)
 
 
 from generation_config import (
@@ -36,17 +34,21 @@ from generation_config import (
     LORA_STYLE_PRESETS, MAX_LORA_COUNT, USER_AVATAR_LORA_STRENGTH,
     CAMERA_SETUP_BASE, LUXURY_DETAILS_BASE, get_real_lora_model
 )
-from config import MAX_FILE_SIZE_BYTES, REPLICATE_API_TOKEN, REPLICATE_USERNAME_OR_ORG_NAME, ADMIN_IDS
+from config import MAX_FILE_SIZE_BYTES, REPLICATE_USERNAME_OR_ORG_NAME, ADMIN_IDS, GENERATION_BUFFER_MAX_MB, GENERATION_SEND_BY_URL
 from database import (
-    check_database_user, update_user_credits, get_active_trainedmodel, log_generation, check_user_resources
+    get_active_trainedmodel, log_generation, check_user_resources,
+    debit_user_resources, credit_user_resources, debit_generation_job, refund_generation_job
 )
 from keyboards import (
     create_main_menu_keyboard, create_rating_keyboard,
     create_subscription_keyboard, create_user_profile_keyboard, create_photo_generate_menu_keyboard
 )
+from generation.job_queue import generation_jobs
+from generation.results import new_generation_id, file_ids_from_messages, save_result, build_media_group
 from generation.utils import (
     TempFileManager, reset_generation_context,
-    send_message_with_fallback, send_photo_with_retry, send_media_group_with_retry
+    send_message_with_fallback, send_photo_with_retry, send_media_group_with_retry,
+    send_photo_strict, send_media_group_strict
 )
 from llama_helper import generate_assisted_prompt
 from handlers.utils import clean_admin_context, safe_escape_markdown as escape_md
@@ -70,10 +72,6 @@ file_operation_semaphore = asyncio.Semaphore(150)
 cache_lock = asyncio.Lock()
 user_generation_lock = {}
 
-# Очередь генераций
-generation_queue = asyncio.Queue(maxsize=800)
-queue_processor_running = False
-
 # СУПЕР КОНФИГУРАЦИЯ (ИЗ 22 ПРОФ МОДЕЛЕЙ)
 BASIC_LORA_CONFIG = {
     "base_realism": {
@@ -276,137 +274,188 @@ async def process_prompt_async(original_prompt: str, model_key: str, generation_
 
     return full_prompt
 
-async def prepare_model_params(use_new_flux: bool, model_key: str, generation_type: str,
-                             prompt: str, num_outputs: int, aspect_ratio: str,
-                             width: int, height: int, user_data: Dict) -> Optional[dict]:
-    """Подготавливает параметры модели."""
-    logger.info(f"Подготовка параметров модели (22 модели основных)")
+PARAM_TEMPLATES_CHECK_INTERVAL = 60
+PORTRAIT_PRESET_WORDS = ("face", "portrait", "person", "лицо", "портрет")
+FASHION_PRESET_WORDS = ("fashion", "style", "dress", "outfit", "мода")
 
-    reference_image_url = user_data.get('reference_image_url')
 
-    if use_new_flux:
-        params = {
-            "prompt": prompt,
-            "model": "dev",
-            "go_fast": True,
-            "lora_scale": 0.98,
-            "megapixels": "1",
-            "num_outputs": num_outputs,
-            "aspect_ratio": aspect_ratio,
-            "output_format": "png",
-            "guidance_scale": 4.5,
-            "output_quality": 100,
-            "prompt_strength": 0.91,
-            "num_inference_steps": 38
-        }
-        if generation_type == 'photo_to_photo' and reference_image_url:
-            params["image"] = reference_image_url
-            params["prompt_strength"] = 0.75
-    else:
-        # Параметры для LoRA
+class _ParamTemplate(NamedTuple):
+    """Неизменяемая часть входных параметров Replicate для пресета."""
+    params: Mapping[str, Any]
+    prompt_additions: Optional[str]
+    loras: Tuple[Tuple[str, str, float], ...]
+
+
+class _ParamTemplates:
+    """Шаблоны параметров по (семейство модели, пресет, соотношение сторон, размер).
+
+    Собираются при старте; при запросе в копию шаблона добавляются только
+    пользовательские поля. Если конфигурация пресетов или LoRA меняется,
+    таблица пересобирается (проверка не чаще раза в минуту).
+    """
+
+    def __init__(self, check_interval: float):
+        self.check_interval = check_interval
+        self._templates: Dict[tuple, _ParamTemplate] = {}
+        self._fingerprint: Optional[int] = None
+        self._checked_at = 0.0
+        self.stats = {'hits': 0, 'builds': 0, 'refreshes': 0}
+
+    @staticmethod
+    def _config_fingerprint() -> int:
+        return hash(repr((BASIC_PRESETS, BASIC_NEGATIVE_PROMPT, LORA_CONFIG, MAX_LORA_COUNT, ASPECT_RATIOS)))
+
+    def _check_config(self) -> None:
+        now = time.monotonic()
+        if self._fingerprint is not None and now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        fingerprint = self._config_fingerprint()
+        if fingerprint != self._fingerprint:
+            if self._fingerprint is not None:
+                self.stats['refreshes'] += 1
+                logger.info("Конфигурация пресетов изменилась, шаблоны параметров пересобираются")
+            self._templates.clear()
+            self._fingerprint = fingerprint
+
+    def warm(self) -> None:
+        """Собирает шаблоны для всех пресетов и соотношений сторон."""
+        self._check_config()
+        for aspect_ratio, (width, height) in ASPECT_RATIOS.items():
+            self.get(True, None, aspect_ratio, width, height, False)
+            for preset_name in BASIC_PRESETS:
+                for custom_prompt in (False, True):
+                    self.get(False, preset_name, aspect_ratio, width, height, custom_prompt)
+        logger.info(f"Шаблоны параметров генерации подготовлены: {len(self._templates)}")
+
+    def get(self, use_new_flux: bool, preset_name: Optional[str], aspect_ratio: str,
+            width: int, height: int, custom_prompt: bool) -> _ParamTemplate:
+        self._check_config()
+        key = (use_new_flux, preset_name, aspect_ratio, width, height, custom_prompt)
+        template = self._templates.get(key)
+        if template is None:
+            template = self._build(*key)
+            self._templates[key] = template
+            self.stats['builds'] += 1
+        else:
+            self.stats['hits'] += 1
+        return template
+
+    @staticmethod
+    def _build(use_new_flux: bool, preset_name: Optional[str], aspect_ratio: str,
+               width: int, height: int, custom_prompt: bool) -> _ParamTemplate:
+        if use_new_flux:
+            params = {
+                "model": "dev",
+                "go_fast": True,
+                "lora_scale": 0.98,
+                "megapixels": "1",
+                "aspect_ratio": aspect_ratio,
+                "output_format": "png",
+                "guidance_scale": 4.5,
+                "output_quality": 100,
+                "prompt_strength": 0.91,
+                "num_inference_steps": 38
+            }
+            return _ParamTemplate(MappingProxyType(params), None, ())
+
+        preset = BASIC_PRESETS.get(preset_name, BASIC_PRESETS["default"])
         params = {
-            "prompt": prompt,
-            "num_outputs": num_outputs,
             "aspect_ratio": aspect_ratio,
             "lora_scale": 0.98,
             "output_format": "png",
-            "guidance_scale": 4.5,
+            "guidance_scale": preset["guidance_scale"],
             "width": width,
             "height": height,
             "scheduler": "DDIM",
             "prompt_strength": 0.85,
             "output_quality": 100,
-            "num_inference_steps": 40
+            "num_inference_steps": preset["num_inference_steps"],
+            "negative_prompt": BASIC_NEGATIVE_PROMPT,
         }
-
-        # Выбираем базовый пресет
-        prompt_lower = prompt.lower()
-        if any(word in prompt_lower for word in ["face", "portrait", "person", "лицо", "портрет"]):
-            selected_preset = "portrait"
-        elif any(word in prompt_lower for word in ["fashion", "style", "dress", "outfit", "мода"]):
-            selected_preset = "fashion"
-        else:
-            selected_preset = "default"
-
-        preset = BASIC_PRESETS.get(selected_preset, BASIC_PRESETS["default"])
-        params["guidance_scale"] = preset["guidance_scale"]
-        params["num_inference_steps"] = preset["num_inference_steps"]
-
-        # Добавляем дополнения
-        if not user_data.get('came_from_custom_prompt'):
-            params["prompt"] = f"{prompt}, {preset['prompt_additions']}"
-
-        # Добавляем модели
-        lora_index = 3
-
-        # Добавляем аватар пользователя если нужно
-        if generation_type in ['with_avatar', 'photo_to_photo']:
-            trigger_word = user_data.get('trigger_word')
-            old_model_id = user_data.get('old_model_id')
-            old_model_version = user_data.get('old_model_version')
-            if trigger_word and old_model_version:
-                if old_model_id:
-                    if '/' not in old_model_id:
-                        avatar_lora = f"{REPLICATE_USERNAME_OR_ORG_NAME}/{old_model_id}:{old_model_version}"
-                    else:
-                        avatar_lora = f"{old_model_id}:{old_model_version}"
-                    params[f"hf_lora_{lora_index}"] = avatar_lora
-                    params[f"lora_scale_{lora_index}"] = USER_AVATAR_LORA_STRENGTH
-                    lora_index += 1
-                    logger.info(f"Добавлен пользовательский аватар (LoRA #{lora_index-1})")
-
-        # Добавляем базовые LoRA
-        if not user_data.get('came_from_custom_prompt'):
+        loras = []
+        if not custom_prompt:
             for lora_name in preset.get("loras", []):
-                if lora_index <= MAX_LORA_COUNT:
-                    # Получаем реальную модель из 5 базовых
-                    lora_cfg = get_real_lora_model(lora_name)
-                    if lora_cfg and "model" in lora_cfg:
-                        params[f"hf_lora_{lora_index}"] = lora_cfg["model"]
-                        params[f"lora_scale_{lora_index}"] = lora_cfg["strength"]
-                        logger.info(f"Добавлена модель {lora_name} (LoRA #{lora_index})")
-                        lora_index += 1
+                # Получаем реальную модель из 5 базовых
+                lora_cfg = get_real_lora_model(lora_name)
+                if lora_cfg and "model" in lora_cfg:
+                    loras.append((lora_name, lora_cfg["model"], lora_cfg["strength"]))
+        return _ParamTemplate(
+            MappingProxyType(params),
+            None if custom_prompt else preset['prompt_additions'],
+            tuple(loras)
+        )
+
+
+param_templates = _ParamTemplates(PARAM_TEMPLATES_CHECK_INTERVAL)
 
-        params["negative_prompt"] = BASIC_NEGATIVE_PROMPT
 
+def _select_preset(prompt: str) -> str:
+    prompt_lower = prompt.lower()
+    if any(word in prompt_lower for word in PORTRAIT_PRESET_WORDS):
+        return "portrait"
+    if any(word in prompt_lower for word in FASHION_PRESET_WORDS):
+        return "fashion"
+    return "default"
+
+
+async def prepare_model_params(use_new_flux: bool, model_key: str, generation_type: str,
+                             prompt: str, num_outputs: int, aspect_ratio: str,
+                             width: int, height: int, user_data: Dict) -> Optional[dict]:
+    """Подготавливает параметры модели: шаблон пресета + пользовательские поля."""
+    reference_image_url = user_data.get('reference_image_url')
+
+    if use_new_flux:
+        template = param_templates.get(True, None, aspect_ratio, width, height, False)
+        params = dict(template.params, prompt=prompt, num_outputs=num_outputs)
         if generation_type == 'photo_to_photo' and reference_image_url:
             params["image"] = reference_image_url
-            params["strength"] = 0.75
-
-        logger.info(f"=== ПАРАМЕТРЫ ГЕНЕРАЦИИ ===")
-        logger.info(f"Используется {lora_index - 1} моделей из 22 доступных")
-        logger.info(f"Preset: {selected_preset}")
-        logger.info(f"Guidance Scale: {params['guidance_scale']}")
-        logger.info(f"Inference Steps: {params['num_inference_steps']}")
+            params["prompt_strength"] = 0.75
+        return params
 
+    selected_preset = _select_preset(prompt)
+    template = param_templates.get(
+        False, selected_preset, aspect_ratio, width, height, bool(user_data.get('came_from_custom_prompt'))
+    )
+    params = dict(template.params, num_outputs=num_outputs)
+    params["prompt"] = f"{prompt}, {template.prompt_additions}" if template.prompt_additions else prompt
+
+    lora_index = 3
+
+    # Добавляем аватар пользователя если нужно
+    if generation_type in ['with_avatar', 'photo_to_photo']:
+        trigger_word = user_data.get('trigger_word')
+        old_model_id = user_data.get('old_model_id')
+        old_model_version = user_data.get('old_model_version')
+        if trigger_word and old_model_version and old_model_id:
+            if '/' not in old_model_id:
+                avatar_lora = f"{REPLICATE_USERNAME_OR_ORG_NAME}/{old_model_id}:{old_model_version}"
+            else:
+                avatar_lora = f"{old_model_id}:{old_model_version}"
+            params[f"hf_lora_{lora_index}"] = avatar_lora
+            params[f"lora_scale_{lora_index}"] = USER_AVATAR_LORA_STRENGTH
+            lora_index += 1
+
+    for _, model, strength in template.loras:
+        if lora_index > MAX_LORA_COUNT:
+            break
+        params[f"hf_lora_{lora_index}"] = model
+        params[f"lora_scale_{lora_index}"] = strength
+        lora_index += 1
+
+    if generation_type == 'photo_to_photo' and reference_image_url:
+        params["image"] = reference_image_url
+        params["strength"] = 0.75
+
+    logger.info(
+        f"Параметры генерации: пресет {selected_preset}, LoRA {lora_index - 3}, "
+        f"guidance {params['guidance_scale']}, шагов {params['num_inference_steps']}"
+    )
     return params
 
-async def start_queue_processor():
-    """Запускает обработчик очереди генераций"""
-    global queue_processor_running
-    if not queue_processor_running:
-        queue_processor_running = True
-        for i in range(15):
-            asyncio.create_task(process_generation_queue(i))
-        logger.info("Запущены обработчики очереди генераций")
-
-async def process_generation_queue(worker_id: int):
-    """Обработчик очереди генераций"""
-    while True:
-        try:
-            task = await generation_queue.get()
-            if task is None:
-                break
-            message, state, num_outputs = task
-            try:
-                await _generate_image_internal(message, state, num_outputs)
-            except Exception as e:
-                logger.error(f"Worker {worker_id}: Ошибка обработки генерации: {e}", exc_info=True)
-            finally:
-                generation_queue.task_done()
-        except Exception as e:
-            logger.error(f"Worker {worker_id}: Критическая ошибка в обработчике очереди: {e}", exc_info=True)
-            await asyncio.sleep(1)
+async def start_queue_processor(bot: Bot, storage) -> None:
+    """Запускает обработчик очереди генераций (повторный вызов ничего не делает)"""
+    await generation_jobs.start(bot, storage, _generate_image_internal)
 
 async def get_user_generation_lock(user_id: int):
     """Получает или создает блокировку для пользователя"""
@@ -445,7 +494,7 @@ async def clear_avatar_cache(user_id: int) -> None:
     """Принудительно очищает кэш аватаров для пользователя в Redis"""
     if redis_active_model_cache is not None:
         try:
-            await redis_active_model_cache.set(user_id, None)
+            await redis_active_model_cache.delete(user_id)
             logger.info(f"Redis-кэш аватаров очищен для user_id={user_id}")
         except Exception as e:
             logger.warning(f"Ошибка очистки кеша для user_id={user_id}: {e}")
@@ -453,20 +502,83 @@ async def clear_avatar_cache(user_id: int) -> None:
         logger.debug(f"Кеш недоступен для user_id={user_id}")
 
 
-async def download_image_async(session: aiohttp.ClientSession, url: str, filepath: str, retry_count: int = 3) -> Optional[str]:
-    """Асинхронная загрузка изображения"""
+class _BufferBudget:
+    """Учёт байт результатов, которые держим в памяти до отправки."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.stats = {'buffered': 0, 'spilled': 0}
+
+    def reserve(self, size: int) -> bool:
+        if self.used + size > self.max_bytes:
+            return False
+        self.used += size
+        return True
+
+    def release(self, size: int) -> None:
+        self.used = max(0, self.used - size)
+
+
+buffer_budget = _BufferBudget(GENERATION_BUFFER_MAX_MB * 1024 * 1024)
+_download_session: Optional[aiohttp.ClientSession] = None
+
+
+async def _get_download_session() -> aiohttp.ClientSession:
+    """Общая сессия для скачивания результатов с Replicate."""
+    global _download_session
+    if _download_session is None or _download_session.closed:
+        _download_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=80, limit_per_host=40),
+            timeout=aiohttp.ClientTimeout(total=60)
+        )
+    return _download_session
+
+
+async def _spill_to_disk(filepath: str, head: bytes, response: aiohttp.ClientResponse) -> str:
+    """Дописывает ответ на диск, если он не поместился в памяти."""
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    async with aiofiles.open(filepath, 'wb') as f:
+        if head:
+            await f.write(head)
+        async for chunk in response.content.iter_chunked(65536):
+            await f.write(chunk)
+    return filepath
+
+
+async def download_image_async(session: aiohttp.ClientSession, url: str, filename: str, retry_count: int = 3) -> Optional[InputFile]:
+    """Скачивает изображение в память (BufferedInputFile); при нехватке бюджета памяти — в файл."""
     async with download_semaphore:
         for attempt in range(retry_count):
             try:
                 timeout = aiohttp.ClientTimeout(total=30)
                 async with session.get(url, timeout=timeout) as response:
                     if response.status == 200:
-                        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-                        async with aiofiles.open(filepath, 'wb') as f:
-                            async for chunk in response.content.iter_chunked(8192):
-                                await f.write(chunk)
-                        logger.debug(f"Успешно загружен файл: {filepath}")
-                        return filepath
+                        expected = response.content_length or 0
+                        if expected and not buffer_budget.reserve(expected):
+                            buffer_budget.stats['spilled'] += 1
+                            path = await _spill_to_disk(f"generated/{filename}", b"", response)
+                            return FSInputFile(path, filename=filename)
+                        data = bytearray()
+                        try:
+                            async for chunk in response.content.iter_chunked(65536):
+                                data.extend(chunk)
+                                # Без Content-Length резервируем по мере чтения
+                                if len(data) > expected:
+                                    if not buffer_budget.reserve(len(data) - expected):
+                                        buffer_budget.release(expected)
+                                        expected = 0
+                                        buffer_budget.stats['spilled'] += 1
+                                        path = await _spill_to_disk(f"generated/{filename}", bytes(data), response)
+                                        return FSInputFile(path, filename=filename)
+                                    expected = len(data)
+                        except BaseException:
+                            buffer_budget.release(expected)
+                            raise
+                        if len(data) < expected:
+                            buffer_budget.release(expected - len(data))
+                        buffer_budget.stats['buffered'] += 1
+                        return BufferedInputFile(bytes(data), filename=filename)
                     else:
                         logger.warning(f"HTTP {response.status} при загрузке {url}")
             except asyncio.TimeoutError:
@@ -479,29 +591,38 @@ async def download_image_async(session: aiohttp.ClientSession, url: str, filepat
 
         return None
 
-async def download_images_parallel(urls: List[str], user_id: int) -> List[str]:
-    """Параллельная загрузка изображений"""
-    paths = []
-    tasks = []
-
-    connector = aiohttp.TCPConnector(limit=15, limit_per_host=8)
-    timeout = aiohttp.ClientTimeout(total=60)
-
-    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
-        for i, url in enumerate(urls):
-            filepath = f"generated/{user_id}_{uuid.uuid4().hex[:8]}_{i}.png"
-            task = download_image_async(session, url, filepath)
-            tasks.append(task)
-
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-
-        for result in results:
-            if isinstance(result, str) and result:
-                paths.append(result)
-            elif isinstance(result, Exception):
-                logger.error(f"Ошибка загрузки: {result}")
-
-    return paths
+async def download_images_parallel(urls: List[str], user_id: int) -> List[InputFile]:
+    """Параллельная загрузка изображений в память"""
+    session = await _get_download_session()
+    results = await asyncio.gather(*[
+        download_image_async(session, url, f"{user_id}_{uuid.uuid4().hex[:8]}_{i}.png")
+        for i, url in enumerate(urls)
+    ], return_exceptions=True)
+
+    files = []
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f"Ошибка загрузки: {result}")
+        elif result is not None:
+            files.append(result)
+    return files
+
+def release_image_files(files: List[Union[str, InputFile]]) -> None:
+    """Освобождает память под результаты и удаляет файлы, ушедшие на диск."""
+    for file in files:
+        if isinstance(file, BufferedInputFile):
+            buffer_budget.release(len(file.data))
+        elif isinstance(file, FSInputFile):
+            asyncio.create_task(cleanup_files([str(file.path)]))
+
+async def close_download_session() -> None:
+    """Закрывает сессию скачивания результатов."""
+    if _download_session is not None and not _download_session.closed:
+        await _download_session.close()
+
+def get_delivery_stats() -> Dict[str, int]:
+    """Сколько результатов отдано из памяти и сколько ушло на диск."""
+    return dict(buffer_budget.stats, buffered_bytes=buffer_budget.used)
 
 async def generate_image(message: Message, state: FSMContext, num_outputs: int = 2, user_id: int = None) -> None:
     """Основная функция генерации изображения с 22 моделями"""
@@ -567,7 +688,7 @@ async def generate_image(message: Message, state: FSMContext, num_outputs: int =
         )
         return
 
-    await start_queue_processor()
+    await start_queue_processor(bot, state.storage)
 
     if not await check_user_cooldown(message_recipient):
         await send_message_with_fallback(
@@ -590,15 +711,6 @@ async def generate_image(message: Message, state: FSMContext, num_outputs: int =
         if not await check_user_resources(bot, target_user_id, required_photos=required_photos):
             return
 
-    if generation_queue.full():
-        await send_message_with_fallback(
-            bot, message_recipient,
-            "😔 Сервер перегружен! Попробуй через минуту.",
-            reply_markup=await create_main_menu_keyboard(message_recipient),
-            parse_mode=ParseMode.MARKDOWN_V2
-        )
-        return
-
     try:
         generation_data = deepcopy({
             'prompt': user_data.get('prompt'),
@@ -623,13 +735,24 @@ async def generate_image(message: Message, state: FSMContext, num_outputs: int =
             'came_from_custom_prompt': user_data.get('came_from_custom_prompt', False),
             'use_llama_prompt': user_data.get('use_llama_prompt', False),
             'last_generation_params': user_data.get('last_generation_params'),
-            'active_avatar_name': user_data.get('active_avatar_name')
+            'active_avatar_name': user_data.get('active_avatar_name'),
+            'style_name': user_data.get('style_name')
         })
 
         await state.update_data(generation_data)
-        await generation_queue.put((message, state, num_outputs))
+        queue_size = await generation_jobs.enqueue(
+            state, target_user_id, message_recipient, generation_data,
+            num_outputs, generation_data['photos_to_deduct']
+        )
+        if queue_size is None:
+            await send_message_with_fallback(
+                bot, message_recipient,
+                "😔 Сервер перегружен! Попробуй через минуту.",
+                reply_markup=await create_main_menu_keyboard(message_recipient),
+                parse_mode=ParseMode.MARKDOWN_V2
+            )
+            return
 
-        queue_size = generation_queue.qsize()
         if queue_size > 10:
             if is_admin_generation:
                 message_text = f"📊 Запрос генерации для пользователя {target_user_id} добавлен в очередь (позиция: ~{queue_size})."
@@ -643,14 +766,6 @@ async def generate_image(message: Message, state: FSMContext, num_outputs: int =
 
         logger.info(f"✅ Генерация добавлена в очередь: recipient={message_recipient}, target={target_user_id}")
 
-    except asyncio.QueueFull:
-        logger.error(f"Очередь переполнена для user_id={message_recipient}")
-        await send_message_with_fallback(
-            bot, message_recipient,
-            "😔 Не удалось добавить в очередь. Попробуй ещё раз!",
-            reply_markup=await create_main_menu_keyboard(message_recipient),
-            parse_mode=ParseMode.MARKDOWN_V2
-        )
     except Exception as e:
         logger.error(f"Непредвиденная ошибка в generate_image: {e}", exc_info=True)
         await send_message_with_fallback(
@@ -660,17 +775,23 @@ async def generate_image(message: Message, state: FSMContext, num_outputs: int =
             parse_mode=ParseMode.MARKDOWN_V2
         )
 
-async def _generate_image_internal(message: Message, state: FSMContext, num_outputs: int = 2) -> None:
+async def _refund_generation(job_id: Optional[int], user_id: int, photos: int) -> None:
+    """Возвращает фото за генерацию; для задания очереди — не больше одного раза."""
+    if job_id is not None:
+        await refund_generation_job(job_id)
+    else:
+        await credit_user_resources(user_id, photos=photos)
+
+async def _generate_image_internal(bot: Bot, state: FSMContext, num_outputs: int = 2, job_id: Optional[int] = None) -> None:
     """Внутренняя функция генерации изображения (оптимизированная версия с 5 базовыми моделями)"""
     from handlers.generation import handle_admin_generation_result
 
     async with asyncio.Lock():
         user_data = await state.get_data()
-        message_recipient = user_data.get('message_recipient', message.from_user.id)
-        target_user_id = user_data.get('generation_target_user', message.from_user.id)
-        admin_user_id = user_data.get('original_admin_user', message.from_user.id)
+        message_recipient = user_data.get('message_recipient', state.key.user_id)
+        target_user_id = user_data.get('generation_target_user', state.key.user_id)
+        admin_user_id = user_data.get('original_admin_user', state.key.user_id)
         is_admin_generation = user_data.get('is_admin_generation', False)
-        bot = message.bot
         bot_id = (await bot.get_me()).id
 
         preserved_data = {}
@@ -689,17 +810,6 @@ async def _generate_image_internal(message: Message, state: FSMContext, num_outp
             async with generation_semaphore:
                 logger.info(f"🎯 Генерация для user_id={target_user_id} с использованием оптимизированной системы")
 
-                subscription_data = await check_database_user(target_user_id)
-                if not isinstance(subscription_data, tuple) or len(subscription_data) < 9:
-                    logger.error(f"Недостаточно данных подписки для user_id={target_user_id}")
-                    await send_message_with_fallback(
-                        bot, message_recipient,
-                        escape_md("❌ Ошибка сервера! Попробуй /menu.", version=2),
-                        reply_markup=await create_main_menu_keyboard(message_recipient),
-                        parse_mode=ParseMode.MARKDOWN_V2
-                    )
-                    return
-
                 generation_type = user_data.get('generation_type')
                 prompt = user_data.get('prompt')
                 aspect_ratio_key = user_data.get('aspect_ratio')
@@ -745,7 +855,14 @@ async def _generate_image_internal(message: Message, state: FSMContext, num_outp
 
                 if not is_admin_generation:
                     logger.info(f"Списание ресурсов для user_id={target_user_id}, требуется фото: {required_photos}")
-                    await update_user_credits(target_user_id, "decrement_photo", amount=required_photos)
+                    if job_id is not None:
+                        balance = await debit_generation_job(job_id, target_user_id, required_photos)
+                    else:
+                        balance = await debit_user_resources(target_user_id, photos=required_photos)
+                    if balance is None:
+                        await check_user_resources(bot, target_user_id, required_photos=required_photos)
+                        await reset_generation_context(state, generation_type)
+                        return
 
                 selected_gender = user_data.get('selected_gender')
                 user_input_for_helper = user_data.get('user_input_for_llama')
@@ -838,6 +955,7 @@ async def _generate_image_internal(message: Message, state: FSMContext, num_outp
                     parse_mode=ParseMode.MARKDOWN_V2
                 )
 
+                image_files: List[Union[str, InputFile]] = []
                 try:
                     user_data = await state.get_data()
                     processed_prompt = await process_prompt_async(
@@ -911,7 +1029,9 @@ async def _generate_image_internal(message: Message, state: FSMContext, num_outp
                         )
 
                     async with replicate_semaphore:
+                        replicate_started = time.monotonic()
                         image_urls = await run_replicate_model_async(replicate_model_id_to_run, input_params)
+                        generation_jobs.record_latency(time.monotonic() - replicate_started)
 
                     if not image_urls:
                         logger.error("Пустой результат от Replicate")
@@ -930,9 +1050,13 @@ async def _generate_image_internal(message: Message, state: FSMContext, num_outp
                             parse_mode=ParseMode.MARKDOWN_V2
                         )
 
-                    image_paths = await download_images_parallel(image_urls, target_user_id)
+                    if GENERATION_SEND_BY_URL:
+                        # Telegram сам скачает результат по ссылке Replicate
+                        image_files = list(image_urls)
+                    else:
+                        image_files = await download_images_parallel(image_urls, target_user_id)
 
-                    if not image_paths:
+                    if not image_files:
                         logger.error("Не удалось загрузить изображения")
                         if isinstance(generation_message, Message):
                             await generation_message.edit_text(
@@ -941,7 +1065,7 @@ async def _generate_image_internal(message: Message, state: FSMContext, num_outp
                                 parse_mode=ParseMode.MARKDOWN_V2
                             )
                         if not is_admin_generation:
-                            await update_user_credits(target_user_id, "increment_photo", amount=required_photos)
+                            await _refund_generation(job_id, target_user_id, required_photos)
                         await reset_generation_context(state, generation_type)
                         return
 
@@ -954,7 +1078,8 @@ async def _generate_image_internal(message: Message, state: FSMContext, num_outp
                         pass
 
                     # Обновляем параметры
-                    generation_params.update({'image_urls': image_urls, 'duration': duration})
+                    generation_id = new_generation_id(job_id)
+                    generation_params.update({'image_urls': image_urls, 'duration': duration, 'generation_id': generation_id})
                     preserved_data.update({
                         'last_generation_params': generation_params,
                     })
@@ -977,19 +1102,21 @@ async def _generate_image_internal(message: Message, state: FSMContext, num_outp
                             'success': True,
                             'image_urls': image_urls,
                             'prompt': processed_prompt,
-                            'style': user_data.get('style_name', 'custom')
+                            'style': user_data.get('style_name', 'custom'),
+                            'generation_id': generation_id
                         }
                         await handle_admin_generation_result(state, admin_user_id, target_user_id, result_data, bot)
                     else:
                         await send_generation_results(
-                            bot, message_recipient, target_user_id, image_paths, duration, aspect_ratio_key,
-                            generation_type, model_key, state, admin_user_id if is_admin_generation else None
+                            bot, message_recipient, target_user_id, image_files, duration, aspect_ratio_key,
+                            generation_type, model_key, state, admin_user_id if is_admin_generation else None,
+                            generation_id=generation_id
                         )
 
                     logger.info(f"🎯 PixelPie_AI генерация завершена для user_id={target_user_id}: "
-                               f"{len(image_paths)} фото за {duration:.1f} сек (22 модели)")
+                               f"{len(image_files)} фото за {duration:.1f} сек (22 модели)")
 
-                    asyncio.create_task(cleanup_files(image_paths + [user_data.get('photo_path')]))
+                    asyncio.create_task(cleanup_files([user_data.get('photo_path')]))
 
                 except Exception as e:
                     logger.error(f"Ошибка генерации для user_id={target_user_id}: {e}", exc_info=True)
@@ -1009,72 +1136,48 @@ async def _generate_image_internal(message: Message, state: FSMContext, num_outp
                                 parse_mode=ParseMode.MARKDOWN_V2
                             )
                     if not is_admin_generation:
-                        await update_user_credits(target_user_id, "increment_photo", amount=required_photos)
+                        await _refund_generation(job_id, target_user_id, required_photos)
                     await reset_generation_context(state, generation_type)
                 finally:
+                    release_image_files(image_files)
                     if preserved_data:
                         await state.update_data(**preserved_data)
                     await clean_admin_context(state)
                     logger.info("Админский контекст очищен после генерации")
 
 async def send_generation_results(bot: Bot, message_recipient: int, target_user_id: int,
-                                image_paths: List[str], duration: float, aspect_ratio: str,
+                                image_files: List[Union[str, InputFile]], duration: float, aspect_ratio: str,
                                 generation_type: str, model_key: str, state: FSMContext,
-                                admin_user_id: int = None) -> None:
-    """Отправляет результаты генерации пользователю"""
+                                admin_user_id: int = None, generation_id: Optional[str] = None) -> None:
+    """Отправляет результаты генерации пользователю.
+
+    image_files — файлы в памяти (BufferedInputFile), файлы на диске или ссылки Replicate.
+    Если Telegram не смог скачать ссылку, результаты скачиваются и отправляются повторно.
+    file_id отправленных фото сохраняются под generation_id для повторных отправок.
+    """
     user_data = await state.get_data()
     state_value = user_data.get('state')
 
     try:
-        if len(image_paths) == 1:
-            caption = escape_md(f"📸 Ваша ИИ генерация фотографии готова! Время: {duration:.1f} сек", version=2)
-            photo_file = FSInputFile(path=image_paths[0])
-            await send_photo_with_retry(
-                bot, message_recipient, photo_file, caption=caption,
-                reply_markup=await create_rating_keyboard(generation_type, model_key, message_recipient, bot),
-                parse_mode=ParseMode.MARKDOWN_V2
-            )
-            if admin_user_id and admin_user_id != message_recipient:
-                await bot.send_photo(
-                    chat_id=admin_user_id,
-                    photo=photo_file,
-                    caption=escape_md(f"Фото для ID {target_user_id}", version=2),
-                    reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
-                        InlineKeyboardButton(text="🔙 К действиям", callback_data=f"user_actions_{target_user_id}")
-                    ]]),
-                    parse_mode=ParseMode.MARKDOWN_V2
-                )
-        else:
-            caption = escape_md(
-                f"📸 {len(image_paths)} Ваших фотографий созданы! ({duration:.1f} сек)\n"
-                f"🎯 Сделано при помощи PixelPie_AI", version=2
-            )
-            media = []
-            for i, path in enumerate(image_paths):
-                photo_file = FSInputFile(path=path)
-                if i == 0:
-                    media.append(InputMediaPhoto(media=photo_file, caption=caption, parse_mode=ParseMode.MARKDOWN_V2))
-                else:
-                    media.append(InputMediaPhoto(media=photo_file))
-
-            await send_media_group_with_retry(bot, message_recipient, media)
-            await send_message_with_fallback(
-                bot, message_recipient,
-                escape_md("⭐ Оцени результат ИИ фотогенерации:", version=2),
-                reply_markup=await create_rating_keyboard(generation_type, model_key, message_recipient, bot),
-                parse_mode=ParseMode.MARKDOWN_V2
-            )
+        try:
+            file_ids = await _send_result_files(bot, message_recipient, target_user_id, image_files, duration,
+                                                generation_type, model_key, admin_user_id)
+        except TelegramBadRequest as e:
+            urls = [file for file in image_files if isinstance(file, str)]
+            if not urls:
+                raise
+            logger.warning(f"Telegram не принял ссылки на результат для user_id={message_recipient}: {e}, отправляем файлы")
+            downloaded = await download_images_parallel(urls, target_user_id)
+            try:
+                if not downloaded:
+                    raise
+                file_ids = await _send_result_files(bot, message_recipient, target_user_id, downloaded, duration,
+                                                    generation_type, model_key, admin_user_id)
+            finally:
+                release_image_files(downloaded)
 
-            if admin_user_id and admin_user_id != message_recipient:
-                await send_media_group_with_retry(bot, admin_user_id, media)
-                await bot.send_message(
-                    chat_id=admin_user_id,
-                    text=escape_md(f"Фото для пользователя {target_user_id} готовы", version=2),
-                    reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
-                        InlineKeyboardButton(text="🔙 К действиям", callback_data=f"user_actions_{target_user_id}")
-                    ]]),
-                    parse_mode=ParseMode.MARKDOWN_V2
-                )
+        await save_result(generation_id, file_ids, user_id=target_user_id,
+                          generation_type=generation_type, model_key=model_key)
 
         await state.clear()
         if state_value:
@@ -1091,6 +1194,70 @@ async def send_generation_results(bot: Bot, message_recipient: int, target_user_
             parse_mode=ParseMode.MARKDOWN_V2
         )
 
+async def _send_result_files(bot: Bot, message_recipient: int, target_user_id: int,
+                             image_files: List[Union[str, InputFile]], duration: float,
+                             generation_type: str, model_key: str, admin_user_id: Optional[int]) -> List[str]:
+    """Отправляет файлы получателю; копия администратору уходит по file_id без повторной загрузки.
+
+    Для ссылок отказ Telegram не повторяется, а поднимается TelegramBadRequest:
+    send_generation_results в этом случае скачивает файлы сам.
+    """
+    by_url = any(isinstance(file, str) and file.startswith(('http://', 'https://')) for file in image_files)
+    send_photo = send_photo_strict if by_url else send_photo_with_retry
+    send_media_group = send_media_group_strict if by_url else send_media_group_with_retry
+    if len(image_files) == 1:
+        caption = escape_md(f"📸 Ваша ИИ генерация фотографии готова! Время: {duration:.1f} сек", version=2)
+        sent = await send_photo(
+            bot, message_recipient, image_files[0], caption=caption,
+            reply_markup=await create_rating_keyboard(generation_type, model_key, message_recipient, bot),
+            parse_mode=ParseMode.MARKDOWN_V2
+        )
+        if not sent:
+            raise RuntimeError(f"Telegram не подтвердил отправку результата для user_id={message_recipient}")
+        file_ids = file_ids_from_messages(sent)
+        if admin_user_id and admin_user_id != message_recipient:
+            await bot.send_photo(
+                chat_id=admin_user_id,
+                photo=file_ids[0] if file_ids else image_files[0],
+                caption=escape_md(f"Фото для ID {target_user_id}", version=2),
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
+                    InlineKeyboardButton(text="🔙 К действиям", callback_data=f"user_actions_{target_user_id}")
+                ]]),
+                parse_mode=ParseMode.MARKDOWN_V2
+            )
+    else:
+        caption = escape_md(
+            f"📸 {len(image_files)} Ваших фотографий созданы! ({duration:.1f} сек)\n"
+            f"🎯 Сделано при помощи PixelPie_AI", version=2
+        )
+        sent = await send_media_group(
+            bot, message_recipient, build_media_group(image_files, caption, ParseMode.MARKDOWN_V2)
+        )
+        if not sent:
+            raise RuntimeError(f"Telegram не подтвердил отправку результата для user_id={message_recipient}")
+        file_ids = file_ids_from_messages(sent)
+        await send_message_with_fallback(
+            bot, message_recipient,
+            escape_md("⭐ Оцени результат ИИ фотогенерации:", version=2),
+            reply_markup=await create_rating_keyboard(generation_type, model_key, message_recipient, bot),
+            parse_mode=ParseMode.MARKDOWN_V2
+        )
+
+        if admin_user_id and admin_user_id != message_recipient:
+            admin_sources = file_ids if len(file_ids) == len(image_files) else image_files
+            await send_media_group_with_retry(
+                bot, admin_user_id, build_media_group(admin_sources, caption, ParseMode.MARKDOWN_V2)
+            )
+            await bot.send_message(
+                chat_id=admin_user_id,
+                text=escape_md(f"Фото для пользователя {target_user_id} готовы", version=2),
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
+                    InlineKeyboardButton(text="🔙 К действиям", callback_data=f"user_actions_{target_user_id}")
+                ]]),
+                parse_mode=ParseMode.MARKDOWN_V2
+            )
+    return file_ids
+
 async def cleanup_files(filepaths: List[Optional[str]]):
     """Асинхронное удаление временных файлов"""
     for filepath in filepaths:
@@ -1111,15 +1278,12 @@ async def run_replicate_model_async(model_id: str, input_params: dict) -> List[s
         reraise=True
     )
     async def _run():
-        loop = asyncio.get_event_loop()
-        replicate_client = replicate.Client(api_token=REPLICATE_API_TOKEN)
         logger.info(f"🚀 Запуск ультра-реалистичной модели {model_id}")
         logger.debug(f"📸 Параметры: {input_params}")
 
-        output = await loop.run_in_executor(
-            None,
-            lambda: replicate_client.run(model_id, input=input_params)
-        )
+        output = await replicate_client.run(model_id, input_params)
+        if isinstance(output, str):
+            output = [output]
 
         image_urls = []
         if isinstance(output, list):
@@ -1137,8 +1301,6 @@ async def run_replicate_model_async(model_id: str, input_params: dict) -> List[s
 async def upload_image_to_replicate(photo_path: str) -> str:
     """Загружает изображение возвращает URL"""
     async with replicate_semaphore:
-        loop = asyncio.get_event_loop()
-
         if not os.path.exists(photo_path):
             raise FileNotFoundError(f"Файл не найден: {photo_path}")
 
@@ -1146,17 +1308,7 @@ async def upload_image_to_replicate(photo_path: str) -> str:
         if file_size > MAX_FILE_SIZE_BYTES:
             raise ValueError(f"Файл слишком большой: {file_size / 1024 / 1024:.2f} MB")
 
-        replicate_client = replicate.Client(api_token=REPLICATE_API_TOKEN)
-
-        def upload_sync():
-            with open(photo_path, 'rb') as f:
-                return replicate_client.files.create(file=f)
-
-        file_response = await loop.run_in_executor(None, upload_sync)
-        image_url = file_response.urls.get('get')
-
-        if not image_url:
-            raise ValueError("Replicate не вернул URL")
+        image_url = await replicate_client.upload_file(photo_path)
 
         logger.info(f"Изображение загружено: {image_url}")
         return image_url
@@ -0,0 +1,170 @@
+# generation/job_queue.py
+import asyncio
+import math
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+from aiogram import Bot
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+
+from config import (
+    GENERATION_MIN_WORKERS, GENERATION_MAX_WORKERS, GENERATION_QUEUE_MAX_DEPTH,
+    GENERATION_QUEUE_DRAIN_SECONDS, GENERATION_JOB_MAX_ATTEMPTS
+)
+from database import (
+    enqueue_generation_job, claim_generation_jobs, finish_generation_job,
+    refund_generation_job, requeue_running_generation_jobs, get_generation_queue_depth
+)
+from logger import get_logger
+
+logger = get_logger('generation')
+
+JobHandler = Callable[..., Awaitable[None]]
+
+
+class GenerationJobQueue:
+    """Очередь генераций в SQLite (таблица generation_jobs).
+
+    Задания переживают перезапуск, выбираются по одному на пользователя
+    (честная очередь), а число одновременных заданий подстраивается под
+    длину очереди и среднюю задержку Replicate.
+    """
+
+    def __init__(self, min_workers: int, max_workers: int, max_depth: int,
+                 drain_seconds: float, max_attempts: int, poll_interval: float = 1.0):
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers, max_workers)
+        self.max_depth = max_depth
+        self.drain_seconds = max(1.0, drain_seconds)
+        self.max_attempts = max(1, max_attempts)
+        self.poll_interval = poll_interval
+        self._bot: Optional[Bot] = None
+        self._storage: Optional[BaseStorage] = None
+        self._handler: Optional[JobHandler] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._running: Set[asyncio.Task] = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._latency: Optional[float] = None
+        self._stats = {
+            'enqueued': 0, 'rejected': 0, 'done': 0, 'failed': 0,
+            'queued': 0, 'oldest_wait': 0.0, 'last_wait': 0.0, 'max_wait': 0.0
+        }
+
+    async def start(self, bot: Bot, storage: BaseStorage, handler: JobHandler) -> None:
+        """Запускает диспетчер (однократно); задания, прерванные перезапуском, возвращаются в очередь."""
+        if self._dispatcher is not None and not self._dispatcher.done():
+            return
+        self._bot, self._storage, self._handler = bot, storage, handler
+        self._wakeup = asyncio.Event()
+        for job_id in await requeue_running_generation_jobs(self.max_attempts):
+            await refund_generation_job(job_id)
+        self._dispatcher = asyncio.create_task(self._dispatch_loop())
+        logger.info(f"Очередь генераций запущена: {self.min_workers}-{self.max_workers} обработчиков")
+
+    async def stop(self) -> None:
+        """Останавливает выборку новых заданий; выполняющиеся задания доработают или вернутся в очередь при старте."""
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+
+    async def enqueue(self, state: FSMContext, user_id: int, recipient_id: int,
+                      payload: Dict[str, Any], num_outputs: int, photos: int) -> Optional[int]:
+        """Сохраняет задание; возвращает глубину очереди или None, если очередь заполнена."""
+        state_key = (state.key.bot_id, state.key.chat_id, state.key.user_id)
+        result = await enqueue_generation_job(
+            user_id, recipient_id, state_key, payload, num_outputs, photos, self.max_depth
+        )
+        if result is None:
+            self._stats['rejected'] += 1
+            return None
+        job_id, depth = result
+        self._stats['enqueued'] += 1
+        self._stats['queued'] = depth
+        logger.info(f"Задание генерации id={job_id} поставлено в очередь для user_id={user_id}, глубина {depth}")
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return depth
+
+    def record_latency(self, seconds: float) -> None:
+        """Учитывает длительность вызова Replicate (скользящее среднее)."""
+        self._latency = seconds if self._latency is None else self._latency * 0.8 + seconds * 0.2
+
+    def target_workers(self) -> int:
+        """Сколько заданий выполнять одновременно, чтобы разобрать очередь за drain_seconds."""
+        latency = self._latency or 30.0
+        needed = math.ceil((self._stats['queued'] + len(self._running)) * latency / self.drain_seconds)
+        return min(self.max_workers, max(self.min_workers, needed))
+
+    async def _dispatch_loop(self) -> None:
+        while True:
+            try:
+                self._wakeup.clear()
+                queued, _, oldest_wait = await get_generation_queue_depth()
+                self._stats['queued'], self._stats['oldest_wait'] = queued, oldest_wait
+                free = self.target_workers() - len(self._running)
+                if queued and free > 0:
+                    for job in await claim_generation_jobs(free):
+                        task = asyncio.create_task(self._run_job(job))
+                        self._running.add(task)
+                        task.add_done_callback(self._on_job_done)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка диспетчера очереди генераций: {e}", exc_info=True)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def _on_job_done(self, task: asyncio.Task) -> None:
+        self._running.discard(task)
+        self._wakeup.set()
+
+    async def _run_job(self, job: Dict[str, Any]) -> None:
+        job_id = job['id']
+        self._stats['last_wait'] = job['waited']
+        self._stats['max_wait'] = max(self._stats['max_wait'], job['waited'])
+        try:
+            bot_id, chat_id, state_user_id = job['state_key']
+            state = FSMContext(
+                storage=self._storage,
+                key=StorageKey(bot_id=bot_id, chat_id=chat_id, user_id=state_user_id)
+            )
+            # Контекст генерации берём из задания: состояние могло смениться или пропасть при перезапуске
+            await state.update_data(job['payload'])
+            await self._handler(self._bot, state, job['num_outputs'], job_id=job_id)
+            await finish_generation_job(job_id)
+            self._stats['done'] += 1
+        except Exception as e:
+            logger.error(f"Ошибка выполнения задания генерации id={job_id}: {e}", exc_info=True)
+            self._stats['failed'] += 1
+            await finish_generation_job(job_id, error=str(e)[:500])
+            await refund_generation_job(job_id)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Глубина очереди, время ожидания, число обработчиков и задержка Replicate."""
+        stats = dict(self._stats)
+        stats.update({
+            'running': len(self._running),
+            'target_workers': self.target_workers(),
+            'replicate_latency': round(self._latency, 2) if self._latency is not None else None,
+        })
+        return stats
+
+
+generation_jobs = GenerationJobQueue(
+    min_workers=GENERATION_MIN_WORKERS,
+    max_workers=GENERATION_MAX_WORKERS,
+    max_depth=GENERATION_QUEUE_MAX_DEPTH,
+    drain_seconds=GENERATION_QUEUE_DRAIN_SECONDS,
+    max_attempts=GENERATION_JOB_MAX_ATTEMPTS,
+)
+
+
+def get_generation_queue_stats() -> Dict[str, Any]:
+    """Метрики очереди генераций."""
+    return generation_jobs.get_stats()
@@ -0,0 +1,197 @@
+# generation/photo_ingest.py
+import asyncio
+import io
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, Iterable, Optional, Set, Tuple
+
+from aiogram import Bot
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from config import TRAINING_PHOTO_WORKERS, TRAINING_PHOTO_MAX_SIDE, TRAINING_PHOTO_MIN_SIDE
+from logger import get_logger
+
+logger = get_logger('generation')
+
+
+class PhotoRejected(ValueError):
+    """Фото не подходит для обучения; текст исключения показывается пользователю."""
+
+
+def _prepare_photo(data: bytes, max_side: int, min_side: int) -> bytes:
+    """Проверяет и сжимает фото (выполняется в отдельном процессе)."""
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img = ImageOps.exif_transpose(img)
+            if min(img.size) < min_side:
+                raise PhotoRejected(f"Фото слишком маленькое ({img.size[0]}x{img.size[1]}), нужно не меньше {min_side} px по короткой стороне.")
+            img = img.convert('RGB')
+            img.thumbnail((max_side, max_side), Image.LANCZOS)
+            buffer = io.BytesIO()
+            img.save(buffer, format='JPEG', quality=95)
+            return buffer.getvalue()
+    except (UnidentifiedImageError, OSError) as e:
+        raise PhotoRejected(f"Не удалось прочитать фото: {e}")
+
+
+class _UserArchive:
+    """ZIP-архив фото одного пользователя, дописываемый по мере готовности фото."""
+
+    __slots__ = ('buffer', 'zip', 'entries', 'tasks', 'touched', 'wanted')
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+        # JPEG уже сжат: без deflate архив собирается простым копированием
+        self.zip = zipfile.ZipFile(self.buffer, 'w', zipfile.ZIP_STORED)
+        self.entries: Dict[str, str] = {}
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.touched = time.monotonic()
+        # Набор фото, для которого собирается архив; None — пока идёт загрузка
+        self.wanted: Optional[Set[str]] = None
+
+    def append(self, file_id: str, data: bytes) -> None:
+        name = f"photo_{len(self.entries) + 1:02d}.jpg"
+        self.zip.writestr(zipfile.ZipInfo(name, date_time=time.localtime()[:6]), data)
+        self.entries[file_id] = name
+        self.touched = time.monotonic()
+
+    def close(self) -> bytes:
+        self.zip.close()
+        return self.buffer.getvalue()
+
+    def cancel(self) -> None:
+        for task in self.tasks.values():
+            task.cancel()
+
+
+class TrainingPhotoIngest:
+    """Потоковая подготовка фото для обучения аватара.
+
+    Каждое фото начинает скачиваться из Telegram сразу при получении,
+    проверяется и сжимается в пуле процессов и дописывается в ZIP в памяти.
+    К подтверждению обучения архив уже собран: остаётся дождаться
+    недокачанных фото и загрузить байты в Replicate. Фото, которых нет
+    в архиве (например, после перезапуска бота), докачиваются по file_id.
+    """
+
+    def __init__(self, workers: int, max_side: int, min_side: int, idle_ttl: float = 3600):
+        self.workers = workers
+        self.max_side = max_side
+        self.min_side = min_side
+        self.idle_ttl = idle_ttl
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._archives: Dict[int, _UserArchive] = {}
+        self._stats = {'accepted': 0, 'rejected': 0, 'errors': 0, 'archives_built': 0}
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def add(self, bot: Bot, user_id: int, file_id: str) -> asyncio.Task:
+        """Начинает скачивание и обработку фото; повторный вызов возвращает ту же задачу."""
+        self._drop_idle()
+        archive = self._archives.setdefault(user_id, _UserArchive())
+        task = archive.tasks.get(file_id)
+        if task is None or (task.done() and (task.cancelled() or task.exception() is not None)):
+            task = asyncio.create_task(self._ingest(bot, user_id, archive, file_id))
+            archive.tasks[file_id] = task
+        archive.touched = time.monotonic()
+        return task
+
+    async def _ingest(self, bot: Bot, user_id: int, archive: _UserArchive, file_id: str) -> None:
+        try:
+            downloaded = await bot.download(file_id)
+            data = await self._prepare(downloaded.getvalue())
+        except PhotoRejected as e:
+            self._stats['rejected'] += 1
+            logger.info(f"Фото {file_id} отклонено для user_id={user_id}: {e}")
+            raise
+        except Exception as e:
+            self._stats['errors'] += 1
+            logger.error(f"Ошибка подготовки фото {file_id} для user_id={user_id}: {e}", exc_info=True)
+            raise
+        if self._archives.get(user_id) is not archive:
+            return  # Набор фото сброшен, пока шло скачивание
+        if archive.wanted is not None and file_id not in archive.wanted:
+            return  # Фото не входит в собираемый набор
+        archive.append(file_id, data)
+        self._stats['accepted'] += 1
+        logger.debug(f"Фото {file_id} добавлено в архив user_id={user_id}: {len(data)} байт, всего {len(archive.entries)}")
+
+    async def _prepare(self, data: bytes) -> bytes:
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._get_executor(), _prepare_photo, data, self.max_side, self.min_side)
+        except BrokenProcessPool:
+            logger.warning("Пул обработки фото сломан, пересоздаю")
+            self._executor = None
+            return await loop.run_in_executor(self._get_executor(), _prepare_photo, data, self.max_side, self.min_side)
+
+    async def build(self, bot: Bot, user_id: int, file_ids: Iterable[str]) -> Tuple[bytes, int]:
+        """Дожидается обработки указанных фото и возвращает байты ZIP и число фото в нём."""
+        file_ids = list(dict.fromkeys(file_ids))
+        if not file_ids:
+            raise ValueError(f"Нет фото для обучения user_id={user_id}")
+        wanted = set(file_ids)
+        self._drop_idle()
+        archive = self._archives.get(user_id)
+        if archive is not None and set(archive.entries) - wanted:
+            # В архиве есть фото из прошлого набора: собираем заново только нужные
+            self.discard(user_id)
+        elif archive is not None:
+            # Недокачанные фото из прошлого набора не должны попасть в архив
+            for file_id in [fid for fid in archive.tasks if fid not in wanted]:
+                archive.tasks.pop(file_id).cancel()
+        self._archives.setdefault(user_id, _UserArchive()).wanted = wanted
+        tasks = [self.add(bot, user_id, file_id) for file_id in file_ids]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        failed = sum(1 for result in results if isinstance(result, BaseException))
+        if failed:
+            logger.warning(f"Не удалось подготовить {failed} из {len(file_ids)} фото для user_id={user_id}")
+        archive = self._archives.pop(user_id, None)
+        if archive is None:
+            raise ValueError(f"Набор фото user_id={user_id} сброшен во время сборки архива")
+        count = len(archive.entries)
+        data = archive.close()
+        self._stats['archives_built'] += 1
+        logger.info(f"ZIP-архив для user_id={user_id} готов: {count} фото, {len(data) / 1024 / 1024:.2f} MB")
+        return data, count
+
+    def discard(self, user_id: int) -> None:
+        """Сбрасывает набор фото пользователя."""
+        archive = self._archives.pop(user_id, None)
+        if archive is not None:
+            archive.cancel()
+            archive.zip.close()
+
+    def _drop_idle(self) -> None:
+        deadline = time.monotonic() - self.idle_ttl
+        for user_id in [uid for uid, archive in self._archives.items() if archive.touched < deadline]:
+            logger.debug(f"Сбрасываю неиспользуемый набор фото user_id={user_id}")
+            self.discard(user_id)
+
+    def shutdown(self) -> None:
+        for user_id in list(self._archives):
+            self.discard(user_id)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self._stats)
+        stats['archives'] = len(self._archives)
+        stats['pending'] = sum(1 for archive in self._archives.values() for task in archive.tasks.values() if not task.done())
+        return stats
+
+
+training_ingest = TrainingPhotoIngest(
+    workers=TRAINING_PHOTO_WORKERS, max_side=TRAINING_PHOTO_MAX_SIDE, min_side=TRAINING_PHOTO_MIN_SIDE
+)
+
+
+def get_photo_ingest_stats() -> Dict[str, Any]:
+    """Метрики подготовки фото для обучения."""
+    return training_ingest.get_stats()
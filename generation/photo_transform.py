@@ -4,8 +4,6 @@ PixelPie AI - Фото Преображение
 Версия с безопасными промптами для избежания sensitive content флагов
 """
 
-import replicate
-import asyncio
 import aiohttp
 import os
 import logging
@@ -17,6 +15,7 @@ import io
 import re
 
 from logger import get_logger
+from replicate_client import replicate_client
 logger = get_logger('generation')
 
 class PhotoTransformGenerator:
@@ -121,9 +120,6 @@ class PhotoTransformGenerator:
             "720p": "720p"
         }
 
-        # Клиент Replicate
-        self.client = replicate.Client(api_token=replicate_api_key)
-
         # Счетчик попыток для каждого пользователя
         self.user_attempts = {}
 
@@ -230,22 +226,13 @@ class PhotoTransformGenerator:
             # Создаем prediction
             logger.info(f"Создание prediction для модели {style_config['model']}")
 
-            prediction = await asyncio.to_thread(
-                self.client.predictions.create,
-                model=style_config['model'],
-                input=input_params
-            )
+            prediction = await replicate_client.create_prediction(style_config['model'], input_params)
 
             logger.info(f"Prediction создан: {prediction.id}")
 
-            # Ждем завершения
-            while prediction.status not in ["succeeded", "failed", "canceled"]:
-                await asyncio.sleep(2)
-                prediction = await asyncio.to_thread(
-                    self.client.predictions.get,
-                    prediction.id
-                )
-                logger.info(f"Статус: {prediction.status}")
+            # Ждем завершения (webhook или опрос с растущим интервалом)
+            prediction = await replicate_client.wait(prediction)
+            logger.info(f"Статус: {prediction.status}")
 
             if prediction.status == "succeeded":
                 output_url = prediction.output
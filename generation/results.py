@@ -0,0 +1,90 @@
+# generation/results.py
+import uuid
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+from aiogram import Bot
+from aiogram.types import InputFile, InputMediaPhoto, Message
+
+from database import result_cache
+from logger import get_logger
+
+logger = get_logger('generation')
+
+MediaSource = Union[str, InputFile]
+
+
+def new_generation_id(job_id: Optional[int] = None) -> str:
+    """Id генерации: для задания очереди — по id задания, иначе случайный."""
+    return f"job{job_id}" if job_id is not None else uuid.uuid4().hex
+
+
+def file_ids_from_messages(messages: Union[Message, Sequence[Message], None]) -> List[str]:
+    """Достаёт file_id фото из ответа send_photo / send_media_group.
+
+    Любой другой ответ (None, False от исчерпавшего попытки retry) даёт [].
+    """
+    if isinstance(messages, Message):
+        messages = [messages]
+    elif not isinstance(messages, (list, tuple)):
+        return []
+    return [message.photo[-1].file_id for message in messages if getattr(message, 'photo', None)]
+
+
+async def save_result(generation_id: str, file_ids: List[str], **meta: Any) -> None:
+    """Запоминает file_id результата, чтобы повторные отправки не загружали файлы заново."""
+    if not generation_id or not file_ids:
+        return
+    try:
+        await result_cache.set(generation_id, {'file_ids': file_ids, **meta})
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить file_id результата {generation_id}: {e}")
+
+
+async def get_result(generation_id: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Сохранённый результат генерации (file_ids и метаданные) или None."""
+    if not generation_id:
+        return None
+    try:
+        return await result_cache.get(generation_id)
+    except Exception as e:
+        logger.warning(f"Не удалось получить результат {generation_id}: {e}")
+        return None
+
+
+def merge_sources(file_ids: List[str], urls: List[str]) -> List[str]:
+    """Для каждого результата берёт file_id, если он есть, иначе ссылку Replicate."""
+    sources = list(file_ids[:len(urls)]) if urls else list(file_ids)
+    sources.extend(urls[len(sources):])
+    return sources
+
+
+async def get_result_sources(generation_data: Dict[str, Any]) -> List[str]:
+    """Что отправлять для сохранённой генерации: file_id из хранилища, для остальных фото — ссылки."""
+    urls = list(generation_data.get('image_urls') or [])
+    stored = await get_result(generation_data.get('generation_id'))
+    if not stored:
+        return urls
+    return merge_sources(stored.get('file_ids') or [], urls or list(stored.get('image_urls') or []))
+
+
+def build_media_group(sources: Sequence[MediaSource], caption: Optional[str] = None,
+                      parse_mode: Optional[str] = None) -> List[InputMediaPhoto]:
+    """Альбом из file_id, ссылок или файлов; подпись у первого элемента."""
+    return [
+        InputMediaPhoto(media=source, caption=caption, parse_mode=parse_mode) if i == 0 and caption
+        else InputMediaPhoto(media=source)
+        for i, source in enumerate(sources)
+    ]
+
+
+async def send_result(bot: Bot, chat_id: int, sources: Sequence[MediaSource], caption: Optional[str] = None,
+                      parse_mode: Optional[str] = None, reply_markup=None) -> List[str]:
+    """Отправляет результат одним фото или альбомом и возвращает file_id отправленных фото."""
+    if len(sources) == 1:
+        message = await bot.send_photo(
+            chat_id=chat_id, photo=sources[0], caption=caption,
+            parse_mode=parse_mode, reply_markup=reply_markup
+        )
+        return file_ids_from_messages(message)
+    messages = await bot.send_media_group(chat_id=chat_id, media=build_media_group(sources, caption, parse_mode))
+    return file_ids_from_messages(messages)
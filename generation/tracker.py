@@ -0,0 +1,255 @@
+# generation/tracker.py
+import asyncio
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import aiofiles
+import aiohttp
+
+from config import TRACKER_MAX_ACTIVE, TRACKER_MAX_CALLBACKS
+from replicate_client import Prediction, replicate_client
+from logger import get_logger
+
+logger = get_logger('generation')
+
+DoneCallback = Callable[[Prediction], Awaitable[None]]
+PendingCallback = Callable[[Prediction, int], Awaitable[None]]
+TimeoutCallback = Callable[[], Awaitable[None]]
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_STATUS_REQUESTS = 10
+
+
+class _Tracked:
+    __slots__ = ('prediction_id', 'kind', 'interval', 'max_checks', 'checks', 'errors',
+                 'next_check', 'on_done', 'on_pending', 'on_timeout')
+
+    def __init__(self, prediction_id: str, kind: str, interval: float, max_checks: Optional[int], delay: float,
+                 on_done: DoneCallback, on_pending: Optional[PendingCallback], on_timeout: Optional[TimeoutCallback]):
+        self.prediction_id = prediction_id
+        self.kind = kind
+        self.interval = interval
+        self.max_checks = max_checks
+        self.checks = 0
+        self.errors = 0
+        self.next_check = time.monotonic() + delay
+        self.on_done = on_done
+        self.on_pending = on_pending
+        self.on_timeout = on_timeout
+
+
+class PredictionTracker:
+    """Отслеживание долгих предсказаний (видео) и обучений Replicate.
+
+    Все ожидающие задачи опрашиваются одним циклом: за тик берётся первая
+    страница списка предсказаний/обучений, а отдельные запросы делаются
+    только для завершившихся и не попавших в список. При настроенном
+    webhook результат приходит сразу, опрос лишь страхует. По завершении
+    вызывается колбэк с итоговым Prediction.
+
+    Реестр ключуется prediction_id: повторная постановка уже отслеживаемой
+    (или ещё обрабатываемой колбэком) задачи игнорируется. Число
+    отслеживаемых задач и одновременно работающих колбэков ограничено;
+    не принятые задачи остаются в БД и подбираются следующим обходом.
+    """
+
+    def __init__(self, max_active: int, max_callbacks: int,
+                 max_status_requests: int = MAX_STATUS_REQUESTS, max_errors: int = 10):
+        self.max_active = max_active
+        self.max_errors = max_errors
+        self._tracked: Dict[str, _Tracked] = {}
+        self._semaphore = asyncio.Semaphore(max_status_requests)
+        self._callback_semaphore = asyncio.Semaphore(max_callbacks)
+        self._loop_task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._callbacks: Dict[str, asyncio.Task] = {}
+        self._stats = {'tracked': 0, 'duplicates': 0, 'rejected': 0, 'completed': 0, 'timeouts': 0,
+                       'list_requests': 0, 'status_requests': 0, 'webhooks': 0, 'errors': 0}
+
+    def track(self, prediction_id: str, kind: str, on_done: DoneCallback, interval: float = 60.0,
+              delay: float = 0.0, max_checks: Optional[int] = None,
+              on_pending: Optional[PendingCallback] = None, on_timeout: Optional[TimeoutCallback] = None) -> bool:
+        """Ставит предсказание ('predictions') или обучение ('trainings') на отслеживание.
+
+        Возвращает False, если задача уже отслеживается или реестр заполнен.
+        """
+        if self.is_tracked(prediction_id):
+            self._stats['duplicates'] += 1
+            logger.debug(f"{prediction_id} уже отслеживается")
+            return False
+        if len(self._tracked) >= self.max_active:
+            self._stats['rejected'] += 1
+            logger.warning(f"Реестр отслеживания заполнен ({self.max_active}), {prediction_id} подберёт следующий обход")
+            return False
+        self._tracked[prediction_id] = _Tracked(
+            prediction_id, kind, interval, max_checks, delay, on_done, on_pending, on_timeout
+        )
+        self._stats['tracked'] += 1
+        if replicate_client.webhook_url:
+            waiter = replicate_client.watch(prediction_id)
+            waiter.add_done_callback(lambda f, pid=prediction_id: self._on_webhook(pid, f))
+        self._ensure_started()
+        self._wakeup.set()
+        return True
+
+    def is_tracked(self, prediction_id: str) -> bool:
+        """Отслеживается ли задача или ещё обрабатывается её результат."""
+        return prediction_id in self._tracked or prediction_id in self._callbacks
+
+    def _ensure_started(self) -> None:
+        if self._loop_task is None or self._loop_task.done():
+            self._wakeup = asyncio.Event()
+            self._loop_task = asyncio.create_task(self._run())
+
+    def _on_webhook(self, prediction_id: str, waiter: asyncio.Future) -> None:
+        if waiter.cancelled() or waiter.exception() is not None:
+            return
+        self._stats['webhooks'] += 1
+        self._complete(prediction_id, waiter.result())
+
+    def _complete(self, prediction_id: str, prediction: Prediction) -> None:
+        item = self._tracked.pop(prediction_id, None)
+        if item is None:
+            return
+        replicate_client.unwatch(prediction_id)
+        self._stats['completed'] += 1
+        self._finish(item.on_done(prediction), prediction_id)
+
+    def _finish(self, coro: Awaitable[None], prediction_id: str) -> None:
+        """Запускает итоговый колбэк; до его окончания задача остаётся в реестре."""
+        task = asyncio.create_task(self._guard(coro, prediction_id))
+        self._callbacks[prediction_id] = task
+        task.add_done_callback(lambda _, pid=prediction_id: self._callbacks.pop(pid, None))
+
+    def _notify(self, coro: Awaitable[None], prediction_id: str) -> None:
+        """Промежуточное уведомление (задача ещё выполняется)."""
+        asyncio.create_task(self._guard(coro, prediction_id))
+
+    async def _guard(self, coro: Awaitable[None], prediction_id: str) -> None:
+        try:
+            async with self._callback_semaphore:
+                await coro
+        except Exception as e:
+            logger.error(f"Ошибка обработки результата {prediction_id}: {e}", exc_info=True)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                due = [item for item in self._tracked.values() if item.next_check <= time.monotonic()]
+                if due:
+                    await self._poll(due)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка цикла отслеживания Replicate: {e}", exc_info=True)
+            self._wakeup.clear()
+            timeout = None
+            if self._tracked:
+                timeout = max(0.5, min(item.next_check for item in self._tracked.values()) - time.monotonic())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _poll(self, due: List[_Tracked]) -> None:
+        """Один тик: статусы всех подошедших задач пачкой."""
+        listed: Dict[str, Prediction] = {}
+        for kind in {item.kind for item in due}:
+            try:
+                self._stats['list_requests'] += 1
+                listed.update((p.id, p) for p in await replicate_client.list_recent(kind))
+            except Exception as e:
+                logger.warning(f"Не удалось получить список {kind} Replicate: {e}")
+        # Завершившиеся и не попавшие в первую страницу запрашиваем по одному: нужен полный output
+        results = await asyncio.gather(*(
+            self._fetch(item) if item.prediction_id not in listed or listed[item.prediction_id].done
+            else self._listed(listed[item.prediction_id])
+            for item in due
+        ), return_exceptions=True)
+        for item, result in zip(due, results):
+            if self._tracked.get(item.prediction_id) is not item:
+                continue  # Уже завершено webhook'ом или перерегистрировано
+            item.next_check = time.monotonic() + item.interval
+            if isinstance(result, Exception):
+                item.errors += 1
+                self._stats['errors'] += 1
+                logger.warning(f"Ошибка проверки статуса {item.prediction_id} ({item.errors}/{self.max_errors}): {result}")
+                if item.errors >= self.max_errors:
+                    self._expire(item)
+                continue
+            if result.done:
+                self._complete(item.prediction_id, result)
+                continue
+            item.checks += 1
+            if item.max_checks is not None and item.checks >= item.max_checks:
+                self._expire(item)
+            elif item.on_pending is not None:
+                self._notify(item.on_pending(result, item.checks), item.prediction_id)
+
+    @staticmethod
+    async def _listed(prediction: Prediction) -> Prediction:
+        return prediction
+
+    async def _fetch(self, item: _Tracked) -> Prediction:
+        async with self._semaphore:
+            self._stats['status_requests'] += 1
+            if item.kind == 'trainings':
+                try:
+                    return await replicate_client.get_training(item.prediction_id)
+                except Exception as e:
+                    logger.warning(f"Не удалось получить статус через trainings API: {e}")
+            return await replicate_client.get_prediction(item.prediction_id)
+
+    def _expire(self, item: _Tracked) -> None:
+        self._tracked.pop(item.prediction_id, None)
+        replicate_client.unwatch(item.prediction_id)
+        self._stats['timeouts'] += 1
+        logger.error(f"Отслеживание {item.prediction_id} прекращено: превышено число проверок")
+        if item.on_timeout is not None:
+            self._finish(item.on_timeout(), item.prediction_id)
+
+    async def stop(self) -> None:
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            try:
+                await self._loop_task
+            except asyncio.CancelledError:
+                pass
+            self._loop_task = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Число отслеживаемых задач и счётчики запросов."""
+        stats = dict(self._stats)
+        stats['pending'] = len(self._tracked)
+        stats['callbacks_running'] = len(self._callbacks)
+        return stats
+
+
+async def download_to_file(url: str, path: str, timeout: float = 600) -> int:
+    """Скачивает файл по частям во временный файл и атомарно переносит в path; возвращает размер."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.part"
+    size = 0
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout, sock_read=60)) as session:
+            async with session.get(url) as response:
+                response.raise_for_status()
+                async with aiofiles.open(tmp_path, 'wb') as f:
+                    async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        await f.write(chunk)
+                        size += len(chunk)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return size
+
+
+prediction_tracker = PredictionTracker(max_active=TRACKER_MAX_ACTIVE, max_callbacks=TRACKER_MAX_CALLBACKS)
+
+
+def get_tracker_stats() -> Dict[str, Any]:
+    """Метрики отслеживания видео и обучений."""
+    return prediction_tracker.get_stats()
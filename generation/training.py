@@ -1,12 +1,11 @@
 from asyncio import Lock
 import re
 import aiosqlite
+from db_pool import db_pool
 import asyncio
 import logging
-import os
 import uuid
 import random
-import zipfile
 from typing import Dict, Optional, List
 from aiogram import Bot, Router
 from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, ContentType
@@ -15,15 +14,16 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.filters import Command
 from aiogram.exceptions import TelegramBadRequest
 from aiogram.enums import ParseMode
-import replicate
 from replicate.exceptions import ReplicateError
 
-from config import REPLICATE_USERNAME_OR_ORG_NAME, ADMIN_IDS, REPLICATE_API_TOKEN, DATABASE_PATH
+from config import REPLICATE_USERNAME_OR_ORG_NAME, ADMIN_IDS, MAX_FILE_SIZE_BYTES
+from replicate_client import replicate_client
 from generation_config import IMAGE_GENERATION_MODELS
-from database import check_database_user, update_user_credits, save_user_trainedmodel, update_trainedmodel_status, log_generation, check_user_resources
+from database import check_database_user, update_user_credits, save_user_trainedmodel, update_trainedmodel_status, log_generation, check_user_resources, debit_user_resources, credit_user_resources
 from keyboards import create_main_menu_keyboard, create_training_keyboard, create_user_profile_keyboard, create_subscription_keyboard, create_confirmation_keyboard
-from generation.utils import TempFileManager, reset_generation_context, send_message_with_fallback
-from generation.images import upload_image_to_replicate
+from generation.utils import reset_generation_context, send_message_with_fallback
+from generation.photo_ingest import training_ingest, PhotoRejected
+from generation.tracker import prediction_tracker
 from handlers.utils import clean_admin_context, safe_escape_markdown as escape_md, escape_message_parts
 from utils import get_cookie_progress_bar
 
@@ -138,9 +138,9 @@ async def schedule_training_notifications(bot: Bot, user_id: int, avatar_name: s
             asyncio.create_task(send_training_progress_with_delay(
                 bot, user_id, minutes, avatar_name, total_minutes, delay=minutes * 60
             ))
-    asyncio.create_task(check_training_status_with_delay(
+    await check_training_status_with_delay(
         bot, {'user_id': user_id, 'prediction_id': training_id, 'model_name': model_name, 'avatar_id': avatar_id}, delay=total_minutes * 60
-    ))
+    )
 
 async def start_training(message: Message, state: FSMContext) -> None:
     """Запускает обучение аватара с использованием Replicate trainings API."""
@@ -200,165 +200,155 @@ async def start_training(message: Message, state: FSMContext) -> None:
 
     model_name_for_db = f"{REPLICATE_USERNAME_OR_ORG_NAME}/fastnew"
 
-    async with TempFileManager() as temp_manager:
+    try:
+        if await debit_user_resources(user_id, avatars=1) is None:
+            await check_user_resources(bot, user_id, required_avatars=1)
+            return
+        logger.info(f"Списан 1 аватар для user_id={user_id} ПЕРЕД запуском обучения.")
+
         try:
-            await update_user_credits(user_id, "decrement_avatar", amount=1)
-            logger.info(f"Списан 1 аватар для user_id={user_id} ПЕРЕД запуском обучения.")
+            zip_bytes, photo_count = await training_ingest.build(bot, user_id, training_photos)
+        except Exception as e_zip:
+            logger.error(f"Ошибка создания ZIP для user_id={user_id}: {e_zip}", exc_info=True)
+            raise RuntimeError(f"Ошибка создания ZIP-архива: {e_zip}")
+        if photo_count < 10:
+            raise RuntimeError(f"Подготовлено только {photo_count} фото из {len(training_photos)}")
+        if len(zip_bytes) > MAX_FILE_SIZE_BYTES:
+            raise ValueError(f"Архив слишком большой: {len(zip_bytes) / 1024 / 1024:.2f} MB")
+
+        await status_message.edit_text(
+            escape_md("📤 Загружаю твои фотографии в облако...", version=2),
+            parse_mode=ParseMode.MARKDOWN_V2
+        )
 
-            zip_dir = f"uploads/{user_id}"
-            os.makedirs(zip_dir, exist_ok=True)
-            zip_filename = f"train_photos_{trigger_word}_{uuid.uuid4().hex[:6]}.zip"
-            zip_path = os.path.join(zip_dir, zip_filename)
-            temp_manager.add(zip_path)
+        zip_url = await replicate_client.upload_file(
+            zip_bytes, f"train_photos_{trigger_word}_{uuid.uuid4().hex[:6]}.zip", 'application/zip'
+        )
+        logger.info(f"Архив фото для user_id={user_id} загружен: {zip_url}")
 
-            try:
-                with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                    for photo_path_item in training_photos:
-                        if os.path.exists(photo_path_item):
-                            zipf.write(photo_path_item, os.path.basename(photo_path_item))
-                            temp_manager.add(photo_path_item)
-                        else:
-                            logger.warning(f"Файл фото {photo_path_item} не найден при создании ZIP для user_id={user_id}")
-                logger.info(f"ZIP-архив создан: {zip_path} с {len(training_photos)} файлами.")
-            except Exception as e_zip:
-                logger.error(f"Ошибка создания ZIP для user_id={user_id}: {e_zip}", exc_info=True)
-                raise RuntimeError(f"Ошибка создания ZIP-архива: {e_zip}")
-
-            replicate_client = replicate.Client(api_token=REPLICATE_API_TOKEN)
+        await status_message.edit_text(
+            escape_md("✅ Фотографии загружены. Запускаю обучение нейросети...", version=2),
+            parse_mode=ParseMode.MARKDOWN_V2
+        )
 
-            await status_message.edit_text(
-                escape_md("📤 Загружаю твои фотографии в облако...", version=2),
-                parse_mode=ParseMode.MARKDOWN_V2
-            )
+        training_params = {"lora_type": "subject", "input_images": zip_url, "training_steps": 1000}
 
-            zip_url = await upload_image_to_replicate(zip_path)
+        logger.info(f"Запуск обучения. Destination: {model_name_for_db}, Version: {TRAINER_VERSION}, Params: {training_params}")
 
-            await status_message.edit_text(
-                escape_md("✅ Фотографии загружены. Запускаю обучение нейросети...", version=2),
-                parse_mode=ParseMode.MARKDOWN_V2
+        training_id = None
+        try:
+            training = await replicate_client.create_training(
+                TRAINER_VERSION, model_name_for_db, training_params
             )
+            training_id = training.id
+            if not training_id:
+                raise ValueError("Не удалось получить ID для задачи обучения!")
+            logger.info(f"Обучение запущено через trainings API: user_id={user_id}, training_id={training_id}, destination={model_name_for_db}")
+        except Exception as e:
+            logger.warning(f"Не удалось создать обучение через trainings API: {e}")
+            try:
+                prediction = await replicate_client.create_prediction(
+                    TRAINER_VERSION, {**training_params, "trigger_word": trigger_word}
+                )
+                training_id = prediction.id or f"training_{uuid.uuid4().hex[:8]}"
+                logger.info(f"Альтернативный запуск обучения как предикции: training_id={training_id}")
+            except Exception as e_alt:
+                logger.error(f"Ошибка альтернативного запуска: {e_alt}")
+                raise
 
-            training_params = {"lora_type": "subject", "input_images": zip_url, "training_steps": 1000}
+        if not training_id:
+            raise ValueError("Не удалось получить ID обучения ни одним способом!")
 
-            logger.info(f"Запуск обучения. Destination: {model_name_for_db}, Version: {TRAINER_VERSION}, Params: {training_params}")
+        new_avatar_id = await save_user_trainedmodel(
+            user_id, training_id, trigger_word, training_photos, avatar_name, training_step="started"
+        )
 
-            training_id = None
-            try:
-                training = replicate_client.trainings.create(
-                    destination=model_name_for_db, version=TRAINER_VERSION, input=training_params
-                )
-                training_id = training.id
-                if not training_id:
-                    raise ValueError("Не удалось получить ID для задачи обучения!")
-                logger.info(f"Обучение запущено через trainings API: user_id={user_id}, training_id={training_id}, destination={model_name_for_db}")
-            except Exception as e:
-                logger.warning(f"Не удалось создать обучение через trainings API: {e}")
-                try:
-                    prediction = replicate_client.run(
-                        TRAINER_VERSION, input={**training_params, "trigger_word": trigger_word}
-                    )
-                    training_id = prediction.id if hasattr(prediction, 'id') else f"training_{uuid.uuid4().hex[:8]}"
-                    logger.info(f"Альтернативный запуск обучения как предикции: training_id={training_id}")
-                except Exception as e_alt:
-                    logger.error(f"Ошибка альтернативного запуска: {e_alt}")
-                    raise
+        if not new_avatar_id:
+            raise RuntimeError("Не удалось сохранить информацию о запуске обучения в БД.")
 
-            if not training_id:
-                raise ValueError("Не удалось получить ID обучения ни одним способом!")
+        await update_trainedmodel_status(avatar_id=new_avatar_id, model_id=model_name_for_db, status='starting')
 
-            new_avatar_id = await save_user_trainedmodel(
-                user_id, training_id, trigger_word, training_photos, avatar_name, training_step="started"
-            )
+        await log_generation(user_id, 'train_flux', TRAINER_VERSION, units_generated=1, style='training', ratio=None)
 
-            if not new_avatar_id:
-                raise RuntimeError("Не удалось сохранить информацию о запуске обучения в БД.")
+        final_user_message = (
+            escape_md(f"🚀 Обучение аватара '{avatar_name}' запущено!", version=2) + "\n\n" +
+            escape_md("⚡ Это займёт всего около 3-х минут благодаря нашей продвинутой нейросети!", version=2) + "\n" +
+            escape_md("📱 Я буду присылать уведомления о прогрессе.", version=2) + "\n" +
+            escape_md("🔔 Ты получишь уведомление, как только аватар будет готов!", version=2) + "\n\n" +
+            escape_md("✨ Наша нейросеть создает аватары высочайшего качества в соответствии с вашими фото!", version=2)
+        )
 
-            await update_trainedmodel_status(avatar_id=new_avatar_id, model_id=model_name_for_db, status='starting')
+        await status_message.edit_text(
+            final_user_message,
+            reply_markup=await create_main_menu_keyboard(user_id),
+            parse_mode=ParseMode.MARKDOWN_V2
+        )
 
-            await log_generation(user_id, 'train_flux', TRAINER_VERSION, units_generated=1, style='training', ratio=None)
+        status_message = None
 
-            final_user_message = (
-                escape_md(f"🚀 Обучение аватара '{avatar_name}' запущено!", version=2) + "\n\n" +
-                escape_md("⚡ Это займёт всего около 3-х минут благодаря нашей продвинутой нейросети!", version=2) + "\n" +
-                escape_md("📱 Я буду присылать уведомления о прогрессе.", version=2) + "\n" +
-                escape_md("🔔 Ты получишь уведомление, как только аватар будет готов!", version=2) + "\n\n" +
-                escape_md("✨ Наша нейросеть создает аватары высочайшего качества в соответствии с вашими фото!", version=2)
-            )
+        await schedule_training_notifications(
+            bot, user_id, avatar_name, new_avatar_id, training_id, model_name_for_db, total_minutes=5
+        )
 
+        await reset_generation_context(state, 'train_flux_started_success')
+
+    except ReplicateError as e_replicate:
+        logger.error(f"Ошибка Replicate при запуске обучения для user_id={user_id}: "
+                    f"{e_replicate.detail if hasattr(e_replicate, 'detail') else e_replicate}", exc_info=True)
+        await credit_user_resources(user_id, avatars=1)
+        logger.info(f"Возвращен 1 аватар для user_id={user_id} из-за ReplicateError при обучении.")
+        user_message_error = (
+            escape_md(f"❌ Ошибка запуска обучения нейросети. ", version=2) +
+            escape_md(f"Аватар '{avatar_name}' возвращён на баланс. Попробуй снова.", version=2)
+        )
+        if status_message:
             await status_message.edit_text(
-                final_user_message,
-                reply_markup=await create_main_menu_keyboard(user_id),
+                user_message_error,
+                reply_markup=await create_user_profile_keyboard(user_id, bot),
                 parse_mode=ParseMode.MARKDOWN_V2
             )
-
-            status_message = None
-
-            await schedule_training_notifications(
-                bot, user_id, avatar_name, new_avatar_id, training_id, model_name_for_db, total_minutes=5
+        else:
+            await send_message_with_fallback(
+                bot, user_id, user_message_error,
+                reply_markup=await create_user_profile_keyboard(user_id, bot),
+                parse_mode=ParseMode.MARKDOWN_V2
             )
-
-            await reset_generation_context(state, 'train_flux_started_success')
-
-        except ReplicateError as e_replicate:
-            logger.error(f"Ошибка Replicate при запуске обучения для user_id={user_id}: "
-                        f"{e_replicate.detail if hasattr(e_replicate, 'detail') else e_replicate}", exc_info=True)
-            await update_user_credits(user_id, "increment_avatar", amount=1)
-            logger.info(f"Возвращен 1 аватар для user_id={user_id} из-за ReplicateError при обучении.")
-            user_message_error = (
-                escape_md(f"❌ Ошибка запуска обучения нейросети. ", version=2) +
-                escape_md(f"Аватар '{avatar_name}' возвращён на баланс. Попробуй снова.", version=2)
+        await reset_generation_context(state, 'train_flux_replicate_error')
+
+    except Exception as e_train:
+        logger.error(f"Общая ошибка запуска обучения для user_id={user_id}: {e_train}", exc_info=True)
+        await credit_user_resources(user_id, avatars=1)
+        logger.info(f"Возвращен 1 аватар для user_id={user_id} из-за общей ошибки обучения.")
+        user_message_error_general = (
+            escape_md(f"❌ Ошибка запуска обучения нейросети. ", version=2) +
+            escape_md(f"Аватар '{avatar_name}' возвращён на баланс. Попробуй снова через несколько минут.", version=2)
+        )
+        if status_message:
+            await status_message.edit_text(
+                user_message_error_general,
+                reply_markup=await create_user_profile_keyboard(user_id, bot),
+                parse_mode=ParseMode.MARKDOWN_V2
             )
-            if status_message:
-                await status_message.edit_text(
-                    user_message_error,
-                    reply_markup=await create_user_profile_keyboard(user_id, bot),
-                    parse_mode=ParseMode.MARKDOWN_V2
-                )
-            else:
-                await send_message_with_fallback(
-                    bot, user_id, user_message_error,
-                    reply_markup=await create_user_profile_keyboard(user_id, bot),
-                    parse_mode=ParseMode.MARKDOWN_V2
-                )
-            await reset_generation_context(state, 'train_flux_replicate_error')
-
-        except Exception as e_train:
-            logger.error(f"Общая ошибка запуска обучения для user_id={user_id}: {e_train}", exc_info=True)
-            await update_user_credits(user_id, "increment_avatar", amount=1)
-            logger.info(f"Возвращен 1 аватар для user_id={user_id} из-за общей ошибки обучения.")
-            user_message_error_general = (
-                escape_md(f"❌ Ошибка запуска обучения нейросети. ", version=2) +
-                escape_md(f"Аватар '{avatar_name}' возвращён на баланс. Попробуй снова через несколько минут.", version=2)
+        else:
+            await send_message_with_fallback(
+                bot, user_id, user_message_error_general,
+                reply_markup=await create_user_profile_keyboard(user_id, bot),
+                parse_mode=ParseMode.MARKDOWN_V2
             )
-            if status_message:
-                await status_message.edit_text(
-                    user_message_error_general,
-                    reply_markup=await create_user_profile_keyboard(user_id, bot),
-                    parse_mode=ParseMode.MARKDOWN_V2
-                )
-            else:
-                await send_message_with_fallback(
-                    bot, user_id, user_message_error_general,
-                    reply_markup=await create_user_profile_keyboard(user_id, bot),
-                    parse_mode=ParseMode.MARKDOWN_V2
-                )
-            await reset_generation_context(state, 'train_flux_general_error')
+        await reset_generation_context(state, 'train_flux_general_error')
 
-        finally:
-            if status_message:
-                try:
-                    await status_message.delete()
-                except Exception:
-                    pass
+    finally:
+        if status_message:
+            try:
+                await status_message.delete()
+            except Exception:
+                pass
 
-async def check_training_status(bot: Bot, data: Dict[str, any]) -> None:
-    """Проверяет статус тренировки модели с улучшенными уведомлениями."""
-    user_id = data['user_id']
-    training_id = data.get('prediction_id', data.get('training_id'))
-    model_name = data['model_name']
-    avatar_id = data['avatar_id']
+TRAINING_POLL_INTERVAL = 30
 
-    async with aiosqlite.connect(DATABASE_PATH) as conn:
+
+async def _get_avatar_info(avatar_id: int):
+    async with db_pool.reader() as conn:
         conn.row_factory = aiosqlite.Row
         c = await conn.cursor()
         await c.execute(
@@ -366,40 +356,81 @@ async def check_training_status(bot: Bot, data: Dict[str, any]) -> None:
             (avatar_id,)
         )
         avatar_info = await c.fetchone()
-
     if not avatar_info:
         logger.error(f"Не найдена информация об аватаре avatar_id={avatar_id}")
+    return avatar_info
+
+
+def _track_training(bot: Bot, data: Dict[str, any], delay: float) -> bool:
+    return prediction_tracker.track(
+        data.get('prediction_id', data.get('training_id')), 'trainings',
+        on_done=lambda training: _finish_training(bot, data, training),
+        on_pending=lambda training, checks: _training_pending(bot, data, training, checks),
+        on_timeout=lambda: _training_check_failed(bot, data),
+        interval=TRAINING_POLL_INTERVAL, delay=delay
+    )
+
+
+async def check_training_status(bot: Bot, data: Dict[str, any]) -> None:
+    """Ставит обучение на отслеживание; результат обработает _finish_training."""
+    logger.info(f"Отслеживание обучения: user_id={data['user_id']}, avatar_id={data['avatar_id']}, "
+                f"training_id={data.get('prediction_id', data.get('training_id'))}")
+    _track_training(bot, data, delay=0)
+
+
+async def _training_pending(bot: Bot, data: Dict[str, any], training, checks: int) -> None:
+    """Обучение ещё идёт: один раз сообщаем, что аватар почти готов."""
+    logger.info(f"Тренировка для user_id={data['user_id']}, avatar_id={data['avatar_id']} всё ещё в процессе: {training.status}")
+    if checks != 1:
         return
+    avatar_info = await _get_avatar_info(data['avatar_id'])
+    if not avatar_info:
+        return
+    safe_avatar_name = escape_md(avatar_info['avatar_name'], version=2)
+    progress_message = (
+        escape_md(f"⏳ Аватар '{safe_avatar_name}' почти готов! Сообщу, как только обучение завершится...", version=2)
+    )
+    await send_message_with_fallback(
+        bot, data['user_id'], progress_message, parse_mode=ParseMode.MARKDOWN_V2, is_escaped=True
+    )
 
-    avatar_name = avatar_info['avatar_name']
-    trigger_word = avatar_info['trigger_word']
 
-    replicate_client = replicate.Client(api_token=REPLICATE_API_TOKEN)
+async def _training_check_failed(bot: Bot, data: Dict[str, any]) -> None:
+    """Статус обучения так и не удалось получить: возвращаем аватар на баланс."""
+    user_id = data['user_id']
+    avatar_info = await _get_avatar_info(data['avatar_id'])
+    avatar_name = avatar_info['avatar_name'] if avatar_info else f"Avatar {data['avatar_id']}"
+    await update_trainedmodel_status(data['avatar_id'], status='failed')
+    await credit_user_resources(user_id, avatars=1)
+    safe_avatar_name = escape_md(avatar_name, version=2)
+    error_message = (
+        escape_md(f"❌ Ошибка проверки обучения аватара '{safe_avatar_name}'. ", version=2) +
+        escape_md("Аватар возвращён на баланс. Попробуй снова позже.", version=2)
+    )
+    await send_message_with_fallback(
+        bot, user_id, error_message, reply_markup=await create_main_menu_keyboard(user_id), parse_mode=ParseMode.MARKDOWN_V2, is_escaped=True
+    )
 
-    try:
-        logger.info(f"Проверка статуса тренировки для user_id={user_id}, avatar_id={avatar_id}, training_id={training_id}")
 
-        training_status = None
-        output = None
+async def _finish_training(bot: Bot, data: Dict[str, any], training) -> None:
+    """Обрабатывает завершённое обучение: сохраняет версию модели и уведомляет пользователя и админов."""
+    user_id = data['user_id']
+    training_id = data.get('prediction_id', data.get('training_id'))
+    model_name = data['model_name']
+    avatar_id = data['avatar_id']
 
-        try:
-            training = replicate_client.trainings.get(training_id)
-            training_status = training.status
-            output = training.output if hasattr(training, 'output') else None
-            logger.info(f"Получен статус через trainings API: {training_status}")
-            logger.debug(f"Training output: {output}")
-        except Exception as e:
-            logger.warning(f"Не удалось получить статус через trainings API: {e}")
-            try:
-                prediction = replicate_client.predictions.get(training_id)
-                training_status = prediction.status
-                output = prediction.output
-                logger.info(f"Получен статус через predictions API: {training_status}")
-                logger.debug(f"Prediction output: {output}")
-            except Exception as e2:
-                logger.error(f"Не удалось получить статус ни через trainings, ни через predictions API: {e2}")
-                training_status = 'failed'
-                output = None
+    avatar_info = await _get_avatar_info(avatar_id)
+    if not avatar_info:
+        return
+
+    avatar_name = avatar_info['avatar_name']
+    trigger_word = avatar_info['trigger_word']
+
+    try:
+        training_status = training.status
+        output = training.output
+        logger.info(f"Обучение training_id={training_id} завершилось со статусом: {training_status}")
+        logger.debug(f"Training output: {output}")
 
         if training_status == 'succeeded':
             model_version = None
@@ -439,12 +470,9 @@ async def check_training_status(bot: Bot, data: Dict[str, any]) -> None:
                 logger.error(f"Не удалось извлечь версию модели из output: {output}")
                 try:
                     model_base = model_name.split(':')[0] if ':' in model_name else model_name
-                    model = replicate_client.models.get(model_base)
-                    if model and hasattr(model, 'latest_version'):
-                        latest_version = model.latest_version
-                        if hasattr(latest_version, 'id'):
-                            model_version = latest_version.id
-                            logger.info(f"Версия получена из latest_version: {model_version}")
+                    model_version = await replicate_client.get_latest_version(model_base)
+                    if model_version:
+                        logger.info(f"Версия получена из latest_version: {model_version}")
                 except Exception as e:
                     logger.error(f"Не удалось получить версию через models API: {e}")
                 if not model_version:
@@ -533,22 +561,11 @@ async def check_training_status(bot: Bot, data: Dict[str, any]) -> None:
             await send_message_with_fallback(
                 bot, user_id, error_message, reply_markup=await create_main_menu_keyboard(user_id), parse_mode=ParseMode.MARKDOWN_V2, is_escaped=True
             )
-            await update_user_credits(user_id, "increment_avatar", amount=1)
-
-        else:
-            logger.info(f"Тренировка для user_id={user_id}, avatar_id={avatar_id} всё ещё в процессе: {training_status}")
-            safe_avatar_name = escape_md(avatar_name, version=2)
-            progress_message = (
-                escape_md(f"⏳ Аватар '{safe_avatar_name}' почти готов! Проверю снова через 30 секунд...", version=2)
-            )
-            await send_message_with_fallback(
-                bot, user_id, progress_message, parse_mode=ParseMode.MARKDOWN_V2, is_escaped=True
-            )
-            asyncio.create_task(check_training_status_with_delay(bot, data, delay=30))
+            await credit_user_resources(user_id, avatars=1)
 
     except Exception as e:
         logger.error(f"Ошибка проверки статуса для user_id={user_id}: {e}", exc_info=True)
-        await update_user_credits(user_id, "increment_avatar", amount=1)
+        await credit_user_resources(user_id, avatars=1)
         safe_avatar_name = escape_md(avatar_name, version=2)
         error_message = (
             escape_md(f"❌ Ошибка проверки обучения аватара '{safe_avatar_name}'. ", version=2) +
@@ -558,15 +575,15 @@ async def check_training_status(bot: Bot, data: Dict[str, any]) -> None:
             bot, user_id, error_message, reply_markup=await create_main_menu_keyboard(user_id), parse_mode=ParseMode.MARKDOWN_V2, is_escaped=True
         )
 
+
 async def check_training_status_with_delay(bot: Bot, data: Dict[str, any], delay: int) -> None:
-    """Проверка статуса обучения с задержкой."""
-    await asyncio.sleep(delay)
-    await check_training_status(bot, data)
+    """Ставит обучение на отслеживание с первой проверкой через delay секунд."""
+    _track_training(bot, data, delay=delay)
 
 async def check_pending_trainings(bot: Bot) -> None:
     """Проверяет и возобновляет незавершенные задачи обучения."""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
             await c.execute("""
@@ -580,8 +597,7 @@ async def check_pending_trainings(bot: Bot) -> None:
             logger.info("Нет незавершенных задач обучения для проверки.")
             return
 
-        logger.info(f"Найдено {len(pending_trainings)} незавершенных задач обучения для проверки.")
-
+        adopted = 0
         for row in pending_trainings:
             user_id = row['user_id']
             training_id = row['prediction_id']
@@ -593,6 +609,8 @@ async def check_pending_trainings(bot: Bot) -> None:
             if not training_id:
                 logger.warning(f"Пропуск проверки обучения для avatar_id={avatar_id}, user_id={user_id}: отсутствует training_id.")
                 continue
+            if prediction_tracker.is_tracked(training_id):
+                continue
 
             model_name_for_check = model_id_db
             if not model_name_for_check:
@@ -603,9 +621,12 @@ async def check_pending_trainings(bot: Bot) -> None:
             logger.info(f"Возобновление проверки статуса обучения для user_id={user_id}, "
                         f"avatar_id={avatar_id}, training_id={training_id}, model_name='{model_name_for_check}'")
 
-            asyncio.create_task(check_training_status_with_delay(bot, {
+            if _track_training(bot, {
                 'user_id': user_id, 'prediction_id': training_id, 'model_name': model_name_for_check, 'avatar_id': avatar_id
-            }, delay=random.randint(10, 30)))
+            }, delay=random.randint(10, 30)):
+                adopted += 1
+
+        logger.info(f"Незавершенных задач обучения: {len(pending_trainings)}, взято на отслеживание: {adopted}")
 
     except Exception as e:
         logger.error(f"Ошибка при проверке незавершенных задач обучения: {e}", exc_info=True)
@@ -797,18 +818,18 @@ async def handle_training_photos(message: Message, state: FSMContext):
     # Используем фото с наивысшим разрешением
     photo = photos[-1]  # Последний элемент имеет максимальное разрешение
     logger.info(f"Обрабатываю фото: file_id={photo.file_id} для user_id={user_id}")
+    if photo.file_id in training_photos:
+        logger.debug(f"Фото {photo.file_id} уже было добавлено для user_id={user_id}")
+        return
     try:
-        file = await bot.get_file(photo.file_id)
-        photo_path = f"temp/{user_id}_{uuid.uuid4()}.jpg"
-        logger.info(f"Создаю путь к файлу: {photo_path}")
-        os.makedirs(os.path.dirname(photo_path), exist_ok=True)
-        await bot.download_file(file.file_path, photo_path)
-        logger.info(f"Файл скачан: {photo_path}, размер: {os.path.getsize(photo_path) if os.path.exists(photo_path) else 'файл не найден'}")
-        if photo_path not in training_photos:
-            training_photos.append(photo_path)
-            logger.info(f"Добавлено фото {photo_path} для user_id={user_id}, всего фото: {len(training_photos)}")
-        else:
-            logger.debug(f"Фото {photo_path} уже было добавлено для user_id={user_id}")
+        # Скачивание, проверка и добавление в архив начинаются сразу, к подтверждению архив готов
+        await training_ingest.add(bot, user_id, photo.file_id)
+    except PhotoRejected as e:
+        await message.reply(
+            escape_md(f"❌ {e} Загрузи другое фото.", version=2),
+            parse_mode=ParseMode.MARKDOWN_V2
+        )
+        return
     except Exception as e:
         logger.error(f"Ошибка обработки фото для user_id={user_id}: {e}", exc_info=True)
         await message.reply(
@@ -817,6 +838,14 @@ async def handle_training_photos(message: Message, state: FSMContext):
         )
         return
 
+    # Пока шла обработка, могли добавиться другие фото альбома
+    user_data = await state.get_data()
+    training_photos = user_data.get('training_photos', [])
+    processed_media_groups = user_data.get('processed_media_groups', set())
+    if photo.file_id not in training_photos:
+        training_photos.append(photo.file_id)
+    logger.info(f"Добавлено фото {photo.file_id} для user_id={user_id}, всего фото: {len(training_photos)}")
+
     # Обновляем список обработанных медиагрупп
     if media_group_id:
         processed_media_groups.add(media_group_id)
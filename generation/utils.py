@@ -1,4 +1,3 @@
-import asyncio
 import logging
 import os
 import tenacity
@@ -8,9 +7,8 @@ from aiogram.types import Message, InputMediaPhoto, InputMediaVideo, FSInputFile
 from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest, TelegramNetworkError
 from contextlib import asynccontextmanager
 from aiogram.enums import ParseMode
-import replicate
 from replicate.exceptions import ReplicateError
-from config import REPLICATE_API_TOKEN
+from replicate_client import replicate_client
 from handlers.utils import safe_escape_markdown as escape_md
 
 from logger import get_logger
@@ -278,6 +276,13 @@ async def send_media_group_with_retry(bot: Bot, chat_id: int, media: list):
         logger.error(f"Ошибка отправки группы медиа для chat_id={chat_id}: {e}", exc_info=True)
         raise
 
+# Варианты для отправки по ссылке: повторяются только временные ошибки, а отказ
+# Telegram (BadRequest, например не удалось скачать ссылку) сразу поднимается,
+# чтобы вызывающий код мог отправить файлы вместо ссылок.
+_retry_transient_send = tenacity.retry_if_exception_type((TelegramRetryAfter, TelegramNetworkError))
+send_photo_strict = send_photo_with_retry.retry_with(retry=_retry_transient_send, retry_error_callback=None, reraise=True)
+send_media_group_strict = send_media_group_with_retry.retry_with(retry=_retry_transient_send, retry_error_callback=None, reraise=True)
+
 @retry_telegram_send
 async def send_video_with_retry(bot: Bot, chat_id: int, video, caption: str = None, reply_markup=None, parse_mode=None):
     """Отправка видео с повторными попытками"""
@@ -307,9 +312,6 @@ async def send_video_with_retry(bot: Bot, chat_id: int, video, caption: str = No
 )
 async def run_replicate_async(model_id: str, input_params: dict):
     """Асинхронный запуск модели Replicate"""
-    loop = asyncio.get_event_loop()
-    replicate_client = replicate.Client(api_token=REPLICATE_API_TOKEN)
-
     prompt_preview = input_params.get('prompt', 'No prompt')
     if isinstance(prompt_preview, str):
         prompt_preview = prompt_preview[:100] + ('...' if len(prompt_preview) > 100 else '')
@@ -317,7 +319,7 @@ async def run_replicate_async(model_id: str, input_params: dict):
     logger.info(f"Запуск Replicate model: {model_id} с параметрами (промпт): {prompt_preview}...")
 
     try:
-        output = await loop.run_in_executor(None, lambda: replicate_client.run(model_id, input=input_params))
+        output = await replicate_client.run(model_id, input_params)
         logger.info(f"Replicate model {model_id} успешно завершен.")
         return output
     except Exception as e:
@@ -1,10 +1,11 @@
 import aiosqlite
+from db_pool import db_pool
 import asyncio
 import logging
 import os
-import requests
 import uuid
 import random
+from typing import Optional
 from aiogram import Bot, Router
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message, CallbackQuery, FSInputFile
 from aiogram.fsm.context import FSMContext
@@ -13,14 +14,14 @@ from aiogram.filters import Command
 from aiogram.types import ContentType
 from aiogram.enums import ParseMode
 from deep_translator import GoogleTranslator
-import replicate
 from replicate.exceptions import ReplicateError
 from states import BotStates
-from config import REPLICATE_API_TOKEN, DATABASE_PATH
-from generation_config import IMAGE_GENERATION_MODELS, GENERATION_TYPE_TO_MODEL_KEY, get_ultra_negative_prompt
-from database import check_database_user, update_user_credits, save_video_task, update_video_task_status, log_generation, check_user_resources
+from replicate_client import replicate_client
+from generation_config import IMAGE_GENERATION_MODELS, GENERATION_TYPE_TO_MODEL_KEY, get_ultra_negative_prompt, get_video_generation_cost
+from database import check_database_user, save_video_task, update_video_task_status, log_generation, check_user_resources, debit_user_resources, credit_user_resources
 from keyboards import create_main_menu_keyboard, create_rating_keyboard, create_video_generate_menu_keyboard, create_subscription_keyboard, create_back_keyboard, create_confirmation_keyboard
 from generation.images import upload_image_to_replicate
+from generation.tracker import prediction_tracker, download_to_file
 from generation.utils import TempFileManager, reset_generation_context, send_message_with_fallback, send_video_with_retry
 from handlers.utils import clean_admin_context, escape_message_parts, safe_escape_markdown as escape_md
 from utils import get_cookie_progress_bar
@@ -176,6 +177,7 @@ async def generate_video(message: Message, state: FSMContext, task_id: int = Non
     if not await check_user_resources(bot, user_id, required_photos=required_photos):
         return
 
+    debited = False
     async with TempFileManager() as temp_manager:
         try:
             if not task_id:
@@ -239,7 +241,7 @@ async def generate_video(message: Message, state: FSMContext, task_id: int = Non
                 )
 
             else:
-                async with aiosqlite.connect(DATABASE_PATH) as conn_check:
+                async with db_pool.reader() as conn_check:
                     c_check = await conn_check.cursor()
                     await c_check.execute(
                         "SELECT video_path, prediction_id FROM video_tasks WHERE id = ? AND user_id = ?",
@@ -286,6 +288,15 @@ async def generate_video(message: Message, state: FSMContext, task_id: int = Non
                     logger.error(f"Дефолтное изображение не найдено: {default_image_path}")
                     raise ValueError("Не удалось найти дефолтное изображение для видео")
 
+            if await debit_user_resources(user_id, photos=required_photos) is None:
+                if task_id:
+                    await update_video_task_status(task_id, status='failed')
+                await check_user_resources(bot, user_id, required_photos=required_photos)
+                await reset_generation_context(state, generation_type or 'ai_video_v2_1')
+                return
+            debited = True
+            logger.info(f"Списано {required_photos} фото для видео user_id={user_id}, task_id={task_id}")
+
             # Определяем стиль для логирования
             if user_data.get('came_from_custom_prompt', False):
                 if user_data.get('use_llama_prompt', False):
@@ -310,17 +321,11 @@ async def generate_video(message: Message, state: FSMContext, task_id: int = Non
                 ratio="16:9"  # Для видео всегда 16:9
             )
 
-            await update_user_credits(user_id, "decrement_photo", amount=required_photos)
-            logger.info(f"Списано {required_photos} фото для видео user_id={user_id}, task_id={task_id}")
-
-            replicate_client = replicate.Client(api_token=REPLICATE_API_TOKEN)
-
             if not prediction_id:
                 logger.info(f"Создание нового предсказания Replicate для видео task_id={task_id}")
 
-                prediction_instance = replicate_client.predictions.create(
-                    version=replicate_video_model_id,
-                    input=input_params_video
+                prediction_instance = await replicate_client.create_prediction(
+                    replicate_video_model_id, input_params_video
                 )
 
                 prediction_id = prediction_instance.id
@@ -330,7 +335,7 @@ async def generate_video(message: Message, state: FSMContext, task_id: int = Non
                 await update_video_task_status(task_id, status='processing', prediction_id=prediction_id)
                 logger.info(f"Видео предсказание создано: prediction_id={prediction_id}, task_id={task_id}")
 
-            asyncio.create_task(check_video_status_with_delay(
+            await check_video_status_with_delay(
                 bot,
                 {
                     'user_id': user_id,
@@ -343,7 +348,7 @@ async def generate_video(message: Message, state: FSMContext, task_id: int = Non
                     'admin_user_id': admin_user_id
                 },
                 delay=60
-            ))
+            )
 
         except Exception as e:
             logger.error(f"Ошибка запуска генерации видео для user_id={user_id}, task_id={task_id}: {e}", exc_info=True)
@@ -366,30 +371,31 @@ async def generate_video(message: Message, state: FSMContext, task_id: int = Non
             if task_id:
                 await update_video_task_status(task_id, status='failed')
 
-            try:
-                await update_user_credits(user_id, "increment_photo", amount=required_photos)
-                logger.info(f"Возвращено {required_photos} фото для user_id={user_id} из-за ошибки запуска видео.")
-            except Exception as db_e:
-                logger.error(f"Ошибка возврата {required_photos} фото для user_id={user_id}: {db_e}")
-                await send_message_with_fallback(
-                    bot, user_id,
-                    f"❌ Ошибка базы данных при возврате {required_photos} печенек Свяжитесь с поддержкой!",
-                    reply_markup=await create_video_generate_menu_keyboard(),
-                    parse_mode=ParseMode.MARKDOWN
-                )
-                if admin_user_id:
+            if debited:
+                try:
+                    await credit_user_resources(user_id, photos=required_photos)
+                    logger.info(f"Возвращено {required_photos} фото для user_id={user_id} из-за ошибки запуска видео.")
+                except Exception as db_e:
+                    logger.error(f"Ошибка возврата {required_photos} фото для user_id={user_id}: {db_e}")
                     await send_message_with_fallback(
-                        bot, admin_user_id,
-                        f"❌ Ошибка базы данных при возврате ресурсов для пользователя ID `{user_id}`.",
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К действиям", callback_data=f"user_actions_{user_id}")]]),
+                        bot, user_id,
+                        f"❌ Ошибка базы данных при возврате {required_photos} печенек Свяжитесь с поддержкой!",
+                        reply_markup=await create_video_generate_menu_keyboard(),
                         parse_mode=ParseMode.MARKDOWN
                     )
+                    if admin_user_id:
+                        await send_message_with_fallback(
+                            bot, admin_user_id,
+                            f"❌ Ошибка базы данных при возврате ресурсов для пользователя ID `{user_id}`.",
+                            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К действиям", callback_data=f"user_actions_{user_id}")]]),
+                            parse_mode=ParseMode.MARKDOWN
+                        )
 
             await reset_generation_context(state, generation_type or 'ai_video_v2_1')
 
         finally:
             if video_path_local_db_entry and task_id:
-                async with aiosqlite.connect(DATABASE_PATH) as conn_clean:
+                async with db_pool.reader() as conn_clean:
                     c_clean = await conn_clean.cursor()
                     await c_clean.execute("SELECT status FROM video_tasks WHERE id = ?", (task_id,))
                     final_status_row = await c_clean.fetchone()
@@ -432,7 +438,7 @@ async def handle_generate_video_callback(query: CallbackQuery, state: FSMContext
     await state.update_data(video_cost=cost, user_id=user_id)
 
     subscription_data = await check_database_user(user_id)
-    photos_balance = subscription_data[0]
+    photos_balance = subscription_data.generations_left
 
     if photos_balance < cost:
         text_parts = [
@@ -812,45 +818,60 @@ async def handle_skip_photo(message: Message, state: FSMContext):
         )
         logger.info(f"Попытка пропуска фото для готового стиля отклонена для user_id={user_id}")
 
+VIDEO_POLL_INTERVAL = 60
+VIDEO_MAX_CHECKS = 30
+
+
+async def _get_video_task_status(task_id: int, user_id: int) -> Optional[str]:
+    async with db_pool.reader() as conn:
+        conn.row_factory = aiosqlite.Row
+        c = await conn.cursor()
+        await c.execute(
+            "SELECT status, video_path FROM video_tasks WHERE id = ? AND user_id = ?",
+            (task_id, user_id)
+        )
+        task_info = await c.fetchone()
+    if not task_info:
+        logger.error(f"Задача видео task_id={task_id} не найдена для user_id={user_id}")
+        return None
+    if task_info['status'] in ['completed', 'failed', 'timeout']:
+        logger.info(f"Видео task_id={task_id} уже имеет финальный статус: {task_info['status']}")
+        return None
+    return task_info['video_path']
+
+
+def _track_video(bot: Bot, data: dict, delay: float) -> bool:
+    return prediction_tracker.track(
+        data['prediction_id'], 'predictions',
+        on_done=lambda prediction: _finish_video(bot, data, prediction),
+        on_timeout=lambda: _video_timeout(bot, data),
+        interval=VIDEO_POLL_INTERVAL, delay=delay, max_checks=VIDEO_MAX_CHECKS
+    )
+
+
 async def check_video_status(bot: Bot, data: dict):
-    """Проверяет статус генерации видео."""
+    """Ставит генерацию видео на отслеживание; результат обработает _finish_video."""
+    logger.info(f"Отслеживание видео: user_id={data['user_id']}, task_id={data['task_id']}, "
+                f"prediction_id={data['prediction_id']}, style_name={data.get('style_name', 'custom')}")
+    _track_video(bot, data, delay=0)
+
+
+async def _finish_video(bot: Bot, data: dict, prediction) -> None:
+    """Обрабатывает завершённое предсказание видео: скачивание, отправка, возврат при ошибке."""
     user_id = data['user_id']
     task_id = data['task_id']
     prediction_id = data['prediction_id']
-    attempt = data.get('attempt', 1)
     generation_type = data.get('generation_type', 'ai_video_v2_1')
     model_key = data.get('model_key')
     style_name = data.get('style_name', 'custom')
     admin_user_id = data.get('admin_user_id')
 
-    logger.info(f"Проверка статуса видео: user_id={user_id}, task_id={task_id}, "
-                f"prediction_id={prediction_id}, attempt={attempt}, style_name={style_name}")
-
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
-            conn.row_factory = aiosqlite.Row
-            c = await conn.cursor()
-            await c.execute(
-                "SELECT status, video_path FROM video_tasks WHERE id = ? AND user_id = ?",
-                (task_id, user_id)
-            )
-            task_info = await c.fetchone()
-
-        if not task_info:
-            logger.error(f"Задача видео task_id={task_id} не найдена для user_id={user_id}")
+        video_path = await _get_video_task_status(task_id, user_id)
+        if video_path is None:
             return
 
-        current_status_db = task_info['status']
-        video_path = task_info['video_path']
-
-        if current_status_db in ['completed', 'failed']:
-            logger.info(f"Видео task_id={task_id} уже имеет финальный статус: {current_status_db}")
-            return
-
-        replicate_client = replicate.Client(api_token=REPLICATE_API_TOKEN)
-        prediction = replicate_client.predictions.get(prediction_id)
         current_replicate_status = prediction.status
-
         logger.info(f"Статус видео на Replicate для prediction_id={prediction_id}: {current_replicate_status}")
 
         if current_replicate_status == 'succeeded':
@@ -866,13 +887,8 @@ async def check_video_status(bot: Bot, data: dict):
             if video_url:
                 try:
                     logger.info(f"Скачивание видео с URL: {video_url}")
-                    response = requests.get(video_url, timeout=300)
-                    response.raise_for_status()
-
-                    os.makedirs(os.path.dirname(video_path), exist_ok=True)
-                    with open(video_path, 'wb') as f:
-                        f.write(response.content)
-                    logger.info(f"Видео сохранено локально: {video_path}")
+                    size = await download_to_file(video_url, video_path)
+                    logger.info(f"Видео сохранено локально: {video_path} ({size} байт)")
 
                     await update_video_task_status(task_id, status='completed', video_path=video_path)
 
@@ -987,7 +1003,7 @@ async def check_video_status(bot: Bot, data: dict):
                 reply_markup=await create_video_generate_menu_keyboard(),
                 parse_mode=ParseMode.MARKDOWN_V2
             )
-            await update_user_credits(user_id, "increment_photo", amount=video_cost)
+            await credit_user_resources(user_id, photos=video_cost)
 
             if admin_user_id:
                 text_admin = escape_message_parts(
@@ -1001,91 +1017,66 @@ async def check_video_status(bot: Bot, data: dict):
                     parse_mode=ParseMode.MARKDOWN_V2
                 )
 
-        else:
-            max_attempts = 30
 
-            if attempt >= max_attempts:
-                logger.error(f"Превышено максимальное количество попыток проверки для task_id={task_id}")
-                await update_video_task_status(task_id, status='timeout')
+    except Exception as e:
+        logger.error(f"Ошибка обработки результата видео для task_id={task_id}: {e}", exc_info=True)
 
-                video_cost = get_video_generation_cost(generation_type)
-                logger.debug(f"Возвращаем {video_cost} фото для user_id={user_id} из-за таймаута")
 
-                text_parts = [
-                    f"❌ Превышено время ожидания генерации видео ({style_name}).",
-                    f" {video_cost} печеньки возвращены на баланс.",
-                    " Обратитесь в поддержку."
-                ]
-                text = escape_message_parts(*text_parts, version=2)
-                await send_message_with_fallback(
-                    bot, user_id,
-                    text,
-                    reply_markup=await create_video_generate_menu_keyboard(),
-                    parse_mode=ParseMode.MARKDOWN_V2
-                )
-                await update_user_credits(user_id, "increment_photo", amount=video_cost)
+async def _video_timeout(bot: Bot, data: dict) -> None:
+    """Видео не завершилось за VIDEO_MAX_CHECKS проверок: таймаут и возврат печенек."""
+    user_id = data['user_id']
+    task_id = data['task_id']
+    generation_type = data.get('generation_type', 'ai_video_v2_1')
+    style_name = data.get('style_name', 'custom')
+    admin_user_id = data.get('admin_user_id')
 
-                if admin_user_id:
-                    text_admin = escape_message_parts(
-                        f"❌ Превышено время ожидания для пользователя ID `{user_id}` (стиль: {style_name}).",
-                        version=2
-                    )
-                    await send_message_with_fallback(
-                        bot, admin_user_id,
-                        text_admin,
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К действиям", callback_data=f"user_actions_{user_id}")]]),
-                        parse_mode=ParseMode.MARKDOWN_V2
-                    )
-                return
+    try:
+        if await _get_video_task_status(task_id, user_id) is None:
+            return
 
-            next_delay = 60
+        logger.error(f"Превышено максимальное количество попыток проверки для task_id={task_id}")
+        await update_video_task_status(task_id, status='timeout')
 
-            logger.info(f"Видео для task_id={task_id} все еще генерируется. "
-                        f"Следующая проверка через {next_delay} сек (попытка {attempt + 1}/{max_attempts})")
+        video_cost = get_video_generation_cost(generation_type)
+        logger.debug(f"Возвращаем {video_cost} фото для user_id={user_id} из-за таймаута")
 
-            asyncio.create_task(check_video_status_with_delay(
-                bot,
-                {
-                    'user_id': user_id,
-                    'task_id': task_id,
-                    'prediction_id': prediction_id,
-                    'attempt': attempt + 1,
-                    'generation_type': generation_type,
-                    'model_key': model_key,
-                    'style_name': style_name,
-                    'admin_user_id': admin_user_id
-                },
-                delay=next_delay
-            ))
+        text_parts = [
+            f"❌ Превышено время ожидания генерации видео ({style_name}).",
+            f" {video_cost} печеньки возвращены на баланс.",
+            " Обратитесь в поддержку."
+        ]
+        text = escape_message_parts(*text_parts, version=2)
+        await send_message_with_fallback(
+            bot, user_id,
+            text,
+            reply_markup=await create_video_generate_menu_keyboard(),
+            parse_mode=ParseMode.MARKDOWN_V2
+        )
+        await credit_user_resources(user_id, photos=video_cost)
 
+        if admin_user_id:
+            text_admin = escape_message_parts(
+                f"❌ Превышено время ожидания для пользователя ID `{user_id}` (стиль: {style_name}).",
+                version=2
+            )
+            await send_message_with_fallback(
+                bot, admin_user_id,
+                text_admin,
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К действиям", callback_data=f"user_actions_{user_id}")]]),
+                parse_mode=ParseMode.MARKDOWN_V2
+            )
     except Exception as e:
-        logger.error(f"Ошибка при проверке статуса видео для task_id={task_id}: {e}", exc_info=True)
+        logger.error(f"Ошибка обработки таймаута видео для task_id={task_id}: {e}", exc_info=True)
 
-        if attempt < 10:
-            asyncio.create_task(check_video_status_with_delay(
-                bot,
-                {
-                    'user_id': user_id,
-                    'task_id': task_id,
-                    'prediction_id': prediction_id,
-                    'attempt': attempt + 1,
-                    'generation_type': generation_type,
-                    'model_key': model_key,
-                    'style_name': style_name,
-                    'admin_user_id': admin_user_id
-                },
-                delay=120
-            ))
 
 async def check_video_status_with_delay(bot: Bot, data: dict, delay: int):
-    """Проверка статуса видео с задержкой."""
-    await asyncio.sleep(delay)
-    await check_video_status(bot, data)
+    """Ставит видео на отслеживание с первой проверкой через delay секунд."""
+    _track_video(bot, data, delay=delay)
 
 async def check_pending_video_tasks(bot: Bot):
     """Проверяет и возобновляет незавершенные задачи видео."""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
 
@@ -1100,8 +1091,7 @@ async def check_pending_video_tasks(bot: Bot):
             logger.info("Нет незавершенных задач видео для проверки.")
             return
 
-        logger.info(f"Найдено {len(pending_tasks)} незавершенных задач видео для проверки.")
-
+        adopted = 0
         for row in pending_tasks:
             task_id = row['id']
             user_id = row['user_id']
@@ -1111,10 +1101,12 @@ async def check_pending_video_tasks(bot: Bot):
             if not prediction_id:
                 logger.warning(f"Пропуск проверки видео для task_id={task_id}, user_id={user_id}: отсутствует prediction_id.")
                 continue
+            if prediction_tracker.is_tracked(prediction_id):
+                continue
 
             generation_type = 'ai_video_v2_1' if model_key == IMAGE_GENERATION_MODELS.get("kwaivgi/kling-v2.1", {}).get("id") else 'ai_video_v2_1'
 
-            asyncio.create_task(check_video_status_with_delay(
+            if _track_video(
                 bot,
                 {
                     'user_id': user_id,
@@ -1126,7 +1118,10 @@ async def check_pending_video_tasks(bot: Bot):
                     'style_name': 'custom'
                 },
                 delay=random.randint(15, 45)
-            ))
+            ):
+                adopted += 1
+
+        logger.info(f"Незавершенных задач видео: {len(pending_tasks)}, взято на отслеживание: {adopted}")
 
     except Exception as e:
         logger.error(f"Ошибка при проверке незавершенных задач видео: {e}", exc_info=True)
@@ -1,6 +1,9 @@
 from typing import Dict, Any, Tuple
-import hashlib
+import copy
 import random
+from functools import lru_cache
+
+from prompt_features import KeywordMatcher, stable_hash
 
 # generation_config.py — Skin Realism v11 (Финальная версия)
 # Уровень "фото со смартфона" — максимальный фотореализм с естественным светом
@@ -954,44 +957,73 @@ def get_real_lora_model(name: str) -> str:
     cfg = LORA_CONFIG.get(name, {})
     return cfg.get("model", "")
 
-def _has(tags, text: str) -> bool:
-    return any(t in text for t in tags)
+# Размер LRU-кэшей сборки промпта: пресеты стилей повторяются тысячи раз в день
+PROMPT_CACHE_SIZE = 2048
+
+# Все ключевые слова, которые проверяются в промпте, — один проход по тексту даёт маску признаков
+PROMPT_FEATURES = KeywordMatcher({
+    "hair": ["hair", "волос", "long hair", "short hair"],
+    "animal": ANIMAL_KEYWORDS,
+    "body": BODY_KEYWORDS,
+    "piercing": PIERCING_KEYWORDS,
+    "portrait": ["portrait"],
+    "beach": BEACH_KEYWORDS,
+    "neon": NEON_KEYWORDS + ["lamp", "lamplight", "тёплая лампа", "лампа"],
+    "leaf": LEAF_KEYWORDS,
+    "smile": SMILE_KEYWORDS,
+    "glasses": GLASSES_KEYWORDS + ["sunglasses", "очки"],
+    "hand": HAND_KEYWORDS,
+    "jewelry": ["jewelry", "украшения", "watch", "часы", "ring", "кольцо",
+                "necklace", "ожерелье", "earrings", "серьги", "bracelet", "браслет",
+                "crown", "корона", "tiara"],
+    "watch": ["watch", "часы", "wristwatch"],
+    "ring": ["ring", "кольцо", "wedding ring"],
+    "necklace": ["necklace", "ожерелье", "chain", "цепочка"],
+    "earrings": ["earrings", "серьги", "earring"],
+    "bracelet": ["bracelet", "браслет", "armband"],
+    "crown": ["crown", "корона", "tiara"],
+    "object": ["object", "item", "thing", "предмет", "вещь"],
+    "flag": ["flag", "флаг", "banner", "знамя"],
+    **{f"shot:{k}": d["keywords"] for k, d in CAMERA_SHOTS.items()},
+}, cache_size=PROMPT_CACHE_SIZE)
+
+_SHOT_MASK = sum(PROMPT_FEATURES.bits[f"shot:{k}"] for k in CAMERA_SHOTS)
+
+def _has(text: str, *features: str) -> bool:
+    return PROMPT_FEATURES.has(text, *features)
 
 def _has_hair_terms(text: str) -> bool:
-    return _has(["hair", "волос", "long hair", "short hair"], text)
+    return _has(text, "hair")
 
 def _has_animal_terms(text: str) -> bool:
-    return _has(ANIMAL_KEYWORDS, text)
+    return _has(text, "animal")
 
 def _has_body_terms(text: str) -> bool:
-    return _has(BODY_KEYWORDS, text)
+    return _has(text, "body")
 
 def _has_piercing_terms(text: str) -> bool:
-    return _has(PIERCING_KEYWORDS, text) or "portrait" in text
+    return _has(text, "piercing", "portrait")
 
 def _has_beach_terms(text: str) -> bool:
-    return _has(BEACH_KEYWORDS, text)
+    return _has(text, "beach")
 
 def _has_neon_terms(text: str) -> bool:
-    return _has(NEON_KEYWORDS + ["lamp", "lamplight", "тёплая лампа", "лампа"], text)
+    return _has(text, "neon")
 
 def _has_leaf_terms(text: str) -> bool:
-    return _has(LEAF_KEYWORDS, text)
+    return _has(text, "leaf")
 
 def _has_smile_terms(text: str) -> bool:
-    return _has(SMILE_KEYWORDS, text)
+    return _has(text, "smile")
 
 def _has_glasses_terms(text: str) -> bool:
-    return _has(GLASSES_KEYWORDS, text) or "sunglasses" in text or "очки" in text
+    return _has(text, "glasses")
 
 def _has_jewelry_terms(text: str) -> bool:
-    return _has(["jewelry", "украшения", "watch", "часы", "ring", "кольцо",
-                 "necklace", "ожерелье", "earrings", "серьги", "bracelet", "браслет",
-                 "crown", "корона", "tiara", "tiara"], text)
+    return _has(text, "jewelry")
 
 def stable_choice(items, key: str):
-    h = int(hashlib.sha256(key.encode("utf-8")).hexdigest(), 16)
-    return items[h % len(items)]
+    return items[stable_hash(key) % len(items)]
 
 GLASSES_STYLES = {
     "classic_rect": "classic rectangular sunglasses, medium frame width, thin temple arms",
@@ -1005,6 +1037,7 @@ def select_glasses_style(prompt: str) -> str:
 # -------------------------------------------------------------
 # === СБОРКА NEGATIVE =========================================
 # -------------------------------------------------------------
+@lru_cache(maxsize=PROMPT_CACHE_SIZE)
 def build_negative_prompt(prompt: str, gen_type: str, style_key: str = "") -> tuple[str, str]:
     p = prompt.lower()
     block = (
@@ -1018,34 +1051,34 @@ def build_negative_prompt(prompt: str, gen_type: str, style_key: str = "") -> tu
     positive_additions = []
     if _has_jewelry_terms(p):
         positive_additions.append(JEWELRY_POSITIVE_TOKENS)
-        if _has(["watch", "часы", "wristwatch"], p):
+        if _has(p, "watch"):
             positive_additions.append(WATCH_POSITIVE_TOKENS)
-        if _has(["ring", "кольцо", "wedding ring"], p):
+        if _has(p, "ring"):
             positive_additions.append(RING_POSITIVE_TOKENS)
-        if _has(["necklace", "ожерелье", "chain", "цепочка"], p):
+        if _has(p, "necklace"):
             positive_additions.append(NECKLACE_POSITIVE_TOKENS)
-        if _has(["earrings", "серьги", "earring"], p):
+        if _has(p, "earrings"):
             positive_additions.append(EARRINGS_POSITIVE_TOKENS)
-        if _has(["bracelet", "браслет", "armband"], p):
+        if _has(p, "bracelet"):
             positive_additions.append(BRACELET_POSITIVE_TOKENS)
-        if _has(["crown", "корона", "tiara"], p):
+        if _has(p, "crown"):
             positive_additions.append(CROWN_TIARA_POSITIVE_TOKENS)
     if _has_body_terms(p):
         positive_additions.append(CLAVICLE_POSITIVE_TOKENS)
     if _has_animal_terms(p):
         positive_additions.append(ANIMAL_POSITIVE_TOKENS)
-    if _has(["object", "item", "thing", "предмет", "вещь"], p):
+    if _has(p, "object"):
         positive_additions.append(OBJECT_POSITIVE_TOKENS)
     if _has_body_terms(p):
         positive_additions.append(BODY_POSITIVE_TOKENS)
     if _has_leaf_terms(p) or _has_beach_terms(p):
         positive_additions.append(DOF_POSITIVE_TOKENS)
-    if _has(["flag", "флаг", "banner", "знамя"], p):
+    if _has(p, "flag"):
         positive_additions.append(FLAG_POSITIVE_TOKENS)
     positive_additions.append(PHOTOREALISTIC_POSITIVE_TOKENS)
 
     extras = [
-        HAND_NEGATIVE_TOKENS if _has(HAND_KEYWORDS, p) else "",
+        HAND_NEGATIVE_TOKENS if _has(p, "hand") else "",
         HAIR_NEGATIVE_TOKENS if (_has_hair_terms(p) or "portrait" in p) else "",
         SKIN_NEGATIVE_TOKENS,
         FOREHEAD_NEGATIVE_TOKENS,
@@ -1067,17 +1100,17 @@ def build_negative_prompt(prompt: str, gen_type: str, style_key: str = "") -> tu
         POSE_NEGATIVE_TOKENS,
         EYES_NEGATIVE_TOKENS,
         JEWELRY_NEGATIVE_TOKENS,
-        WATCH_NEGATIVE_TOKENS if _has(["watch", "часы", "wristwatch"], p) else "",
-        RING_NEGATIVE_TOKENS if _has(["ring", "кольцо", "wedding ring"], p) else "",
-        NECKLACE_NEGATIVE_TOKENS if _has(["necklace", "ожерелье", "chain", "цепочка"], p) else "",
-        EARRINGS_NEGATIVE_TOKENS if _has(["earrings", "серьги", "earring"], p) else "",
-        BRACELET_NEGATIVE_TOKENS if _has(["bracelet", "браслет", "armband"], p) else "",
-        CROWN_TIARA_NEGATIVE_TOKENS if _has(["crown", "корона", "tiara", "tiara"], p) else "",
+        WATCH_NEGATIVE_TOKENS if _has(p, "watch") else "",
+        RING_NEGATIVE_TOKENS if _has(p, "ring") else "",
+        NECKLACE_NEGATIVE_TOKENS if _has(p, "necklace") else "",
+        EARRINGS_NEGATIVE_TOKENS if _has(p, "earrings") else "",
+        BRACELET_NEGATIVE_TOKENS if _has(p, "bracelet") else "",
+        CROWN_TIARA_NEGATIVE_TOKENS if _has(p, "crown") else "",
         CLAVICLE_NEGATIVE_TOKENS if _has_body_terms(p) else "",
         FORBIDDEN_ELEMENTS_NEGATIVE,
         ANIMAL_NEGATIVE_TOKENS if _has_animal_terms(p) else "",
-        OBJECT_NEGATIVE_TOKENS if _has(["object", "item", "thing", "предмет", "вещь"], p) else "",
-        FLAG_NEGATIVE_TOKENS if _has(["flag", "флаг", "banner", "знамя"], p) else "",
+        OBJECT_NEGATIVE_TOKENS if _has(p, "object") else "",
+        FLAG_NEGATIVE_TOKENS if _has(p, "flag") else "",
         BODY_NEGATIVE_TOKENS if _has_body_terms(p) else "",
         FABRIC_NEGATIVE_TOKENS,
         BOKEH_NEGATIVE_TOKENS,
@@ -1101,6 +1134,11 @@ def build_negative_prompt(prompt: str, gen_type: str, style_key: str = "") -> tu
 # === КАЧЕСТВО / СИД ==========================================
 # -------------------------------------------------------------
 def choose_quality_params(gen_type: str, aspect: str, style_key: str = "") -> Dict[str, Any]:
+    # Параметры зависят только от аргументов; вызывающий код правит копию
+    return copy.deepcopy(_quality_params(gen_type, aspect, style_key))
+
+@lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def _quality_params(gen_type: str, aspect: str, style_key: str) -> Dict[str, Any]:
     key = (
         "fast_hq" if gen_type in ["fast", "realtime"]
         else "portrait_ultra" if gen_type == "portrait_ultra"
@@ -1190,16 +1228,22 @@ def choose_quality_params(gen_type: str, aspect: str, style_key: str = "") -> Di
     return params
 
 def select_camera_shot(p_low: str, key: str = "") -> str:
+    pool = _camera_shot_pool(PROMPT_FEATURES.mask(p_low) & _SHOT_MASK)
+    if not key:
+        key = p_low
+    return stable_choice(pool, key)
+
+@lru_cache(maxsize=None)
+def _camera_shot_pool(shot_mask: int) -> Tuple[str, ...]:
+    """Взвешенный пул планов для набора совпавших ключевых слов планов."""
     pool: list[str] = []
     for k, d in CAMERA_SHOTS.items():
-        w = int(d["weight"] * (2 if _has(d["keywords"], p_low) else 1) * 100)
+        w = int(d["weight"] * (2 if shot_mask & PROMPT_FEATURES.bits[f"shot:{k}"] else 1) * 100)
         if k in ["extreme_close_up", "close_up", "medium_shot"]:
             w = int(w * 1.2)
         if w > 0:
             pool.extend([k] * w)
-    if not key:
-        key = p_low
-    return stable_choice(pool, key)
+    return tuple(pool)
 
 # -------------------------------------------------------------
 # === AUTO‑BEAUTY 2.0: ПРАВИЛА И ДЕЙСТВИЯ =====================
@@ -1278,6 +1322,11 @@ def get_optimal_lora_config(prompt: str, gen_type: str, style_key: str = "") ->
     if is_nsfw_prompt(prompt):
         raise ValueError("❌ Запрошена откровенная/NSFW-сцена. Генерация запрещена.")
 
+    # План собирается один раз на (prompt, gen_type, style_key); вызывающий код правит копию
+    return copy.deepcopy(_optimal_lora_config(prompt, gen_type, style_key))
+
+@lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def _optimal_lora_config(prompt: str, gen_type: str, style_key: str) -> Dict[str, Any]:
     p_low = prompt.lower()
     is_creative = is_creative_style(style_key)
     has_animals = _has_animal_terms(p_low)
@@ -1299,7 +1348,7 @@ def get_optimal_lora_config(prompt: str, gen_type: str, style_key: str = "") ->
 
     loras = ["avatar_personal_lora"] + LORA_STYLE_PRESETS[preset]["loras"][:]
     need_hands = (not has_animals) and (
-        _has(HAND_KEYWORDS, p_low)
+        _has(p_low, "hand")
         or shot in ["medium_shot", "full_shot", "long_shot", "low_angle", "high_angle"]
     )
     if need_hands and "hands_ultra" not in loras:
@@ -1387,6 +1436,8 @@ def get_optimal_lora_config(prompt: str, gen_type: str, style_key: str = "") ->
         if t
     )
 
+    updated_prompt, negative_prompt = build_negative_prompt(prompt, gen_type, style_key)
+
     q = choose_quality_params(gen_type, aspect, style_key)
 
     if _has_neon_terms(p_low):
@@ -1443,8 +1494,6 @@ def get_optimal_lora_config(prompt: str, gen_type: str, style_key: str = "") ->
         "auto_beauty_rules": AUTO_BEAUTY_RULES,
     })
 
-    updated_prompt, negative_prompt = build_negative_prompt(prompt, gen_type, style_key)
-
     return {
         "loras": loras,
         "quality_params": q,
@@ -1735,7 +1784,7 @@ __all__ = [
     "get_max_quality_params", "get_ultra_negative_prompt",
     "start_avatar_training", "get_person_model",
     "select_camera_shot", "get_resolution_by_ratio",
-    "select_glasses_style", "stable_choice",
+    "select_glasses_style", "stable_choice", "get_prompt_cache_stats",
     "OCCLUSION_EDGE_NEGATIVE", "POSE_REJECTION_RULES",
     "EXPRESSION_POSITIVE_TOKENS", "EXPRESSION_NEGATIVE_TOKENS",
     "TREE_POSE_NEGATIVE", "FACE_OCCLUSION_NEGATIVE", "HAND_SCALE_NEGATIVE",
@@ -1945,6 +1994,7 @@ def analyze_prompt_intent(prompt: str) -> dict:
 
     return analysis
 
+@lru_cache(maxsize=PROMPT_CACHE_SIZE)
 def create_optimized_prompt(user_prompt: str, generation_type: str = "with_avatar") -> str:
     """
     Создает оптимизированный промпт на основе анализа намерения пользователя.
@@ -1975,3 +2025,14 @@ def create_optimized_prompt(user_prompt: str, generation_type: str = "with_avata
         enhanced_prompt += ", video generation, motion capture, dynamic movement, cinematic quality"
 
     return enhanced_prompt
+
+def get_prompt_cache_stats() -> Dict[str, Any]:
+    """Попадания и промахи LRU-кэшей сборки промпта."""
+    caches = {
+        "features": PROMPT_FEATURES.mask,
+        "negative_prompt": build_negative_prompt,
+        "quality_params": _quality_params,
+        "lora_config": _optimal_lora_config,
+        "optimized_prompt": create_optimized_prompt,
+    }
+    return {name: cache.cache_info()._asdict() for name, cache in caches.items()}
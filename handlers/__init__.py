@@ -1,49 +1,104 @@
-from .user.commands import start, menu, help_command, check_training, check_user_blocked, extract_utm_from_text
-from .user.messages import handle_text, handle_email_input, handle_email_change_input, handle_photo, handle_admin_text, handle_video
-from .admin.commands import debug_avatars
-from .user.callbacks import handle_user_callback
-from .admin.generation import (
-    generation_router, generate_photo_for_user, handle_admin_style_selection,
-    handle_admin_custom_prompt, handle_admin_aspect_ratio_selection,
-    handle_admin_generation_result, process_image_generation,
-    cancel as generation_cancel, generation_callback_handler, handle_admin_prompt_message
-)
-from .user.payments import (
-    check_payment_status_and_update_message, handle_successful_payment_message,
-    handle_expired_payment_message, schedule_payment_check
-)
-from .system.errors import error_handler
-from .utils import (
-    safe_escape_markdown, send_message_with_fallback, safe_answer_callback,
-    delete_message_safe, check_user_permissions, get_user_display_name,
-    format_user_mention, truncate_text, send_typing_action,
-    send_upload_photo_action, send_upload_video_action, get_tariff_text,
-    check_resources, check_active_avatar, check_style_config, create_payment_link,
-    get_bot_summary_stats
-)
+# handlers/__init__.py
+"""
+Обработчики бота
+"""
 
-from .admin.user_management import show_user_actions, show_user_profile_admin, show_user_avatars_admin, delete_user_admin
-from .admin.broadcast import broadcast_message_admin
-from .admin.panels import (
-    admin_panel, show_admin_stats,
-    get_all_failed_avatars, delete_all_failed_avatars, admin_show_failed_avatars,
-    admin_confirm_delete_all_failed, admin_execute_delete_all_failed,
-    send_daily_payments_report, cancel as panels_cancel
-)
-from .admin.broadcast import (
-    broadcast_router, initiate_broadcast, clear_user_data
-)
-from .admin.callbacks import (
-    admin_callbacks_router, show_dev_test_payment,
-    handle_admin_send_generation, handle_admin_regenerate
-)
-from .admin.visualization import (
-    visualization_router, show_visualization, visualize_payments,
-    visualize_registrations, visualize_generations, show_activity_stats,
-    handle_activity_stats, handle_activity_dates_input, cancel as visualization_cancel,
-    visualization_callback_handler
-)
-from .user.photo_transform import photo_transform_router, init_photo_generator
+import importlib
+
+# Имя -> (подмодуль, имя в подмодуле). Подмодуль загружается при первом
+# обращении: импорт отдельного обработчика не тянет за собой весь пакет
+# и не замыкает цикл импортов generation <-> handlers.
+_EXPORTS = {
+    'start': ('.user.commands', 'start'),
+    'menu': ('.user.commands', 'menu'),
+    'help_command': ('.user.commands', 'help_command'),
+    'check_training': ('.user.commands', 'check_training'),
+    'check_user_blocked': ('.user.commands', 'check_user_blocked'),
+    'extract_utm_from_text': ('.user.commands', 'extract_utm_from_text'),
+    'handle_text': ('.user.messages', 'handle_text'),
+    'handle_email_input': ('.user.messages', 'handle_email_input'),
+    'handle_email_change_input': ('.user.messages', 'handle_email_change_input'),
+    'handle_photo': ('.user.messages', 'handle_photo'),
+    'handle_admin_text': ('.user.messages', 'handle_admin_text'),
+    'handle_video': ('.user.messages', 'handle_video'),
+    'debug_avatars': ('.admin.commands', 'debug_avatars'),
+    'handle_user_callback': ('.user.callbacks', 'handle_user_callback'),
+    'generation_router': ('.admin.generation', 'generation_router'),
+    'generate_photo_for_user': ('.admin.generation', 'generate_photo_for_user'),
+    'handle_admin_style_selection': ('.admin.generation', 'handle_admin_style_selection'),
+    'handle_admin_custom_prompt': ('.admin.generation', 'handle_admin_custom_prompt'),
+    'handle_admin_aspect_ratio_selection': ('.admin.generation', 'handle_admin_aspect_ratio_selection'),
+    'handle_admin_generation_result': ('.admin.generation', 'handle_admin_generation_result'),
+    'process_image_generation': ('.admin.generation', 'process_image_generation'),
+    'generation_cancel': ('.admin.generation', 'cancel'),
+    'generation_callback_handler': ('.admin.generation', 'generation_callback_handler'),
+    'handle_admin_prompt_message': ('.admin.generation', 'handle_admin_prompt_message'),
+    'check_payment_status_and_update_message': ('.user.payments', 'check_payment_status_and_update_message'),
+    'handle_successful_payment_message': ('.user.payments', 'handle_successful_payment_message'),
+    'handle_expired_payment_message': ('.user.payments', 'handle_expired_payment_message'),
+    'schedule_payment_check': ('.user.payments', 'schedule_payment_check'),
+    'error_handler': ('.system.errors', 'error_handler'),
+    'safe_escape_markdown': ('.utils', 'safe_escape_markdown'),
+    'send_message_with_fallback': ('.utils', 'send_message_with_fallback'),
+    'safe_answer_callback': ('.utils', 'safe_answer_callback'),
+    'delete_message_safe': ('.utils', 'delete_message_safe'),
+    'check_user_permissions': ('.utils', 'check_user_permissions'),
+    'get_user_display_name': ('.utils', 'get_user_display_name'),
+    'format_user_mention': ('.utils', 'format_user_mention'),
+    'truncate_text': ('.utils', 'truncate_text'),
+    'send_typing_action': ('.utils', 'send_typing_action'),
+    'send_upload_photo_action': ('.utils', 'send_upload_photo_action'),
+    'send_upload_video_action': ('.utils', 'send_upload_video_action'),
+    'get_tariff_text': ('.utils', 'get_tariff_text'),
+    'check_resources': ('.utils', 'check_resources'),
+    'check_active_avatar': ('.utils', 'check_active_avatar'),
+    'check_style_config': ('.utils', 'check_style_config'),
+    'create_payment_link': ('.utils', 'create_payment_link'),
+    'get_bot_summary_stats': ('.utils', 'get_bot_summary_stats'),
+    'show_user_actions': ('.admin.user_management', 'show_user_actions'),
+    'show_user_profile_admin': ('.admin.user_management', 'show_user_profile_admin'),
+    'show_user_avatars_admin': ('.admin.user_management', 'show_user_avatars_admin'),
+    'delete_user_admin': ('.admin.user_management', 'delete_user_admin'),
+    'broadcast_message_admin': ('.admin.broadcast', 'broadcast_message_admin'),
+    'admin_panel': ('.admin.panels', 'admin_panel'),
+    'show_admin_stats': ('.admin.panels', 'show_admin_stats'),
+    'get_all_failed_avatars': ('.admin.panels', 'get_all_failed_avatars'),
+    'delete_all_failed_avatars': ('.admin.panels', 'delete_all_failed_avatars'),
+    'admin_show_failed_avatars': ('.admin.panels', 'admin_show_failed_avatars'),
+    'admin_confirm_delete_all_failed': ('.admin.panels', 'admin_confirm_delete_all_failed'),
+    'admin_execute_delete_all_failed': ('.admin.panels', 'admin_execute_delete_all_failed'),
+    'send_daily_payments_report': ('.admin.panels', 'send_daily_payments_report'),
+    'panels_cancel': ('.admin.panels', 'cancel'),
+    'broadcast_router': ('.admin.broadcast', 'broadcast_router'),
+    'initiate_broadcast': ('.admin.broadcast', 'initiate_broadcast'),
+    'clear_user_data': ('.admin.broadcast', 'clear_user_data'),
+    'admin_callbacks_router': ('.admin.callbacks', 'admin_callbacks_router'),
+    'show_dev_test_payment': ('.admin.callbacks', 'show_dev_test_payment'),
+    'handle_admin_send_generation': ('.admin.callbacks', 'handle_admin_send_generation'),
+    'handle_admin_regenerate': ('.admin.callbacks', 'handle_admin_regenerate'),
+    'visualization_router': ('.admin.visualization', 'visualization_router'),
+    'show_visualization': ('.admin.visualization', 'show_visualization'),
+    'visualize_payments': ('.admin.visualization', 'visualize_payments'),
+    'visualize_registrations': ('.admin.visualization', 'visualize_registrations'),
+    'visualize_generations': ('.admin.visualization', 'visualize_generations'),
+    'show_activity_stats': ('.admin.visualization', 'show_activity_stats'),
+    'handle_activity_stats': ('.admin.visualization', 'handle_activity_stats'),
+    'handle_activity_dates_input': ('.admin.visualization', 'handle_activity_dates_input'),
+    'visualization_cancel': ('.admin.visualization', 'cancel'),
+    'visualization_callback_handler': ('.admin.visualization', 'visualization_callback_handler'),
+    'photo_transform_router': ('.user.photo_transform', 'photo_transform_router'),
+    'init_photo_generator': ('.user.photo_transform', 'init_photo_generator'),
+}
+
+
+def __getattr__(name):
+    try:
+        module, attr = _EXPORTS[name]
+    except KeyError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
+    value = getattr(importlib.import_module(module, __name__), attr)
+    globals()[name] = value
+    return value
 
 
 __all__ = [
@@ -7,25 +7,27 @@ import pytz
 import os
 import time
 from datetime import datetime, timedelta
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Tuple
 from aiogram import Router, Bot, F
 from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.fsm.context import FSMContext
 from aiogram.enums import ParseMode
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from database import (
-    get_all_users_stats, get_broadcasts_with_buttons, get_broadcast_buttons, get_paid_users, get_non_paid_users, save_broadcast_button
+    get_broadcasts_with_buttons, get_broadcast_buttons, save_broadcast_button,
+    count_broadcast_recipients, iter_broadcast_recipients, get_broadcast_checkpoint, save_broadcast_checkpoint
 )
-from config import ADMIN_IDS, DATABASE_PATH, ALLOWED_BROADCAST_CALLBACKS, BROADCAST_CALLBACK_ALIASES
+from config import ADMIN_IDS, DATABASE_PATH, ALLOWED_BROADCAST_CALLBACKS, BROADCAST_CALLBACK_ALIASES, BROADCAST_RATE, BROADCAST_CONCURRENCY, BROADCAST_PAGE_SIZE
 from keyboards import (
-    create_admin_keyboard, create_dynamic_broadcast_keyboard, create_admin_user_actions_keyboard, create_broadcast_with_payment_audience_keyboard
+    create_admin_keyboard, build_broadcast_keyboard, create_admin_user_actions_keyboard, create_broadcast_with_payment_audience_keyboard
 )
 from handlers.utils import (
     escape_message_parts, send_message_with_fallback, unescape_markdown, anti_spam
 )
 from states import BotStates
+from rate_limiter import TokenBucket
 
 from logger import get_logger
 logger = get_logger('main')
@@ -121,197 +123,165 @@ async def initiate_broadcast(query: CallbackQuery, state: FSMContext) -> None:
     await query.answer()
     logger.info(f"initiate_broadcast: user_id={user_id}, callback_data={callback_data}")
 
-async def broadcast_message_admin(bot: Bot, message_text: str, admin_user_id: int, media_type: str = None, media_id: str = None, buttons: List[Dict[str, str]] = None) -> None:
-    """Выполняет рассылку всем пользователям."""
+async def _send_broadcast_item(bot: Bot, user_id: int, text: str, media_type: Optional[str], media_id: Optional[str],
+                               reply_markup: Optional[InlineKeyboardMarkup], parse_mode: Optional[str]) -> None:
+    """Отправляет одно сообщение рассылки (текст, фото или видео)."""
+    if media_type == 'photo' and media_id:
+        await bot.send_photo(
+            chat_id=user_id, photo=media_id,
+            caption=text, parse_mode=parse_mode,
+            reply_markup=reply_markup
+        )
+    elif media_type == 'video' and media_id:
+        await bot.send_video(
+            chat_id=user_id, video=media_id,
+            caption=text, parse_mode=parse_mode,
+            reply_markup=reply_markup
+        )
+    else:
+        await bot.send_message(
+            chat_id=user_id, text=text, parse_mode=parse_mode,
+            reply_markup=reply_markup
+        )
+
+async def run_broadcast(
+    bot: Bot,
+    message_text: str,
+    admin_user_id: int,
+    target_group: str = 'all',
+    media_type: Optional[str] = None,
+    media_id: Optional[str] = None,
+    buttons: List[Dict[str, str]] = None,
+    broadcast_id: Optional[int] = None,
+    title: str = "Рассылка"
+) -> Tuple[int, int]:
+    """Рассылает готовый (экранированный) текст группе пользователей.
+
+    Получатели читаются постранично, отправляют BROADCAST_CONCURRENCY задач
+    с общим лимитом BROADCAST_RATE сообщений в секунду. Для запланированной
+    рассылки после каждой страницы сохраняется контрольная точка, и после
+    перезапуска рассылка продолжается с неё. Возвращает (отправлено, ошибок).
+    """
     buttons = buttons or []
-    all_users_data, _ = await get_all_users_stats(page=1, page_size=1000000)
-    target_users = [user[0] for user in all_users_data]
-    sent_count = 0
-    failed_count = 0
-    total_to_send = len(target_users)
-    logger.info(f"Начало общей рассылки от админа {admin_user_id} для {total_to_send} пользователей.")
+    # Клавиатура зависит только от того, ограничен ли получатель, — собираем оба варианта один раз
+    keyboards = {
+        False: build_broadcast_keyboard(buttons) if buttons else None,
+        True: build_broadcast_keyboard(buttons, restricted=True) if buttons else None,
+    }
+    limiter = TokenBucket(BROADCAST_RATE, capacity=max(1, int(BROADCAST_RATE)))
+    last_user_id, sent_count, failed_count = (0, 0, 0)
+    if broadcast_id:
+        last_user_id, sent_count, failed_count = await get_broadcast_checkpoint(broadcast_id)
+    resumed = last_user_id > 0
+
+    total_to_send = await count_broadcast_recipients(target_group)
+    logger.info(f"{title} от админа {admin_user_id}: группа {target_group}, ~{total_to_send} пользователей"
+                f"{f', продолжение после user_id={last_user_id}' if resumed else ''}.")
     await send_message_with_fallback(
         bot, admin_user_id,
         escape_message_parts(
-            f"🚀 Начинаю рассылку для ~`{total_to_send}` пользователей...",
+            f"🔁 Продолжаю рассылку (уже отправлено `{sent_count}`) для ~`{total_to_send}` пользователей..." if resumed
+            else f"🚀 Начинаю рассылку для ~`{total_to_send}` пользователей...",
             version=2
         ),
         parse_mode=ParseMode.MARKDOWN_V2
     )
-    for target_user_id in target_users:
-        try:
-            reply_markup = await create_dynamic_broadcast_keyboard(buttons, target_user_id) if buttons else None
+
+    queue: asyncio.Queue = asyncio.Queue()
+    started_at = time.monotonic()
+
+    async def deliver(user_id: int, restricted: bool) -> bool:
+        reply_markup = keyboards[restricted and user_id not in ADMIN_IDS]
+        text, parse_mode = message_text, ParseMode.MARKDOWN_V2
+        for attempt in range(3):
+            await limiter.acquire()
             try:
-                # Пытаемся отправить с MarkdownV2
-                if media_type == 'photo' and media_id:
-                    await bot.send_photo(
-                        chat_id=target_user_id, photo=media_id,
-                        caption=message_text, parse_mode=ParseMode.MARKDOWN_V2,
-                        reply_markup=reply_markup
-                    )
-                elif media_type == 'video' and media_id:
-                    await bot.send_video(
-                        chat_id=target_user_id, video=media_id,
-                        caption=message_text, parse_mode=ParseMode.MARKDOWN_V2,
-                        reply_markup=reply_markup
-                    )
-                else:
-                    await bot.send_message(
-                        chat_id=target_user_id, text=message_text, parse_mode=ParseMode.MARKDOWN_V2,
-                        reply_markup=reply_markup
-                    )
+                await _send_broadcast_item(bot, user_id, text, media_type, media_id, reply_markup, parse_mode)
+                return True
+            except TelegramRetryAfter as e:
+                # Превышен лимит Telegram: останавливаем всех отправителей и повторяем
+                limiter.pause(e.retry_after)
+            except TelegramForbiddenError as e:
+                logger.debug(f"Пользователь {user_id} недоступен для рассылки: {e}")
+                return False
             except TelegramBadRequest as e:
+                if parse_mode is None:
+                    logger.warning(f"Не удалось отправить рассылку пользователю {user_id}: {e}")
+                    return False
                 # Fallback: отправка без Markdown
-                logger.warning(f"Ошибка Markdown для user_id={target_user_id}: {e}. Пробуем без парсинга.")
-                raw_text = unescape_markdown(message_text)
-                if media_type == 'photo' and media_id:
-                    await bot.send_photo(
-                        chat_id=target_user_id, photo=media_id,
-                        caption=raw_text, parse_mode=None,
-                        reply_markup=reply_markup
-                    )
-                elif media_type == 'video' and media_id:
-                    await bot.send_video(
-                        chat_id=target_user_id, video=media_id,
-                        caption=raw_text, parse_mode=None,
-                        reply_markup=reply_markup
-                    )
+                logger.warning(f"Ошибка Markdown для user_id={user_id}: {e}. Пробуем без парсинга.")
+                text, parse_mode = unescape_markdown(message_text), None
+            except Exception as e:
+                logger.error(f"Ошибка отправки сообщения пользователю {user_id}: {e}", exc_info=True)
+                return False
+        logger.warning(f"Сообщение пользователю {user_id} не отправлено после {attempt + 1} попыток")
+        return False
+
+    async def sender() -> None:
+        nonlocal sent_count, failed_count
+        while True:
+            item = await queue.get()
+            try:
+                if item is None:
+                    return
+                if await deliver(*item):
+                    sent_count += 1
                 else:
-                    await bot.send_message(
-                        chat_id=target_user_id, text=raw_text, parse_mode=None,
-                        reply_markup=reply_markup
-                    )
-            sent_count += 1
-            if sent_count % 20 == 0:
-                await asyncio.sleep(1)
-        except Exception as e:
-            logger.error(f"Ошибка отправки сообщения пользователю {target_user_id}: {e}", exc_info=True)
-            failed_count += 1
+                    failed_count += 1
+            finally:
+                queue.task_done()
+
+    senders = [asyncio.create_task(sender()) for _ in range(max(1, BROADCAST_CONCURRENCY))]
+    try:
+        async for page in iter_broadcast_recipients(target_group, after_user_id=last_user_id, page_size=BROADCAST_PAGE_SIZE):
+            for recipient in page:
+                queue.put_nowait(recipient)
+            # Ждём всю страницу: тогда все user_id до last_user_id обработаны
+            await queue.join()
+            last_user_id = page[-1][0]
+            if broadcast_id:
+                await save_broadcast_checkpoint(broadcast_id, last_user_id, sent_count, failed_count)
+            logger.info(f"{title}: отправлено {sent_count}, ошибок {failed_count}, последний user_id={last_user_id}")
+    finally:
+        for _ in senders:
+            queue.put_nowait(None)
+        await asyncio.gather(*senders, return_exceptions=True)
+
+    if broadcast_id:
+        await save_broadcast_checkpoint(broadcast_id, last_user_id, sent_count, failed_count, status='completed')
+
+    elapsed = time.monotonic() - started_at
     summary_text = escape_message_parts(
-        f"🏁 Рассылка завершена!\n",
+        f"🏁 {title} завершена!\n",
         f"✅ Отправлено: `{sent_count}`\n",
-        f"❌ Не удалось отправить: `{failed_count}`",
+        f"❌ Не удалось отправить: `{failed_count}`\n",
+        f"⏱ Время: `{int(elapsed)}` сек",
         version=2
     )
     await send_message_with_fallback(
         bot, admin_user_id, summary_text, reply_markup=await create_admin_keyboard(),
         parse_mode=ParseMode.MARKDOWN_V2
     )
-    logger.info(f"Общая рассылка завершена. Отправлено: {sent_count}, Ошибок: {failed_count}")
+    logger.info(f"{title} завершена за {elapsed:.0f} сек. Отправлено: {sent_count}, Ошибок: {failed_count}, пауз по лимиту: {limiter.get_stats()['pauses']}")
+    return sent_count, failed_count
 
-async def broadcast_to_paid_users(bot: Bot, message_text: str, admin_user_id: int, media_type: str = None, media_id: str = None, buttons: List[Dict[str, str]] = None) -> None:
-    """Выполняет рассылку только оплатившим пользователям."""
-    buttons = buttons or []
-    target_users = await get_paid_users()
-    sent_count = 0
-    failed_count = 0
-    total_to_send = len(target_users)
-    logger.info(f"Начало рассылки для оплативших от админа {admin_user_id} для {total_to_send} пользователей.")
-    await send_message_with_fallback(
-        bot, admin_user_id,
-        escape_message_parts(
-            f"🚀 Начинаю рассылку для ~`{total_to_send}` оплативших пользователей...",
-            version=2
-        ),
-        parse_mode=ParseMode.MARKDOWN_V2
-    )
+def _with_signature(message_text: str) -> str:
+    """Добавляет подпись и экранирует текст рассылки."""
     signature = "🍪 PixelPie"
     caption = message_text + ("\n\n" + signature if message_text.strip() else "\n" + signature)
-    escaped_caption = escape_message_parts(caption, version=2)
-    for target_user_id in target_users:
-        try:
-            reply_markup = await create_dynamic_broadcast_keyboard(buttons, target_user_id) if buttons else None
-            if media_type == 'photo' and media_id:
-                await bot.send_photo(
-                    chat_id=target_user_id, photo=media_id,
-                    caption=escaped_caption, parse_mode=ParseMode.MARKDOWN_V2,
-                    reply_markup=reply_markup
-                )
-            elif media_type == 'video' and media_id:
-                await bot.send_video(
-                    chat_id=target_user_id, video=media_id,
-                    caption=escaped_caption, parse_mode=ParseMode.MARKDOWN_V2,
-                    reply_markup=reply_markup
-                )
-            else:
-                await bot.send_message(
-                    chat_id=target_user_id, text=escaped_caption, parse_mode=ParseMode.MARKDOWN_V2,
-                    reply_markup=reply_markup
-                )
-            sent_count += 1
-            if sent_count % 20 == 0:
-                await asyncio.sleep(1)
-        except Exception as e:
-            logger.error(f"Ошибка отправки сообщения пользователю {target_user_id}: {e}", exc_info=True)
-            failed_count += 1
-    summary_text = escape_message_parts(
-        f"🏁 Рассылка для оплативших завершена!\n",
-        f"✅ Отправлено: `{sent_count}`\n",
-        f"❌ Не удалось отправить: `{failed_count}`",
-        version=2
-    )
-    await send_message_with_fallback(
-        bot, admin_user_id, summary_text, reply_markup=await create_admin_keyboard(),
-        parse_mode=ParseMode.MARKDOWN_V2
-    )
-    logger.info(f"Рассылка для оплативших завершена. Отправлено: {sent_count}, Ошибок: {failed_count}")
+    return escape_message_parts(caption, version=2)
+
+async def broadcast_message_admin(bot: Bot, message_text: str, admin_user_id: int, media_type: str = None, media_id: str = None, buttons: List[Dict[str, str]] = None) -> None:
+    """Выполняет рассылку всем пользователям."""
+    await run_broadcast(bot, message_text, admin_user_id, 'all', media_type, media_id, buttons, title="Рассылка")
+
+async def broadcast_to_paid_users(bot: Bot, message_text: str, admin_user_id: int, media_type: str = None, media_id: str = None, buttons: List[Dict[str, str]] = None) -> None:
+    """Выполняет рассылку только оплатившим пользователям."""
+    await run_broadcast(bot, _with_signature(message_text), admin_user_id, 'paid', media_type, media_id, buttons, title="Рассылка для оплативших")
 
 async def broadcast_to_non_paid_users(bot: Bot, message_text: str, admin_user_id: int, media_type: str = None, media_id: str = None, buttons: List[Dict[str, str]] = None) -> None:
     """Выполняет рассылку только не оплатившим пользователям."""
-    buttons = buttons or []
-    target_users = await get_non_paid_users()
-    sent_count = 0
-    failed_count = 0
-    total_to_send = len(target_users)
-    logger.info(f"Начало рассылки для не оплативших от админа {admin_user_id} для {total_to_send} пользователей.")
-    await send_message_with_fallback(
-        bot, admin_user_id,
-        escape_message_parts(
-            f"🚀 Начинаю рассылку для ~`{total_to_send}` не оплативших пользователей...",
-            version=2
-        ),
-        parse_mode=ParseMode.MARKDOWN_V2
-    )
-    signature = "🍪 PixelPie"
-    caption = message_text + ("\n\n" + signature if message_text.strip() else "\n" + signature)
-    escaped_caption = escape_message_parts(caption, version=2)
-    for target_user_id in target_users:
-        try:
-            reply_markup = await create_dynamic_broadcast_keyboard(buttons, target_user_id) if buttons else None
-            if media_type == 'photo' and media_id:
-                await bot.send_photo(
-                    chat_id=target_user_id, photo=media_id,
-                    caption=escaped_caption, parse_mode=ParseMode.MARKDOWN_V2,
-                    reply_markup=reply_markup
-                )
-            elif media_type == 'video' and media_id:
-                await bot.send_video(
-                    chat_id=target_user_id, video=media_id,
-                    caption=escaped_caption, parse_mode=ParseMode.MARKDOWN_V2,
-                    reply_markup=reply_markup
-                )
-            else:
-                await bot.send_message(
-                    chat_id=target_user_id, text=escaped_caption, parse_mode=ParseMode.MARKDOWN_V2,
-                    reply_markup=reply_markup
-                )
-            sent_count += 1
-            if sent_count % 20 == 0:
-                await asyncio.sleep(1)
-        except Exception as e:
-            logger.error(f"Ошибка отправки сообщения пользователю {target_user_id}: {e}", exc_info=True)
-            failed_count += 1
-    summary_text = escape_message_parts(
-        f"🏁 Рассылка для не оплативших завершена!\n",
-        f"✅ Отправлено: `{sent_count}`\n",
-        f"❌ Не удалось отправить: `{failed_count}`",
-        version=2
-    )
-    await send_message_with_fallback(
-        bot, admin_user_id, summary_text, reply_markup=await create_admin_keyboard(),
-        parse_mode=ParseMode.MARKDOWN_V2
-    )
-    logger.info(f"Рассылка для не оплативших завершена. Отправлено: {sent_count}, Ошибок: {failed_count}")
+    await run_broadcast(bot, _with_signature(message_text), admin_user_id, 'non_paid', media_type, media_id, buttons, title="Рассылка для не оплативших")
 
 async def broadcast_with_payment(
     bot: Bot,
@@ -322,60 +292,4 @@ async def broadcast_with_payment(
     buttons: List[Dict[str, str]] = None
 ) -> None:
     """Выполняет рассылку всем пользователям с кнопкой для перехода к тарифам."""
-    buttons = buttons or []
-    all_users_data, _ = await get_all_users_stats(page=1, page_size=1000000)
-    target_users = [user[0] for user in all_users_data]
-    sent_count = 0
-    failed_count = 0
-    total_to_send = len(target_users)
-    logger.info(f"Начало рассылки с оплатой от админа {admin_user_id} для {total_to_send} пользователей.")
-    await send_message_with_fallback(
-        bot, admin_user_id,
-        escape_message_parts(
-            f"🚀 Начинаю рассылку с оплатой для ~`{total_to_send}` пользователей...",
-            version=2
-        ),
-        parse_mode=ParseMode.MARKDOWN_V2
-    )
-    signature = "🍪 PixelPie"
-    caption = message_text + ("\n\n" + signature if message_text.strip() else "\n" + signature)
-    escaped_caption = escape_message_parts(caption, version=2)
-    for target_user_id in target_users:
-        try:
-            reply_markup = await create_dynamic_broadcast_keyboard(buttons, target_user_id) if buttons else None
-            if media_type == 'photo' and media_id:
-                await bot.send_photo(
-                    chat_id=target_user_id, photo=media_id,
-                    caption=escaped_caption, parse_mode=ParseMode.MARKDOWN_V2,
-                    reply_markup=reply_markup
-                )
-            elif media_type == 'video' and media_id:
-                await bot.send_video(
-                    chat_id=target_user_id, video=media_id,
-                    caption=escaped_caption, parse_mode=ParseMode.MARKDOWN_V2,
-                    reply_markup=reply_markup
-                )
-            else:
-                await bot.send_message(
-                    chat_id=target_user_id, text=escaped_caption,
-                    parse_mode=ParseMode.MARKDOWN_V2, reply_markup=reply_markup
-                )
-            sent_count += 1
-            if sent_count % 20 == 0:
-                await asyncio.sleep(1)
-        except Exception as e:
-            logger.error(f"Ошибка отправки сообщения пользователю {target_user_id}: {e}", exc_info=True)
-            failed_count += 1
-    summary_text = escape_message_parts(
-        f"🏁 Рассылка с оплатой завершена!\n",
-        f"✅ Отправлено: `{sent_count}`\n",
-        f"❌ Не удалось отправить: `{failed_count}`",
-        version=2
-    )
-    await send_message_with_fallback(
-        bot, admin_user_id, summary_text,
-        reply_markup=await create_admin_keyboard(), parse_mode=ParseMode.MARKDOWN_V2
-    )
-    logger.info(f"Рассылка с оплатой завершена. Отправлено: {sent_count}, Ошибок: {failed_count}")
-
-# TODO: Добавить остальные функции из handlers/broadcast.py
\ No newline at end of file
+    await run_broadcast(bot, _with_signature(message_text), admin_user_id, 'all', media_type, media_id, buttons, title="Рассылка с оплатой")
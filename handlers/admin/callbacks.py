@@ -3,6 +3,7 @@
 import asyncio
 import logging
 import os
+import tempfile
 import time
 from typing import Optional, Dict, Any, List
 from datetime import datetime, timedelta
@@ -43,7 +44,7 @@ from handlers.utils import (
     escape_message_parts, anti_spam
 , smart_message_send, smart_message_send_with_photo)
 from keyboards import create_admin_keyboard
-from report import report_generator, send_report_to_admin, delete_report_file
+from report import REPORT_TYPES, export_report_to_admin, delete_report_file
 
 from logger import get_logger
 logger = get_logger('main')
@@ -106,7 +107,7 @@ admin_callbacks_router = Router()
 async def handle_admin_send_generation(query: CallbackQuery, state: FSMContext) -> None:
     """Обработчик для отправки генерации пользователю."""
     from handlers.admin.generation import process_image_generation
-    from generation.utils import download_images_parallel
+    from generation.results import get_result_sources
 
     admin_user_id = query.from_user.id
     await query.answer()
@@ -140,27 +141,23 @@ async def handle_admin_send_generation(query: CallbackQuery, state: FSMContext)
         await query.answer("❌ Данные генерации не найдены.", show_alert=True)
         return
 
-    # Загружаем изображения, если пути отсутствуют
-    image_paths = user_data.get('last_admin_image_paths', [])
-    if not image_paths:
-        logger.info(f"Загрузка изображений для target_user_id={target_user_id}")
-        image_paths = await download_images_parallel(generation_data['image_urls'], target_user_id)
-        if not image_paths:
-            logger.error(f"Не удалось загрузить изображения для target_user_id={target_user_id}")
-            text = escape_message_parts(
-                f"❌ Ошибка загрузки изображений для пользователя ID `{target_user_id}`.",
-                version=2
-            )
-            await query.message.edit_text(
-                text,
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="🔙 К действиям", callback_data=f"user_actions_{target_user_id}")]
-                ]),
-                parse_mode=ParseMode.MARKDOWN_V2
-            )
-            await query.answer("❌ Ошибка загрузки изображений.", show_alert=True)
-            return
-        await state.update_data(last_admin_image_paths=image_paths)
+    # Фото уже есть в Telegram (file_id) или доступны по ссылке Replicate — повторно не скачиваем
+    images = await get_result_sources(generation_data)
+    if not images:
+        logger.error(f"Нет изображений для target_user_id={target_user_id}")
+        text = escape_message_parts(
+            f"❌ Ошибка загрузки изображений для пользователя ID `{target_user_id}`.",
+            version=2
+        )
+        await query.message.edit_text(
+            text,
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="🔙 К действиям", callback_data=f"user_actions_{target_user_id}")]
+            ]),
+            parse_mode=ParseMode.MARKDOWN_V2
+        )
+        await query.answer("❌ Ошибка загрузки изображений.", show_alert=True)
+        return
 
     # Гарантируем сохранение админского контекста
     await state.update_data(
@@ -179,7 +176,7 @@ async def handle_admin_send_generation(query: CallbackQuery, state: FSMContext)
             bot=query.bot,
             state=state,
             user_id=target_user_id,
-            image_paths=image_paths,
+            images=images,
             duration=generation_data.get('duration', 0.0),
             aspect_ratio=generation_data.get('aspect_ratio', '1:1'),
             generation_type=generation_data.get('generation_type', 'with_avatar'),
@@ -228,6 +225,39 @@ async def handle_admin_regenerate(query: CallbackQuery, state: FSMContext) -> No
     await state.update_data(user_id=query.from_user.id)
     await generate_photo_for_user(query, state, target_user_id)
 
+async def handle_admin_report(query: CallbackQuery, state: FSMContext) -> None:
+    """Выгрузка XLSX-отчёта по кнопке админ-панели."""
+    if query.from_user.id not in ADMIN_IDS:
+        await query.answer("❌ Нет доступа.", show_alert=True)
+        return
+
+    report_type = query.data[len("admin_report_"):]
+    if report_type not in REPORT_TYPES:
+        await query.answer("❌ Неизвестный отчет.", show_alert=True)
+        return
+
+    await query.answer("⏳ Отчет формируется...")
+    await export_report_to_admin(query.bot, query.from_user.id, report_type)
+
+async def handle_delete_report(query: CallbackQuery, state: FSMContext) -> None:
+    """Удаляет файл отчета после отправки администратору."""
+    if query.from_user.id not in ADMIN_IDS:
+        await query.answer("❌ Нет доступа.", show_alert=True)
+        return
+
+    # В callback_data только имя файла: отчеты лежат во временном каталоге
+    filename = os.path.basename(query.data[len("delete_report_"):])
+    if not filename.endswith('.xlsx'):
+        await query.answer("❌ Неверное имя файла.", show_alert=True)
+        return
+
+    await delete_report_file(os.path.join(tempfile.gettempdir(), filename))
+    try:
+        await query.message.delete()
+    except TelegramBadRequest as e:
+        logger.debug(f"Не удалось удалить сообщение с отчетом: {e}")
+    await query.answer("🗑 Файл отчета удален")
+
 # TODO: Проверить, есть ли ещё функции из handlers/callbacks_admin.py, которые нужно добавить
 
 # Регистрация callback'ов
@@ -237,6 +267,8 @@ from aiogram import F
 admin_callbacks_router.callback_query.register(show_dev_test_payment, F.data == "dev_test_payment")
 admin_callbacks_router.callback_query.register(handle_admin_send_generation, F.data.startswith("admin_send_generation:"))
 admin_callbacks_router.callback_query.register(handle_admin_regenerate, F.data.startswith("admin_regenerate:"))
+admin_callbacks_router.callback_query.register(handle_admin_report, F.data.startswith("admin_report_"))
+admin_callbacks_router.callback_query.register(handle_delete_report, F.data.startswith("delete_report_"))
 
 # Регистрация callback'ов для админских команд
 admin_callbacks_router.callback_query.register(confirm_addcook_callback, F.data.startswith("confirm_addcook_"))
@@ -1,6 +1,5 @@
 # handlers/admin/generation.py
 
-import asyncio
 import logging
 from typing import Optional, List, Dict, Tuple
 from aiogram import Router, Bot
@@ -19,6 +18,7 @@ from keyboards import (
 )
 from generation.images import generate_image, process_prompt_async, prepare_model_params
 from generation.utils import reset_generation_context
+from generation.results import new_generation_id, file_ids_from_messages, save_result, send_result, get_result_sources
 
 from logger import get_logger
 logger = get_logger('generation')
@@ -54,7 +54,7 @@ async def generate_photo_for_user(query: CallbackQuery, state: FSMContext, targe
 
     # Проверяем существование пользователя
     target_user_info = await check_database_user(target_user_id)
-    if not target_user_info or (target_user_info[3] is None and target_user_info[8] is None):
+    if not target_user_info or (target_user_info.username is None and target_user_info.first_name is None):
         await send_message_with_fallback(
             query.bot, admin_id,
             escape_md(f"❌ Пользователь ID `{target_user_id}` не найден.", version=2),
@@ -347,7 +347,7 @@ async def handle_admin_generation_result(state: FSMContext, admin_id: int, targe
                 [InlineKeyboardButton(text="🔙 К действиям", callback_data=f"user_actions_{target_user_id}")]
             ])
 
-            await bot.send_photo(
+            sent = await bot.send_photo(
                 chat_id=admin_id,
                 photo=result_data['image_urls'][0],
                 caption=caption,
@@ -355,8 +355,16 @@ async def handle_admin_generation_result(state: FSMContext, admin_id: int, targe
                 reply_markup=keyboard
             )
 
+            # Первое фото уже загружено в Telegram: при отправке пользователю используем его file_id
+            generation_id = result_data.get('generation_id') or new_generation_id()
+            await save_result(
+                generation_id, file_ids_from_messages(sent),
+                image_urls=result_data.get('image_urls'), user_id=target_user_id
+            )
+
             await state.update_data(**{f'last_admin_generation_{target_user_id}': {
                 'image_urls': result_data.get('image_urls'),
+                'generation_id': generation_id,
                 'prompt': result_data.get('prompt'),
                 'style': result_data.get('style', user_data.get('style_key', 'custom'))
             }})
@@ -390,7 +398,7 @@ async def process_image_generation(
     bot: Bot,
     state: FSMContext,
     user_id: int,
-    image_paths: List[str],
+    images: List[str],
     duration: float,
     aspect_ratio: str,
     generation_type: str,
@@ -398,8 +406,7 @@ async def process_image_generation(
     admin_user_id: Optional[int] = None
 ) -> None:
     from keyboards import create_rating_keyboard, create_admin_user_actions_keyboard
-    from generation.utils import send_message_with_fallback, send_media_group_with_retry, cleanup_files
-    from aiogram.types import InputMediaPhoto, FSInputFile
+    from generation.utils import send_message_with_fallback
 
     logger.info(f"Начало process_image_generation: user_id={user_id}, admin_user_id={admin_user_id}, generation_type={generation_type}")
 
@@ -426,8 +433,8 @@ async def process_image_generation(
         logger.debug(f"is_admin_generation={is_admin_generation}, admin_user_id={admin_user_id}")
 
         # Проверяем, что изображения существуют
-        if not image_paths:
-            logger.error(f"Пустой список image_paths для user_id={user_id}")
+        if not images:
+            logger.error(f"Пустой список images для user_id={user_id}")
             await send_message_with_fallback(
                 bot, user_id,
                 escape_md("❌ Ошибка: изображения не получены. Попробуйте снова.", version=2),
@@ -445,7 +452,7 @@ async def process_image_generation(
 
         # Формируем подпись для пользователя
         caption = escape_md(
-            f"📸 {len(image_paths)} ваших фотографий созданы! ({duration:.1f} сек)\n"
+            f"📸 {len(images)} ваших фотографий созданы! ({duration:.1f} сек)\n"
             f"🎨 Стиль: {style_name}\n"
             f"👤 Аватар: {active_avatar_name}\n"
             f"⚡ Сделано при помощи PixelPie_AI", version=2
@@ -454,24 +461,13 @@ async def process_image_generation(
         # Отправляем изображения пользователю
         logger.info(f"Отправка изображений пользователю user_id={user_id}")
         try:
-            if len(image_paths) == 1:
-                photo_file = FSInputFile(path=image_paths[0])
-                await bot.send_photo(
-                    chat_id=user_id,
-                    photo=photo_file,
-                    caption=caption,
-                    reply_markup=await create_rating_keyboard(generation_type, model_key, user_id, bot),
-                    parse_mode=ParseMode.MARKDOWN_V2
+            if len(images) == 1:
+                file_ids = await send_result(
+                    bot, user_id, images, caption=caption, parse_mode=ParseMode.MARKDOWN_V2,
+                    reply_markup=await create_rating_keyboard(generation_type, model_key, user_id, bot)
                 )
             else:
-                media = []
-                for i, path in enumerate(image_paths):
-                    photo_file = FSInputFile(path=path)
-                    if i == 0:
-                        media.append(InputMediaPhoto(media=photo_file, caption=caption, parse_mode=ParseMode.MARKDOWN_V2))
-                    else:
-                        media.append(InputMediaPhoto(media=photo_file))
-                await send_media_group_with_retry(bot, user_id, media)
+                file_ids = await send_result(bot, user_id, images, caption=caption, parse_mode=ParseMode.MARKDOWN_V2)
                 await send_message_with_fallback(
                     bot, user_id,
                     escape_md("⭐ Оцени результат ИИ фотогенерации:", version=2),
@@ -539,14 +535,20 @@ async def process_image_generation(
                 'model_key': model_key,
                 'style': style_name,
                 'image_urls': user_data.get(f'last_admin_generation_{user_id}', {}).get('image_urls', []),
+                'generation_id': user_data.get(f'last_admin_generation_{user_id}', {}).get('generation_id'),
                 'selected_gender': user_data.get('selected_gender'),
                 'user_input_for_llama': user_data.get('user_input_for_llama'),
                 'duration': duration
             }} if is_admin_generation else {}
         )
 
-        # Очищаем временные файлы
-        asyncio.create_task(cleanup_files(image_paths))
+        # Все фото теперь есть в Telegram: повторные отправки пойдут по file_id
+        last_admin_generation = user_data.get(f'last_admin_generation_{user_id}', {})
+        if last_admin_generation.get('generation_id'):
+            await save_result(
+                last_admin_generation['generation_id'], file_ids,
+                image_urls=last_admin_generation.get('image_urls'), user_id=user_id
+            )
         logger.info(f"Результаты генерации обработаны для user_id={user_id}, state={user_data.get('state')}")
 
     except Exception as e:
@@ -605,9 +607,9 @@ async def generation_callback_handler(query: CallbackQuery, state: FSMContext) -
                 )
                 await query.answer()
                 return
-            image_paths = user_data.get('last_admin_image_paths', [])
-            if not image_paths:
-                logger.error(f"Нет локальных путей изображений для target_user_id={target_user_id}")
+            images = await get_result_sources(last_gen_data)
+            if not images:
+                logger.error(f"Нет изображений для target_user_id={target_user_id}")
                 await query.message.edit_text(
                     escape_md(f"❌ Ошибка: изображения недоступны для пользователя ID `{target_user_id}`.", version=2),
                     reply_markup=await create_admin_user_actions_keyboard(target_user_id, False),
@@ -619,7 +621,7 @@ async def generation_callback_handler(query: CallbackQuery, state: FSMContext) -
                 bot=query.bot,
                 state=state,
                 user_id=target_user_id,
-                image_paths=image_paths,
+                images=images,
                 duration=0.0,  # Duration недоступен, используем 0.0
                 aspect_ratio=user_data.get('last_admin_generation', {}).get('aspect_ratio', '1:1'),
                 generation_type=user_data.get('last_admin_generation', {}).get('generation_type', 'with_avatar'),
@@ -15,7 +15,8 @@ from database import (
     get_user_trainedmodels, get_registrations_by_date
 )
 import aiosqlite
-from config import ADMIN_IDS, DATABASE_PATH
+from db_pool import db_pool
+from config import ADMIN_IDS
 from keyboards import create_admin_keyboard, create_main_menu_keyboard
 from handlers.utils import (
     safe_escape_markdown as escape_md, truncate_text, safe_edit_message, debug_markdown_text,
@@ -194,7 +195,7 @@ async def get_all_failed_avatars() -> List[Dict]:
     """Получает список всех аватаров с ошибками из базы данных."""
     failed_avatars = []
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as db:
+        async with db_pool.reader() as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute("""
                 SELECT
@@ -228,7 +229,7 @@ async def get_all_failed_avatars() -> List[Dict]:
 async def delete_all_failed_avatars() -> int:
     """Удаляет все аватары с ошибками из базы данных."""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as db:
+        async with db_pool.writer() as db:
             cursor = await db.execute("""
                 DELETE FROM user_trainedmodels
                 WHERE status IN ('failed', 'error') OR status IS NULL OR status = ''
@@ -399,13 +400,13 @@ async def send_daily_payments_report(bot: Bot) -> None:
         # Генерируем Excel-файлы, если есть данные
         if payments:
             payments_filename = f"payments_{yesterday}_{uuid.uuid4().hex[:8]}.xlsx"
-            payments_file_path = create_payments_excel(payments, payments_filename, yesterday)
+            payments_file_path = await asyncio.to_thread(create_payments_excel, payments, payments_filename, yesterday)
         else:
             logger.info(f"Платежи за {yesterday} не найдены.")
 
         if registrations:
             registrations_filename = f"registrations_{yesterday}_{uuid.uuid4().hex[:8]}.xlsx"
-            registrations_file_path = create_registrations_excel(registrations, registrations_filename, yesterday)
+            registrations_file_path = await asyncio.to_thread(create_registrations_excel, registrations, registrations_filename, yesterday)
         else:
             logger.info(f"Регистрации за {yesterday} не найдены.")
 
@@ -15,7 +15,7 @@ from aiogram.filters import Command
 from database import (
     check_database_user, get_user_generation_stats, get_user_payments, get_user_trainedmodels,
     get_user_rating_and_registration, get_user_logs, delete_user_activity, block_user_access, is_user_blocked,
-    update_user_credits, get_active_trainedmodel, search_users_by_query
+    update_user_credits, get_active_trainedmodel, search_users_by_query, refresh_user_cache
 )
 from config import ADMIN_IDS
 from keyboards import create_admin_user_actions_keyboard, create_admin_keyboard
@@ -23,7 +23,7 @@ from handlers.utils import (
     escape_message_parts, send_message_with_fallback, truncate_text,
     create_isolated_context, clean_admin_context
 )
-import aiosqlite
+from db_pool import db_pool
 from keyboards import create_main_menu_keyboard
 
 from logger import get_logger
@@ -69,7 +69,7 @@ async def show_user_actions(query: CallbackQuery, state: FSMContext) -> None:
         return
 
     target_user_info = await check_database_user(target_user_id)
-    if not target_user_info or (target_user_info[3] is None and target_user_info[8] is None):
+    if not target_user_info or (target_user_info.username is None and target_user_info.first_name is None):
         await state.clear()
         text = escape_message_parts(
             f"❌ Пользователь ID `{target_user_id}` не найден.",
@@ -667,12 +667,13 @@ async def confirm_reset_avatar(query: CallbackQuery, state: FSMContext, target_u
     display_name = f_name or u_name or f"ID {target_user_id}"
 
     # Сбрасываем активный аватар пользователя
-    async with aiosqlite.connect(DATABASE_PATH) as conn:
+    async with db_pool.writer() as conn:
         await conn.execute(
             "UPDATE users SET active_avatar_id = NULL WHERE user_id = ?",
             (target_user_id,)
         )
         await conn.commit()
+    await refresh_user_cache(target_user_id)
 
     text = escape_message_parts(
         f"🔄 Аватар пользователя сброшен!\n\n"
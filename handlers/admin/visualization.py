@@ -2,25 +2,16 @@
 
 import asyncio
 import logging
-import os
-import io
 from datetime import datetime, timedelta
-from typing import List, Dict
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-import seaborn as sns
 from aiogram import Router, Bot
-from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, BufferedInputFile
 from aiogram.fsm.context import FSMContext
 from aiogram.enums import ParseMode
 from aiogram.filters import Command
-from database import get_payments_by_date, get_user_activity_metrics, get_generation_cost_log
-from config import ADMIN_IDS, DATABASE_PATH
-from generation_config import IMAGE_GENERATION_MODELS
+from database import get_user_activity_metrics
+from config import ADMIN_IDS
+from chart_service import chart_service
 from handlers.utils import safe_escape_markdown as escape_md, send_message_with_fallback
-import aiosqlite
 from keyboards import create_admin_keyboard, create_admin_user_actions_keyboard
 
 
@@ -56,8 +47,8 @@ async def show_visualization(query: CallbackQuery, state: FSMContext) -> None:
         reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard), parse_mode=ParseMode.MARKDOWN
     )
 
-async def visualize_payments(query: CallbackQuery, state: FSMContext) -> None:
-    """Показывает график платежей за последние 30 дней."""
+async def _send_chart(query: CallbackQuery, state: FSMContext, chart: str, title: str, caption: str, empty_text: str) -> None:
+    """Отправляет график из сервиса графиков (отрисовка вне event loop, PNG кэшируется)."""
     user_id = query.from_user.id
     if user_id not in ADMIN_IDS:
         await state.clear()
@@ -67,77 +58,30 @@ async def visualize_payments(query: CallbackQuery, state: FSMContext) -> None:
         return
 
     try:
-        end_date = datetime.now().date()
-        start_date = end_date - timedelta(days=30)
-        payments = await get_payments_by_period(start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
-
-        logger.info(f"Найдено {len(payments)} платежей за период {start_date} - {end_date}")
-
-        dates = []
-        amounts = []
-        current_date = start_date
-        while current_date <= end_date:
-            dates.append(current_date)
-            amounts.append(0.0)
-            current_date += timedelta(days=1)
-
-        for payment in payments:
-            if payment[4] is None:
-                logger.warning(f"Платеж {payment[3]} имеет пустую дату created_at")
-                continue
-            try:
-                payment_date = datetime.strptime(payment[4], '%Y-%m-%d %H:%M:%S').date()
-                if start_date <= payment_date <= end_date:
-                    index = dates.index(payment_date)
-                    amounts[index] += float(payment[2])
-            except (ValueError, AttributeError) as e:
-                logger.warning(f"Ошибка обработки даты платежа {payment[3]}: {e}")
-
-        if not any(amounts):
-            text = escape_md("⚠️ Нет данных о платежах за последние 30 дней.")
-            await state.clear()
+        png = await chart_service.render(chart, days=30)
+        await state.clear()
+        if png is None:
             await send_message_with_fallback(
-                query.bot, user_id, text,
+                query.bot, user_id, escape_md(empty_text),
                 reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🔙 К визуализации", callback_data="admin_visualization")]]),
                 parse_mode=ParseMode.MARKDOWN
             )
             return
 
-        plt.figure(figsize=(12, 6))
-        sns.set_style("whitegrid")
-        plt.plot(dates, amounts, color='#4CAF50', linewidth=2, marker='o')
-        plt.fill_between(dates, amounts, color=(76/255, 175/255, 80/255, 0.2))
-        plt.title("Динамика платежей за последние 30 дней", fontsize=14, pad=10)
-        plt.xlabel("Дата", fontsize=12)
-        plt.ylabel("Сумма (RUB)", fontsize=12)
-        plt.gca().xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
-        plt.gca().xaxis.set_major_locator(mdates.DayLocator(interval=5))
-        plt.xticks(rotation=45, ha='right')
-        plt.tight_layout()
-
-        buffer = io.BytesIO()
-        plt.savefig(buffer, format='png', dpi=100)
-        buffer.seek(0)
-        plt.close()
-
-        text = escape_md("📈 График платежей за последние 30 дней:")
         reply_markup = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="🔙 К визуализации", callback_data="admin_visualization")],
             [InlineKeyboardButton(text="🏠 Админ-панель", callback_data="admin_panel")]
         ])
         await send_message_with_fallback(
-            query.bot, user_id, text,
+            query.bot, user_id, escape_md(title),
             reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN
         )
-
         await query.bot.send_photo(
-            chat_id=user_id, photo=buffer, caption="График платежей"
+            chat_id=user_id, photo=BufferedInputFile(png, filename=f"{chart}.png"), caption=caption
         )
-        buffer.close()
-        await state.clear()
 
     except Exception as e:
-        logger.error(f"Ошибка при визуализации платежей: {e}", exc_info=True)
+        logger.error(f"Ошибка при визуализации {chart}: {e}", exc_info=True)
         text = escape_md("❌ Ошибка создания графика. Проверьте логи.")
         await state.clear()
         await send_message_with_fallback(
@@ -146,189 +90,26 @@ async def visualize_payments(query: CallbackQuery, state: FSMContext) -> None:
             parse_mode=ParseMode.MARKDOWN
         )
 
+async def visualize_payments(query: CallbackQuery, state: FSMContext) -> None:
+    """Показывает график платежей за последние 30 дней."""
+    await _send_chart(
+        query, state, 'payments', "📈 График платежей за последние 30 дней:", "График платежей",
+        "⚠️ Нет данных о платежах за последние 30 дней."
+    )
+
 async def visualize_registrations(query: CallbackQuery, state: FSMContext) -> None:
     """Показывает график регистраций за последние 30 дней."""
-    user_id = query.from_user.id
-    if user_id not in ADMIN_IDS:
-        await state.clear()
-        await query.message.answer(
-            escape_md("❌ У вас нет прав."), parse_mode=ParseMode.MARKDOWN
-        )
-        return
-
-    try:
-        if not os.path.exists(DATABASE_PATH):
-            logger.error(f"Файл базы данных не найден: {DATABASE_PATH}")
-            text = escape_md("❌ Файл базы данных не найден. Обратитесь к администратору.")
-            await state.clear()
-            await send_message_with_fallback(
-                query.bot, user_id, text,
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🔙 К визуализации", callback_data="admin_visualization")]]),
-                parse_mode=ParseMode.MARKDOWN
-            )
-            return
-
-        end_date = datetime.now()
-        start_date = end_date - timedelta(days=30)
-
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
-            conn.row_factory = aiosqlite.Row
-            c = await conn.cursor()
-            await c.execute(
-                """
-                SELECT DATE(created_at) as reg_date, COUNT(*) as count
-                FROM users
-                WHERE created_at BETWEEN ? AND ?
-                GROUP BY DATE(created_at)
-                ORDER BY reg_date
-                """,
-                (start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
-            )
-            registrations = await c.fetchall()
-
-        dates = []
-        counts = []
-        current_date = start_date
-        while current_date <= end_date:
-            dates.append(current_date.strftime('%Y-%m-%d'))
-            counts.append(0)
-            current_date += timedelta(days=1)
-
-        for reg in registrations:
-            reg_date = reg['reg_date']
-            if reg_date in dates:
-                counts[dates.index(reg_date)] = reg['count']
-
-        plt.figure(figsize=(12, 6))
-        sns.set_style("whitegrid")
-        plt.bar(dates, counts, color='#2196F3', edgecolor='#1976D2')
-        plt.title("Динамика регистраций за последние 30 дней", fontsize=14, pad=10)
-        plt.xlabel("Дата", fontsize=12)
-        plt.ylabel("Количество регистраций", fontsize=12)
-        plt.xticks(rotation=45, ha='right')
-        plt.tight_layout()
-
-        buffer = io.BytesIO()
-        plt.savefig(buffer, format='png', dpi=100)
-        buffer.seek(0)
-        plt.close()
-
-        text = escape_md("📊 График регистраций за последние 30 дней:")
-        reply_markup = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔙 К визуализации", callback_data="admin_visualization")],
-            [InlineKeyboardButton(text="🏠 Админ-панель", callback_data="admin_panel")]
-        ])
-        await send_message_with_fallback(
-            query.bot, user_id, text,
-            reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN
-        )
-
-        await query.bot.send_photo(
-            chat_id=user_id, photo=buffer, caption="График регистраций"
-        )
-        buffer.close()
-        await state.clear()
-
-    except Exception as e:
-        logger.error(f"Ошибка при визуализации регистраций: {e}", exc_info=True)
-        text = escape_md("❌ Ошибка создания графика. Проверьте логи.")
-        await state.clear()
-        await send_message_with_fallback(
-            query.bot, user_id, text,
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🔙 К визуализации", callback_data="admin_visualization")]]),
-            parse_mode=ParseMode.MARKDOWN
-        )
+    await _send_chart(
+        query, state, 'registrations', "📊 График регистраций за последние 30 дней:", "График регистраций",
+        "⚠️ Нет данных о регистрациях за последние 30 дней."
+    )
 
 async def visualize_generations(query: CallbackQuery, state: FSMContext) -> None:
     """Показывает график генераций за последние 30 дней."""
-    user_id = query.from_user.id
-    if user_id not in ADMIN_IDS:
-        await state.clear()
-        await query.message.answer(
-            escape_md("❌ У вас нет прав."), parse_mode=ParseMode.MARKDOWN
-        )
-        return
-
-    try:
-        if not os.path.exists(DATABASE_PATH):
-            logger.error(f"Файл базы данных не найден: {DATABASE_PATH}")
-            text = escape_md("❌ Файл базы данных не найден. Обратитесь к администратору.")
-            await state.clear()
-            await send_message_with_fallback(
-                query.bot, user_id, text,
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🔙 К визуализации", callback_data="admin_visualization")]]),
-                parse_mode=ParseMode.MARKDOWN
-            )
-            return
-
-        end_date = datetime.now().strftime('%Y-%m-%d')
-        start_date = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
-        log_entries = await get_generation_cost_log(start_date_str=start_date, end_date_str=end_date)
-
-        dates = []
-        generation_counts: Dict[str, List[int]] = {}
-        current_date = datetime.strptime(start_date, '%Y-%m-%d')
-        end_date_dt = datetime.strptime(end_date, '%Y-%m-%d')
-        while current_date <= end_date_dt:
-            dates.append(current_date.strftime('%Y-%m-%d'))
-            current_date += timedelta(days=1)
-
-        for entry in log_entries:
-            model_id, units, _, created_at = entry
-            date_str = str(created_at).split(' ')[0]
-            if date_str in dates:
-                if model_id not in generation_counts:
-                    generation_counts[model_id] = [0] * len(dates)
-                generation_counts[model_id][dates.index(date_str)] += units
-
-        plt.figure(figsize=(12, 6))
-        sns.set_style("whitegrid")
-        colors = sns.color_palette("husl", len(generation_counts))
-
-        for idx, (model_id, counts) in enumerate(generation_counts.items()):
-            model_name = next(
-                (m_data.get('name', model_id) for _, m_data in IMAGE_GENERATION_MODELS.items() if m_data.get('id') == model_id),
-                model_id
-            )
-            plt.plot(dates, counts, label=model_name, color=colors[idx], linewidth=2)
-
-        plt.title("Динамика генераций за последние 30 дней", fontsize=14, pad=10)
-        plt.xlabel("Дата", fontsize=12)
-        plt.ylabel("Количество генераций", fontsize=12)
-        plt.xticks(rotation=45, ha='right')
-        plt.legend(title="Модели", bbox_to_anchor=(1.05, 1), loc='upper left')
-        plt.tight_layout()
-
-        buffer = io.BytesIO()
-        plt.savefig(buffer, format='png', dpi=100)
-        buffer.seek(0)
-        plt.close()
-
-        text = escape_md("📸 График генераций за последние 30 дней:")
-        reply_markup = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔙 К визуализации", callback_data="admin_visualization")],
-            [InlineKeyboardButton(text="🏠 Админ-панель", callback_data="admin_panel")]
-        ])
-        await send_message_with_fallback(
-            query.bot, user_id, text,
-            reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN
-        )
-
-        await query.bot.send_photo(
-            chat_id=user_id, photo=buffer, caption="График генераций"
-        )
-        buffer.close()
-        await state.clear()
-
-    except Exception as e:
-        logger.error(f"Ошибка при визуализации генераций: {e}", exc_info=True)
-        text = escape_md("❌ Ошибка создания графика. Проверьте логи.")
-        await state.clear()
-        await send_message_with_fallback(
-            query.bot, user_id, text,
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🔙 К визуализации", callback_data="admin_visualization")]]),
-            parse_mode=ParseMode.MARKDOWN
-        )
+    await _send_chart(
+        query, state, 'generations', "📸 График генераций за последние 30 дней:", "График генераций",
+        "⚠️ Нет данных о генерациях за последние 30 дней."
+    )
 
 async def show_activity_stats(query: CallbackQuery, state: FSMContext) -> None:
     """Показывает меню для запроса статистики активности пользователей."""
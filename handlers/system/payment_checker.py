@@ -64,8 +64,8 @@ async def handle_successful_payment_message(
         # Получаем текущий баланс пользователя
         user_data = await check_database_user(user_id)
         if user_data:
-            current_photos = user_data[0] if len(user_data) > 0 else 0  # generations_left
-            current_avatars = user_data[1] if len(user_data) > 1 else 0  # avatar_left
+            current_photos = user_data.generations_left
+            current_avatars = user_data.avatar_left
         else:
             current_photos = 0
             current_avatars = 0
@@ -2,11 +2,12 @@
 
 import logging
 import aiosqlite
+from db_pool import db_pool
 from aiogram import Router
 from aiogram.types import CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, Message
 from aiogram.fsm.context import FSMContext
 from aiogram.enums import ParseMode
-from config import ADMIN_IDS, DATABASE_PATH
+from config import ADMIN_IDS
 from database import check_database_user, is_user_blocked
 from handlers.utils import safe_escape_markdown as escape_md, safe_answer_callback, smart_message_send
 from keyboards import create_main_menu_keyboard, create_referral_keyboard, create_admin_keyboard
@@ -58,7 +59,7 @@ async def handle_referrals_callback(query: CallbackQuery, state: FSMContext) ->
 async def handle_referrals_menu_callback(query: CallbackQuery, state: FSMContext, user_id: int) -> None:  # noqa: ARG001
     """Меню реферальной программы."""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             cursor = await conn.cursor()
             await cursor.execute("SELECT COUNT(*) FROM users WHERE referrer_id = ?", (user_id,))
@@ -161,7 +162,7 @@ async def handle_my_referrals_callback(query: CallbackQuery, state: FSMContext,
     """Показ рефералов пользователя и бонусов."""
     logger.debug("handle_my_referrals: user_id=%s", user_id)
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
             await c.execute("SELECT referred_id, status, created_at, completed_at FROM referrals WHERE referrer_id = ?", (user_id,))
@@ -90,17 +90,8 @@ async def handle_back_to_menu_callback(query: CallbackQuery, state: FSMContext,
     # Проверка данных подписки
     try:
         subscription_data = await check_database_user(user_id)
-        if not subscription_data or len(subscription_data) < 11:
-            logger.error(f"Неполные данные подписки для user_id={user_id}")
-            await query.message.answer(
-                escape_md("❌ Ошибка сервера! Попробуйте позже.", version=2),
-                reply_markup=await create_main_menu_keyboard(user_id),
-                parse_mode=ParseMode.MARKDOWN_V2
-            )
-            return
-
-        generations_left = subscription_data[0]
-        avatar_left = subscription_data[1]
+        generations_left = subscription_data.generations_left
+        avatar_left = subscription_data.avatar_left
 
         # Формируем текст меню с счётчиком
         total = await bot_counter.get_total_count()
@@ -3,54 +3,114 @@
 Пользовательские обработчики
 """
 
-from .onboarding import (
-    onboarding_router, send_onboarding_message, schedule_welcome_message,
-    schedule_daily_reminders, send_daily_reminders, proceed_to_tariff_callback,
-    setup_onboarding_handlers
-)
-from .commands import (
-    start, menu, help_command, check_training, 
-    check_user_blocked, extract_utm_from_text
-)
-from .messages import (
-    handle_text, handle_email_input, handle_email_change_input,
-    handle_manual_prompt_input, handle_llama_prompt_input,
-    handle_custom_prompt_photo_input, handle_admin_text,
-    handle_admin_chat_message, handle_photo, handle_prompt_based_photo,
-    handle_photo_to_photo_reference, handle_photo_to_photo_mask, handle_video
-)
-from .callbacks import (
-    handle_proceed_to_payment_callback, handle_user_callback, handle_back_to_menu_callback,
-    delete_all_videos, handle_photo_generate_menu_callback, handle_video_generate_menu_callback,
-    handle_generate_with_avatar_callback, handle_style_selection_callback, handle_style_choice_callback,
-    handle_male_styles_page_callback, handle_female_styles_page_callback, handle_photo_to_photo_callback,
-    handle_ai_video_callback, handle_video_style_choice_callback, handle_custom_prompt_manual_callback,
-    handle_custom_prompt_llama_callback, handle_confirm_video_generation_callback, handle_confirm_assisted_prompt_callback,
-    handle_edit_assisted_prompt_callback, handle_skip_prompt_callback, handle_aspect_ratio_callback,
-    handle_back_to_aspect_selection_callback, handle_back_to_style_selection_callback, handle_confirm_generation_callback,
-    handle_rating_callback, handle_user_profile_callback, handle_check_subscription_callback,
-    handle_user_stats_callback, handle_subscribe_callback, handle_payment_callback, handle_my_avatars_callback,
-    handle_select_avatar_callback, handle_train_flux_callback, handle_continue_upload_callback,
-    handle_start_training_callback, handle_support_callback, handle_help_callback, handle_terms_callback,
-    handle_select_new_male_avatar_styles_callback, handle_select_new_female_avatar_styles_callback,
-    handle_confirm_start_training_callback, handle_back_to_avatar_name_input_callback, handle_use_suggested_trigger_callback,
-    handle_confirm_photo_quality_callback, handle_repeat_last_generation_callback, handle_change_email_callback,
-    handle_confirm_change_email_callback, handle_skip_mask_callback, ask_for_aspect_ratio_callback, cancel,
-    user_callbacks_router
-)
+import importlib
+
+# Имя -> (подмодуль, имя в подмодуле). Подмодуль загружается при первом
+# обращении: импорт отдельного обработчика не тянет за собой весь пакет
+# и не замыкает цикл импортов generation <-> handlers.
+_EXPORTS = {
+    'onboarding_router': ('.onboarding', 'onboarding_router'),
+    'send_onboarding_message': ('.onboarding', 'send_onboarding_message'),
+    'schedule_welcome_message': ('.onboarding', 'schedule_welcome_message'),
+    'schedule_daily_reminders': ('.onboarding', 'schedule_daily_reminders'),
+    'send_daily_reminders': ('.onboarding', 'send_daily_reminders'),
+    'send_onboarding_batch': ('.onboarding', 'send_onboarding_batch'),
+    'process_onboarding_jobs': ('.onboarding', 'process_onboarding_jobs'),
+    'proceed_to_tariff_callback': ('.onboarding', 'proceed_to_tariff_callback'),
+    'setup_onboarding_handlers': ('.onboarding', 'setup_onboarding_handlers'),
+    'start': ('.commands', 'start'),
+    'menu': ('.commands', 'menu'),
+    'help_command': ('.commands', 'help_command'),
+    'check_training': ('.commands', 'check_training'),
+    'check_user_blocked': ('.commands', 'check_user_blocked'),
+    'extract_utm_from_text': ('.commands', 'extract_utm_from_text'),
+    'handle_text': ('.messages', 'handle_text'),
+    'handle_email_input': ('.messages', 'handle_email_input'),
+    'handle_email_change_input': ('.messages', 'handle_email_change_input'),
+    'handle_manual_prompt_input': ('.messages', 'handle_manual_prompt_input'),
+    'handle_llama_prompt_input': ('.messages', 'handle_llama_prompt_input'),
+    'handle_custom_prompt_photo_input': ('.messages', 'handle_custom_prompt_photo_input'),
+    'handle_admin_text': ('.messages', 'handle_admin_text'),
+    'handle_admin_chat_message': ('.messages', 'handle_admin_chat_message'),
+    'handle_photo': ('.messages', 'handle_photo'),
+    'handle_prompt_based_photo': ('.messages', 'handle_prompt_based_photo'),
+    'handle_photo_to_photo_reference': ('.messages', 'handle_photo_to_photo_reference'),
+    'handle_photo_to_photo_mask': ('.messages', 'handle_photo_to_photo_mask'),
+    'handle_video': ('.messages', 'handle_video'),
+    'handle_proceed_to_payment_callback': ('.callbacks', 'handle_proceed_to_payment_callback'),
+    'handle_user_callback': ('.callbacks', 'handle_user_callback'),
+    'handle_back_to_menu_callback': ('.callbacks', 'handle_back_to_menu_callback'),
+    'delete_all_videos': ('.callbacks', 'delete_all_videos'),
+    'handle_photo_generate_menu_callback': ('.callbacks', 'handle_photo_generate_menu_callback'),
+    'handle_video_generate_menu_callback': ('.callbacks', 'handle_video_generate_menu_callback'),
+    'handle_generate_with_avatar_callback': ('.callbacks', 'handle_generate_with_avatar_callback'),
+    'handle_style_selection_callback': ('.callbacks', 'handle_style_selection_callback'),
+    'handle_style_choice_callback': ('.callbacks', 'handle_style_choice_callback'),
+    'handle_male_styles_page_callback': ('.callbacks', 'handle_male_styles_page_callback'),
+    'handle_female_styles_page_callback': ('.callbacks', 'handle_female_styles_page_callback'),
+    'handle_photo_to_photo_callback': ('.callbacks', 'handle_photo_to_photo_callback'),
+    'handle_ai_video_callback': ('.callbacks', 'handle_ai_video_callback'),
+    'handle_video_style_choice_callback': ('.callbacks', 'handle_video_style_choice_callback'),
+    'handle_custom_prompt_manual_callback': ('.callbacks', 'handle_custom_prompt_manual_callback'),
+    'handle_custom_prompt_llama_callback': ('.callbacks', 'handle_custom_prompt_llama_callback'),
+    'handle_confirm_video_generation_callback': ('.callbacks', 'handle_confirm_video_generation_callback'),
+    'handle_confirm_assisted_prompt_callback': ('.callbacks', 'handle_confirm_assisted_prompt_callback'),
+    'handle_edit_assisted_prompt_callback': ('.callbacks', 'handle_edit_assisted_prompt_callback'),
+    'handle_skip_prompt_callback': ('.callbacks', 'handle_skip_prompt_callback'),
+    'handle_aspect_ratio_callback': ('.callbacks', 'handle_aspect_ratio_callback'),
+    'handle_back_to_aspect_selection_callback': ('.callbacks', 'handle_back_to_aspect_selection_callback'),
+    'handle_back_to_style_selection_callback': ('.callbacks', 'handle_back_to_style_selection_callback'),
+    'handle_confirm_generation_callback': ('.callbacks', 'handle_confirm_generation_callback'),
+    'handle_rating_callback': ('.callbacks', 'handle_rating_callback'),
+    'handle_user_profile_callback': ('.callbacks', 'handle_user_profile_callback'),
+    'handle_check_subscription_callback': ('.callbacks', 'handle_check_subscription_callback'),
+    'handle_user_stats_callback': ('.callbacks', 'handle_user_stats_callback'),
+    'handle_subscribe_callback': ('.callbacks', 'handle_subscribe_callback'),
+    'handle_payment_callback': ('.callbacks', 'handle_payment_callback'),
+    'handle_my_avatars_callback': ('.callbacks', 'handle_my_avatars_callback'),
+    'handle_select_avatar_callback': ('.callbacks', 'handle_select_avatar_callback'),
+    'handle_train_flux_callback': ('.callbacks', 'handle_train_flux_callback'),
+    'handle_continue_upload_callback': ('.callbacks', 'handle_continue_upload_callback'),
+    'handle_start_training_callback': ('.callbacks', 'handle_start_training_callback'),
+    'handle_support_callback': ('.callbacks', 'handle_support_callback'),
+    'handle_help_callback': ('.callbacks', 'handle_help_callback'),
+    'handle_terms_callback': ('.callbacks', 'handle_terms_callback'),
+    'handle_select_new_male_avatar_styles_callback': ('.callbacks', 'handle_select_new_male_avatar_styles_callback'),
+    'handle_select_new_female_avatar_styles_callback': ('.callbacks', 'handle_select_new_female_avatar_styles_callback'),
+    'handle_confirm_start_training_callback': ('.callbacks', 'handle_confirm_start_training_callback'),
+    'handle_back_to_avatar_name_input_callback': ('.callbacks', 'handle_back_to_avatar_name_input_callback'),
+    'handle_use_suggested_trigger_callback': ('.callbacks', 'handle_use_suggested_trigger_callback'),
+    'handle_confirm_photo_quality_callback': ('.callbacks', 'handle_confirm_photo_quality_callback'),
+    'handle_repeat_last_generation_callback': ('.callbacks', 'handle_repeat_last_generation_callback'),
+    'handle_change_email_callback': ('.callbacks', 'handle_change_email_callback'),
+    'handle_confirm_change_email_callback': ('.callbacks', 'handle_confirm_change_email_callback'),
+    'handle_skip_mask_callback': ('.callbacks', 'handle_skip_mask_callback'),
+    'ask_for_aspect_ratio_callback': ('.callbacks', 'ask_for_aspect_ratio_callback'),
+    'cancel': ('.callbacks', 'cancel'),
+    'user_callbacks_router': ('.callbacks', 'user_callbacks_router'),
+    'check_payment_status_and_update_message': ('.payments', 'check_payment_status_and_update_message'),
+    'handle_successful_payment_message': ('.payments', 'handle_successful_payment_message'),
+    'handle_expired_payment_message': ('.payments', 'handle_expired_payment_message'),
+    'schedule_payment_check': ('.payments', 'schedule_payment_check'),
+    'photo_transform_router': ('.photo_transform', 'photo_transform_router'),
+    'init_photo_generator': ('.photo_transform', 'init_photo_generator'),
+}
+
+
+def __getattr__(name):
+    try:
+        module, attr = _EXPORTS[name]
+    except KeyError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
+    value = getattr(importlib.import_module(module, __name__), attr)
+    globals()[name] = value
+    return value
 
-from .payments import (
-    check_payment_status_and_update_message, handle_successful_payment_message,
-    handle_expired_payment_message, schedule_payment_check
-)
-from .photo_transform import (
-    photo_transform_router, init_photo_generator
-)
 
 __all__ = [
     # Onboarding
     'onboarding_router', 'send_onboarding_message', 'schedule_welcome_message',
-    'schedule_daily_reminders', 'send_daily_reminders', 'proceed_to_tariff_callback',
+    'schedule_daily_reminders', 'send_daily_reminders', 'send_onboarding_batch', 'process_onboarding_jobs', 'proceed_to_tariff_callback',
     'setup_onboarding_handlers',
     
     # Commands
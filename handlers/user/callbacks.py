@@ -1,6 +1,7 @@
 import re
 import asyncio
 import aiosqlite
+from db_pool import db_pool
 import logging
 import os
 import time
@@ -14,14 +15,15 @@ from aiogram.enums import ParseMode
 from aiogram.filters import Command
 from datetime import datetime
 from states import BotStates, VideoStates
-from config import ADMIN_IDS, DATABASE_PATH, TARIFFS
+from config import ADMIN_IDS, TARIFFS
+from tariffs import tariff_registry
 from generation_config import IMAGE_GENERATION_MODELS, ASPECT_RATIOS, NEW_MALE_AVATAR_STYLES, NEW_FEMALE_AVATAR_STYLES, get_video_generation_cost
 from style import new_male_avatar_prompts, new_female_avatar_prompts
 from database import (
     check_database_user, update_user_balance, add_rating, get_user_trainedmodels,
     get_active_trainedmodel, delete_trained_model, get_user_video_tasks,
     get_user_rating_and_registration, get_user_generation_stats, get_user_payments,
-    is_user_blocked, user_cache, update_user_credits, check_user_resources, is_old_user
+    is_user_blocked, refresh_user_cache, update_user_credits, check_user_resources, is_old_user
 )
 from keyboards import (
     create_main_menu_keyboard, create_photo_generate_menu_keyboard,
@@ -252,26 +254,11 @@ async def handle_back_to_menu_callback(query: CallbackQuery, state: FSMContext,
     logger.debug(f"handle_back_to_menu_callback вызван для user_id={user_id}")
     await state.clear()
     subscription_data = await check_database_user(user_id)
-    if not subscription_data or len(subscription_data) < 11:
-        logger.error(f"Неполные данные подписки для user_id={user_id}: {subscription_data}")
-        text = escape_message_parts(
-            "❌ Ошибка получения данных.",
-            " Попробуйте позже.",
-            version=2
-        )
-        await smart_message_send(
-            query,
-            text=text,
-            reply_markup=await create_main_menu_keyboard(user_id),
-            parse_mode=ParseMode.MARKDOWN_V2
-        )
-        return
-
-    generations_left = subscription_data[0] if subscription_data and len(subscription_data) > 0 else 0
-    avatar_left = subscription_data[1] if subscription_data and len(subscription_data) > 1 else 0
-    first_purchase = bool(subscription_data[5]) if len(subscription_data) > 5 else True
-    created_at = subscription_data[10] if subscription_data and len(subscription_data) > 10 else None
-    last_reminder_type = subscription_data[9] if subscription_data and len(subscription_data) > 9 else None
+    generations_left = subscription_data.generations_left
+    avatar_left = subscription_data.avatar_left
+    first_purchase = bool(subscription_data.first_purchase)
+    created_at = subscription_data.created_at
+    last_reminder_type = subscription_data.last_reminder_type
 
     # Проверяем статус оплаты
     payments = await get_user_payments(user_id)
@@ -456,15 +443,8 @@ async def handle_generate_with_avatar_callback(query: CallbackQuery, state: FSMC
             )
         logger.info(f"Инициализация 'Фотосессия с аватаром' для user_id={user_id}, target_user_id={target_user_id}")
 
-        # Инвалидируем кэш подписки
-        if user_cache is not None:
-            try:
-                await user_cache.delete(target_user_id)
-                logger.debug(f"Кэш подписки инвалидирован для user_id={target_user_id}")
-            except Exception as e:
-                logger.warning(f"Ошибка при инвалидации user_cache для user_id={target_user_id}: {e}")
-        else:
-            logger.debug(f"Кеш недоступен для user_id={target_user_id}")
+        # Обновляем кэш подписки актуальными данными
+        await refresh_user_cache(target_user_id)
 
         # Проверяем подписку
         subscription_data = await check_resources(query.bot, target_user_id)
@@ -480,20 +460,11 @@ async def handle_generate_with_avatar_callback(query: CallbackQuery, state: FSMC
             )
             return
 
-        # Проверяем, что subscription_data — это кортеж
-        if not isinstance(subscription_data, tuple) or len(subscription_data) < 10:
-            logger.error(f"Некорректные данные подписки для user_id={target_user_id}: {subscription_data}")
-            await state.clear()
-            await query.answer("❌ Ошибка данных подписки", show_alert=True)
-            await smart_message_send(
-                query,
-                text=escape_md("❌ Некорректные данные подписки. Обратитесь в поддержку: @AXIDI_Help", version=2),
-                reply_markup=await create_main_menu_keyboard(user_id),
-                parse_mode=ParseMode.MARKDOWN_V2
-            )
-            return
-
-        generations_left, avatar_left, has_trained_model, _, _, _, _, active_avatar_id, _, is_blocked, _, _, _, _ = subscription_data
+        generations_left = subscription_data.generations_left
+        avatar_left = subscription_data.avatar_left
+        has_trained_model = subscription_data.has_trained_model
+        active_avatar_id = subscription_data.active_avatar_id
+        is_blocked = subscription_data.is_blocked
         logger.info(f"Баланс user_id={target_user_id}: generations_left={generations_left}, avatar_left={avatar_left}, has_trained_model={has_trained_model}, active_avatar_id={active_avatar_id}, is_blocked={is_blocked}")
 
         if is_blocked:
@@ -1787,23 +1758,7 @@ async def handle_user_profile_callback(query: CallbackQuery, state: FSMContext,
     await state.clear()
     await reset_generation_context(state, "user_profile", user_id=user_id)
     subscription_data = await check_database_user(user_id)
-    if not subscription_data or len(subscription_data) < 9:
-        await state.clear()
-        text = escape_message_parts(
-            "❌ Ошибка получения данных профиля.",
-            " Попробуйте позже.",
-            version=2
-        )
-        logger.debug(f"handle_user_profile_callback: сформирован текст: {text[:200]}...")
-        await smart_message_send(
-            query,
-            text=text,
-            reply_markup=await create_main_menu_keyboard(user_id),
-            parse_mode=ParseMode.MARKDOWN_V2
-        )
-        await state.update_data(user_id=user_id)
-        return
-    generations_left, avatar_left = subscription_data[0], subscription_data[1]
+    generations_left, avatar_left = subscription_data.generations_left, subscription_data.avatar_left
     text_parts = [
         "👤 Личный кабинет\n\n",
         f"💰 Баланс: {generations_left} печенек, {avatar_left} аватар{'ов' if avatar_left != 1 else ''}"
@@ -1822,23 +1777,9 @@ async def handle_check_subscription_callback(query: CallbackQuery, state: FSMCon
     """Проверка подписки."""
     logger.debug(f"handle_check_subscription_callback вызван для user_id={user_id}")
     subscription_data = await check_database_user(user_id)
-    if not subscription_data or len(subscription_data) < 9:
-        await state.clear()
-        await safe_answer_callback(query, "❌ Ошибка получения данных", show_alert=True)
-        text = escape_message_parts(
-            "❌ Ошибка получения данных профиля.",
-            " Попробуйте позже.",
-            version=2
-        )
-        logger.debug(f"handle_check_subscription_callback: сформирован текст: {text[:200]}...")
-        await query.message.answer(
-            text,
-            reply_markup=await create_main_menu_keyboard(user_id),
-            parse_mode=ParseMode.MARKDOWN_V2
-        )
-        await state.update_data(user_id=user_id)
-        return
-    generations_left, avatar_left, _, username, _, _, email, _, _, _, _, _, _, _ = subscription_data
+    generations_left = subscription_data.generations_left
+    avatar_left = subscription_data.avatar_left
+    email = subscription_data.email
     text_parts = [
         "💳 Твоя подписка:\n\n",
         f"📸 Печенек на балансе: {generations_left}\n",
@@ -1872,7 +1813,7 @@ async def handle_user_stats_callback(query: CallbackQuery, state: FSMContext, us
         gen_stats = await get_user_generation_stats(user_id)
         payments = await get_user_payments(user_id)
         total_spent = sum(p[2] for p in payments if p[2] is not None)
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
             await c.execute("SELECT referred_id, status, completed_at FROM referrals WHERE referrer_id = ?", (user_id,))
@@ -1900,7 +1841,7 @@ async def handle_user_stats_callback(query: CallbackQuery, state: FSMContext, us
         ref_user_id = ref['referred_id']
         ref_status = ref['status']
         ref_data = await check_database_user(ref_user_id)
-        has_purchased = ref_status == 'completed' or (ref_data and len(ref_data) > 5 and not bool(ref_data[5]))
+        has_purchased = ref_status == 'completed' or not bool(ref_data.first_purchase)
         if has_purchased:
             active_referrals += 1
             total_bonuses += 5
@@ -1986,23 +1927,7 @@ async def handle_subscribe_callback(query: CallbackQuery, state: FSMContext, use
     await delete_all_videos(state, user_id, query.bot)
     await state.clear()
     subscription_data = await check_database_user(user_id)
-    if not subscription_data or len(subscription_data) < 11:
-        logger.error(f"Неполные данные подписки для user_id={user_id}: {subscription_data}")
-        text = escape_message_parts(
-            "❌ Ошибка получения данных.",
-            " Попробуйте позже.",
-            version=2
-        )
-        await smart_message_send(
-            query,
-            text=text,
-            reply_markup=await create_main_menu_keyboard(user_id),
-            parse_mode=ParseMode.MARKDOWN_V2
-        )
-        await state.update_data(user_id=user_id)
-        return
-
-    first_purchase = bool(subscription_data[5])
+    first_purchase = bool(subscription_data.first_purchase)
     payments = await get_user_payments(user_id)
     is_paying_user = len(payments) > 0
     logger.info(f"handle_subscribe_callback: user_id={user_id}, payment_count={len(payments) if payments else 0}, first_purchase={first_purchase}, is_paying_user={is_paying_user}")
@@ -2014,15 +1939,15 @@ async def handle_subscribe_callback(query: CallbackQuery, state: FSMContext, use
     registration_date = datetime.now(moscow_tz)
     time_since_registration = float('inf')
     days_since_registration = 0
-    last_reminder_type = subscription_data[9] if subscription_data and len(subscription_data) > 9 else None
-    if subscription_data and len(subscription_data) > 10 and subscription_data[10]:
+    last_reminder_type = subscription_data.last_reminder_type
+    if subscription_data.created_at:
         try:
-            registration_date = moscow_tz.localize(datetime.strptime(subscription_data[10], '%Y-%m-%d %H:%M:%S'))
+            registration_date = moscow_tz.localize(datetime.strptime(subscription_data.created_at, '%Y-%m-%d %H:%M:%S'))
             time_since_registration = (datetime.now(moscow_tz) - registration_date).total_seconds()
             days_since_registration = (datetime.now(moscow_tz).date() - registration_date.date()).days
             logger.debug(f"Calculated time_since_registration={time_since_registration}, days_since_registration={days_since_registration} for user_id={user_id}")
         except ValueError as e:
-            logger.error(f"Невалидная дата регистрации для user_id={user_id}: {subscription_data[10]}. Ошибка: {e}")
+            logger.error(f"Невалидная дата регистрации для user_id={user_id}: {subscription_data.created_at}. Ошибка: {e}")
 
     # Проверяем, является ли пользователь старым
     is_old_user_flag = await is_old_user(user_id, cutoff_date="2025-07-11")
@@ -2155,36 +2080,11 @@ async def handle_payment_callback(query: CallbackQuery, state: FSMContext, user_
     logger.info(f"Начало handle_payment_callback для user_id={user_id}, callback_data={callback_data}")
 
     try:
-        # Извлечение суммы из callback_data
-        amount_str = callback_data.replace("pay_", "")
-        try:
-            amount = float(amount_str)
-        except ValueError:
-            logger.error(f"Некорректная сумма в callback_data: {amount_str}, user_id={user_id}")
-            await safe_answer_callback(query, "❌ Неверный формат тарифа", show_alert=True)
-            text = escape_message_parts(
-                "❌ Неверный формат тарифа.",
-                " Выберите тариф заново.",
-                version=2
-            )
-            await smart_message_send(
-                query,
-                text=text,
-                reply_markup=await create_subscription_keyboard(hide_mini_tariff=True),
-                parse_mode=ParseMode.MARKDOWN_V2
-            )
-            await state.update_data(user_id=user_id)
-            return
-
-        # Поиск тарифа по сумме
-        tariff_key = None
-        for key, details in TARIFFS.items():
-            if abs(float(details["amount"]) - amount) < 0.01:
-                tariff_key = key
-                break
+        # Поиск тарифа по callback_data кнопки
+        tariff_key = tariff_registry.key_for_callback(callback_data)
 
         if not tariff_key:
-            logger.error(f"Тариф с суммой {amount} не найден в TARIFFS для user_id={user_id}")
+            logger.error(f"Тариф для callback_data={callback_data} не найден в TARIFFS для user_id={user_id}")
             await safe_answer_callback(query, "❌ Тариф не найден", show_alert=True)
             text = escape_message_parts(
                 "❌ Выбранный тариф не найден.",
@@ -2208,17 +2108,17 @@ async def handle_payment_callback(query: CallbackQuery, state: FSMContext, user_
         registration_date = datetime.now(moscow_tz)
         days_since_registration = 0
         time_since_registration = float('inf')
-        if subscription_data and len(subscription_data) > 10 and subscription_data[10]:
+        if subscription_data.created_at:
             try:
-                registration_date = moscow_tz.localize(datetime.strptime(subscription_data[10], '%Y-%m-%d %H:%M:%S'))
+                registration_date = moscow_tz.localize(datetime.strptime(subscription_data.created_at, '%Y-%m-%d %H:%M:%S'))
                 days_since_registration = (datetime.now(moscow_tz).date() - registration_date.date()).days
                 time_since_registration = (datetime.now(moscow_tz) - registration_date).total_seconds()
             except ValueError as e:
-                logger.warning(f"Невалидный формат даты в subscription_data[10] для user_id={user_id}: {subscription_data[10]}. Ошибка: {e}")
+                logger.warning(f"Невалидный формат даты created_at для user_id={user_id}: {subscription_data.created_at}. Ошибка: {e}")
 
         payments = await get_user_payments(user_id)
         is_paying_user = len(payments) > 0
-        last_reminder_type = subscription_data[9] if subscription_data and len(subscription_data) > 9 else None
+        last_reminder_type = subscription_data.last_reminder_type
 
         # Проверка актуальности тарифа для неоплативших пользователей
         if not is_paying_user:
@@ -2260,7 +2160,7 @@ async def handle_payment_callback(query: CallbackQuery, state: FSMContext, user_
         logger.debug(f"Сохранены данные платежа для user_id={user_id}: amount={amount}, description={description}")
 
         # Проверка email
-        email = subscription_data[6] if subscription_data and len(subscription_data) > 6 and subscription_data[6] else None
+        email = subscription_data.email or None
         logger.debug(f"Email для user_id={user_id}: {email}")
 
         if email:
@@ -2284,7 +2184,7 @@ async def handle_payment_callback(query: CallbackQuery, state: FSMContext, user_
             try:
                 bot_username = (await query.bot.get_me()).username
                 payment_url, payment_id = await create_payment_link(user_id, email, amount, description, bot_username)
-                is_first_purchase = bool(subscription_data[5]) if len(subscription_data) > 5 else True
+                is_first_purchase = bool(subscription_data.first_purchase)
                 bonus_text = " (+ 1 аватар в подарок!)" if is_first_purchase and tariff.get("photos", 0) > 0 else ""
 
                 # Формирование текста с корректным экранированием
@@ -2323,6 +2223,7 @@ async def handle_payment_callback(query: CallbackQuery, state: FSMContext, user_
                             run_date=check_time,
                             args=[query.bot, user_id, payment_id, payment_message.message_id, tariff_key],
                             id=f"payment_check_{payment_id}_{user_id}",
+                            replace_existing=True,  # Ссылка из кэша: проверяем последнее сообщение
                             misfire_grace_time=300
                         )
                         logger.info(f"Запланирована проверка платежа {payment_id} для user_id={user_id} в {check_time}")
@@ -2397,7 +2298,7 @@ async def handle_select_avatar_callback(query: CallbackQuery, state: FSMContext,
     logger.debug(f"handle_select_avatar_callback вызван для user_id={user_id}, callback_data={callback_data}")
     try:
         avatar_id = int(callback_data.split('_')[2])
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             c = await conn.cursor()
             await c.execute("SELECT avatar_id FROM user_trainedmodels WHERE avatar_id = ? AND user_id = ?", (avatar_id, user_id))
             if not await c.fetchone():
@@ -2467,6 +2368,8 @@ async def handle_train_flux_callback(query: CallbackQuery, state: FSMContext, us
     
     # Устанавливаем правильное состояние FSM для загрузки фотографий
     from generation.training import TrainingStates
+    from generation.photo_ingest import training_ingest
+    training_ingest.discard(user_id)
     await state.set_state(TrainingStates.AWAITING_PHOTOS)
     await state.update_data(training_step='upload_photos', training_photos=[], user_id=user_id)
     
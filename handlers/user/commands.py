@@ -125,7 +125,7 @@ async def start(message: Message, state: FSMContext) -> None:
                             referrer_id = None
                         else:
                             ref_data = await check_database_user(referrer_id)
-                            if not ref_data or ref_data[3] is None:
+                            if ref_data.username is None:
                                 logger.warning("Referrer ID %s not found.", referrer_id)
                                 referrer_id = None
                             elif await is_user_blocked(referrer_id):
@@ -147,17 +147,10 @@ async def start(message: Message, state: FSMContext) -> None:
 
     try:
         subscription_data = await check_database_user(user_id)
-        if not subscription_data or len(subscription_data) < 11:
-            logger.error("Неполные данные подписки для user_id=%s: %s", user_id, subscription_data)
-            await message.answer(
-                escape_md("❌ Ошибка сервера! Попробуйте /start позже.", version= 2),
-                parse_mode=ParseMode.MARKDOWN_V2
-            )
-            return
-        is_notified = subscription_data[4]
-        first_purchase = bool(subscription_data[5])
-        last_reminder_type = subscription_data[9]
-        created_at = subscription_data[10]
+        is_notified = subscription_data.is_notified
+        first_purchase = bool(subscription_data.first_purchase)
+        last_reminder_type = subscription_data.last_reminder_type
+        created_at = subscription_data.created_at
     except Exception as e:  # noqa: B001
         logger.error("Ошибка проверки подписки для user_id=%s: %s", user_id, e, exc_info=True)
         await message.answer(
@@ -300,18 +293,11 @@ async def menu(message: Message, state: FSMContext) -> None:
     # Проверка данных подписки
     try:
         subscription_data = await check_database_user(user_id)
-        if not subscription_data or len(subscription_data) < 14:
-            logger.error("Неполные данные подписки для user_id=%s: %s", user_id, subscription_data)
-            error_text = escape_md("❌ Ошибка сервера! Попробуйте /menu позже.", version=2)
-            main_menu_kb = await create_main_menu_keyboard(user_id)
-            await message.answer(
-                error_text,
-                reply_markup=main_menu_kb,
-                parse_mode=ParseMode.MARKDOWN_V2
-            )
-            return
-        generations_left, avatar_left, _, _, _, first_purchase_db_val, _, _, _, last_reminder_type, created_at, _, _, _ = subscription_data
-        first_purchase = bool(first_purchase_db_val)
+        generations_left = subscription_data.generations_left
+        avatar_left = subscription_data.avatar_left
+        last_reminder_type = subscription_data.last_reminder_type
+        created_at = subscription_data.created_at
+        first_purchase = bool(subscription_data.first_purchase)
     except Exception as e:  # noqa: B001
         logger.error("Ошибка проверки подписки для user_id=%s: %s", user_id, e, exc_info=True)
         error_text = escape_md("❌ Ошибка сервера! Попробуйте /menu позже.", version=2)
@@ -575,22 +561,7 @@ async def check_training(message: Message, state: FSMContext, user_id: int) -> N
     try:
         # Проверяем данные пользователя
         subscription_data = await check_database_user(effective_user_id)
-        if not subscription_data or len(subscription_data) < 11:
-            logger.error("Неполные данные подписки для user_id=%s: %s", effective_user_id, subscription_data)
-            text = escape_md(
-                f"❌ Ошибка получения данных пользователя ID {effective_user_id}. Попробуйте позже или обратитесь в поддержку: @AXIDI_Help",
-                version=2
-            )
-            await send_message_with_fallback(
-                message.bot, user_id, text,
-                reply_markup=await create_main_menu_keyboard(user_id),
-                parse_mode=ParseMode.MARKDOWN_V2
-            )
-            await state.update_data(user_id=user_id)
-            return
-
-        # Распаковываем данные подписки
-        _, _, _, _, _, _, _, active_avatar_id, _, _, _, _, _, _ = subscription_data
+        active_avatar_id = subscription_data.active_avatar_id
         logger.debug("Данные подписки получены для user_id=%s", effective_user_id)
 
         trained_models = await get_user_trainedmodels(effective_user_id)
@@ -13,12 +13,12 @@ import logging
 import re
 import os
 import uuid
-import aiosqlite
+from db_pool import db_pool
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
 from aiogram.enums import ParseMode
-from config import ADMIN_IDS, DATABASE_PATH, TARIFFS
-from database import is_user_blocked, block_user_access, check_database_user
+from config import ADMIN_IDS, TARIFFS
+from database import is_user_blocked, block_user_access, check_database_user, refresh_user_cache
 from keyboards import create_main_menu_keyboard, create_subscription_keyboard, create_user_profile_keyboard, create_back_keyboard, create_aspect_ratio_keyboard, create_photo_generate_menu_keyboard, create_admin_keyboard, create_broadcast_keyboard
 from generation.videos import create_video_photo_keyboard
 from llama_helper import generate_assisted_prompt
@@ -220,19 +220,20 @@ async def handle_email_input(message: Message, state: FSMContext, email: str = N
 
     try:
         # Сохраняем email в базе данных
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.writer() as conn:
             await conn.execute(
                 'UPDATE users SET email = ? WHERE user_id = ?',
                 (email, user_id)
             )
             await conn.commit()
+        await refresh_user_cache(user_id)
         logger.info(f'Email `{email}` сохранен для user_id={user_id}')
 
         # Проверяем конфигурацию YooKassa
         bot_username = (await bot.get_me()).username
         payment_url, payment_id = await create_payment_link(user_id, email, payment_amount, payment_description, bot_username)
         subscription_data = await check_database_user(user_id)
-        is_first_purchase = bool(subscription_data[5]) if subscription_data and len(subscription_data) > 5 else True
+        is_first_purchase = bool(subscription_data.first_purchase)
         bonus_text = ' (+ 1 аватар в подарок!)' if is_first_purchase and TARIFFS[tariff_key].get('photos', 0) > 0 else ''
 
         # Формируем текст с явным экранированием суммы
@@ -290,12 +291,13 @@ async def handle_email_change_input(message: Message, state: FSMContext, email:
         return
 
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.writer() as conn:
             await conn.execute(
                 'UPDATE users SET email = ? WHERE user_id = ?',
                 (email, user_id)
             )
             await conn.commit()
+        await refresh_user_cache(user_id)
         logger.info(f'Email изменен на `{email}` для user_id={user_id}')
         await state.clear()
         await message.answer(
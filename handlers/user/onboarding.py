@@ -4,20 +4,29 @@ import asyncio
 import logging
 import os
 from datetime import datetime, timedelta
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 import pytz
 from aiogram import Bot, Router
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile, Message, CallbackQuery, InputMediaPhoto
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.fsm.context import FSMContext
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.cron import CronTrigger
 import aiosqlite
-from config import DATABASE_PATH, TARIFFS, ADMIN_IDS, ERROR_LOG_ADMIN
+from db_pool import db_pool
+from config import (
+    DATABASE_PATH, TARIFFS, ADMIN_IDS, ERROR_LOG_ADMIN, ONBOARDING_SEND_RATE, ONBOARDING_SEND_CONCURRENCY,
+    ONBOARDING_JOB_MAX_ATTEMPTS, ONBOARDING_RETRY_DELAY_SECONDS
+)
+from tariffs import tariff_registry
 from handlers.utils import safe_escape_markdown as escape_md, smart_message_send, smart_message_send_with_photo, get_tariff_text
-from database import check_database_user, get_user_payments, is_old_user, mark_welcome_message_sent, get_users_for_reminders, is_user_blocked, block_user_access
+from database import (
+    UserSnapshot, check_database_user, get_user_payments, is_old_user, mark_welcome_message_sent,
+    get_due_onboarding_messages, mark_onboarding_message_sent, block_user_access,
+    enqueue_onboarding_job, claim_due_onboarding_jobs, finish_onboarding_job
+)
 from keyboards import create_subscription_keyboard, create_main_menu_keyboard
 from onboarding_config import get_day_config, get_message_text, has_user_purchases
+from rate_limiter import TokenBucket
 
 from logger import get_logger
 logger = get_logger('main')
@@ -31,13 +40,17 @@ EXAMPLE_IMAGES = [
     "images/example3.jpg",
 ]
 
-async def send_onboarding_message(bot: Bot, user_id: int, message_type: str, subscription_data: Optional[tuple] = None, first_purchase: bool = False) -> None:
-    """Отправляет сообщения онбординга в зависимости от типа."""
+async def send_onboarding_message(bot: Bot, user_id: int, message_type: str, subscription_data: Optional[UserSnapshot] = None, first_purchase: bool = False) -> bool:
+    """Отправляет сообщения онбординга в зависимости от типа.
+
+    Возвращает False, если отправить не удалось; пропуск (сообщение уже
+    отправлено, есть покупки) считается успехом.
+    """
     logger.debug("Отправка сообщения типа %s для user_id=%s", message_type, user_id)
 
     try:
-        username = subscription_data[3] if subscription_data and len(subscription_data) > 3 else "Пользователь"
-        first_name = subscription_data[8] if subscription_data and len(subscription_data) > 8 else "Пользователь"
+        username = subscription_data.username if subscription_data else "Пользователь"
+        first_name = subscription_data.first_name if subscription_data else "Пользователь"
 
         # Проверяем, является ли пользователь старым
         is_old_user_flag = await is_old_user(user_id, cutoff_date="2025-07-11")
@@ -46,16 +59,16 @@ async def send_onboarding_message(bot: Bot, user_id: int, message_type: str, sub
         # Если пользователь старый, не отправляем напоминания
         if is_old_user_flag and message_type.startswith("reminder_"):
             logger.info("Напоминание %s НЕ отправлено для user_id=%s: пользователь старый", message_type, user_id)
-            return
+            return True
 
         # Проверяем, есть ли у пользователя покупки
         has_purchases = await has_user_purchases(user_id, DATABASE_PATH)
         if has_purchases:
             logger.debug("Пользователь %s уже имеет покупки, пропускаем воронку", user_id)
-            return
+            return True
 
         # Получаем данные о последнем отправленном напоминании
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
             await c.execute("SELECT last_reminder_type, last_reminder_sent, welcome_message_sent FROM users WHERE user_id = ?", (user_id,))
@@ -67,168 +80,255 @@ async def send_onboarding_message(bot: Bot, user_id: int, message_type: str, sub
         # Пропускаем отправку приветственного сообщения, если оно уже было отправлено
         if message_type == "welcome" and welcome_message_sent:
             logger.info("Приветственное сообщение уже отправлено для user_id=%s, пропускаем", user_id)
-            return
+            return True
 
         # Пропускаем отправку напоминания, если оно уже было отправлено
         if last_reminder_type == message_type:
             logger.info("Сообщение %s уже отправлено для user_id=%s, пропускаем", message_type, user_id)
-            return
+            return True
 
-        # Получаем текст сообщения из конфигурации
-        message_data = get_message_text(message_type, first_name)
-        if not message_data:
-            logger.error("Неизвестный тип сообщения: %s для user_id=%s", message_type, user_id)
-            return
+        return await _deliver_onboarding_message(bot, user_id, message_type, username, first_name)
 
-        # Создаем клавиатуру в зависимости от типа сообщения
-        if message_type == "welcome":
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(
-                    text=message_data["button_text"],
-                    callback_data=message_data["callback_data"]
-                )]
-            ])
-            with_images = True
-        elif message_type == "reminder_day5":
+    except Exception as e:
+        await _report_onboarding_failure(bot, user_id, message_type, e)
+        return False
+
+def _build_onboarding_keyboard(message_type: str, message_data: Dict[str, str]) -> InlineKeyboardMarkup:
+    """Клавиатура с кнопкой из конфигурации воронки."""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(
+            text=message_data["button_text"],
+            callback_data=message_data["callback_data"]
+        )]
+    ])
+
+async def _deliver_onboarding_message(
+    bot: Bot,
+    user_id: int,
+    message_type: str,
+    username: Optional[str],
+    first_name: Optional[str],
+    limiter: Optional[TokenBucket] = None,
+    keyboards: Optional[Dict[str, InlineKeyboardMarkup]] = None,
+    notify_admins: bool = True
+) -> bool:
+    """Отправляет сообщение онбординга без повторных проверок и отмечает отправку. Возвращает True при успехе.
+
+    При рассылке пачкой передаются общий ограничитель частоты и готовые клавиатуры.
+    """
+    # Получаем текст сообщения из конфигурации
+    message_data = get_message_text(message_type, first_name or "Пользователь")
+    if not message_data:
+        logger.error("Неизвестный тип сообщения: %s для user_id=%s", message_type, user_id)
+        return False
+
+    # Создаем клавиатуру в зависимости от типа сообщения
+    keyboard = keyboards.get(message_type) if keyboards else None
+    if keyboard is None:
+        if message_type == "reminder_day5":
             # Для последнего дня показываем все тарифы
             keyboard = await create_subscription_keyboard(hide_mini_tariff=False)
-            with_images = False
         else:
-            # Для остальных дней показываем кнопку оплаты конкретного тарифа
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(
-                    text=message_data["button_text"],
-                    callback_data=message_data["callback_data"]
-                )]
-            ])
-            with_images = False
+            # Для остальных дней показываем кнопку из конфигурации
+            keyboard = _build_onboarding_keyboard(message_type, message_data)
+    with_images = message_type == "welcome"
 
-        try:
-            if with_images:
-                # Формируем медиагруппу для изображений
-                media_group = []
-                for img_path in EXAMPLE_IMAGES:
-                    if os.path.exists(img_path):
-                        media_group.append(InputMediaPhoto(media=FSInputFile(path=img_path)))
-                    else:
-                        logger.warning("Изображение не найдено: %s", img_path)
-                if media_group:
-                    await bot.send_media_group(
-                        chat_id=user_id,
-                        media=media_group
-                    )
-                    logger.info("Медиагруппа с %d изображениями отправлена пользователю %s", len(media_group), user_id)
-                else:
-                    logger.warning("Нет доступных изображений для медиагруппы для user_id=%s", user_id)
-
-            await bot.send_message(
-                chat_id=user_id,
-                text=escape_md(message_data["text"], version=2),
-                reply_markup=keyboard,
-                parse_mode=ParseMode.MARKDOWN_V2
-            )
-            logger.info("Сообщение %s отправлено пользователю %s", message_type, user_id)
-
-            # Обновление статуса отправки сообщения
-            moscow_tz = pytz.timezone('Europe/Moscow')
-            async with aiosqlite.connect(DATABASE_PATH) as conn:
-                c = await conn.cursor()
-                if message_type == "welcome":
-                    await c.execute(
-                        "UPDATE users SET welcome_message_sent = 1, last_reminder_type = ?, last_reminder_sent = ? WHERE user_id = ?",
-                        (message_type, datetime.now(moscow_tz).strftime('%Y-%m-%d %H:%M:%S'), user_id)
-                    )
+    try:
+        if with_images:
+            # Формируем медиагруппу для изображений
+            media_group = []
+            for img_path in EXAMPLE_IMAGES:
+                if os.path.exists(img_path):
+                    media_group.append(InputMediaPhoto(media=FSInputFile(path=img_path)))
                 else:
-                    await c.execute(
-                        "UPDATE users SET last_reminder_type = ?, last_reminder_sent = ? WHERE user_id = ?",
-                        (message_type, datetime.now(moscow_tz).strftime('%Y-%m-%d %H:%M:%S'), user_id)
-                    )
-                await conn.commit()
-                logger.debug("Статус сообщения %s обновлён для user_id=%s", message_type, user_id)
-
-            # Уведомление админов об успешной отправке напоминания
-            if message_type.startswith("reminder_"):
-                admin_message = escape_md(
-                    f"📬 Напоминание '{message_type}' успешно отправлено пользователю ID {user_id} (@{username})",
-                    version=2
+                    logger.warning("Изображение не найдено: %s", img_path)
+            if media_group:
+                if limiter:
+                    await limiter.acquire()
+                await bot.send_media_group(
+                    chat_id=user_id,
+                    media=media_group
                 )
-                for admin_id in ADMIN_IDS:
-                    try:
-                        await bot.send_message(
-                            chat_id=admin_id,
-                            text=admin_message,
-                            parse_mode=ParseMode.MARKDOWN_V2
-                        )
-                        logger.info("Уведомление о напоминании %s отправлено админу %s", message_type, admin_id)
-                    except Exception as e:
-                        logger.error("Ошибка отправки уведомления админу %s для user_id=%s: %s", admin_id, user_id, e)
-
-        except Exception as e:
-            error_msg = str(e)
-            logger.error("Ошибка отправки сообщения %s для user_id=%s: %s", message_type, user_id, error_msg)
-
-            # Проверяем тип ошибки и обрабатываем соответственно
-            if "chat not found" in error_msg.lower():
-                logger.warning("Пользователь %s заблокировал бота или удалил чат", user_id)
-                # Блокируем пользователя с использованием централизованной функции
-                block_reason = f"Чат не найден: {error_msg}"
-                await block_user_access(user_id, block=True, block_reason=block_reason)
-                return
-            elif "bot can't initiate conversation" in error_msg.lower():
-                logger.warning("Пользователь %s не начал диалог с ботом", user_id)
-                return
-            elif any(phrase in error_msg.lower() for phrase in [
-                "user_is_blocked", "user is blocked",
-                "bot was blocked by the user", "forbidden: bot was blocked"
-            ]):
-                logger.warning("Пользователь %s заблокировал бота: %s", user_id, error_msg)
-                # Используем централизованную обработку блокировки
-                from handlers.utils import handle_user_blocked_bot
-                await handle_user_blocked_bot(user_id, error_msg)
-                return
+                logger.info("Медиагруппа с %d изображениями отправлена пользователю %s", len(media_group), user_id)
             else:
-                # Для других ошибок пытаемся отправить сообщение об ошибке
-                try:
-                    await bot.send_message(
-                        chat_id=user_id,
-                        text=escape_md("❌ Произошла ошибка. Попробуйте снова или обратитесь в поддержку: @AXIDI_Help", version=2),
-                        reply_markup=await create_main_menu_keyboard(user_id),
-                        parse_mode=ParseMode.MARKDOWN_V2
-                    )
-                except Exception as send_error:
-                    logger.error("Не удалось отправить сообщение об ошибке пользователю %s: %s", user_id, send_error)
+                logger.warning("Нет доступных изображений для медиагруппы для user_id=%s", user_id)
+
+        if limiter:
+            await limiter.acquire()
+        await bot.send_message(
+            chat_id=user_id,
+            text=escape_md(message_data["text"], version=2),
+            reply_markup=keyboard,
+            parse_mode=ParseMode.MARKDOWN_V2
+        )
+        logger.info("Сообщение %s отправлено пользователю %s", message_type, user_id)
 
-            # Уведомление админов об ошибке
+        # Обновление статуса отправки сообщения
+        moscow_tz = pytz.timezone('Europe/Moscow')
+        await mark_onboarding_message_sent(user_id, message_type, datetime.now(moscow_tz).strftime('%Y-%m-%d %H:%M:%S'))
+        logger.debug("Статус сообщения %s обновлён для user_id=%s", message_type, user_id)
+
+        # Уведомление админов об успешной отправке напоминания
+        if notify_admins and message_type.startswith("reminder_"):
+            admin_message = escape_md(
+                f"📬 Напоминание '{message_type}' успешно отправлено пользователю ID {user_id} (@{username})",
+                version=2
+            )
             for admin_id in ADMIN_IDS:
                 try:
                     await bot.send_message(
                         chat_id=admin_id,
-                        text=escape_md(f"🚨 Ошибка отправки сообщения '{message_type}' для user_id={user_id}: {error_msg}", version=2),
+                        text=admin_message,
                         parse_mode=ParseMode.MARKDOWN_V2
                     )
-                    logger.info("Уведомление об ошибке отправки %s отправлено админу %s", message_type, admin_id)
-                except Exception as e_admin:
-                    logger.error("Ошибка отправки уведомления об ошибке админу %s: %s", admin_id, e_admin)
+                    logger.info("Уведомление о напоминании %s отправлено админу %s", message_type, admin_id)
+                except Exception as e:
+                    logger.error("Ошибка отправки уведомления админу %s для user_id=%s: %s", admin_id, user_id, e)
+        return True
+
+    except TelegramRetryAfter as e:
+        if limiter is None:
+            raise
+        # Telegram просит подождать: останавливаем всех отправителей пачки
+        limiter.pause(e.retry_after)
+        raise
 
     except Exception as e:
-        logger.error("Критическая ошибка в send_onboarding_message для user_id=%s, message_type=%s: %s", user_id, message_type, e, exc_info=True)
-        for admin_id in ERROR_LOG_ADMIN:
+        error_msg = str(e)
+        logger.error("Ошибка отправки сообщения %s для user_id=%s: %s", message_type, user_id, error_msg)
+
+        # Проверяем тип ошибки и обрабатываем соответственно
+        if "chat not found" in error_msg.lower():
+            logger.warning("Пользователь %s заблокировал бота или удалил чат", user_id)
+            # Блокируем пользователя с использованием централизованной функции
+            block_reason = f"Чат не найден: {error_msg}"
+            await block_user_access(user_id, block=True, block_reason=block_reason)
+            return False
+        elif "bot can't initiate conversation" in error_msg.lower():
+            logger.warning("Пользователь %s не начал диалог с ботом", user_id)
+            return False
+        elif any(phrase in error_msg.lower() for phrase in [
+            "user_is_blocked", "user is blocked",
+            "bot was blocked by the user", "forbidden: bot was blocked"
+        ]):
+            logger.warning("Пользователь %s заблокировал бота: %s", user_id, error_msg)
+            # Используем централизованную обработку блокировки
+            from handlers.utils import handle_user_blocked_bot
+            await handle_user_blocked_bot(user_id, error_msg)
+            return False
+        else:
+            # Для других ошибок пытаемся отправить сообщение об ошибке
+            try:
+                await bot.send_message(
+                    chat_id=user_id,
+                    text=escape_md("❌ Произошла ошибка. Попробуйте снова или обратитесь в поддержку: @AXIDI_Help", version=2),
+                    reply_markup=await create_main_menu_keyboard(user_id),
+                    parse_mode=ParseMode.MARKDOWN_V2
+                )
+            except Exception as send_error:
+                logger.error("Не удалось отправить сообщение об ошибке пользователю %s: %s", user_id, send_error)
+
+        # Уведомление админов об ошибке
+        for admin_id in ADMIN_IDS:
             try:
                 await bot.send_message(
                     chat_id=admin_id,
-                    text=escape_md(f"🚨 Критическая ошибка в send_onboarding_message для user_id={user_id}, message_type={message_type}: {str(e)}", version=2),
+                    text=escape_md(f"🚨 Ошибка отправки сообщения '{message_type}' для user_id={user_id}: {error_msg}", version=2),
                     parse_mode=ParseMode.MARKDOWN_V2
                 )
+                logger.info("Уведомление об ошибке отправки %s отправлено админу %s", message_type, admin_id)
             except Exception as e_admin:
-                logger.error("Ошибка отправки уведомления админу %s: %s", admin_id, e_admin)
+                logger.error("Ошибка отправки уведомления об ошибке админу %s: %s", admin_id, e_admin)
+        return False
+
+async def _report_onboarding_failure(bot: Bot, user_id: int, message_type: str, error: Exception) -> None:
+    """Логирует критическую ошибку онбординга и уведомляет админов."""
+    logger.error("Критическая ошибка в send_onboarding_message для user_id=%s, message_type=%s: %s", user_id, message_type, error, exc_info=error)
+    for admin_id in ERROR_LOG_ADMIN:
+        try:
+            await bot.send_message(
+                chat_id=admin_id,
+                text=escape_md(f"🚨 Критическая ошибка в send_onboarding_message для user_id={user_id}, message_type={message_type}: {str(error)}", version=2),
+                parse_mode=ParseMode.MARKDOWN_V2
+            )
+        except Exception as e_admin:
+            logger.error("Ошибка отправки уведомления админу %s: %s", admin_id, e_admin)
+
+async def send_onboarding_batch(bot: Bot, targets: List[Dict[str, Any]]) -> Dict[str, int]:
+    """Рассылает сообщения онбординга пользователям, отобранным get_due_onboarding_messages.
+
+    Отправители работают параллельно, общая частота ограничена ONBOARDING_SEND_RATE.
+    Возвращает число успешных отправок по типам сообщений.
+    """
+    sent: Dict[str, int] = {}
+    if not targets:
+        return sent
+
+    limiter = TokenBucket(ONBOARDING_SEND_RATE, capacity=max(1, int(ONBOARDING_SEND_RATE)))
+    # Клавиатуры одинаковы для всех получателей одного типа — собираем один раз
+    keyboards: Dict[str, InlineKeyboardMarkup] = {}
+    for message_type in {target['message_type'] for target in targets}:
+        if message_type == "reminder_day5":
+            keyboards[message_type] = await create_subscription_keyboard(hide_mini_tariff=False)
+        else:
+            message_data = get_message_text(message_type, "")
+            if message_data:
+                keyboards[message_type] = _build_onboarding_keyboard(message_type, message_data)
+
+    queue: asyncio.Queue = asyncio.Queue()
+    for target in targets:
+        queue.put_nowait(target)
+
+    async def sender() -> None:
+        while True:
+            try:
+                target = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            user_id = target['user_id']
+            message_type = target['message_type']
+            for attempt in range(2):
+                try:
+                    delivered = await _deliver_onboarding_message(
+                        bot, user_id, message_type, target['username'], target['first_name'],
+                        limiter=limiter, keyboards=keyboards, notify_admins=False
+                    )
+                except TelegramRetryAfter:
+                    if attempt == 0:
+                        continue
+                    logger.warning("Сообщение %s для user_id=%s не отправлено: повторный RetryAfter", message_type, user_id)
+                    delivered = False
+                except Exception as e:
+                    await _report_onboarding_failure(bot, user_id, message_type, e)
+                    delivered = False
+                if delivered:
+                    sent[message_type] = sent.get(message_type, 0) + 1
+                break
+
+    workers = min(ONBOARDING_SEND_CONCURRENCY, len(targets))
+    await asyncio.gather(*(sender() for _ in range(max(1, workers))))
+    logger.info("Рассылка онбординга завершена: %s из %d, ожидание лимита %.1f сек", sent, len(targets), limiter.get_stats()['waited'])
+
+    # Вместо уведомления о каждом напоминании — одна сводка
+    reminders = {message_type: count for message_type, count in sent.items() if message_type.startswith("reminder_")}
+    if reminders:
+        summary = ", ".join(f"{message_type}: {count}" for message_type, count in sorted(reminders.items()))
+        for admin_id in ADMIN_IDS:
+            try:
+                await bot.send_message(
+                    chat_id=admin_id,
+                    text=escape_md(f"📬 Напоминания отправлены ({summary})", version=2),
+                    parse_mode=ParseMode.MARKDOWN_V2
+                )
+            except Exception as e:
+                logger.error("Ошибка отправки сводки напоминаний админу %s: %s", admin_id, e)
+    return sent
+
 
 async def schedule_welcome_message(bot: Bot, user_id: int) -> None:
     """Планирует отправку приветственного сообщения через 1 час после регистрации."""
     try:
         subscription_data = await check_database_user(user_id)
-        if not subscription_data:
-            logger.error("Неполные данные подписки для user_id=%s", user_id)
-            return
 
         # Проверяем, есть ли у пользователя покупки
         has_purchases = await has_user_purchases(user_id, DATABASE_PATH)
@@ -241,18 +341,18 @@ async def schedule_welcome_message(bot: Bot, user_id: int) -> None:
 
         # Проверяем валидность даты регистрации
         registration_date = current_time
-        if subscription_data and len(subscription_data) > 10 and subscription_data[10]:
+        if subscription_data.created_at:
             try:
-                registration_date = moscow_tz.localize(datetime.strptime(subscription_data[10], '%Y-%m-%d %H:%M:%S'))
+                registration_date = moscow_tz.localize(datetime.strptime(subscription_data.created_at, '%Y-%m-%d %H:%M:%S'))
             except ValueError as e:
-                logger.warning("Невалидный формат даты в subscription_data[10] для user_id=%s: %s. Используется текущая дата. Ошибка: %s", user_id, subscription_data[10], e)
+                logger.warning("Невалидный формат даты created_at для user_id=%s: %s. Используется текущая дата. Ошибка: %s", user_id, subscription_data.created_at, e)
                 logger.debug("Содержимое subscription_data для user_id=%s: %s", user_id, subscription_data)
 
         # Планируем отправку через 1 час
         schedule_time = registration_date + timedelta(hours=1)
 
         # Проверяем, было ли уже отправлено приветственное сообщение
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
             await c.execute("SELECT welcome_message_sent FROM users WHERE user_id = ?", (user_id,))
@@ -268,24 +368,57 @@ async def schedule_welcome_message(bot: Bot, user_id: int) -> None:
             await send_onboarding_message(bot, user_id, "welcome", subscription_data)
             return
 
-        scheduler = AsyncIOScheduler(timezone=moscow_tz)
-        job_id = f"welcome_{user_id}"
-
+        # Задание хранится в БД и выполняется общим планировщиком (process_onboarding_jobs)
         logger.info("Планируем приветственное сообщение для user_id=%s на %s", user_id, schedule_time)
-        scheduler.add_job(
-            send_onboarding_message,
-            trigger='date',
-            run_date=schedule_time,
-            args=[bot, user_id, "welcome", subscription_data],
-            id=job_id,
-            misfire_grace_time=300
-        )
-        scheduler.start()
+        if not await enqueue_onboarding_job(user_id, "welcome", schedule_time):
+            logger.debug("Приветственное сообщение для user_id=%s уже запланировано", user_id)
+            return
         logger.info("Приветственное сообщение запланировано для user_id=%s", user_id)
 
     except Exception as e:
         logger.error("Ошибка планирования приветственного сообщения для user_id=%s: %s", user_id, e, exc_info=True)
 
+async def process_onboarding_jobs(bot: Bot) -> None:
+    """Выполняет отложенные сообщения онбординга, срок которых наступил (вызывается планировщиком из main.py)."""
+    try:
+        moscow_tz = pytz.timezone('Europe/Moscow')
+        jobs = await claim_due_onboarding_jobs(datetime.now(moscow_tz))
+        if not jobs:
+            return
+        logger.info("Выполняется %d отложенных сообщений онбординга", len(jobs))
+
+        semaphore = asyncio.Semaphore(ONBOARDING_SEND_CONCURRENCY)
+
+        async def run(job: Dict[str, Any]) -> None:
+            async with semaphore:
+                try:
+                    subscription_data = await check_database_user(job['user_id'])
+                    if await send_onboarding_message(bot, job['user_id'], job['message_type'], subscription_data):
+                        await finish_onboarding_job(job['id'])
+                        return
+                    error = "Сообщение не отправлено"
+                except Exception as e:
+                    logger.error("Ошибка выполнения задания онбординга id=%s: %s", job['id'], e, exc_info=True)
+                    error = str(e)
+                await _retry_onboarding_job(job, error)
+
+        await asyncio.gather(*(run(job) for job in jobs))
+
+    except Exception as e:
+        logger.error("Ошибка обработки заданий онбординга: %s", e, exc_info=True)
+
+async def _retry_onboarding_job(job: Dict[str, Any], error: str) -> None:
+    """Переносит неудавшееся задание с растущей задержкой; после ONBOARDING_JOB_MAX_ATTEMPTS — failed."""
+    attempts = job.get('attempts') or 1
+    if attempts >= ONBOARDING_JOB_MAX_ATTEMPTS:
+        logger.warning("Задание онбординга id=%s не выполнено за %d попыток: %s", job['id'], attempts, error)
+        await finish_onboarding_job(job['id'], error=error)
+        return
+    delay = ONBOARDING_RETRY_DELAY_SECONDS * 2 ** (attempts - 1)
+    retry_at = datetime.now(pytz.timezone('Europe/Moscow')) + timedelta(seconds=delay)
+    logger.info("Задание онбординга id=%s перенесено на %s (попытка %d): %s", job['id'], retry_at, attempts, error)
+    await finish_onboarding_job(job['id'], error=error, retry_at=retry_at)
+
 async def schedule_daily_reminders(bot: Bot) -> None:
     """Планирует ежедневные напоминания в 11:15 по МСК."""
     try:
@@ -297,64 +430,11 @@ async def schedule_daily_reminders(bot: Bot) -> None:
 async def send_daily_reminders(bot: Bot) -> None:
     """Отправляет ежедневные напоминания пользователям."""
     try:
-        users = await get_users_for_reminders()
-        logger.info("Найдено %d пользователей для ежедневных напоминаний", len(users))
-
         moscow_tz = pytz.timezone('Europe/Moscow')
-        current_time = datetime.now(moscow_tz)
-
-        for user in users:
-            user_id = user['user_id']
-            first_name = user['first_name']
-            username = user['username']
-            created_at = user['created_at']
-            last_reminder_type = user['last_reminder_type']
-
-            # Проверяем, заблокирован ли пользователь
-            if await is_user_blocked(user_id):
-                logger.info("Пользователь user_id=%s заблокирован, пропускаем напоминание", user_id)
-                continue
-
-            # Проверяем, является ли пользователь старым
-            is_old_user_flag = await is_old_user(user_id, cutoff_date="2025-07-11")
-            if is_old_user_flag:
-                logger.info("Пользователь user_id=%s старый, пропускаем напоминание", user_id)
-                continue
-
-            # Проверяем, есть ли у пользователя покупки
-            has_purchases = await has_user_purchases(user_id, DATABASE_PATH)
-            if has_purchases:
-                logger.info("Пользователь user_id=%s уже имеет покупки, пропускаем напоминание", user_id)
-                continue
-
-            try:
-                registration_date = datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S').replace(tzinfo=moscow_tz)
-            except ValueError as e:
-                logger.warning("Невалидный формат даты для user_id=%s: %s. Пропускаем. Ошибка: %s", user_id, created_at, e)
-                continue
-
-            days_since_registration = (current_time.date() - registration_date.date()).days
-
-            # Определяем, какое напоминание нужно отправить
-            if days_since_registration == 1 and last_reminder_type != "reminder_day2":
-                message_type = "reminder_day2"
-            elif days_since_registration == 2 and last_reminder_type != "reminder_day3":
-                message_type = "reminder_day3"
-            elif days_since_registration == 3 and last_reminder_type != "reminder_day4":
-                message_type = "reminder_day4"
-            elif days_since_registration >= 4 and last_reminder_type != "reminder_day5":
-                message_type = "reminder_day5"
-            else:
-                continue
-
-            subscription_data = await check_database_user(user_id)
-            if not subscription_data or len(subscription_data) < 14:
-                logger.error("Неполные данные подписки для user_id=%s, пропускаем", user_id)
-                continue
-
-            logger.info("Отправка напоминания %s для user_id=%s", message_type, user_id)
-            await send_onboarding_message(bot, user_id, message_type, subscription_data)
+        targets = await get_due_onboarding_messages('reminder', datetime.now(moscow_tz), cutoff_date="2025-07-11")
+        logger.info("Найдено %d пользователей для ежедневных напоминаний", len(targets))
 
+        await send_onboarding_batch(bot, targets)
         logger.info("Ежедневные напоминания отправлены")
 
     except Exception as e:
@@ -364,18 +444,10 @@ async def proceed_to_tariff_callback(callback_query: CallbackQuery, state: FSMCo
     """Обрабатывает нажатие кнопки 'Начать' для перехода к тарифам."""
     user_id = callback_query.from_user.id
     subscription_data = await check_database_user(user_id)
-    if not subscription_data or len(subscription_data) < 14:
-        await smart_message_send(
-            callback_query,
-            text=escape_md("❌ Ошибка сервера! Попробуйте позже.", version=2),
-            parse_mode=ParseMode.MARKDOWN_V2
-        )
-        await callback_query.answer()
-        return
 
     # Проверяем, есть ли у пользователя покупки
     has_purchases = await has_user_purchases(user_id, DATABASE_PATH)
-    first_purchase = bool(subscription_data[5]) if len(subscription_data) > 5 else True
+    first_purchase = bool(subscription_data.first_purchase)
 
     if has_purchases:
         # Для оплативших пользователей показываем все тарифы
@@ -398,7 +470,7 @@ async def proceed_to_tariff_callback(callback_query: CallbackQuery, state: FSMCo
             message_text = f"💎 Тариф '{tariff_key.title()}' за {price}₽\n{description}\n\nТы получаешь:\n✅ 70 фото высокого качества\n✅ 1 аватар в подарок при первой покупке\n✅ Генерация по описанию\n✅ Оживление фото\n✅ Идеи из канала: @pixelpie_idea"
 
             keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text=f"💳 Выбрать тариф за {price}₽", callback_data=f"pay_{price}")],
+                [InlineKeyboardButton(text=f"💳 Выбрать тариф за {price}₽", callback_data=tariff_registry.callback_for(tariff_key) or f"pay_{price}")],
                 [InlineKeyboardButton(text="🔙 Главное меню", callback_data="back_to_menu")]
             ])
 
@@ -433,16 +505,7 @@ def setup_onboarding_handlers():
         """Обрабатывает нажатие кнопки 'Выбрать тариф' для показа всех тарифов."""
         user_id = query.from_user.id
         subscription_data = await check_database_user(user_id)
-        if not subscription_data or len(subscription_data) < 14:
-            await smart_message_send(
-                query,
-                text=escape_md("❌ Ошибка сервера! Попробуйте позже.", version=2),
-                parse_mode=ParseMode.MARKDOWN_V2
-            )
-            await query.answer()
-            return
-
-        first_purchase = bool(subscription_data[5]) if len(subscription_data) > 5 else True
+        first_purchase = bool(subscription_data.first_purchase)
 
         # Показываем все тарифы
         tariff_message_text = get_tariff_text(first_purchase=first_purchase, is_paying_user=False)
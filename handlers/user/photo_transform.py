@@ -3,18 +3,19 @@
 """
 
 import asyncio
-import uuid
 from typing import Optional
 
 from aiogram import Router, F
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import CallbackQuery, Message, BufferedInputFile
+from aiogram.types import CallbackQuery, Message
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest
 
 from handlers.utils import escape_message_parts, smart_message_send, smart_message_send_with_photo
 from database import check_database_user, update_user_credits
 from config import ADMIN_IDS
+from generation.results import new_generation_id, file_ids_from_messages, save_result
 
 # Глобальная переменная для хранения генератора
 photo_generator = None
@@ -75,7 +76,7 @@ async def start_photo_transform(callback: CallbackQuery, state: FSMContext):
             )
             return
         
-        generations_left = user_info[0]
+        generations_left = user_info.generations_left
         if generations_left <= 0:
             await callback.message.answer(
                 escape_message_parts(
@@ -134,7 +135,7 @@ async def handle_photo(message: Message, state: FSMContext):
             )
             return
         
-        generations_left = user_info[0]
+        generations_left = user_info.generations_left
         if generations_left <= 0:
             await message.answer(
                 escape_message_parts(
@@ -258,7 +259,7 @@ async def handle_aspect_ratio_selection(callback: CallbackQuery, state: FSMConte
             )
             return
         
-        generations_left = user_info[0]
+        generations_left = user_info.generations_left
         if generations_left <= 0:
             await callback.message.answer(
                 escape_message_parts(
@@ -312,56 +313,62 @@ async def handle_aspect_ratio_selection(callback: CallbackQuery, state: FSMConte
                 # Генерация успешна
                 image_url = result.get('image_url')
                 
-                # Скачиваем результат
-                import aiohttp
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(image_url) as response:
-                        if response.status == 200:
-                            result_image_bytes = await response.read()
-                            
-                            # Создаем файл для отправки
-                            result_file = BufferedInputFile(
-                                result_image_bytes,
-                                filename=f"transformed_{user_id}_{uuid.uuid4().hex[:8]}.png"
-                            )
-                            
-                            # Отправляем результат
-                            success_text = (
-                                f"✅ **Генерация завершена!**\n\n"
-                                f"🎨 Стиль: `{selected_style}`\n"
-                                f"📐 Соотношение: `{aspect_ratio}`\n\n"
-                                f"💾 Сохраните изображение, нажав на него."
-                            )
-                            
-                            await callback.bot.send_photo(
-                                chat_id=user_id,
-                                photo=result_file,
-                                caption=escape_message_parts(success_text, version=2),
-                                parse_mode=ParseMode.MARKDOWN_V2
-                            )
-                            
-                            # Списываем печеньку
-                            await update_user_credits(user_id, -1, 'g')
-                            
-                            # Обновляем прогресс-сообщение
-                            final_progress_text = (
-                                f"✅ **Генерация завершена!**\n\n"
-                                f"🎨 Стиль: `{selected_style}`\n"
-                                f"📐 Соотношение: `{aspect_ratio}`\n\n"
-                                f"💰 Осталось печенек: `{generations_left - 1}`"
-                            )
-                            
-                            await progress_message.edit_text(
-                                escape_message_parts(final_progress_text, version=2),
-                                parse_mode=ParseMode.MARKDOWN_V2
-                            )
-                            
-                            logger.info(f"Успешная генерация фото-трансформации для user_id={user_id}")
-                            
-                        else:
-                            raise Exception(f"Ошибка скачивания результата: {response.status}")
+                if not image_url:
                     raise Exception("Не удалось получить URL результата")
-                    
+
+                success_text = (
+                    f"✅ **Генерация завершена!**\n\n"
+                    f"🎨 Стиль: `{selected_style}`\n"
+                    f"📐 Соотношение: `{aspect_ratio}`\n\n"
+                    f"💾 Сохраните изображение, нажав на него."
+                )
+
+                # Telegram сам скачивает результат по ссылке; загружаем байты, только если не смог
+                try:
+                    sent = await callback.bot.send_photo(
+                        chat_id=user_id,
+                        photo=image_url,
+                        caption=escape_message_parts(success_text, version=2),
+                        parse_mode=ParseMode.MARKDOWN_V2
+                    )
+                except TelegramBadRequest:
+                    from generation.images import download_images_parallel, release_image_files
+                    files = await download_images_parallel([image_url], user_id)
+                    if not files:
+                        raise Exception("Ошибка скачивания результата")
+                    try:
+                        sent = await callback.bot.send_photo(
+                            chat_id=user_id,
+                            photo=files[0],
+                            caption=escape_message_parts(success_text, version=2),
+                            parse_mode=ParseMode.MARKDOWN_V2
+                        )
+                    finally:
+                        release_image_files(files)
+
+                await save_result(
+                    result.get('prediction_id') or new_generation_id(),
+                    file_ids_from_messages(sent), user_id=user_id, style=selected_style
+                )
+
+                # Списываем печеньку
+                await update_user_credits(user_id, -1, 'g')
+
+                # Обновляем прогресс-сообщение
+                final_progress_text = (
+                    f"✅ **Генерация завершена!**\n\n"
+                    f"🎨 Стиль: `{selected_style}`\n"
+                    f"📐 Соотношение: `{aspect_ratio}`\n\n"
+                    f"💰 Осталось печенек: `{generations_left - 1}`"
+                )
+
+                await progress_message.edit_text(
+                    escape_message_parts(final_progress_text, version=2),
+                    parse_mode=ParseMode.MARKDOWN_V2
+                )
+
+                logger.info(f"Успешная генерация фото-трансформации для user_id={user_id}")
+
             else:
                 # Генерация не удалась
                 error_message = result.get('error', 'Неизвестная ошибка') if result else 'Ошибка генерации'
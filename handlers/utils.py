@@ -8,11 +8,12 @@ import tenacity
 from aiogram.fsm.context import FSMContext
 import uuid
 import copy
+import hashlib
 from typing import Optional, Dict, Any, Awaitable, Callable
 import asyncio
 import time
 from datetime import datetime, timezone
-from database import delete_user_activity, log_user_action, block_user_access
+from database import delete_user_activity, log_user_action, block_user_access, payment_link_cache
 
 from config import TARIFFS, YOOKASSA_SHOP_ID, SECRET_KEY, YOOKASSA_TEST_TOKEN, ADMIN_IDS
 
@@ -20,15 +21,9 @@ from logger import get_logger
 logger = get_logger('main')
 
 import aiosqlite
-from config import DATABASE_PATH
+from db_pool import db_pool
 
-# Проверка наличия YooKassa
-try:
-    from yookassa import Configuration as YooKassaConfiguration, Payment as YooKassaPayment
-    YOOKASSA_AVAILABLE = True
-except ImportError:
-    YOOKASSA_AVAILABLE = False
-    logger.warning("Библиотека yookassa не установлена. Функции оплаты не будут работать.")
+from yookassa_client import yookassa_client
 
 # Декоратор для retry при работе с Telegram API
 retry_telegram_call = tenacity.retry(
@@ -507,22 +502,8 @@ async def check_resources(bot: Bot, user_id: int, required_photos: int = 0, requ
         subscription_data = await check_database_user(user_id)
         logger.debug(f"[check_resources] Получены данные подписки для user_id={user_id}: {subscription_data}")
 
-        if not subscription_data:
-            logger.error(f"Нет данных подписки для user_id={user_id}")
-            error_text = safe_escape_markdown("❌ Ошибка получения данных подписки. Попробуйте позже.", version=2)
-            main_menu_kb = await create_main_menu_keyboard(user_id)
-            await send_message_with_fallback(bot, user_id, error_text, reply_markup=main_menu_kb, parse_mode=ParseMode.MARKDOWN_V2)
-            return None
-
-        if len(subscription_data) < 9:
-            logger.error(f"Неполные данные подписки для user_id={user_id}: {subscription_data}")
-            error_text = safe_escape_markdown("❌ Ошибка сервера. Обратитесь в поддержку.", version=2)
-            main_menu_kb = await create_main_menu_keyboard(user_id)
-            await send_message_with_fallback(bot, user_id, error_text, reply_markup=main_menu_kb, parse_mode=ParseMode.MARKDOWN_V2)
-            return None
-
-        generations_left = subscription_data[0] if subscription_data[0] is not None else 0
-        avatar_left = subscription_data[1] if subscription_data[1] is not None else 0
+        generations_left = subscription_data.generations_left
+        avatar_left = subscription_data.avatar_left
 
         logger.info(f"Проверка ресурсов для user_id={user_id}: фото={generations_left}, аватары={avatar_left}")
         logger.info(f"Требуется: фото={required_photos}, аватары={required_avatars}")
@@ -537,7 +518,7 @@ async def check_resources(bot: Bot, user_id: int, required_photos: int = 0, requ
 
         if error_message_parts:
             error_summary = "\n".join(error_message_parts)
-            first_purchase = subscription_data[5] if len(subscription_data) > 5 else True
+            first_purchase = subscription_data.first_purchase
             tariff_message_text = get_tariff_text(first_purchase)
 
             full_message = f"{safe_escape_markdown(error_summary, version=2)}\n\n{tariff_message_text}"
@@ -620,18 +601,31 @@ def check_style_config(style_type: str) -> bool:
 
     return True
 
+# Создаваемые прямо сейчас ссылки: параллельные нажатия ждут один платёж
+_payment_links_in_flight: Dict[str, asyncio.Future] = {}
+
+
+def _payment_link_key(user_id: int, amount_value: float, description: str) -> str:
+    digest = hashlib.sha1(f"{amount_value:.2f}|{description[:128]}".encode('utf-8')).hexdigest()[:16]
+    return f"{user_id}_{digest}"
+
+
+async def forget_payment_link(user_id: int, amount_value: float, description: str) -> None:
+    """Убирает ссылку из кэша (платёж оплачен): следующее нажатие создаст новый платёж."""
+    try:
+        await payment_link_cache.delete(_payment_link_key(user_id, amount_value, description))
+    except Exception as e:
+        logger.warning(f"Не удалось сбросить кэш ссылки на оплату для user_id={user_id}: {e}")
+
+
 async def create_payment_link(user_id: int, email: str, amount_value: float, description: str, bot_username: str) -> tuple[str, str]:
     """
     Создает ссылку на оплату через YooKassa.
     Возвращает кортеж (payment_url, payment_id).
+    Пока ссылка действительна, повторный вызов для того же пользователя и тарифа возвращает её же.
     """
     logger.debug(f"create_payment_link вызван: user_id={user_id}, email={email}, amount={amount_value}, description={description}, bot_username={bot_username}")
 
-    if not YOOKASSA_AVAILABLE:
-        logger.error(f"YooKassa недоступна для user_id={user_id}: библиотека не установлена")
-        # ИСПРАВЛЕНО: возвращаем ошибку вместо тестовой ссылки
-        raise Exception("Система платежей недоступна. Обратитесь к администратору.")
-
     # ИСПРАВЛЕНО: убираем проверку тестового токена в продакшене
     # Проверяем только в dev среде
     if os.getenv('ENVIRONMENT', 'development') != 'production':
@@ -651,11 +645,45 @@ async def create_payment_link(user_id: int, email: str, amount_value: float, des
         logger.error(f"YooKassa не настроена для user_id={user_id}: YOOKASSA_SHOP_ID={YOOKASSA_SHOP_ID}, SECRET_KEY={'***' if SECRET_KEY else None}")
         raise Exception("Система платежей не настроена. Обратитесь к администратору.")
 
+    cache_key = _payment_link_key(user_id, amount_value, description)
+    try:
+        cached = await payment_link_cache.get(cache_key)
+    except Exception as e:
+        logger.warning(f"Ошибка чтения кэша ссылок на оплату: {e}")
+        cached = None
+    if cached:
+        logger.info(f"Ссылка на оплату из кэша: ID={cached['payment_id']}, user_id={user_id}")
+        return cached['url'], cached['payment_id']
+
+    in_flight = _payment_links_in_flight.get(cache_key)
+    if in_flight is not None:
+        result = await asyncio.shield(in_flight)
+        if result is None:
+            raise Exception("Ошибка создания платежа. Попробуйте позже.")
+        return result
+
+    future = asyncio.get_running_loop().create_future()
+    _payment_links_in_flight[cache_key] = future
+    result = None
+    try:
+        result = await _create_yookassa_payment(user_id, email, amount_value, description, bot_username)
+    finally:
+        _payment_links_in_flight.pop(cache_key, None)
+        future.set_result(result)
+
+    payment_url, payment_id = result
+    try:
+        await payment_link_cache.set(cache_key, {'url': payment_url, 'payment_id': payment_id})
+    except Exception as e:
+        logger.warning(f"Ошибка записи кэша ссылок на оплату: {e}")
+    return payment_url, payment_id
+
+
+async def _create_yookassa_payment(user_id: int, email: str, amount_value: float, description: str, bot_username: str) -> tuple[str, str]:
+    """Создаёт платёж в YooKassa и возвращает (payment_url, payment_id)."""
     try:
-        YooKassaConfiguration.account_id = YOOKASSA_SHOP_ID
-        YooKassaConfiguration.secret_key = SECRET_KEY
         idempotency_key = str(uuid.uuid4())
-        logger.debug(f"Инициализация YooKassa: account_id={YOOKASSA_SHOP_ID}, idempotency_key={idempotency_key}")
+        logger.debug(f"Создание платежа YooKassa: account_id={YOOKASSA_SHOP_ID}, idempotency_key={idempotency_key}")
 
         # Подготавливаем основные данные платежа
         payment_data = {
@@ -695,15 +723,16 @@ async def create_payment_link(user_id: int, email: str, amount_value: float, des
         }
         logger.debug(f"Добавлен чек для email={customer_email}")
 
-        payment = YooKassaPayment.create(payment_data, idempotency_key)
+        payment = await yookassa_client.create_payment(payment_data, idempotency_key)
+        confirmation_url = (payment.get('confirmation') or {}).get('confirmation_url')
 
-        if not hasattr(payment, 'confirmation') or not hasattr(payment.confirmation, 'confirmation_url'):
+        if not payment.get('id') or not confirmation_url:
             logger.error(f"Некорректный ответ YooKassa для user_id={user_id}: payment={payment}")
             # ИСПРАВЛЕНО: возвращаем ошибку вместо тестовой ссылки
             raise Exception("Ошибка создания платежа. Попробуйте позже.")
 
-        logger.info(f"Платёж YooKassa успешно создан: ID={payment.id}, URL={payment.confirmation.confirmation_url}, user_id={user_id}")
-        return payment.confirmation.confirmation_url, payment.id
+        logger.info(f"Платёж YooKassa успешно создан: ID={payment['id']}, URL={confirmation_url}, user_id={user_id}")
+        return confirmation_url, payment['id']
 
     except Exception as e:
         logger.error(f"Ошибка создания платежа YooKassa для user_id={user_id}, amount={amount_value}: {e}", exc_info=True)
@@ -915,7 +944,7 @@ def anti_spam(timeout: float = 2.0, except_states: tuple = ("avatar_training",))
 async def get_bot_summary_stats() -> str:
     """Получает общую статистику бота для отображения"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
+        async with db_pool.reader() as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
 
@@ -48,7 +48,8 @@ from keyboards.support import (
 from keyboards.broadcast import (
     create_broadcast_keyboard,
     create_broadcast_with_payment_audience_keyboard,
-    create_dynamic_broadcast_keyboard
+    create_dynamic_broadcast_keyboard,
+    build_broadcast_keyboard
 )
 
 from keyboards.utils import (
@@ -103,6 +104,7 @@ __all__ = [
     'create_broadcast_keyboard',
     'create_broadcast_with_payment_audience_keyboard',
     'create_dynamic_broadcast_keyboard',
+    'build_broadcast_keyboard',
     
     # Utility keyboards
     'create_photo_upload_keyboard',
@@ -54,7 +54,8 @@ from .support import (
 from .broadcast import (
     create_broadcast_keyboard,
     create_broadcast_with_payment_audience_keyboard,
-    create_dynamic_broadcast_keyboard
+    create_dynamic_broadcast_keyboard,
+    build_broadcast_keyboard
 )
 
 from .utils import (
@@ -109,6 +110,7 @@ __all__ = [
     'create_broadcast_keyboard',
     'create_broadcast_with_payment_audience_keyboard',
     'create_dynamic_broadcast_keyboard',
+    'build_broadcast_keyboard',
     
     # Utility keyboards
     'create_photo_upload_keyboard',
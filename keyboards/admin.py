@@ -30,6 +30,14 @@ async def create_admin_keyboard(user_id: Optional[int] = None) -> InlineKeyboard
                 InlineKeyboardButton(text="🔗 Отчет рефералов", callback_data="admin_referral_stats"),
                 InlineKeyboardButton(text="📉 Визуализация", callback_data="admin_visualization")
             ],
+            [
+                InlineKeyboardButton(text="📥 XLSX пользователей", callback_data="admin_report_users"),
+                InlineKeyboardButton(text="📥 XLSX активности", callback_data="admin_report_activity")
+            ],
+            [
+                InlineKeyboardButton(text="📥 XLSX платежей", callback_data="admin_report_payments"),
+                InlineKeyboardButton(text="📥 XLSX рефералов", callback_data="admin_report_referrals")
+            ],
             [
                 InlineKeyboardButton(text="💰 Расходы Replicate", callback_data="admin_replicate_costs"),
                 InlineKeyboardButton(text="🧹 Проблемные аватары", callback_data="admin_failed_avatars")
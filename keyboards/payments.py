@@ -67,7 +67,7 @@ async def create_payment_only_keyboard(user_id: int, time_since_registration: fl
         # Проверяем статус оплаты
         subscription_data = await check_database_user(user_id)
         payments = await get_user_payments(user_id)
-        is_paying_user = bool(payments) or (subscription_data and len(subscription_data) > 5 and not bool(subscription_data[5]))
+        is_paying_user = bool(payments) or not bool(subscription_data.first_purchase)
         logger.debug(f"create_payment_only_keyboard: user_id={user_id}, is_paying_user={is_paying_user}, days_since_registration={days_since_registration}, time_since_registration={time_since_registration}, is_old_user={is_old_user}")
 
         if is_paying_user:
@@ -127,8 +127,8 @@ async def create_payment_only_keyboard(user_id: int, time_since_registration: fl
             keyboard.append([InlineKeyboardButton(text=tariff["display"], callback_data=callback_data)])
 
         # Условное добавление кнопок "В меню" и "Информация о тарифах"
-        generations_left = subscription_data[0] if subscription_data and len(subscription_data) > 0 else 0
-        avatar_left = subscription_data[1] if subscription_data and len(subscription_data) > 1 else 0
+        generations_left = subscription_data.generations_left
+        avatar_left = subscription_data.avatar_left
         if generations_left > 0 or avatar_left > 0 or user_id in ADMIN_IDS:
             keyboard.append([InlineKeyboardButton(text="🔙 В меню", callback_data="back_to_menu_safe")])
             keyboard.append([InlineKeyboardButton(text="ℹ️ Информация о тарифах", callback_data="tariff_info")])
@@ -7,7 +7,7 @@ import logging
 from typing import Optional
 from aiogram import Bot
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
-from database import check_user_resources, get_user_payments, get_user_trainedmodels, get_active_trainedmodel, check_database_user
+from database import get_user_payments, get_user_trainedmodels, get_active_trainedmodel, check_database_user
 
 from logger import get_logger
 logger = get_logger('keyboards')
@@ -16,10 +16,7 @@ async def create_user_profile_keyboard(user_id: int, bot: Bot) -> InlineKeyboard
     """Создаёт клавиатуру личного кабинета пользователя."""
     try:
         subscription_data = await check_database_user(user_id)
-        generations_left, avatar_left = (0, 0)
-
-        if subscription_data and len(subscription_data) >= 2:
-            generations_left, avatar_left = subscription_data[0], subscription_data[1]
+        generations_left, avatar_left = subscription_data.generations_left, subscription_data.avatar_left
     except Exception as e:
         logger.error(f"Ошибка получения подписки в create_user_profile_keyboard для user_id={user_id}: {e}")
         generations_left, avatar_left = ('?', '?')
@@ -149,13 +146,9 @@ async def create_rating_keyboard(
 
         if user_id and bot:
             try:
-                subscription_data = await check_user_resources(bot, user_id, required_photos=5)
-                if isinstance(subscription_data, tuple) and len(subscription_data) >= 2:
-                    generations_left = subscription_data[0]
-                    if generations_left < 5:
-                        keyboard.append([InlineKeyboardButton(text="💳 Пополнить", callback_data="subscribe")])
-                else:
-                    logger.warning(f"Некорректные данные подписки для user_id={user_id}: {subscription_data}")
+                subscription_data = await check_database_user(user_id)
+                if subscription_data.generations_left < 5:
+                    keyboard.append([InlineKeyboardButton(text="💳 Пополнить", callback_data="subscribe")])
             except Exception as e:
                 logger.error(f"Ошибка проверки баланса в create_rating_keyboard для user_id={user_id}: {e}", exc_info=True)
 
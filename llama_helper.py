@@ -1,8 +1,12 @@
-import replicate
 import logging
 import asyncio
-from typing import Optional
+import hashlib
+import re
+import time
+from typing import Any, Dict, Optional
 from config import REPLICATE_API_TOKEN
+from database import prompt_assist_cache
+from replicate_client import replicate_client
 from generation_config import IMAGE_GENERATION_MODELS
 
 # Настройка логирования
@@ -13,14 +17,40 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+_WHITESPACE = re.compile(r'\s+')
+_EDGE_PUNCTUATION = ' .,!?;:"\'«»()-'
+
+
+def normalize_idea(user_query: str) -> str:
+    """Нормализует идею для кэша: регистр, ё, пробелы и пунктуация по краям."""
+    return _WHITESPACE.sub(' ', user_query.lower().replace('ё', 'е')).strip(_EDGE_PUNCTUATION)
+
+
 class LlamaPromptAssistant:
-    """Класс для работы с Llama 3 для генерации промптов"""
+    """Класс для работы с Llama 3 для генерации промптов.
+
+    Готовые промпты кэшируются (Redis + локальный LRU) по нормализованной
+    идее, полу и типу генерации; одинаковые одновременные запросы ждут
+    один вызов Llama.
+    """
     
     def __init__(self):
         self.model_id = IMAGE_GENERATION_MODELS.get("meta-llama-3-8b-instruct", {}).get("id")
         if not self.model_id:
             logger.error("Llama 3 model ID не найден в конфигурации")
             raise ValueError("Llama 3 model configuration missing")
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self._latency: Optional[float] = None
+        self._stats = {'llama_calls': 0, 'cache_hits': 0, 'coalesced': 0, 'saved_seconds': 0.0}
+
+    @staticmethod
+    def _cache_key(user_query: str, gender: str, generation_type: str, max_length_chars: int) -> str:
+        key = f"{generation_type}|{gender}|{max_length_chars}|{normalize_idea(user_query)}"
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def _count_saved(self, counter: str) -> None:
+        self._stats[counter] += 1
+        self._stats['saved_seconds'] += self._latency or 0.0
     
     async def generate_prompt(self, user_query: str, gender: str, max_length_chars: int = 1000, generation_type: str = 'with_avatar') -> str:
         """
@@ -54,18 +84,63 @@ class LlamaPromptAssistant:
         # Пользовательский промпт
         full_prompt_for_llama = f'User idea: "{user_query}". Desired gender focus: {normalized_gender}.'
 
+        cache_key = self._cache_key(user_query, normalized_gender, generation_type, max_length_chars)
+        try:
+            cached = await prompt_assist_cache.get(cache_key)
+        except Exception as e:
+            logger.warning(f"Ошибка чтения кэша промптов Llama: {e}")
+            cached = None
+        if cached and cached.get('prompt'):
+            self._count_saved('cache_hits')
+            logger.info(f"Промпт Llama 3 из кэша для: '{user_query}'")
+            return cached['prompt']
+
+        in_flight = self._in_flight.get(cache_key)
+        if in_flight is not None:
+            self._count_saved('coalesced')
+            final_prompt = await asyncio.shield(in_flight)
+            return final_prompt or user_query
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[cache_key] = future
+        final_prompt = None
+        try:
+            final_prompt = await self._generate_uncached(
+                user_query, normalized_gender, max_length_chars, generation_type, system_prompt,
+                full_prompt_for_llama, max_new_tokens_calculated
+            )
+        finally:
+            self._in_flight.pop(cache_key, None)
+            future.set_result(final_prompt)
+
+        if not final_prompt:
+            return user_query
+        try:
+            await prompt_assist_cache.set(cache_key, {'prompt': final_prompt})
+        except Exception as e:
+            logger.warning(f"Ошибка записи кэша промптов Llama: {e}")
+        return final_prompt
+
+    async def _generate_uncached(self, user_query: str, normalized_gender: str, max_length_chars: int,
+                                 generation_type: str, system_prompt: str, full_prompt_for_llama: str,
+                                 max_new_tokens_calculated: int) -> Optional[str]:
+        """Вызывает Llama 3; возвращает улучшенный промпт или None."""
         logger.info(f"Запрос Llama 3 для: '{user_query}', пол: {normalized_gender}, тип: {generation_type}")
         logger.debug(f"Системный промпт: {system_prompt}")
         logger.debug(f"Пользовательский промпт: {full_prompt_for_llama}")
         logger.debug(f"max_new_tokens: {max_new_tokens_calculated}")
 
+        started = time.monotonic()
         try:
             # Выполняем запрос к Replicate API
+            self._stats['llama_calls'] += 1
             output = await self._run_replicate_model(
                 system_prompt, 
                 full_prompt_for_llama, 
                 max_new_tokens_calculated
             )
+            elapsed = time.monotonic() - started
+            self._latency = elapsed if self._latency is None else self._latency * 0.8 + elapsed * 0.2
             
             # Обрабатываем и очищаем результат
             final_prompt = self._process_output(output, max_length_chars)
@@ -75,11 +150,22 @@ class LlamaPromptAssistant:
                 return final_prompt
             else:
                 logger.warning("Llama 3 не смог улучшить промпт, используется оригинальный")
-                return user_query
+                return None
                 
         except Exception as e:
             logger.error(f"Ошибка при вызове Replicate API для Llama 3: {e}", exc_info=True)
-            return user_query
+            return None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Вызовы Llama, попадания в кэш, схлопнутые запросы и сэкономленное время."""
+        stats = dict(self._stats)
+        requests = stats['llama_calls'] + stats['cache_hits'] + stats['coalesced']
+        stats['hit_rate'] = (stats['cache_hits'] + stats['coalesced']) / requests if requests else 0.0
+        stats['saved_seconds'] = round(stats['saved_seconds'], 1)
+        stats['llama_latency'] = round(self._latency, 2) if self._latency is not None else None
+        stats['in_flight'] = len(self._in_flight)
+        stats['cache'] = prompt_assist_cache.get_stats()
+        return stats
     
     def _create_system_prompt(self, gender: str, user_query: str, generation_type: str) -> str:
         """Создает системный промпт для Llama 3 в зависимости от типа генерации."""
@@ -129,8 +215,6 @@ class LlamaPromptAssistant:
     
     async def _run_replicate_model(self, system_prompt: str, user_prompt: str, max_tokens: int) -> str:
         """Выполняет запрос к модели Replicate."""
-        loop = asyncio.get_event_loop()
-        
         # Параметры для Llama 3
         input_params = {
             "top_k": 50,
@@ -147,14 +231,12 @@ class LlamaPromptAssistant:
             )
         }
         
-        # Выполняем в отдельном потоке для совместимости с asyncio
-        output_stream = await loop.run_in_executor(
-            None, 
-            lambda: replicate.run(self.model_id, input=input_params)
-        )
+        output = await replicate_client.run(self.model_id, input_params)
         
-        # Собираем результат из потока
-        generated_text = "".join([str(event) for event in output_stream])
+        # Языковые модели возвращают список токенов
+        if isinstance(output, str):
+            return output
+        generated_text = "".join(str(event) for event in output or [])
         return generated_text
     
     def _process_output(self, output: str, max_length: int) -> str:
@@ -228,6 +310,12 @@ async def generate_assisted_prompt(user_query: str, gender: str, max_length_char
         logger.error(f"Ошибка в generate_assisted_prompt: {e}", exc_info=True)
         return user_query
 
+def get_prompt_assist_stats() -> Dict[str, Any]:
+    """Метрики кэша промптов Llama."""
+    if llama_assistant is None:
+        return {}
+    return llama_assistant.get_stats()
+
 # Функция для тестирования
 async def test_llama_assistant():
     """Тестовая функция для проверки работы Llama ассистента."""
@@ -261,4 +349,4 @@ async def test_llama_assistant():
 if __name__ == '__main__':
     asyncio.run(test_llama_assistant())
     
-__all__ = ['LlamaPromptAssistant', 'get_llama_assistant', 'generate_assisted_prompt']
\ No newline at end of file
+__all__ = ['LlamaPromptAssistant', 'get_llama_assistant', 'generate_assisted_prompt', 'get_prompt_assist_stats']
\ No newline at end of file
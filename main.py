@@ -7,11 +7,15 @@ import os
 import time
 from threading import Thread  # Оставляем импорт на случай будущего использования
 from datetime import datetime, timezone, timedelta
-from typing import Dict, Optional, Any
+from typing import Dict, Any
 import pytz
-import aiosqlite
+from db_pool import db_pool, get_pool_stats
+from analytics_buffer import analytics_buffer, get_analytics_stats
+from replicate_client import replicate_client, get_replicate_stats
+from yookassa_client import yookassa_client, get_yookassa_stats
+from payment_queue import payment_queue, get_payment_queue_stats, PaymentEventRejected
 from generation_config import GENERATION_TYPE_TO_MODEL_KEY
-from handlers.user.onboarding import setup_onboarding_handlers, onboarding_router, schedule_welcome_message, schedule_daily_reminders, send_onboarding_message, send_daily_reminders
+from handlers.user.onboarding import setup_onboarding_handlers, onboarding_router, schedule_daily_reminders, send_onboarding_batch, send_daily_reminders, process_onboarding_jobs
 from aiogram import Bot, Dispatcher
 from aiogram.types import Update, InlineKeyboardMarkup, InlineKeyboardButton, Message, ContentType
 from aiogram.enums import ParseMode
@@ -23,13 +27,15 @@ import aiohttp
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 from bot_counter import bot_counter
-from config import TELEGRAM_BOT_TOKEN as TOKEN, ADMIN_IDS, TARIFFS, DATABASE_PATH, METRICS_CONFIG, ERROR_LOG_ADMIN
-from handlers.utils import safe_escape_markdown as escape_md, send_message_with_fallback, escape_message_parts, unescape_markdown, create_duplicate_protection_middleware
+from config import TELEGRAM_BOT_TOKEN as TOKEN, ADMIN_IDS, TARIFFS, METRICS_CONFIG, ERROR_LOG_ADMIN
+from tariffs import tariff_registry
+from handlers.utils import safe_escape_markdown as escape_md, send_message_with_fallback, escape_message_parts, unescape_markdown, create_duplicate_protection_middleware, forget_payment_link
 from database import (
-    init_db, add_resources_on_payment, check_database_user, get_user_payments, is_old_user,
-    user_cache, is_user_blocked, get_user_actions_stats, check_referral_integrity,
-    update_user_balance, get_scheduled_broadcasts, get_users_for_welcome_message,
-    mark_welcome_message_sent, block_user_access, update_user_credits, retry_on_locked, get_broadcast_buttons,
+    init_db, apply_payment,
+    get_user_cache_stats, get_user_actions_stats,
+    update_user_balance, get_scheduled_broadcasts, get_interrupted_broadcasts, set_broadcast_status,
+    get_due_onboarding_messages, requeue_running_onboarding_jobs,
+    block_user_access, get_broadcast_buttons,
     start_periodic_tasks, backup_database
 )
 from handlers.user.commands import start, menu, help_command, check_training
@@ -43,10 +49,7 @@ from handlers.admin.visualization import handle_activity_dates_input
 from handlers.admin.user_management import (
     handle_balance_change_input, handle_block_reason_input, user_management_callback_handler, handle_user_search_input
 )
-from handlers.admin.broadcast import (
-    broadcast_message_admin, broadcast_to_paid_users, broadcast_to_non_paid_users,
-    broadcast_with_payment
-)
+from handlers.admin.broadcast import run_broadcast
 from handlers.admin.payments import handle_payments_date_input
 from handlers.admin.callbacks import (
     admin_callbacks_router, handle_admin_send_generation, handle_admin_regenerate
@@ -56,6 +59,13 @@ from handlers.user.callbacks import handle_user_callback, user_callbacks_router
 from handlers.system.utils import utils_callback_handler, utils_callbacks_router
 from handlers.system.referrals import referrals_callback_handler, referrals_callbacks_router
 from generation import check_pending_trainings, check_pending_video_tasks
+from generation.images import start_queue_processor, close_download_session, get_delivery_stats, param_templates
+from llama_helper import get_prompt_assist_stats
+from generation.job_queue import generation_jobs, get_generation_queue_stats
+from generation.tracker import prediction_tracker, get_tracker_stats
+from generation.photo_ingest import training_ingest, get_photo_ingest_stats
+from chart_service import chart_service, get_chart_stats
+from report import report_generator
 from keyboards import create_main_menu_keyboard
 from fsm_handlers import setup_conversation_handler, fsm_router, BotStates
 from handlers.admin.user_management import user_management_router, cancel
@@ -83,19 +93,6 @@ scheduler_instance = None
 # YOOKASSA_WEBHOOK_SECRET = os.getenv('YOOKASSA_SECRET', '')
 WEBHOOK_URL = os.getenv('WEBHOOK_URL', 'https://axidiphotoai.ru/webhook')
 
-async def is_payment_processed_webhook(payment_id: str) -> bool:
-    """Проверяет, был ли платёж уже обработан."""
-    try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
-            c = await conn.cursor()
-            await c.execute("SELECT COUNT(*) FROM payments WHERE payment_id = ?", (payment_id,))
-            count = (await c.fetchone())[0]
-        logger.debug(f"Проверка payment_id={payment_id}: обработан = {count > 0}")
-        return count > 0
-    except Exception as e:
-        logger.error(f"Ошибка проверки платежа {payment_id}: {e}", exc_info=True)
-        return True
-
 # def verify_yookassa_signature(webhook_data: Dict, signature: str) -> bool:
 #     """Проверяет подпись вебхука YooKassa."""
 #     try:
@@ -113,85 +110,6 @@ async def is_payment_processed_webhook(payment_id: str) -> bool:
 #         logger.error(f"Ошибка проверки подписи: {e}")
 #         return False
 
-async def add_payment_log(user_id: int, payment_id: str, amount: float, payment_info: Dict[str, Any]) -> bool:
-    """Добавляет запись о платеже в лог."""
-    try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
-            c = await conn.cursor()
-            current_timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
-            payment_info_json = json.dumps(payment_info, ensure_ascii=False)
-            await c.execute("""
-                INSERT OR IGNORE INTO payment_logs (user_id, payment_id, amount, payment_info, created_at)
-                VALUES (?, ?, ?, ?, ?)
-            """, (user_id, payment_id, amount, payment_info_json, current_timestamp))
-            await conn.commit()
-            if c.rowcount > 0:
-                logger.info(f"Платеж записан в логи: user_id={user_id}, payment_id={payment_id}, amount={amount}")
-                return True
-            else:
-                logger.warning(f"Платеж уже существует в логах: payment_id={payment_id}")
-                return True
-    except Exception as e:
-        logger.error(f"Ошибка записи платежа в логи: {e}")
-        return False
-
-async def update_user_payment_stats(user_id: int, payment_amount: float) -> bool:
-    """Обновляет статистику платежей пользователя."""
-    try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
-            c = await conn.cursor()
-            current_timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
-            await c.execute("""
-                SELECT total_payments, total_amount, first_payment_date
-                FROM user_payment_stats
-                WHERE user_id = ?
-            """, (user_id,))
-            existing_stats = await c.fetchone()
-            if existing_stats:
-                new_total_payments = existing_stats[0] + 1
-                new_total_amount = existing_stats[1] + payment_amount
-                await c.execute("""
-                    UPDATE user_payment_stats
-                    SET total_payments = ?, total_amount = ?, last_payment_date = ?
-                    WHERE user_id = ?
-                """, (new_total_payments, new_total_amount, current_timestamp, user_id))
-            else:
-                await c.execute("""
-                    INSERT INTO user_payment_stats
-                    (user_id, total_payments, total_amount, first_payment_date, last_payment_date)
-                    VALUES (?, 1, ?, ?, ?)
-                """, (user_id, payment_amount, current_timestamp, current_timestamp))
-            await conn.commit()
-            logger.info(f"Статистика платежей обновлена для user_id={user_id}")
-            return True
-    except Exception as e:
-        logger.error(f"Ошибка обновления статистики платежей для user_id={user_id}: {e}")
-        return False
-
-async def get_referrer_info(user_id: int) -> Optional[Dict[str, Any]]:
-    """Получает информацию о реферере пользователя."""
-    try:
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
-            conn.row_factory = aiosqlite.Row
-            c = await conn.cursor()
-            await c.execute("""
-                SELECT u.referrer_id, ref.username as referrer_username, ref.first_name as referrer_name
-                FROM users u
-                LEFT JOIN users ref ON u.referrer_id = ref.user_id
-                WHERE u.user_id = ?
-            """, (user_id,))
-            result = await c.fetchone()
-            if result and result['referrer_id']:
-                return {
-                    'referrer_id': result['referrer_id'],
-                    'referrer_username': result['referrer_username'],
-                    'referrer_name': result['referrer_name']
-                }
-            return None
-    except Exception as e:
-        logger.error(f"Ошибка получения информации о реферере для user_id={user_id}: {e}")
-        return None
-
 async def handle_webhook_error(error_message: str, webhook_data: Dict = None):
     """Обрабатывает ошибки вебхука и уведомляет админов."""
     logger.error(f"Ошибка webhook: {error_message}")
@@ -233,200 +151,61 @@ async def _send_message_async(
 
 # УДАЛЕНО: _handle_successful_payment_async_standalone - заменена на интегрированное решение
 
+async def _process_payment_event(bot: Bot, event: Dict[str, Any]) -> None:
+    """Обрабатывает сохранённое событие webhook YooKassa (вызывается очередью событий оплаты)."""
+    payment_obj = event['payload'].get('object', {})
+    payment_id = event['payment_id']
+    metadata = payment_obj.get('metadata', {})
+
+    user_id = int(metadata.get('user_id', 0))
+    description = metadata.get('description_for_user', 'Неизвестный платеж')
+    amount_obj = payment_obj.get('amount', {})
+    amount = float(amount_obj.get('value', 0)) if amount_obj.get('value') else 0.0
+
+    # Тариф по сумме платежа: сумма из API — строка, сравниваем в копейках
+    plan_key = tariff_registry.key_for_amount(amount_obj.get('value'))
+
+    if not plan_key or not user_id:
+        logger.error(f"❌ Неизвестный тариф или пользователь для payment_id={payment_id}: amount={amount}, user_id={user_id}")
+        await handle_webhook_error(f"Неизвестный тариф для amount={amount}", event['payload'])
+        raise PaymentEventRejected('Unknown tariff plan or user')
+
+    logger.info(f"🎯 Обрабатываем платеж: user_id={user_id}, payment_id={payment_id}, amount={amount}, plan_key={plan_key}")
+    await _handle_successful_payment_async(
+        user_id=user_id,
+        plan_key=plan_key,
+        payment_id=payment_id,
+        payment_amount=amount,
+        description=description,
+        bot=bot
+    )
+    await forget_payment_link(user_id, amount, description)
+
+
 async def _handle_successful_payment_async(
     user_id: int, plan_key: str, payment_id: str, payment_amount: float, description: str, bot: Bot
 ) -> None:
-    """Обрабатывает успешный платёж."""
+    """Проводит успешный платёж и после фиксации транзакции рассылает уведомления."""
     logger.info(f"Начало обработки платежа: user_id={user_id}, payment_id={payment_id}, plan_key={plan_key}")
 
-    if await is_payment_processed_webhook(payment_id):
+    # Начисление, реферальный бонус, логи и статистика — одна транзакция; повтор отсекается в БД
+    result = await apply_payment(user_id, plan_key, payment_amount, payment_id)
+    if result is None:
         logger.warning(f"Платеж {payment_id} для user_id={user_id} уже обработан.")
         return
 
-    try:
-        if not await check_referral_integrity(user_id):
-            logger.error(f"Не удалось восстановить реферальную связь для user_id={user_id}")
-            for admin_id in ADMIN_IDS:
-                await _send_message_async(
-                    bot, admin_id,
-                    escape_md(f"⚠️ Не удалось восстановить реферальную связь для user_id={user_id}, payment_id={payment_id}", version=2),
-                    parse_mode=ParseMode.MARKDOWN_V2
-                )
-        else:
-            logger.debug(f"Реферальная связь проверена для user_id={user_id}")
-    except Exception as e:
-        logger.error(f"Ошибка проверки реферальной связи для user_id={user_id}: {e}", exc_info=True)
-
-    initial_subscription = await check_database_user(user_id)
-    if not initial_subscription or len(initial_subscription) < 9:
-        logger.error(f"Неполные данные подписки для user_id={user_id}")
-        await _send_message_async(
-            bot, user_id,
-            escape_md("❌ Ошибка обработки платежа. Обратитесь в поддержку: @AXIDI_Help", version=2),
-            parse_mode=ParseMode.MARKDOWN_V2
-        )
-        return
-
-    initial_avatars = initial_subscription[1]
-    initial_first_purchase = bool(initial_subscription[5])
-
-    # Определяем, является ли это первой покупкой
-    previous_payments = await get_user_payments(user_id)
-    payment_count = len([p for p in previous_payments if p[0] != payment_id])  # Исключаем текущий платеж
-    is_first_purchase = (payment_count == 0)
-
-    logger.info(f"Определение первой покупки: user_id={user_id}, previous_payments={payment_count}, "
-                f"initial_first_purchase={initial_first_purchase}, is_first_purchase={is_first_purchase}")
-
-    try:
-        # Передаем правильный флаг is_first_purchase
-        payment_processed_successfully = await add_resources_on_payment(
-            user_id, plan_key, payment_amount, payment_id, bot, is_first_purchase=is_first_purchase
-        )
-        if not payment_processed_successfully:
-            logger.error(f"Ошибка начисления ресурсов для user_id={user_id}, plan={plan_key}, payment_id={payment_id}")
-            await _send_message_async(
-                bot, user_id,
-                escape_md("❌ Ошибка начисления ресурсов. Обратитесь в поддержку: @AXIDI_Help", version=2),
-                parse_mode=ParseMode.MARKDOWN_V2
-            )
-            for admin_id in ADMIN_IDS:
-                await _send_message_async(
-                    bot, admin_id,
-                    escape_md(f"⚠️ Ошибка начисления ресурсов для user_id={user_id}, payment_id={payment_id}", version=2),
-                    parse_mode=ParseMode.MARKDOWN_V2
-                )
-            return
-        logger.info(f"Ресурсы начислены для user_id={user_id}, plan={plan_key}, payment_id={payment_id}")
-    except Exception as e:
-        logger.error(f"Исключение при начислении ресурсов для user_id={user_id}: {e}", exc_info=True)
-        return
-
-    logger.info(f"Сохранение платежа в логи...")
-    tariff_info = TARIFFS.get(plan_key, {})
-    photos_added = tariff_info.get('photos', 0)
-    avatars_to_add = tariff_info.get('avatars', 0)
-
-    bonus_avatar = False
-
-    # Проверяем наличие реферера для начисления бонуса РЕФЕРЕРУ (не пользователю)
-    referrer_info = await get_referrer_info(user_id)
-    referrer_id = referrer_info['referrer_id'] if referrer_info else None
-
-    # Бонусный аватар только при первой покупке
-    if is_first_purchase and plan_key != 'аватар':
-        avatars_to_add += 1
-        bonus_avatar = True
-        logger.info(f"Добавлен бонусный аватар для первой покупки user_id={user_id}")
-
-    payment_info = {
-        'tariff_key': plan_key,
-        'photos_added': photos_added,
-        'avatars_added': avatars_to_add,
-        'is_first_purchase': is_first_purchase,
-        'bonus_avatar': bonus_avatar
-    }
-
-    await add_payment_log(user_id, payment_id, payment_amount, payment_info)
-    await update_user_payment_stats(user_id, payment_amount)
-
-    # Гарантируем обновление first_purchase с повторными попытками
-    if is_first_purchase:
-        max_attempts = 5
-        for attempt in range(max_attempts):
-            try:
-                logger.info(f"Попытка {attempt + 1}/{max_attempts}: Обновление статуса первой покупки для user_id={user_id}")
-                await update_user_credits(user_id, action="set_first_purchase_completed")
-                logger.info(f"first_purchase успешно обновлен для user_id={user_id}")
-                if user_cache is not None:
-                    try:
-                        await user_cache.delete(user_id)  # Инвалидируем кэш после обновления
-                    except Exception as e:
-                        logger.warning(f"Ошибка удаления кеша для user_id={user_id}: {e}")
-                break
-            except Exception as e:
-                logger.error(f"Попытка {attempt + 1}/{max_attempts}: Ошибка обновления first_purchase для user_id={user_id}: {e}", exc_info=True)
-                if attempt < max_attempts - 1:
-                    await asyncio.sleep(0.5 * (2 ** attempt))  # Экспоненциальная задержка
-                else:
-                    logger.critical(f"Не удалось обновить first_purchase для user_id={user_id} после {max_attempts} попыток")
-                    for admin_id in ADMIN_IDS:
-                        await _send_message_async(
-                            bot, admin_id,
-                            escape_md(f"🚨 Критическая ошибка: Не удалось обновить first_purchase для user_id={user_id} после {max_attempts} попыток: {str(e)}", version=2),
-                            parse_mode=ParseMode.MARKDOWN_V2
-                        )
-
-    logger.info(f"Инвалидация кэша для user_id={user_id}")
-    if user_cache is not None:
-        try:
-            await user_cache.delete(user_id)
-            logger.debug(f"Кэш инвалидирован для user_id={user_id}")
-        except Exception as e:
-            logger.warning(f"Ошибка удаления кеша для user_id={user_id}: {e}")
-    else:
-        logger.debug(f"Кеш недоступен для user_id={user_id}")
-
-    logger.info(f"Получение актуальных данных после начисления...")
-    try:
-        subscription_data = await asyncio.wait_for(check_database_user(user_id), timeout=5.0)
-        logger.info(f"Данные получены: subscription_data длина = {len(subscription_data) if subscription_data else 0}")
-
-        if not subscription_data:
-            logger.error(f"Нет данных подписки для user_id={user_id}")
-            await _send_message_async(
-                bot, user_id,
-                escape_md("❌ Ошибка обновления баланса. Обратитесь в поддержку: @AXIDI_Help", version=2),
-                parse_mode=ParseMode.MARKDOWN_V2
-            )
-            return
-
-        if len(subscription_data) >= 9:
-            generations_left = subscription_data[0]
-            avatar_left = subscription_data[1]
-            training_mode = subscription_data[2] if len(subscription_data) > 2 else None
-            username = subscription_data[3] if len(subscription_data) > 3 else None
-            is_notified = subscription_data[4] if len(subscription_data) > 4 else None
-            first_purchase = subscription_data[5] if len(subscription_data) > 5 else None
-            registration_date = subscription_data[6] if len(subscription_data) > 6 else None
-            blocked = subscription_data[7] if len(subscription_data) > 7 else None
-            first_name = subscription_data[8] if len(subscription_data) > 8 else None
-            logger.info(f"Данные после начисления: user_id={user_id}, photos={generations_left}, avatars={avatar_left}")
-        else:
-            logger.error(f"Неполные данные подписки для user_id={user_id}: длина {len(subscription_data)}")
-            return
-
-    except asyncio.TimeoutError:
-        logger.error(f"Таймаут при получении данных подписки для user_id={user_id}")
-        return
-    except Exception as e:
-        logger.error(f"Ошибка при получении данных подписки: {e}", exc_info=True)
-        return
-
-    logger.info(f"Подготовка данных для уведомлений...")
-    try:
-        payments = await asyncio.wait_for(get_user_payments(user_id), timeout=3.0)
-        payment_count = len([p for p in payments if p[0] != payment_id])  # Исключаем текущий платеж
-    except:
-        payment_count = 0
-        logger.warning(f"Не удалось получить историю платежей для user_id={user_id}")
-
-    try:
-        referrer_text = f"ID {referrer_id}" if referrer_id else "Отсутствует"
-    except:
-        referrer_id = None
-        referrer_text = "Отсутствует"
-        logger.warning(f"Не удалось получить информацию о реферере для user_id={user_id}")
+    generations_left = result['generations_left']
+    avatar_left = result['avatar_left']
+    username = result['username']
+    first_name = result['first_name']
+    is_first_purchase = result['is_first_purchase']
+    payment_count = result['payment_count']
+    referrer_id = result['referrer_id']
+    referrer_text = f"ID {referrer_id}" if referrer_id else "Отсутствует"
 
     photos = TARIFFS.get(plan_key, {}).get('photos', 0)
-    avatars = TARIFFS.get(plan_key, {}).get('avatars', 0)
-
-    avatars_added = avatar_left - initial_avatars
-    bonus_avatars = 0
-    if is_first_purchase and plan_key != 'аватар':
-        expected_avatars = avatars + 1
-        if avatars_added >= expected_avatars:
-            bonus_avatars = 1
+    avatars_added = result['avatars_added']
+    bonus_avatars = 1 if result['bonus_avatar'] else 0
 
     added_text = f"{photos} печенек"
     if avatars_added > 0:
@@ -434,6 +213,13 @@ async def _handle_successful_payment_async(
         if bonus_avatars:
             added_text += f" (включая бонусный)"
 
+    if result['referral_photos']:
+        await _send_message_async(
+            bot, referrer_id,
+            escape_md(f"🎁 Ваш друг оплатил подписку! Вам начислено {result['referral_photos']} печенек за реферала!", version=2),
+            parse_mode=ParseMode.MARKDOWN_V2
+        )
+
     logger.info(f"=== НАЧАЛО ОТПРАВКИ УВЕДОМЛЕНИЯ ПОЛЬЗОВАТЕЛЮ ===")
     try:
         bot_username = (await bot.get_me()).username.lstrip('@') or "Bot"
@@ -565,62 +351,54 @@ async def create_integrated_webhook_app(bot_instance: Bot) -> web.Application:
     async def webhook_handler(request):
         """Обработчик webhook от YooKassa - максимальная производительность."""
         try:
-            data = await request.json()
+            body = await request.read()
+            data = json.loads(body)
             logger.info(f"🚀 Получен webhook: {data.get('event', 'unknown')}")
 
             if data.get('event') == 'payment.succeeded':
-                payment_obj = data.get('object', {})
-                payment_id = payment_obj.get('id')
-                metadata = payment_obj.get('metadata', {})
-
-                user_id = int(metadata.get('user_id', 0))
-                description = metadata.get('description_for_user', 'Неизвестный платеж')
-                amount_obj = payment_obj.get('amount', {})
-                amount = float(amount_obj.get('value', 0)) if amount_obj.get('value') else 0.0
-
-                # Определяем тариф по сумме платежа
-                plan_key = None
-                for key, tariff_details in TARIFFS.items():
-                    if abs(tariff_details["amount"] - amount) < 0.01:
-                        plan_key = key
-                        break
-
-                if not plan_key:
-                    logger.error(f"❌ Неизвестный тариф для amount={amount}, user_id={user_id}")
-                    return web.json_response({'status': 'error', 'message': 'Unknown tariff plan'}, status=400)
-
-                logger.info(f"🎯 Обрабатываем платеж: user_id={user_id}, payment_id={payment_id}, amount={amount}, plan_key={plan_key}")
-
-                # ПРЯМОЙ вызов с bot_instance - максимальная производительность!
-                await _handle_successful_payment_async(
-                    user_id=user_id,
-                    plan_key=plan_key,
-                    payment_id=payment_id,
-                    payment_amount=amount,
-                    description=description,
-                    bot=bot_instance  # ← КЛЮЧЕВОЕ ПРЕИМУЩЕСТВО!
-                )
+                payment_id = data.get('object', {}).get('id')
+                if not payment_id:
+                    logger.error("❌ Webhook payment.succeeded без id платежа")
+                    return web.json_response({'status': 'error', 'message': 'Missing payment id'}, status=400)
 
-                logger.info(f"✅ Платеж {payment_id} обработан мгновенно!")
-                return web.json_response({'status': 'success'})
+                # Сохраняем сырое событие и сразу отвечаем; платёж проведёт очередь событий оплаты
+                created = await payment_queue.submit(payment_id, data['event'], body.decode('utf-8'))
+                logger.info(f"✅ Платеж {payment_id} {'принят в обработку' if created else 'уже был получен'}")
+                return web.json_response({'status': 'success' if created else 'duplicate'})
 
             # Обработка тестовых webhook
             elif data.get('event') == 'test_event':
                 return web.json_response({'status': 'test_ok'})
 
+            return web.json_response({'status': 'ignored'})
+
         except Exception as e:
             logger.error(f"❌ Ошибка webhook: {e}", exc_info=True)
             return web.json_response({'status': 'error', 'message': str(e)}, status=500)
 
+    async def replicate_webhook_handler(request):
+        """Обработчик webhook от Replicate: будит ожидающие предсказания."""
+        try:
+            body = await request.read()
+            if not replicate_client.verify_webhook(request.headers, body):
+                logger.warning("Отклонён webhook Replicate с неверной подписью")
+                return web.json_response({'status': 'error', 'message': 'Invalid signature'}, status=401)
+            replicate_client.handle_webhook(json.loads(body))
+            return web.json_response({'status': 'ok'})
+        except Exception as e:
+            logger.error(f"❌ Ошибка webhook Replicate: {e}", exc_info=True)
+            return web.json_response({'status': 'error', 'message': str(e)}, status=500)
+
     async def health_handler(request):
         """Health check endpoint."""
-        return web.json_response({'status': 'healthy', 'timestamp': time.time()})
+        return web.json_response({'status': 'healthy', 'timestamp': time.time(), 'db_pool': get_pool_stats(), 'analytics': get_analytics_stats(), 'user_cache': get_user_cache_stats(), 'replicate': get_replicate_stats(), 'generation_queue': get_generation_queue_stats(), 'delivery': get_delivery_stats(), 'prompt_assist': get_prompt_assist_stats(), 'tracker': get_tracker_stats(), 'photo_ingest': get_photo_ingest_stats(), 'yookassa': get_yookassa_stats(), 'payment_queue': get_payment_queue_stats(), 'charts': get_chart_stats()})
 
     # Создаем aiohttp приложение
     app = web.Application()
     app.router.add_post('/webhook', webhook_handler)
     app.router.add_get('/health', health_handler)
     app.router.add_post('/test_webhook', webhook_handler)
+    app.router.add_post('/replicate/webhook', replicate_webhook_handler)
 
     logger.info("🚀 Интегрированное webhook приложение создано")
     return app
@@ -629,64 +407,13 @@ async def check_and_schedule_onboarding(bot: Bot) -> None:
     """Проверяет и планирует онбординговые сообщения для всех пользователей при запуске бота."""
     logger.info("Начало проверки онбординговых сообщений при запуске бота...")
     try:
-        # Получаем всех пользователей, которые ещё не получили приветственное сообщение
-        users = await get_users_for_welcome_message()
-        logger.info(f"Найдено {len(users)} пользователей для отправки приветственного сообщения")
-
+        # Одним запросом отбираем тех, кому пора отправить приветствие:
+        # старые пользователи, оплатившие и заблокированные отсекаются в SQL
         moscow_tz = pytz.timezone('Europe/Moscow')
-        current_time = datetime.now(moscow_tz)
-
-        for user in users:
-            user_id = user['user_id']
-            first_name = user['first_name']
-            username = user['username']
-            created_at = user['created_at']
-
-            # Проверяем, заблокирован ли пользователь
-            if await is_user_blocked(user_id):
-                logger.info(f"Пользователь user_id={user_id} заблокирован, пропускаем онбординг")
-                continue
-
-            # Проверяем, является ли пользователь старым
-            is_old_user_flag = await is_old_user(user_id, cutoff_date="2025-07-11")
-            if is_old_user_flag:
-                logger.info(f"Пользователь user_id={user_id} старый, пропускаем онбординг")
-                await mark_welcome_message_sent(user_id)  # Отмечаем, чтобы не отправлять повторно
-                continue
-
-            # Проверяем, есть ли у пользователя покупки
-            from onboarding_config import has_user_purchases
-            has_purchases = await has_user_purchases(user_id, DATABASE_PATH)
-            if has_purchases:
-                logger.info(f"Пользователь user_id={user_id} уже имеет покупки, пропускаем онбординг")
-                await mark_welcome_message_sent(user_id)
-                continue
-
-            # Получаем данные о последнем отправленном напоминании
-            subscription_data = await check_database_user(user_id)
-            if not subscription_data or len(subscription_data) < 14:
-                logger.error(f"Неполные данные подписки для user_id={user_id}, пропускаем")
-                continue
-
-            welcome_message_sent = subscription_data[11]
-
-            try:
-                registration_date = datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S').replace(tzinfo=moscow_tz)
-            except ValueError as e:
-                logger.warning(f"Невалидный формат даты для user_id={user_id}: {created_at}. Используется текущая дата. Ошибка: {e}")
-                registration_date = current_time
-
-            time_since_registration = (current_time - registration_date).total_seconds()
-
-            # Отправляем приветственное сообщение, если оно ещё не отправлено и прошло больше часа
-            if not welcome_message_sent and time_since_registration >= 3600:  # 1 час
-                logger.info(f"Отправка приветственного сообщения для user_id={user_id}")
-                await send_onboarding_message(bot, user_id, "welcome", subscription_data)
-                await mark_welcome_message_sent(user_id)
-                # Планируем приветственное сообщение для новых пользователей
-                await schedule_welcome_message(bot_instance, user_id)
-                continue
+        targets = await get_due_onboarding_messages('welcome', datetime.now(moscow_tz), cutoff_date="2025-07-11")
+        logger.info(f"Найдено {len(targets)} пользователей для отправки приветственного сообщения")
 
+        await send_onboarding_batch(bot, targets)
         logger.info("Проверка онбординговых сообщений завершена")
 
     except Exception as e:
@@ -703,6 +430,76 @@ async def check_and_schedule_onboarding(bot: Bot) -> None:
 
 # УДАЛЕНО: Все Flask routes заменены на интегрированный aiohttp webhook
 
+# Выполняющиеся рассылки (держим ссылки, чтобы задачи не собрал GC)
+_broadcast_tasks: set = set()
+
+async def _run_scheduled_broadcast(bot: Bot, broadcast_id: int, broadcast_data: Dict[str, Any]) -> None:
+    """Выполняет запланированную рассылку с контрольными точками в scheduled_broadcasts."""
+    message_text = broadcast_data.get('message', '')
+    media = broadcast_data.get('media', None)
+    media_type = media.get('type') if media else None
+    media_id = media.get('file_id') if media else None
+    target_group = broadcast_data.get('broadcast_type', 'all')
+    admin_user_id = broadcast_data.get('admin_user_id', ADMIN_IDS[0])
+    try:
+        # Извлекаем кнопки из таблицы broadcast_buttons
+        buttons = await get_broadcast_buttons(broadcast_id)
+        # Если кнопки не найдены в таблице, используем резерв из broadcast_data
+        if not buttons and 'buttons' in broadcast_data:
+            buttons = broadcast_data.get('buttons', [])
+            logger.debug(f"Кнопки для broadcast_id={broadcast_id} взяты из broadcast_data: {buttons}")
+
+        if target_group.startswith('with_payment'):
+            # Аудитория рассылки с оплатой: with_payment_all / with_payment_paid / with_payment_non_paid
+            audience = target_group[len('with_payment'):].lstrip('_') or 'all'
+            if not buttons or broadcast_data.get('with_payment_button', False):
+                buttons = list(buttons or []) + [{"text": "Да, хочу! 💳", "callback_data": "subscribe"}]
+            target_group, title = audience, "Рассылка с оплатой"
+        elif target_group in ('all', 'paid', 'non_paid'):
+            title = {'all': "Рассылка", 'paid': "Рассылка для оплативших", 'non_paid': "Рассылка для не оплативших"}[target_group]
+        else:
+            logger.warning(f"Неизвестная группа рассылки для ID {broadcast_id}: {target_group}")
+            await set_broadcast_status(broadcast_id, 'failed')
+            return
+
+        # Очищаем текст от возможного экранирования и экранируем заново
+        raw_message = unescape_markdown(message_text)
+        logger.debug(f"Очищенный текст сообщения для broadcast_id={broadcast_id}: {raw_message[:100]}...")
+        signature = "🍪 PixelPie"
+        caption = raw_message + ("\n\n" + signature if raw_message.strip() else "\n" + signature)
+        escaped_caption = escape_message_parts(caption, version=2)
+        logger.debug(f"Экранированный текст для отправки: {escaped_caption[:100]}...")
+
+        await run_broadcast(
+            bot, escaped_caption, admin_user_id, target_group, media_type, media_id, buttons,
+            broadcast_id=broadcast_id, title=title
+        )
+        logger.info(f"Рассылка ID {broadcast_id} завершена")
+    except Exception as e:
+        logger.error(f"Ошибка выполнения рассылки ID {broadcast_id}: {e}", exc_info=True)
+        # Иначе статус running остаётся и рассылка возобновляется при каждом перезапуске
+        try:
+            await set_broadcast_status(broadcast_id, 'failed')
+        except Exception as e_status:
+            logger.error(f"Не удалось отметить рассылку ID {broadcast_id} как failed: {e_status}")
+        for admin_id in ADMIN_IDS:
+            try:
+                await send_message_with_fallback(
+                    bot, admin_id,
+                    escape_message_parts(
+                        f"🚨 Ошибка выполнения рассылки ID {broadcast_id} для группы {target_group}: {str(e)}",
+                        version=2
+                    ),
+                    parse_mode=ParseMode.MARKDOWN_V2
+                )
+            except Exception as e_notify:
+                logger.error(f"Не удалось уведомить админа {admin_id}: {e_notify}")
+
+def _start_broadcast_task(bot: Bot, broadcast_id: int, broadcast_data: Dict[str, Any]) -> None:
+    task = asyncio.create_task(_run_scheduled_broadcast(bot, broadcast_id, broadcast_data))
+    _broadcast_tasks.add(task)
+    task.add_done_callback(_broadcast_tasks.discard)
+
 async def process_scheduled_broadcasts(bot: Bot) -> None:
     """Обрабатывает запланированные рассылки."""
     try:
@@ -719,71 +516,17 @@ async def process_scheduled_broadcasts(bot: Bot) -> None:
             if not isinstance(broadcast_data, dict):
                 logger.error(f"Некорректные данные broadcast_data для broadcast_id={broadcast_id}")
                 continue
-            message_text = broadcast_data.get('message', '')
-            media = broadcast_data.get('media', None)
-            media_type = media.get('type') if media else None
-            media_id = media.get('file_id') if media else None
-            target_group = broadcast_data.get('broadcast_type', 'all')
-            admin_user_id = broadcast_data.get('admin_user_id', ADMIN_IDS[0])
-            # Извлекаем кнопки из таблицы broadcast_buttons
-            buttons = await get_broadcast_buttons(broadcast_id)
-            # Если кнопки не найдены в таблице, используем резерв из broadcast_data
-            if not buttons and 'buttons' in broadcast_data:
-                buttons = broadcast_data.get('buttons', [])
-                logger.debug(f"Кнопки для broadcast_id={broadcast_id} взяты из broadcast_data: {buttons}")
             scheduled_time = broadcast.get('scheduled_time')
             if not scheduled_time:
                 logger.warning(f"Рассылка ID {broadcast_id} пропущена: отсутствует scheduled_time")
                 continue
-            logger.info(f"Выполняется рассылка ID {broadcast_id} для группы {target_group} на {scheduled_time}")
-
-            # Очищаем текст от возможного экранирования и экранируем заново
-            raw_message = unescape_markdown(message_text)
-            logger.debug(f"Очищенный текст сообщения для broadcast_id={broadcast_id}: {raw_message[:100]}...")
-            signature = "🍪 PixelPie"
-            caption = raw_message + ("\n\n" + signature if raw_message.strip() else "\n" + signature)
-            escaped_caption = escape_message_parts(caption, version=2)
-            logger.debug(f"Экранированный текст для отправки: {escaped_caption[:100]}...")
+            logger.info(f"Выполняется рассылка ID {broadcast_id} для группы {broadcast_data.get('broadcast_type', 'all')} на {scheduled_time}")
 
-            reply_markup = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="Да, хочу! 💳", callback_data="subscribe")]
-            ]) if broadcast_data.get('with_payment_button', False) else None
-
-            try:
-                async with aiosqlite.connect(DATABASE_PATH, timeout=15) as conn:
-                    c = await conn.cursor()
-                    await c.execute(
-                        "UPDATE scheduled_broadcasts SET status = 'completed' WHERE id = ?",
-                        (broadcast_id,)
-                    )
-                    await conn.commit()
-                logger.debug(f"Статус рассылки ID {broadcast_id} обновлен на completed")
-                if target_group == 'all':
-                    await broadcast_message_admin(bot, escaped_caption, admin_user_id, media_type, media_id, buttons)
-                elif target_group == 'paid':
-                    await broadcast_to_paid_users(bot, escaped_caption, admin_user_id, media_type, media_id, buttons)
-                elif target_group == 'non_paid':
-                    await broadcast_to_non_paid_users(bot, escaped_caption, admin_user_id, media_type, media_id, buttons)
-                elif target_group.startswith('with_payment'):
-                    await broadcast_with_payment(bot, escaped_caption, admin_user_id, media_type, media_id, buttons)
-                else:
-                    logger.warning(f"Неизвестная группа рассылки для ID {broadcast_id}: {target_group}")
-                    continue
-                logger.info(f"Рассылка ID {broadcast_id} завершена")
-            except Exception as e:
-                logger.error(f"Ошибка выполнения рассылки ID {broadcast_id}: {e}", exc_info=True)
-                for admin_id in ADMIN_IDS:
-                    try:
-                        await send_message_with_fallback(
-                            bot, admin_id,
-                            escape_message_parts(
-                                f"🚨 Ошибка выполнения рассылки ID {broadcast_id} для группы {target_group}: {str(e)}",
-                                version=2
-                            ),
-                            parse_mode=ParseMode.MARKDOWN_V2
-                        )
-                    except Exception as e_notify:
-                        logger.error(f"Не удалось уведомить админа {admin_id}: {e_notify}")
+            # Статус running: рассылку не возьмут повторно, а после перезапуска она продолжится
+            await set_broadcast_status(broadcast_id, 'running')
+            logger.debug(f"Статус рассылки ID {broadcast_id} обновлен на running")
+            # Рассылка идёт в фоне, чтобы не блокировать ежеминутную проверку
+            _start_broadcast_task(bot, broadcast_id, broadcast_data)
     except Exception as e:
         logger.error(f"Ошибка в фоновой задаче рассылок: {e}", exc_info=True)
         for admin_id in ADMIN_IDS:
@@ -796,6 +539,12 @@ async def process_scheduled_broadcasts(bot: Bot) -> None:
             except Exception as e_notify:
                 logger.error(f"Не удалось уведомить админа {admin_id}: {e_notify}")
 
+async def resume_interrupted_broadcasts(bot: Bot) -> None:
+    """Продолжает рассылки, прерванные перезапуском, с сохранённой контрольной точки."""
+    for broadcast in await get_interrupted_broadcasts():
+        logger.info(f"Продолжение рассылки ID {broadcast['id']} после перезапуска")
+        _start_broadcast_task(bot, broadcast['id'], broadcast['broadcast_data'])
+
 async def run_checks(bot: Bot) -> None:
     """Запускает проверки задач генерации."""
     try:
@@ -829,8 +578,7 @@ async def notify_startup() -> None:
 async def init_payment_tables():
     """Инициализирует таблицы для платежей и добавляет столбец last_reminder_type."""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as db:
-            await db.execute("PRAGMA busy_timeout = 30000")
+        async with db_pool.writer() as db:
             c = await db.cursor()
             # Проверяем, существует ли столбец last_reminder_type
             await c.execute("PRAGMA table_info(users)")
@@ -1169,9 +917,30 @@ async def main():
             misfire_grace_time=300,
             id='daily_detailed_report'
         )
+
+        # Отложенные сообщения онбординга хранятся в таблице onboarding_jobs
+        await requeue_running_onboarding_jobs()
+        scheduler.add_job(
+            process_onboarding_jobs,
+            trigger=CronTrigger(minute='*', timezone=pytz.timezone('Europe/Moscow')),
+            args=[bot_instance],
+            misfire_grace_time=30,
+            max_instances=1,
+            id='onboarding_jobs'
+        )
         scheduler.start()
         logger.info("Планировщик задач запущен")
 
+        # Продолжаем рассылки, прерванные перезапуском
+        asyncio.create_task(resume_interrupted_broadcasts(bot_instance))
+
+        # Шаблоны параметров генерации собираются один раз при старте
+        param_templates.warm()
+
+        # Очередь генераций: задания из generation_jobs продолжаются после перезапуска
+        await start_queue_processor(bot_instance, dp.storage)
+        await payment_queue.start(bot_instance, _process_payment_event)
+
         # Запуск проверки онбординговых сообщений
         logger.info("Запуск проверки онбординговых сообщений...")
         asyncio.create_task(check_and_schedule_onboarding(bot_instance))
@@ -1230,6 +999,17 @@ async def main():
             logger.info("Счетчик пользователей не имеет метода stop, пропускаем")
             await bot_instance.session.close()
             logger.info("Сессия бота закрыта")
+        await generation_jobs.stop()
+        await payment_queue.stop()
+        await prediction_tracker.stop()
+        training_ingest.shutdown()
+        chart_service.shutdown()
+        report_generator.shutdown()
+        await close_download_session()
+        await analytics_buffer.stop()
+        await replicate_client.close()
+        await yookassa_client.close()
+        await db_pool.close()
         logger.info("Бот полностью остановлен.")
 
 if __name__ == '__main__':
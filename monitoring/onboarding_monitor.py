@@ -149,7 +149,7 @@ class OnboardingMonitor:
                         continue
 
                     # Определяем тип напоминания
-                    last_reminder = subscription_data[12] if len(subscription_data) > 12 else None
+                    last_reminder = subscription_data.last_reminder_type
                     reminder_type = self._get_next_reminder_type(last_reminder)
 
                     if reminder_type:
@@ -5,7 +5,7 @@
 """
 
 import asyncio
-import aiosqlite
+from db_pool import db_pool
 import logging
 import os
 import sys
@@ -42,7 +42,7 @@ class BotMonitoringSystem:
             # Проверяем аватары за последние 6 часов (поскольку отчет запускается каждые 6 часов)
             six_hours_ago = datetime.now() - timedelta(hours=6)
 
-            async with aiosqlite.connect(DATABASE_PATH) as conn:
+            async with db_pool.reader() as conn:
                 cursor = await conn.cursor()
 
                 # Получаем аватары со статусом 'success' за последние 6 часов
@@ -214,7 +214,7 @@ class BotMonitoringSystem:
             free_space_gb = (disk_usage.f_frsize * disk_usage.f_bavail) / (1024**3)
 
             # Проверяем количество пользователей
-            async with aiosqlite.connect(DATABASE_PATH) as conn:
+            async with db_pool.reader() as conn:
                 cursor = await conn.cursor()
                 await cursor.execute("SELECT COUNT(*) FROM users")
                 total_users = (await cursor.fetchone())[0]
@@ -529,7 +529,7 @@ class BotMonitoringSystem:
             # Получаем статистику за последний час
             one_hour_ago = datetime.now(self.moscow_tz) - timedelta(hours=1)
 
-            async with aiosqlite.connect(DATABASE_PATH) as conn:
+            async with db_pool.reader() as conn:
                 cursor = await conn.cursor()
 
                 # Новые пользователи за час
@@ -606,7 +606,7 @@ class BotMonitoringSystem:
             timestamp = datetime.now(self.moscow_tz).strftime('%Y-%m-%d %H:%M:%S MSK')
             yesterday = datetime.now(self.moscow_tz) - timedelta(days=1)
 
-            async with aiosqlite.connect(DATABASE_PATH) as conn:
+            async with db_pool.reader() as conn:
                 cursor = await conn.cursor()
 
                 # Статистика за день
@@ -93,8 +93,14 @@ def get_message_text(message_type: str, first_name: str) -> Dict[str, str]:
 async def has_user_purchases(user_id: int, database_path: str) -> bool:
     """Проверяет, есть ли у пользователя успешные покупки"""
     import aiosqlite
+    from config import DATABASE_PATH
     try:
-        async with aiosqlite.connect(database_path) as conn:
+        if database_path == DATABASE_PATH:
+            from db_pool import db_pool
+            connection = db_pool.reader()
+        else:
+            connection = aiosqlite.connect(database_path)
+        async with connection as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
             await c.execute("""
@@ -0,0 +1,125 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+from aiogram import Bot
+
+from config import PAYMENT_EVENT_BATCH_SIZE, PAYMENT_EVENT_MAX_ATTEMPTS
+from database import (
+    save_payment_event, claim_payment_events, finish_payment_event,
+    requeue_running_payment_events, get_payment_events_depth
+)
+from logger import get_logger
+
+logger = get_logger('payments')
+
+EventHandler = Callable[[Bot, Dict[str, Any]], Awaitable[None]]
+
+
+class PaymentEventRejected(Exception):
+    """Событие нельзя провести (неизвестный тариф или пользователь): повторять бесполезно."""
+
+
+class PaymentEventQueue:
+    """Очередь событий оплаты в SQLite (таблица payment_events).
+
+    Webhook только сохраняет сырое событие и сразу отвечает YooKassa;
+    повторная доставка отсекается первичным ключом payment_id. Обработчик
+    проводит платёж одной транзакцией и после неё рассылает уведомления.
+    События переживают перезапуск, упавшие повторяются до max_attempts раз.
+    """
+
+    def __init__(self, batch_size: int, max_attempts: int, poll_interval: float = 5.0):
+        self.batch_size = max(1, batch_size)
+        self.max_attempts = max(1, max_attempts)
+        self.poll_interval = poll_interval
+        self._bot: Optional[Bot] = None
+        self._handler: Optional[EventHandler] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._running: Set[asyncio.Task] = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stats = {'received': 0, 'duplicates': 0, 'done': 0, 'retried': 0, 'failed': 0, 'queued': 0}
+
+    async def start(self, bot: Bot, handler: EventHandler) -> None:
+        """Запускает обработку (однократно); события, прерванные перезапуском, возвращаются в очередь."""
+        if self._dispatcher is not None and not self._dispatcher.done():
+            return
+        self._bot, self._handler = bot, handler
+        self._wakeup = asyncio.Event()
+        await requeue_running_payment_events()
+        self._dispatcher = asyncio.create_task(self._dispatch_loop())
+        logger.info("Очередь событий оплаты запущена")
+
+    async def stop(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+
+    async def submit(self, payment_id: str, event: str, payload: str) -> bool:
+        """Сохраняет событие webhook; False для повторной доставки."""
+        created = await save_payment_event(payment_id, event, payload)
+        if not created:
+            self._stats['duplicates'] += 1
+            logger.info(f"Повторный webhook для платежа {payment_id} отклонён")
+            return False
+        self._stats['received'] += 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return True
+
+    async def _dispatch_loop(self) -> None:
+        while True:
+            try:
+                self._wakeup.clear()
+                free = self.batch_size - len(self._running)
+                if free > 0:
+                    for event in await claim_payment_events(free):
+                        task = asyncio.create_task(self._run_event(event))
+                        self._running.add(task)
+                        task.add_done_callback(self._on_event_done)
+                self._stats['queued'] = await get_payment_events_depth()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка диспетчера событий оплаты: {e}", exc_info=True)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def _on_event_done(self, task: asyncio.Task) -> None:
+        self._running.discard(task)
+        self._wakeup.set()
+
+    async def _run_event(self, event: Dict[str, Any]) -> None:
+        payment_id = event['payment_id']
+        try:
+            # Обработчик сам отмечает событие в транзакции проведения платежа
+            await self._handler(self._bot, event)
+            self._stats['done'] += 1
+        except PaymentEventRejected as e:
+            logger.error(f"Событие оплаты {payment_id} отклонено: {e}")
+            await finish_payment_event(payment_id, 'failed', str(e)[:500])
+            self._stats['failed'] += 1
+        except Exception as e:
+            logger.error(f"Ошибка обработки события оплаты {payment_id} (попытка {event['attempts']}): {e}", exc_info=True)
+            await asyncio.sleep(min(60, 2 ** event['attempts']))
+            status = await finish_payment_event(payment_id, 'failed', str(e)[:500], self.max_attempts)
+            self._stats['retried' if status == 'queued' else 'failed'] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Число полученных, повторных и обработанных событий оплаты."""
+        stats = dict(self._stats)
+        stats['running'] = len(self._running)
+        return stats
+
+
+payment_queue = PaymentEventQueue(batch_size=PAYMENT_EVENT_BATCH_SIZE, max_attempts=PAYMENT_EVENT_MAX_ATTEMPTS)
+
+
+def get_payment_queue_stats() -> Dict[str, Any]:
+    """Метрики очереди событий оплаты."""
+    return payment_queue.get_stats()
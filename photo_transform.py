@@ -3,8 +3,6 @@
 PixelPie AI - Фото Преображение
 """
 
-import replicate
-import asyncio
 import aiohttp
 import os
 import logging
@@ -15,6 +13,7 @@ from PIL import Image
 import io
 
 from logger import get_logger
+from replicate_client import replicate_client
 logger = get_logger('generation')
 
 class PhotoTransformGenerator:
@@ -99,9 +98,6 @@ class PhotoTransformGenerator:
             "720p": "720p"
         }
 
-        # Клиент Replicate
-        self.client = replicate.Client(api_token=replicate_api_key)
-
     async def generate_image(self, image_bytes: bytes, style: str, user_id: int, aspect_ratio: str = "3:4", resolution: str = "720p") -> Dict[str, Any]:
         """
         Генерация изображения в выбранном стиле с поддержкой aspect_ratio
@@ -162,22 +158,13 @@ class PhotoTransformGenerator:
             # Создаем prediction
             logger.info(f"Создание prediction для модели {style_config['model']}")
 
-            prediction = await asyncio.to_thread(
-                self.client.predictions.create,
-                model=style_config['model'],
-                input=input_params
-            )
+            prediction = await replicate_client.create_prediction(style_config['model'], input_params)
 
             logger.info(f"Prediction создан: {prediction.id}")
 
-            # Ждем завершения
-            while prediction.status not in ["succeeded", "failed", "canceled"]:
-                await asyncio.sleep(2)
-                prediction = await asyncio.to_thread(
-                    self.client.predictions.get,
-                    prediction.id
-                )
-                logger.info(f"Статус: {prediction.status}")
+            # Ждем завершения (webhook или опрос с растущим интервалом)
+            prediction = await replicate_client.wait(prediction)
+            logger.info(f"Статус: {prediction.status}")
 
             if prediction.status == "succeeded":
                 output_url = prediction.output
@@ -0,0 +1,53 @@
+import hashlib
+import re
+from functools import lru_cache
+from typing import Dict, Iterable, Mapping
+
+
+class KeywordMatcher:
+    """Признаки промпта по спискам ключевых слов за один проход.
+
+    Все ключевые слова собраны в одно регулярное выражение; каждое совпадение
+    даёт битовую маску признаков, так что вместо десятков проверок
+    `any(k in text for k in keywords)` текст сканируется один раз.
+    Семантика та же, что у проверки подстрокой: "ring" находится и в "earring".
+    """
+
+    def __init__(self, features: Mapping[str, Iterable[str]], cache_size: int = 4096):
+        self.bits: Dict[str, int] = {name: 1 << i for i, name in enumerate(features)}
+        keyword_bits: Dict[str, int] = {}
+        for name, keywords in features.items():
+            for keyword in keywords:
+                keyword_bits[keyword] = keyword_bits.get(keyword, 0) | self.bits[name]
+        # Вхождение слова означает и вхождение всех его подстрок-ключей
+        self._masks: Dict[str, int] = {
+            keyword: _or_bits(bits for other, bits in keyword_bits.items() if other in keyword)
+            for keyword in keyword_bits
+        }
+        # Опережающая проверка находит самое длинное слово с каждой позиции текста
+        alternation = "|".join(re.escape(k) for k in sorted(keyword_bits, key=len, reverse=True))
+        self._pattern = re.compile(f"(?=({alternation}))") if keyword_bits else None
+        self.mask = lru_cache(maxsize=cache_size)(self._scan)
+
+    def _scan(self, text: str) -> int:
+        if self._pattern is None:
+            return 0
+        return _or_bits(self._masks[m.group(1)] for m in self._pattern.finditer(text))
+
+    def has(self, text: str, *names: str) -> bool:
+        """Есть ли в тексте хотя бы один из признаков."""
+        mask = self.mask(text)
+        return any(mask & self.bits[name] for name in names)
+
+
+def _or_bits(values: Iterable[int]) -> int:
+    result = 0
+    for value in values:
+        result |= value
+    return result
+
+
+@lru_cache(maxsize=4096)
+def stable_hash(key: str) -> int:
+    """Детерминированный хэш строки (SHA-256), вычисляется один раз на ключ."""
+    return int(hashlib.sha256(key.encode("utf-8")).hexdigest(), 16)
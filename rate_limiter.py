@@ -0,0 +1,58 @@
+import asyncio
+import time
+from typing import Any, Dict
+
+from logger import get_logger
+
+logger = get_logger('main')
+
+
+class TokenBucket:
+    """Ограничитель частоты: не более rate операций в секунду с запасом capacity.
+
+    pause() останавливает всех ожидающих (например, после RetryAfter от Telegram).
+    """
+
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = max(rate, 0.001)
+        self.capacity = max(1, capacity)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+        self._stats = {'acquired': 0, 'waited': 0.0, 'pauses': 0}
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self) -> None:
+        """Ждёт свободный токен."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                else:
+                    self._refill(now)
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        self._stats['acquired'] += 1
+                        return
+                    delay = (1 - self._tokens) / self.rate
+                self._stats['waited'] += delay
+                await asyncio.sleep(delay)
+
+    def pause(self, seconds: float) -> None:
+        """Приостанавливает выдачу токенов на seconds секунд."""
+        until = time.monotonic() + seconds
+        if until > self._paused_until:
+            self._paused_until = until
+            self._tokens = 0.0
+            self._updated = until
+            self._stats['pauses'] += 1
+            logger.warning(f"Отправка приостановлена на {seconds} сек")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Счётчики выданных токенов, суммарного ожидания и пауз."""
+        return dict(self._stats)
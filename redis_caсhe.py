@@ -1,54 +1,285 @@
 import redis.asyncio as redis
+import asyncio
 import json
-from typing import Optional, Dict, Any
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Tuple
+
+from logger import get_logger
+
+logger = get_logger('database')
+
+# Канал, через который процессы бота сообщают друг другу об изменённых ключах
+INVALIDATION_CHANNEL = "cache:invalidate"
+
+
+class _InvalidationListener:
+    """Подписка на канал инвалидации: сбрасывает L1 всех кэшей при изменении ключа в другом процессе."""
+
+    def __init__(self):
+        self.instance_id = uuid.uuid4().hex
+        self._caches: Dict[Tuple[int, str], "RedisCacheBase"] = {}
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    def register(self, cache: "RedisCacheBase") -> None:
+        self._caches[(id(cache.redis), cache.prefix)] = cache
+
+    def ensure_started(self, redis_client: redis.Redis) -> None:
+        """Запускает слушателя для клиента Redis в текущем event loop (однократно)."""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        task = self._tasks.get(id(redis_client))
+        if task is not None and not task.done() and task.get_loop() is loop:
+            return
+        self._tasks[id(redis_client)] = loop.create_task(self._listen(redis_client))
+
+    def _drop_all(self, redis_client: redis.Redis) -> None:
+        for (client_id, _), cache in self._caches.items():
+            if client_id == id(redis_client):
+                cache.clear_local()
+
+    async def _listen(self, redis_client: redis.Redis) -> None:
+        while True:
+            pubsub = redis_client.pubsub()
+            try:
+                await pubsub.subscribe(INVALIDATION_CHANNEL)
+                # Пока не были подписаны, могли пропустить сообщения
+                self._drop_all(redis_client)
+                async for message in pubsub.listen():
+                    if message.get('type') != 'message':
+                        continue
+                    payload = message['data']
+                    if isinstance(payload, bytes):
+                        payload = payload.decode()
+                    sender, _, key = payload.partition('|')
+                    if sender == self.instance_id:
+                        continue
+                    prefix, _, entity_id = key.rpartition(':')
+                    cache = self._caches.get((id(redis_client), prefix))
+                    if cache is not None:
+                        cache.forget_local(entity_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Подписка на инвалидацию кэша прервана: {e}")
+                self._drop_all(redis_client)
+                await asyncio.sleep(5)
+            finally:
+                try:
+                    await pubsub.close()
+                except Exception:
+                    pass
+
+
+_listener = _InvalidationListener()
+
+
+class JsonCodec:
+    """Сериализация значений кэша в JSON (по умолчанию)."""
+
+    @staticmethod
+    def dumps(data: Any) -> str:
+        return json.dumps(data)
+
+    @staticmethod
+    def loads(raw: Any) -> Any:
+        return json.loads(raw)
+
 
 class RedisCacheBase:
-    """Базовый класс для всех кэшей с общими методами."""
-    def __init__(self, redis_client: redis.Redis, prefix: str, ttl: int = 300):
+    """Базовый класс для всех кэшей с общими методами.
+
+    Перед Redis стоит локальный LRU-кэш (L1) с TTL; изменения рассылаются
+    другим процессам через pub/sub. Без Redis работает только L1.
+    """
+    def __init__(self, redis_client: Optional[redis.Redis], prefix: str, ttl: int = 300, local_size: int = 5000, codec: Any = JsonCodec):
         self.redis = redis_client
         self.prefix = prefix  # Например, "user", "model", "cooldown"
         self.ttl = ttl
+        self.local_size = local_size
+        self.codec = codec  # Объект с методами dumps/loads
+        self._local: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self.stats = {'local_hits': 0, 'redis_hits': 0, 'misses': 0}
+        if self.redis is not None:
+            _listener.register(self)
+
+    def _local_get(self, entity_id: int) -> Tuple[bool, Any]:
+        key = str(entity_id)
+        entry = self._local.get(key)
+        if entry is None:
+            return False, None
+        expires_at, data = entry
+        if expires_at < time.monotonic():
+            del self._local[key]
+            return False, None
+        self._local.move_to_end(key)
+        return True, data
+
+    def _local_put(self, entity_id: int, data: Any) -> None:
+        key = str(entity_id)
+        self._local[key] = (time.monotonic() + self.ttl, data)
+        self._local.move_to_end(key)
+        while len(self._local) > self.local_size:
+            self._local.popitem(last=False)
+
+    def forget_local(self, entity_id: Any) -> None:
+        """Удаляет запись из L1 (без обращения к Redis)."""
+        self._local.pop(str(entity_id), None)
+
+    def clear_local(self) -> None:
+        """Полностью очищает L1."""
+        self._local.clear()
+
+    async def _publish(self, entity_id: int) -> None:
+        try:
+            await self.redis.publish(INVALIDATION_CHANNEL, f"{_listener.instance_id}|{self.prefix}:{entity_id}")
+        except Exception:
+            pass
 
     async def get(self, entity_id: int) -> Optional[Dict[str, Any]]:
+        found, data = self._local_get(entity_id)
+        if found:
+            self.stats['local_hits'] += 1
+            return data
         if self.redis is None:
+            self.stats['misses'] += 1
             return None
+        _listener.ensure_started(self.redis)
         try:
             raw = await self.redis.get(f"{self.prefix}:{entity_id}")
-            return json.loads(raw) if raw else None
+            data = self.codec.loads(raw) if raw else None
         except Exception:
+            data = None
+        if data is None:
+            self.stats['misses'] += 1
             return None
+        self.stats['redis_hits'] += 1
+        self._local_put(entity_id, data)
+        return data
 
     async def set(self, entity_id: int, data: Dict[str, Any]):
+        payload = self.codec.dumps(data)
+        # В L1 кладём то же, что вернёт чтение из Redis (для JSON кортежи становятся списками)
+        self._local_put(entity_id, self.codec.loads(payload))
         if self.redis is None:
             return
+        _listener.ensure_started(self.redis)
         try:
             await self.redis.set(
                 f"{self.prefix}:{entity_id}",
-                json.dumps(data),
+                payload,
                 ex=self.ttl
             )
+            await self._publish(entity_id)
         except Exception:
             pass
 
     async def delete(self, entity_id: int):
+        self.forget_local(entity_id)
         if self.redis is None:
             return
         try:
             await self.redis.delete(f"{self.prefix}:{entity_id}")
+            await self._publish(entity_id)
         except Exception:
             pass
 
+    def get_stats(self) -> Dict[str, Any]:
+        """Счётчики попаданий L1/Redis и промахов."""
+        stats = dict(self.stats)
+        stats['local_size'] = len(self._local)
+        lookups = stats['local_hits'] + stats['redis_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['local_hits'] + stats['redis_hits']) / lookups if lookups else 0.0
+        return stats
+
 
 class RedisUserCache(RedisCacheBase):
-    """Кэш данных пользователя."""
-    def __init__(self, redis_client: redis.Redis, ttl: int = 300):
-        super().__init__(redis_client, "user", ttl)
+    """Кэш данных пользователя с версиями: запись устаревшей версии отклоняется."""
+
+    # Пишем значение, только если его версия не меньше текущего счётчика версий
+    _SET_IF_CURRENT = """
+local current = tonumber(redis.call('GET', KEYS[2]) or '0')
+if tonumber(ARGV[1]) < current then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+    def __init__(self, redis_client: Optional[redis.Redis], ttl: int = 300, local_size: int = 5000, codec: Any = JsonCodec):
+        super().__init__(redis_client, "user", ttl, local_size, codec)
+        self.stats.update({'stale': 0, 'writes': 0})
+        # Версии без Redis хранятся локально
+        self._local_versions: "OrderedDict[str, int]" = OrderedDict()
+
+    def _version_key(self, entity_id: int) -> str:
+        return f"{self.prefix}:ver:{entity_id}"
+
+    async def current_version(self, entity_id: int) -> int:
+        """Текущая версия записи; читается до обращения к БД."""
+        if self.redis is None:
+            return self._local_versions.get(str(entity_id), 0)
+        try:
+            raw = await self.redis.get(self._version_key(entity_id))
+            return int(raw) if raw else 0
+        except Exception:
+            return 0
+
+    async def bump_version(self, entity_id: int) -> int:
+        """Увеличивает версию записи: все ранее начатые чтения становятся устаревшими."""
+        if self.redis is None:
+            key = str(entity_id)
+            version = self._local_versions.pop(key, 0) + 1
+            self._local_versions[key] = version
+            while len(self._local_versions) > self.local_size:
+                self._local_versions.popitem(last=False)
+            return version
+        try:
+            key = self._version_key(entity_id)
+            version = await self.redis.incr(key)
+            await self.redis.expire(key, self.ttl * 2)
+            return int(version)
+        except Exception:
+            return 0
+
+    async def set(self, entity_id: int, data: Any, version: Optional[int] = None) -> bool:
+        """Сохраняет данные, если версия не устарела; без версии пишет как текущую."""
+        if version is None:
+            version = await self.current_version(entity_id)
+        payload = self.codec.dumps(data)
+        if self.redis is None:
+            stored = version >= self._local_versions.get(str(entity_id), 0)
+        else:
+            _listener.ensure_started(self.redis)
+            try:
+                stored = await self.redis.eval(
+                    self._SET_IF_CURRENT, 2,
+                    f"{self.prefix}:{entity_id}", self._version_key(entity_id),
+                    version, payload, self.ttl
+                )
+            except Exception:
+                return False
+        if not stored:
+            self.stats['stale'] += 1
+            return False
+        self.stats['writes'] += 1
+        self._local_put(entity_id, self.codec.loads(payload))
+        if self.redis is not None:
+            await self._publish(entity_id)
+        return True
+
+    async def delete(self, entity_id: int):
+        await self.bump_version(entity_id)
+        await super().delete(entity_id)
 
 
 class RedisActiveModelCache(RedisCacheBase):
     """Кэш активной модели пользователя."""
-    def __init__(self, redis_client: redis.Redis, ttl: int = 300):
-        super().__init__(redis_client, "model", ttl)
+    def __init__(self, redis_client: Optional[redis.Redis], ttl: int = 300, local_size: int = 5000):
+        super().__init__(redis_client, "model", ttl, local_size)
 
 
 class RedisUserCooldown:
@@ -76,5 +307,23 @@ class RedisUserCooldown:
 
 class RedisGenParamsCache(RedisCacheBase):
     """Кэш параметров генерации."""
-    def __init__(self, redis_client: redis.Redis, ttl: int = 300):
-        super().__init__(redis_client, "params", ttl)
+    def __init__(self, redis_client: Optional[redis.Redis], ttl: int = 300, local_size: int = 5000):
+        super().__init__(redis_client, "params", ttl, local_size)
+
+
+class RedisResultCache(RedisCacheBase):
+    """Кэш результатов генераций: file_id отправленных в Telegram файлов по id генерации."""
+    def __init__(self, redis_client: Optional[redis.Redis], ttl: int = 604800, local_size: int = 5000):
+        super().__init__(redis_client, "result", ttl, local_size)
+
+
+class RedisPromptAssistCache(RedisCacheBase):
+    """Кэш промптов Llama по нормализованной идее пользователя, полу и типу генерации."""
+    def __init__(self, redis_client: Optional[redis.Redis], ttl: int = 259200, local_size: int = 5000):
+        super().__init__(redis_client, "llama", ttl, local_size)
+
+
+class RedisPaymentLinkCache(RedisCacheBase):
+    """Кэш ссылок на оплату по пользователю и тарифу: повторные нажатия не создают новых платежей."""
+    def __init__(self, redis_client: Optional[redis.Redis], ttl: int = 600, local_size: int = 5000):
+        super().__init__(redis_client, "paylink", ttl, local_size)
@@ -0,0 +1,329 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Union
+
+import aiohttp
+from replicate.exceptions import ReplicateError
+
+from config import (
+    REPLICATE_API_TOKEN, REPLICATE_HTTP_CONNECTIONS, REPLICATE_POLL_MIN_INTERVAL,
+    REPLICATE_POLL_MAX_INTERVAL, REPLICATE_WEBHOOK_URL, REPLICATE_WEBHOOK_SECRET
+)
+from logger import get_logger
+
+logger = get_logger('generation')
+
+_VERSION_ID = re.compile(r'^[0-9a-f]{64}$')
+TERMINAL_STATUSES = ('succeeded', 'failed', 'canceled')
+# Webhook, пришедшие раньше, чем ожидатель зарегистрирован: сколько и как долго хранить
+EARLY_WEBHOOKS_MAX = 1000
+EARLY_WEBHOOKS_TTL = 600.0
+
+
+class ReplicateAPIError(ReplicateError):
+    """Ошибка HTTP API Replicate или неуспешное завершение предсказания."""
+
+    def __init__(self, message: str, status: Optional[int] = None, prediction: Optional["Prediction"] = None):
+        Exception.__init__(self, message)
+        self.message = message
+        self.status = status
+        self.prediction = prediction
+
+    def __str__(self) -> str:
+        return self.message
+
+
+class Prediction(NamedTuple):
+    """Состояние предсказания (или обучения) Replicate."""
+    id: str
+    status: str
+    output: Any = None
+    error: Any = None
+    logs: Optional[str] = None
+    metrics: Optional[Dict[str, Any]] = None
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> "Prediction":
+        return cls(
+            id=data.get('id'),
+            status=data.get('status'),
+            output=data.get('output'),
+            error=data.get('error'),
+            logs=data.get('logs'),
+            metrics=data.get('metrics'),
+        )
+
+    @property
+    def done(self) -> bool:
+        return self.status in TERMINAL_STATUSES
+
+
+class AsyncReplicateClient:
+    """Асинхронный клиент Replicate поверх общей aiohttp-сессии.
+
+    Предсказания создаются и опрашиваются без потоков: ожидание идёт через
+    webhook (если заданы REPLICATE_WEBHOOK_URL и REPLICATE_WEBHOOK_SECRET)
+    с редким контрольным опросом либо через опрос с растущим интервалом.
+    """
+
+    BASE_URL = "https://api.replicate.com/v1"
+
+    def __init__(self, api_token: Optional[str], max_connections: int = 100,
+                 poll_min_interval: float = 0.5, poll_max_interval: float = 5.0,
+                 webhook_url: Optional[str] = None, webhook_secret: Optional[str] = None):
+        self.api_token = api_token
+        self.max_connections = max_connections
+        self.poll_min_interval = poll_min_interval
+        self.poll_max_interval = max(poll_max_interval, poll_min_interval)
+        self.webhook_url = webhook_url or None
+        self.webhook_secret = webhook_secret or None
+        if self.webhook_url and not self.webhook_secret:
+            # Без секрета любой может завершить чужое предсказание поддельным webhook
+            logger.warning("REPLICATE_WEBHOOK_URL задан без REPLICATE_WEBHOOK_SECRET: webhook отключены, используется опрос")
+            self.webhook_url = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._session_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._waiters: Dict[str, asyncio.Future] = {}
+        self._early: "OrderedDict[str, Tuple[float, Prediction]]" = OrderedDict()
+        self._stats = {'requests': 0, 'polls': 0, 'webhooks': 0, 'early_webhooks': 0, 'rate_limited': 0, 'errors': 0}
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop is not loop:
+            self._session_loop = loop
+            self._session = aiohttp.ClientSession(
+                headers={'Authorization': f"Bearer {self.api_token}"},
+                connector=aiohttp.TCPConnector(limit=self.max_connections, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(total=120, connect=15),
+            )
+        return self._session
+
+    async def _request(self, method: str, path: str, **kwargs) -> Dict[str, Any]:
+        """HTTP-запрос к API; при 429 ждёт Retry-After и повторяет."""
+        session = await self._get_session()
+        for attempt in range(5):
+            self._stats['requests'] += 1
+            async with session.request(method, f"{self.BASE_URL}/{path}", **kwargs) as response:
+                if response.status == 429:
+                    self._stats['rate_limited'] += 1
+                    delay = float(response.headers.get('Retry-After') or 2 ** attempt)
+                    logger.warning(f"Replicate: превышен лимит запросов, повтор через {delay} сек")
+                    await asyncio.sleep(delay)
+                    continue
+                if response.status >= 400:
+                    self._stats['errors'] += 1
+                    try:
+                        body = await response.json(content_type=None)
+                        detail = body.get('detail') or body.get('title') or body
+                    except Exception:
+                        detail = await response.text()
+                    raise ReplicateAPIError(f"Replicate API {method} {path}: HTTP {response.status} - {detail}", status=response.status)
+                return await response.json(content_type=None)
+        raise ReplicateAPIError(f"Replicate API {method} {path}: превышен лимит запросов", status=429)
+
+    def _webhook_fields(self, webhook: bool) -> Dict[str, Any]:
+        if not (webhook and self.webhook_url):
+            return {}
+        return {'webhook': self.webhook_url, 'webhook_events_filter': ['completed']}
+
+    async def create_prediction(self, model: str, input: Dict[str, Any], webhook: bool = True) -> Prediction:
+        """Создаёт предсказание. model: 'owner/name', 'owner/name:version' или id версии."""
+        payload: Dict[str, Any] = {'input': input, **self._webhook_fields(webhook)}
+        if ':' in model:
+            payload['version'] = model.split(':', 1)[1]
+            data = await self._request('POST', 'predictions', json=payload)
+        elif _VERSION_ID.match(model):
+            payload['version'] = model
+            data = await self._request('POST', 'predictions', json=payload)
+        else:
+            data = await self._request('POST', f"models/{model}/predictions", json=payload)
+        return Prediction.from_json(data)
+
+    async def get_prediction(self, prediction_id: str) -> Prediction:
+        return Prediction.from_json(await self._request('GET', f"predictions/{prediction_id}"))
+
+    async def cancel_prediction(self, prediction_id: str) -> Prediction:
+        return Prediction.from_json(await self._request('POST', f"predictions/{prediction_id}/cancel"))
+
+    async def create_training(self, model_version: str, destination: str, input: Dict[str, Any],
+                              webhook: bool = True) -> Prediction:
+        """Запускает обучение. model_version: 'owner/name:version'."""
+        model, _, version = model_version.partition(':')
+        data = await self._request(
+            'POST', f"models/{model}/versions/{version}/trainings",
+            json={'destination': destination, 'input': input, **self._webhook_fields(webhook)}
+        )
+        return Prediction.from_json(data)
+
+    async def get_training(self, training_id: str) -> Prediction:
+        return Prediction.from_json(await self._request('GET', f"trainings/{training_id}"))
+
+    async def list_recent(self, kind: str = 'predictions') -> List[Prediction]:
+        """Первая страница последних предсказаний ('predictions') или обучений ('trainings')."""
+        data = await self._request('GET', kind)
+        return [Prediction.from_json(item) for item in data.get('results') or []]
+
+    async def get_latest_version(self, model: str) -> Optional[str]:
+        """Id последней версии модели 'owner/name'."""
+        data = await self._request('GET', f"models/{model}")
+        return (data.get('latest_version') or {}).get('id')
+
+    async def upload_file(self, file: Union[str, bytes], filename: str = 'file', content_type: str = 'application/octet-stream') -> str:
+        """Загружает файл (путь или байты) в Replicate Files и возвращает URL для скачивания."""
+        if isinstance(file, str):
+            filename = os.path.basename(file)
+            with open(file, 'rb') as f:
+                file = await asyncio.to_thread(f.read)
+        form = aiohttp.FormData()
+        form.add_field('content', file, filename=filename, content_type=content_type)
+        data = await self._request('POST', 'files', data=form)
+        url = (data.get('urls') or {}).get('get')
+        if not url:
+            raise ReplicateAPIError("Replicate не вернул URL загруженного файла")
+        return url
+
+    async def wait(self, prediction: Prediction, timeout: Optional[float] = None) -> Prediction:
+        """Ждёт завершения предсказания: по webhook или опросом с растущим интервалом.
+
+        Webhook может прийти, пока create_prediction ещё ждёт ответа API, то есть
+        до регистрации ожидателя; такие уведомления handle_webhook сохраняет,
+        и wait() забирает их сразу, не дожидаясь контрольного опроса.
+        """
+        deadline = time.monotonic() + timeout if timeout else None
+        interval = self.poll_min_interval
+        waiter = None
+        if self.webhook_url and not prediction.done:
+            waiter = self.watch(prediction.id)
+        try:
+            while not prediction.done:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise asyncio.TimeoutError(f"Предсказание {prediction.id} не завершилось за {timeout} сек")
+                if waiter is not None:
+                    # Webhook придёт сам; редкий опрос страхует от потерянных уведомлений
+                    delay = self.poll_max_interval * 6
+                    if deadline is not None:
+                        delay = min(delay, max(0.0, deadline - time.monotonic()))
+                    try:
+                        prediction = await asyncio.wait_for(asyncio.shield(waiter), timeout=delay)
+                        continue
+                    except asyncio.TimeoutError:
+                        pass
+                else:
+                    await asyncio.sleep(interval)
+                    interval = min(interval * 1.5, self.poll_max_interval)
+                self._stats['polls'] += 1
+                prediction = await self.get_prediction(prediction.id)
+            return prediction
+        finally:
+            self._waiters.pop(prediction.id, None)
+
+    async def run(self, model: str, input: Dict[str, Any], timeout: Optional[float] = 900) -> Any:
+        """Создаёт предсказание, дожидается его и возвращает output."""
+        prediction = await self.create_prediction(model, input)
+        prediction = await self.wait(prediction, timeout=timeout)
+        if prediction.status != 'succeeded':
+            raise ReplicateAPIError(
+                f"Предсказание {prediction.id} модели {model} завершилось со статусом {prediction.status}: {prediction.error}",
+                prediction=prediction
+            )
+        return prediction.output
+
+    def watch(self, prediction_id: str) -> asyncio.Future:
+        """Future, которое завершит webhook этого предсказания (для отслеживания без wait())."""
+        waiter = self._waiters.get(prediction_id)
+        if waiter is None:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters[prediction_id] = waiter
+            early = self._early.pop(prediction_id, None)
+            if early is not None:
+                waiter.set_result(early[1])
+        return waiter
+
+    def unwatch(self, prediction_id: str) -> None:
+        waiter = self._waiters.pop(prediction_id, None)
+        if waiter is not None and not waiter.done():
+            waiter.cancel()
+
+    def verify_webhook(self, headers: Any, body: bytes) -> bool:
+        """Проверяет подпись webhook Replicate; без REPLICATE_WEBHOOK_SECRET webhook отклоняются."""
+        if not self.webhook_secret:
+            return False
+        webhook_id = headers.get('webhook-id')
+        timestamp = headers.get('webhook-timestamp')
+        signatures = headers.get('webhook-signature')
+        if not (webhook_id and timestamp and signatures):
+            return False
+        try:
+            if abs(time.time() - int(timestamp)) > 300:
+                return False
+        except ValueError:
+            return False
+        secret = base64.b64decode(self.webhook_secret.split('_', 1)[-1])
+        signed = f"{webhook_id}.{timestamp}.".encode() + body
+        expected = base64.b64encode(hmac.new(secret, signed, hashlib.sha256).digest()).decode()
+        return any(
+            hmac.compare_digest(expected, signature.split(',', 1)[-1])
+            for signature in signatures.split()
+        )
+
+    def handle_webhook(self, payload: Dict[str, Any]) -> bool:
+        """Передаёт результат из webhook ожидающему wait(); возвращает True, если его ждали.
+
+        Завершённое предсказание, которое ещё никто не ждёт, сохраняется на
+        EARLY_WEBHOOKS_TTL секунд для wait()/watch().
+        """
+        prediction = Prediction.from_json(payload)
+        self._stats['webhooks'] += 1
+        if not prediction.done:
+            return False
+        waiter = self._waiters.get(prediction.id)
+        if waiter is None:
+            self._remember_early(prediction)
+            return False
+        if waiter.done():
+            return False
+        waiter.set_result(prediction)
+        return True
+
+    def _remember_early(self, prediction: Prediction) -> None:
+        now = time.monotonic()
+        while self._early:
+            oldest_id, (received, _) = next(iter(self._early.items()))
+            if now - received < EARLY_WEBHOOKS_TTL and len(self._early) < EARLY_WEBHOOKS_MAX:
+                break
+            del self._early[oldest_id]
+        self._early[prediction.id] = (now, prediction)
+        self._stats['early_webhooks'] += 1
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Счётчики запросов, опросов и webhook."""
+        stats = dict(self._stats)
+        stats['waiting'] = len(self._waiters)
+        stats['early_buffered'] = len(self._early)
+        return stats
+
+
+replicate_client = AsyncReplicateClient(
+    REPLICATE_API_TOKEN,
+    max_connections=REPLICATE_HTTP_CONNECTIONS,
+    poll_min_interval=REPLICATE_POLL_MIN_INTERVAL,
+    poll_max_interval=REPLICATE_POLL_MAX_INTERVAL,
+    webhook_url=REPLICATE_WEBHOOK_URL,
+    webhook_secret=REPLICATE_WEBHOOK_SECRET,
+)
+
+
+def get_replicate_stats() -> Dict[str, Any]:
+    """Метрики клиента Replicate."""
+    return replicate_client.get_stats()
@@ -1,170 +1,189 @@
 import asyncio
+import multiprocessing
 import os
+import queue
+import sqlite3
 import tempfile
-from datetime import datetime, timedelta
-from typing import List, Dict, Any, Optional
-import pandas as pd
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
 from aiogram import Bot
 from aiogram.types import FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton
-import sqlite3
-import logging
+from openpyxl import Workbook
 
+from config import DATABASE_PATH, REPORT_WORKERS, REPORT_PAGE_SIZE, REPORT_WIDTH_SAMPLE_ROWS, REPORT_PROGRESS_INTERVAL
+from excel_utils import write_sheet
 from logger import get_logger
+from tariffs import tariff_registry
 logger = get_logger('main')
 
-class ReportGenerator:
-    def __init__(self, db_path: str = "users.db"):
-        self.db_path = db_path
+ProgressCallback = Callable[[str, int, int], Awaitable[None]]
 
-    def get_db_connection(self):
-        """Создает соединение с базой данных"""
-        return sqlite3.connect(self.db_path)
+PAYMENT_STATUSES = {'pending': 'В ожидании', 'completed': 'Завершен', 'failed': 'Ошибка'}
+REFERRAL_STATUSES = {'pending': 'В ожидании', 'completed': 'Завершен'}
 
-    async def create_users_report(self) -> str:
-        """Создает отчет по пользователям"""
-        try:
-            conn = self.get_db_connection()
-            query = """
-            SELECT
-                user_id,
-                username,
-                first_name,
-                generations_left,
-                avatar_left,
-                has_trained_model,
-                is_notified,
-                first_purchase,
-                email,
-                active_avatar_id,
-                referrer_id,
-                is_blocked,
-                block_reason,
-                welcome_message_sent,
-                last_reminder_type,
-                last_reminder_sent,
-                utm_source,
-                created_at,
-                updated_at
-            FROM users
-            ORDER BY created_at DESC
-            """
-
-            df = pd.read_sql_query(query, conn)
-            conn.close()
-
-            # Переименовываем колонки на русский
-            column_mapping = {
-                'user_id': 'ID пользователя',
-                'username': 'Имя пользователя',
-                'first_name': 'Имя',
-                'generations_left': 'Осталось генераций',
-                'avatar_left': 'Осталось аватаров',
-                'has_trained_model': 'Есть обученная модель',
-                'is_notified': 'Уведомления включены',
-                'first_purchase': 'Первая покупка',
-                'email': 'Email',
-                'active_avatar_id': 'ID активного аватара',
-                'referrer_id': 'ID пригласившего',
-                'is_blocked': 'Заблокирован',
-                'block_reason': 'Причина блокировки',
-                'welcome_message_sent': 'Приветствие отправлено',
-                'last_reminder_type': 'Тип последнего напоминания',
-                'last_reminder_sent': 'Последнее напоминание',
-                'utm_source': 'UTM источник',
-                'created_at': 'Дата регистрации',
-                'updated_at': 'Последнее обновление',
-            }
-
-            df = df.rename(columns=column_mapping)
-
-            # Преобразуем булевы значения (с проверкой наличия колонок)
-            boolean_columns = {
-                'Есть обученная модель': 'Есть обученная модель',
-                'Уведомления включены': 'Уведомления включены',
-                'Первая покупка': 'Первая покупка',
-                'Заблокирован': 'Заблокирован',
-                'Приветствие отправлено': 'Приветствие отправлено'
-            }
-
-            for col_name, col_key in boolean_columns.items():
-                if col_key in df.columns:
-                    df[col_name] = df[col_name].map({1: 'Да', 0: 'Нет'})
-                else:
-                    logger.warning(f"Колонка {col_key} отсутствует в отчете пользователей")
-
-            # Сохраняем в Excel
-            filename = f"users_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-            filepath = os.path.join(tempfile.gettempdir(), filename)
-
-            with pd.ExcelWriter(filepath, engine='openpyxl') as writer:
-                df.to_excel(writer, sheet_name='Пользователи', index=False)
-
-                # Автоматически подгоняем ширину колонок
-                worksheet = writer.sheets['Пользователи']
-                for column in worksheet.columns:
-                    max_length = 0
-                    column_letter = column[0].column_letter
-                    for cell in column:
-                        try:
-                            if len(str(cell.value)) > max_length:
-                                max_length = len(str(cell.value))
-                        except:
-                            pass
-                    adjusted_width = min(max_length + 2, 50)
-                    worksheet.column_dimensions[column_letter].width = adjusted_width
-
-            return filepath
+# Преобразования значений ячеек: (значение, строка выборки) -> значение в отчёте.
+# Листы ссылаются на них по имени, чтобы описание отчёта передавалось в процесс-воркер
+_FORMATTERS: Dict[str, Callable[[Any, sqlite3.Row], Any]] = {
+    'bool': lambda value, row: {1: 'Да', 0: 'Нет'}.get(value, value),
+    'payment_status': lambda value, row: PAYMENT_STATUSES.get(value, value),
+    'referral_status': lambda value, row: REFERRAL_STATUSES.get(value, value),
+    'plan': lambda value, row: tariff_registry.display_name(value, row['amount']),
+}
 
-        except Exception as e:
-            logger.error(f"Ошибка создания отчета пользователей: {e}", exc_info=True)
-            raise
+# Очередь прогресса воркеров; задаётся при старте процесса пула
+_progress_queue = None
 
-    async def create_activity_report(self) -> str:
-        """Создает отчет по активности пользователей"""
+
+def _init_worker(progress_queue) -> None:
+    global _progress_queue
+    _progress_queue = progress_queue
+
+
+def _report_progress(job_id: str, sheet: str, total: int, written: int) -> None:
+    if _progress_queue is not None:
         try:
-            conn = self.get_db_connection()
+            _progress_queue.put_nowait((job_id, sheet, written, total))
+        except queue.Full:
+            pass
+
 
-            # Получаем данные о генерациях
-            generation_query = """
+def _iter_rows(cursor: sqlite3.Cursor, formatters: List[Tuple[int, Callable]], page_size: int) -> Iterator[List[Any]]:
+    """Строки выборки страницами по page_size с применёнными преобразованиями."""
+    while True:
+        page = cursor.fetchmany(page_size)
+        if not page:
+            return
+        for row in page:
+            values = list(row)
+            for idx, fmt in formatters:
+                values[idx] = fmt(values[idx], row)
+            yield values
+
+
+def _write_report(db_path: str, filepath: str, sheets: List[Dict[str, Any]], job_id: str,
+                  page_size: int, sample_rows: int) -> int:
+    """Выгружает листы отчёта в XLSX (выполняется в отдельном процессе).
+
+    SQLite читается курсором страницами по page_size строк, книга пишется в
+    write-only режиме: память не зависит от размера таблиц. Число строк для
+    прогресса берётся отдельным запросом count по базовой таблице, без
+    повторного выполнения сортирующей выборки.
+    """
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    conn.row_factory = sqlite3.Row
+    wb = Workbook(write_only=True)
+    total_rows = 0
+    try:
+        for sheet in sheets:
+            title = sheet['title']
+            headers = [header for _, header, _ in sheet['columns']]
+            formatters = [(idx, _FORMATTERS[fmt]) for idx, (_, _, fmt) in enumerate(sheet['columns']) if fmt]
+            expected = conn.execute(sheet['count']).fetchone()[0]
+            _report_progress(job_id, title, expected, 0)
+            total_rows += write_sheet(
+                wb.create_sheet(title), headers,
+                _iter_rows(conn.execute(sheet['query']), formatters, page_size),
+                sample_size=sample_rows, on_rows=partial(_report_progress, job_id, title, expected),
+                chunk_size=page_size
+            )
+        wb.save(filepath)
+    finally:
+        conn.close()
+    return total_rows
+
+
+USERS_SHEETS = [
+    {
+        'title': 'Пользователи',
+        'count': "SELECT COUNT(*) FROM users",
+        'query': """
+            SELECT
+                user_id, username, first_name, generations_left, avatar_left, has_trained_model,
+                is_notified, first_purchase, email, active_avatar_id, referrer_id, is_blocked,
+                block_reason, welcome_message_sent, last_reminder_type, last_reminder_sent,
+                utm_source, created_at, updated_at
+            FROM users
+            ORDER BY created_at DESC
+        """,
+        'columns': [
+            ('user_id', 'ID пользователя', None),
+            ('username', 'Имя пользователя', None),
+            ('first_name', 'Имя', None),
+            ('generations_left', 'Осталось генераций', None),
+            ('avatar_left', 'Осталось аватаров', None),
+            ('has_trained_model', 'Есть обученная модель', 'bool'),
+            ('is_notified', 'Уведомления включены', 'bool'),
+            ('first_purchase', 'Первая покупка', 'bool'),
+            ('email', 'Email', None),
+            ('active_avatar_id', 'ID активного аватара', None),
+            ('referrer_id', 'ID пригласившего', None),
+            ('is_blocked', 'Заблокирован', 'bool'),
+            ('block_reason', 'Причина блокировки', None),
+            ('welcome_message_sent', 'Приветствие отправлено', 'bool'),
+            ('last_reminder_type', 'Тип последнего напоминания', None),
+            ('last_reminder_sent', 'Последнее напоминание', None),
+            ('utm_source', 'UTM источник', None),
+            ('created_at', 'Дата регистрации', None),
+            ('updated_at', 'Последнее обновление', None),
+        ],
+    },
+]
+
+ACTIVITY_SHEETS = [
+    {
+        'title': 'Генерации',
+        'count': "SELECT COUNT(*) FROM generation_log",
+        'query': """
             SELECT
-                gl.user_id,
-                u.username,
-                u.first_name,
-                gl.generation_type,
-                gl.replicate_model_id,
-                gl.units_generated,
-                gl.cost_per_unit,
-                gl.total_cost,
-                gl.style,
-                gl.ratio,
-                gl.created_at
+                gl.user_id, u.username, u.first_name, gl.generation_type, gl.replicate_model_id,
+                gl.units_generated, gl.cost_per_unit, gl.total_cost, gl.style, gl.ratio, gl.created_at
             FROM generation_log gl
             LEFT JOIN users u ON gl.user_id = u.user_id
             ORDER BY gl.created_at DESC
-            """
-
-            df_generations = pd.read_sql_query(generation_query, conn)
-
-            # Получаем данные о действиях пользователей
-            actions_query = """
+        """,
+        'columns': [
+            ('user_id', 'ID пользователя', None),
+            ('username', 'Имя пользователя', None),
+            ('first_name', 'Имя', None),
+            ('generation_type', 'Тип генерации', None),
+            ('replicate_model_id', 'Модель', None),
+            ('units_generated', 'Количество единиц', None),
+            ('cost_per_unit', 'Стоимость за единицу', None),
+            ('total_cost', 'Общая стоимость', None),
+            ('style', 'Стиль', None),
+            ('ratio', 'Соотношение', None),
+            ('created_at', 'Дата генерации', None),
+        ],
+    },
+    {
+        'title': 'Действия',
+        'count': "SELECT COUNT(*) FROM user_actions",
+        'query': """
             SELECT
-                ua.user_id,
-                u.username,
-                u.first_name,
-                ua.action,
-                ua.details,
-                ua.style,
-                ua.ratio,
-                ua.created_at
+                ua.user_id, u.username, u.first_name, ua.action, ua.details, ua.style, ua.ratio, ua.created_at
             FROM user_actions ua
             LEFT JOIN users u ON ua.user_id = u.user_id
             ORDER BY ua.created_at DESC
-            """
-
-            df_actions = pd.read_sql_query(actions_query, conn)
-
-            # Получаем статистику по дням
-            daily_stats_query = """
+        """,
+        'columns': [
+            ('user_id', 'ID пользователя', None),
+            ('username', 'Имя пользователя', None),
+            ('first_name', 'Имя', None),
+            ('action', 'Действие', None),
+            ('details', 'Детали', None),
+            ('style', 'Стиль', None),
+            ('ratio', 'Соотношение', None),
+            ('created_at', 'Дата действия', None),
+        ],
+    },
+    {
+        'title': 'Статистика по дням',
+        'count': "SELECT COUNT(DISTINCT DATE(created_at)) FROM generation_log WHERE created_at >= date('now', '-30 days')",
+        'query': """
             SELECT
                 DATE(gl.created_at) as date,
                 COUNT(DISTINCT gl.user_id) as active_users,
@@ -174,99 +193,42 @@ class ReportGenerator:
             WHERE gl.created_at >= date('now', '-30 days')
             GROUP BY DATE(gl.created_at)
             ORDER BY date DESC
-            """
-
-            df_daily_stats = pd.read_sql_query(daily_stats_query, conn)
-            conn.close()
-
-            # Переименовываем колонки
-            df_generations = df_generations.rename(columns={
-                'user_id': 'ID пользователя',
-                'username': 'Имя пользователя',
-                'first_name': 'Имя',
-                'generation_type': 'Тип генерации',
-                'replicate_model_id': 'Модель',
-                'units_generated': 'Количество единиц',
-                'cost_per_unit': 'Стоимость за единицу',
-                'total_cost': 'Общая стоимость',
-                'style': 'Стиль',
-                'ratio': 'Соотношение',
-                'created_at': 'Дата генерации'
-            })
-
-            df_actions = df_actions.rename(columns={
-                'user_id': 'ID пользователя',
-                'username': 'Имя пользователя',
-                'first_name': 'Имя',
-                'action': 'Действие',
-                'details': 'Детали',
-                'style': 'Стиль',
-                'ratio': 'Соотношение',
-                'created_at': 'Дата действия'
-            })
-
-            df_daily_stats = df_daily_stats.rename(columns={
-                'date': 'Дата',
-                'active_users': 'Активных пользователей',
-                'total_generations': 'Всего генераций',
-                'total_units': 'Всего единиц'
-            })
-
-            # Сохраняем в Excel
-            filename = f"activity_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-            filepath = os.path.join(tempfile.gettempdir(), filename)
-
-            with pd.ExcelWriter(filepath, engine='openpyxl') as writer:
-                df_generations.to_excel(writer, sheet_name='Генерации', index=False)
-                df_actions.to_excel(writer, sheet_name='Действия', index=False)
-                df_daily_stats.to_excel(writer, sheet_name='Статистика по дням', index=False)
-
-                # Автоматически подгоняем ширину колонок для всех листов
-                for sheet_name in writer.sheets:
-                    worksheet = writer.sheets[sheet_name]
-                    for column in worksheet.columns:
-                        max_length = 0
-                        column_letter = column[0].column_letter
-                        for cell in column:
-                            try:
-                                if len(str(cell.value)) > max_length:
-                                    max_length = len(str(cell.value))
-                            except:
-                                pass
-                        adjusted_width = min(max_length + 2, 50)
-                        worksheet.column_dimensions[column_letter].width = adjusted_width
-
-            return filepath
-
-        except Exception as e:
-            logger.error(f"Ошибка создания отчета активности: {e}", exc_info=True)
-            raise
-
-    async def create_payments_report(self) -> str:
-        """Создает отчет по платежам"""
-        try:
-            conn = self.get_db_connection()
-
-                        # Получаем данные о платежах
-            payments_query = """
+        """,
+        'columns': [
+            ('date', 'Дата', None),
+            ('active_users', 'Активных пользователей', None),
+            ('total_generations', 'Всего генераций', None),
+            ('total_units', 'Всего единиц', None),
+        ],
+    },
+]
+
+PAYMENTS_SHEETS = [
+    {
+        'title': 'Платежи',
+        'count': "SELECT COUNT(*) FROM payments",
+        'query': """
             SELECT
-                p.payment_id,
-                p.user_id,
-                u.username,
-                u.first_name,
-                p.plan,
-                p.amount,
-                p.status,
-                p.created_at
+                p.payment_id, p.user_id, u.username, u.first_name, p.plan, p.amount, p.status, p.created_at
             FROM payments p
             LEFT JOIN users u ON p.user_id = u.user_id
             ORDER BY p.created_at DESC
-            """
-
-            df_payments = pd.read_sql_query(payments_query, conn)
-
-            # Получаем статистику платежей
-            payment_stats_query = """
+        """,
+        'columns': [
+            ('payment_id', 'ID платежа', None),
+            ('user_id', 'ID пользователя', None),
+            ('username', 'Имя пользователя', None),
+            ('first_name', 'Имя', None),
+            ('plan', 'План', 'plan'),
+            ('amount', 'Сумма', None),
+            ('status', 'Статус', 'payment_status'),
+            ('created_at', 'Дата создания', None),
+        ],
+    },
+    {
+        'title': 'Статистика платежей',
+        'count': "SELECT COUNT(DISTINCT user_id) FROM payments WHERE status = 'completed'",
+        'query': """
             SELECT
                 user_id,
                 COUNT(*) as total_payments,
@@ -277,95 +239,37 @@ class ReportGenerator:
             WHERE status = 'completed'
             GROUP BY user_id
             ORDER BY total_amount DESC
-            """
-
-            df_payment_stats = pd.read_sql_query(payment_stats_query, conn)
-
-            # Получаем детальные логи платежей
-            payment_logs_query = """
-            SELECT
-                pl.payment_id,
-                pl.payment_info,
-                pl.amount,
-                pl.created_at
+        """,
+        'columns': [
+            ('user_id', 'ID пользователя', None),
+            ('total_payments', 'Всего платежей', None),
+            ('total_amount', 'Общая сумма', None),
+            ('first_payment_date', 'Дата первого платежа', None),
+            ('last_payment_date', 'Дата последнего платежа', None),
+        ],
+    },
+    {
+        'title': 'Логи платежей',
+        'count': "SELECT COUNT(*) FROM payment_logs",
+        'query': """
+            SELECT pl.payment_id, pl.payment_info, pl.amount, pl.created_at
             FROM payment_logs pl
             ORDER BY pl.created_at DESC
-            """
-
-            df_payment_logs = pd.read_sql_query(payment_logs_query, conn)
-            conn.close()
-
-            # Переименовываем колонки
-            df_payments = df_payments.rename(columns={
-                'payment_id': 'ID платежа',
-                'user_id': 'ID пользователя',
-                'username': 'Имя пользователя',
-                'first_name': 'Имя',
-                'plan': 'План',
-                'amount': 'Сумма',
-                'status': 'Статус',
-                'created_at': 'Дата создания'
-            })
-
-            df_payment_stats = df_payment_stats.rename(columns={
-                'user_id': 'ID пользователя',
-                'total_payments': 'Всего платежей',
-                'total_amount': 'Общая сумма',
-                'first_payment_date': 'Дата первого платежа',
-                'last_payment_date': 'Дата последнего платежа'
-            })
-
-            df_payment_logs = df_payment_logs.rename(columns={
-                'payment_id': 'ID платежа',
-                'payment_info': 'Информация о платеже',
-                'amount': 'Сумма',
-                'created_at': 'Дата создания'
-            })
-
-            # Преобразуем статусы
-            df_payments['Статус'] = df_payments['Статус'].map({
-                'pending': 'В ожидании',
-                'completed': 'Завершен',
-                'failed': 'Ошибка'
-            })
-
-            # Сохраняем в Excel
-            filename = f"payments_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-            filepath = os.path.join(tempfile.gettempdir(), filename)
-
-            with pd.ExcelWriter(filepath, engine='openpyxl') as writer:
-                df_payments.to_excel(writer, sheet_name='Платежи', index=False)
-                df_payment_stats.to_excel(writer, sheet_name='Статистика платежей', index=False)
-                df_payment_logs.to_excel(writer, sheet_name='Логи платежей', index=False)
-
-                # Автоматически подгоняем ширину колонок
-                for sheet_name in writer.sheets:
-                    worksheet = writer.sheets[sheet_name]
-                    for column in worksheet.columns:
-                        max_length = 0
-                        column_letter = column[0].column_letter
-                        for cell in column:
-                            try:
-                                if len(str(cell.value)) > max_length:
-                                    max_length = len(str(cell.value))
-                            except:
-                                pass
-                        adjusted_width = min(max_length + 2, 50)
-                        worksheet.column_dimensions[column_letter].width = adjusted_width
-
-            return filepath
-
-        except Exception as e:
-            logger.error(f"Ошибка создания отчета платежей: {e}", exc_info=True)
-            raise
-
-    async def create_referrals_report(self) -> str:
-        """Создает отчет по рефералам"""
-        try:
-            conn = self.get_db_connection()
-
-            # Получаем данные о рефералах
-            referrals_query = """
+        """,
+        'columns': [
+            ('payment_id', 'ID платежа', None),
+            ('payment_info', 'Информация о платеже', None),
+            ('amount', 'Сумма', None),
+            ('created_at', 'Дата создания', None),
+        ],
+    },
+]
+
+REFERRALS_SHEETS = [
+    {
+        'title': 'Рефералы',
+        'count': "SELECT COUNT(*) FROM referrals",
+        'query': """
             SELECT
                 r.referrer_id,
                 CASE
@@ -384,12 +288,21 @@ class ReportGenerator:
             LEFT JOIN users u1 ON r.referrer_id = u1.user_id
             LEFT JOIN users u2 ON r.referred_id = u2.user_id
             ORDER BY r.created_at DESC
-            """
-
-            df_referrals = pd.read_sql_query(referrals_query, conn)
-
-            # Получаем награды за рефералов
-            rewards_query = """
+        """,
+        'columns': [
+            ('referrer_id', 'ID пригласившего', None),
+            ('referrer_display', 'Пригласивший', None),
+            ('referred_id', 'ID приглашенного', None),
+            ('referred_display', 'Приглашенный', None),
+            ('created_at', 'Дата создания', None),
+            ('completed_at', 'Дата завершения', None),
+            ('status', 'Статус', 'referral_status'),
+        ],
+    },
+    {
+        'title': 'Награды',
+        'count': "SELECT COUNT(*) FROM referral_rewards",
+        'query': """
             SELECT
                 rr.referrer_id,
                 CASE
@@ -407,12 +320,20 @@ class ReportGenerator:
             LEFT JOIN users u ON rr.referrer_id = u.user_id
             LEFT JOIN users u2 ON rr.referred_user_id = u2.user_id
             ORDER BY rr.created_at DESC
-            """
-
-            df_rewards = pd.read_sql_query(rewards_query, conn)
-
-            # Получаем статистику рефералов
-            stats_query = """
+        """,
+        'columns': [
+            ('referrer_id', 'ID пригласившего', None),
+            ('referrer_display', 'Получатель награды', None),
+            ('referred_user_id', 'ID приглашенного', None),
+            ('referred_display', 'За кого награда', None),
+            ('created_at', 'Дата награды', None),
+            ('reward_photos', 'Награда (фото)', None),
+        ],
+    },
+    {
+        'title': 'Статистика',
+        'count': "SELECT COUNT(*) FROM referral_stats",
+        'query': """
             SELECT
                 rs.user_id,
                 CASE
@@ -425,75 +346,126 @@ class ReportGenerator:
             FROM referral_stats rs
             LEFT JOIN users u ON rs.user_id = u.user_id
             ORDER BY rs.total_referrals DESC
-            """
-
-            df_stats = pd.read_sql_query(stats_query, conn)
-            conn.close()
-
-            # Переименовываем колонки
-            df_referrals = df_referrals.rename(columns={
-                'referrer_id': 'ID пригласившего',
-                'referrer_display': 'Пригласивший',
-                'referred_id': 'ID приглашенного',
-                'referred_display': 'Приглашенный',
-                'created_at': 'Дата создания',
-                'completed_at': 'Дата завершения',
-                'status': 'Статус'
-            })
-
-            df_rewards = df_rewards.rename(columns={
-                'referrer_id': 'ID пригласившего',
-                'referrer_display': 'Получатель награды',
-                'referred_user_id': 'ID приглашенного',
-                'referred_display': 'За кого награда',
-                'created_at': 'Дата награды',
-                'reward_photos': 'Награда (фото)'
-            })
-
-            df_stats = df_stats.rename(columns={
-                'user_id': 'ID пользователя',
-                'user_display': 'Пользователь',
-                'total_referrals': 'Всего рефералов',
-                'total_reward_photos': 'Всего наград (фото)',
-                'updated_at': 'Последнее обновление'
-            })
-
-            # Преобразуем статусы
-            df_referrals['Статус'] = df_referrals['Статус'].map({
-                'pending': 'В ожидании',
-                'completed': 'Завершен'
-            })
-
-            # Сохраняем в Excel
-            filename = f"referrals_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-            filepath = os.path.join(tempfile.gettempdir(), filename)
-
-            with pd.ExcelWriter(filepath, engine='openpyxl') as writer:
-                df_referrals.to_excel(writer, sheet_name='Рефералы', index=False)
-                df_rewards.to_excel(writer, sheet_name='Награды', index=False)
-                df_stats.to_excel(writer, sheet_name='Статистика', index=False)
-
-                # Автоматически подгоняем ширину колонок
-                for sheet_name in writer.sheets:
-                    worksheet = writer.sheets[sheet_name]
-                    for column in worksheet.columns:
-                        max_length = 0
-                        column_letter = column[0].column_letter
-                        for cell in column:
-                            try:
-                                if len(str(cell.value)) > max_length:
-                                    max_length = len(str(cell.value))
-                            except:
-                                pass
-                        adjusted_width = min(max_length + 2, 50)
-                        worksheet.column_dimensions[column_letter].width = adjusted_width
-
-            return filepath
+        """,
+        'columns': [
+            ('user_id', 'ID пользователя', None),
+            ('user_display', 'Пользователь', None),
+            ('total_referrals', 'Всего рефералов', None),
+            ('total_reward_photos', 'Всего наград (фото)', None),
+            ('updated_at', 'Последнее обновление', None),
+        ],
+    },
+]
+
+
+class ReportGenerator:
+    """XLSX-отчёты для админов.
+
+    Выгрузка идёт в пуле процессов, поэтому event loop не блокируется;
+    воркер пишет в очередь число выгруженных строк, а переданный колбэк
+    progress получает его не чаще раза в progress_interval секунд.
+    """
+
+    def __init__(self, db_path: str = DATABASE_PATH, workers: int = REPORT_WORKERS,
+                 page_size: int = REPORT_PAGE_SIZE, sample_rows: int = REPORT_WIDTH_SAMPLE_ROWS,
+                 progress_interval: float = REPORT_PROGRESS_INTERVAL):
+        self.db_path = db_path
+        self.workers = workers
+        self.page_size = page_size
+        self.sample_rows = sample_rows
+        self.progress_interval = progress_interval
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._queue = None
+        self._progress: Dict[str, Tuple[str, int, int]] = {}
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            context = multiprocessing.get_context()
+            self._queue = context.Queue()
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=context,
+                initializer=_init_worker, initargs=(self._queue,)
+            )
+        return self._executor
+
+    def _drain_progress(self) -> None:
+        while self._queue is not None:
+            try:
+                job_id, sheet, written, total = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            self._progress[job_id] = (sheet, written, total)
+
+    async def _export(self, prefix: str, sheets: List[Dict[str, Any]], progress: Optional[ProgressCallback] = None) -> str:
+        filename = f"{prefix}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+        filepath = os.path.join(tempfile.gettempdir(), filename)
+        job_id = uuid.uuid4().hex
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            self._get_executor(), _write_report,
+            self.db_path, filepath, sheets, job_id, self.page_size, self.sample_rows
+        )
+        reported = None
+        try:
+            while True:
+                done, _ = await asyncio.wait({future}, timeout=self.progress_interval)
+                self._drain_progress()
+                current = self._progress.get(job_id)
+                if progress is not None and current is not None and current != reported and not done:
+                    reported = current
+                    try:
+                        await progress(*current)
+                    except Exception as e:
+                        logger.warning(f"Не удалось сообщить прогресс отчета {prefix}: {e}")
+                if done:
+                    break
+            rows = future.result()
+        except BrokenProcessPool:
+            logger.warning("Пул выгрузки отчетов сломан, пересоздаю")
+            self._executor = None
+            raise
+        finally:
+            self._progress.pop(job_id, None)
+        logger.info(f"Отчет {filename} сформирован: {rows} строк")
+        return filepath
 
+    async def create_users_report(self, progress: Optional[ProgressCallback] = None) -> str:
+        """Создает отчет по пользователям"""
+        try:
+            return await self._export('users_report', USERS_SHEETS, progress)
+        except Exception as e:
+            logger.error(f"Ошибка создания отчета пользователей: {e}", exc_info=True)
+            raise
+
+    async def create_activity_report(self, progress: Optional[ProgressCallback] = None) -> str:
+        """Создает отчет по активности пользователей"""
+        try:
+            return await self._export('activity_report', ACTIVITY_SHEETS, progress)
+        except Exception as e:
+            logger.error(f"Ошибка создания отчета активности: {e}", exc_info=True)
+            raise
+
+    async def create_payments_report(self, progress: Optional[ProgressCallback] = None) -> str:
+        """Создает отчет по платежам"""
+        try:
+            return await self._export('payments_report', PAYMENTS_SHEETS, progress)
+        except Exception as e:
+            logger.error(f"Ошибка создания отчета платежей: {e}", exc_info=True)
+            raise
+
+    async def create_referrals_report(self, progress: Optional[ProgressCallback] = None) -> str:
+        """Создает отчет по рефералам"""
+        try:
+            return await self._export('referrals_report', REFERRALS_SHEETS, progress)
         except Exception as e:
             logger.error(f"Ошибка создания отчета рефералов: {e}", exc_info=True)
             raise
 
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
 async def send_report_to_admin(bot: Bot, admin_id: int, filepath: str, report_type: str):
     """Отправляет отчет администратору"""
     try:
@@ -536,5 +508,36 @@ async def delete_report_file(filepath: str):
     except Exception as e:
         logger.error(f"Ошибка удаления файла отчета: {e}")
 
+async def export_report_to_admin(bot: Bot, admin_id: int, report_type: str) -> None:
+    """Формирует отчет, показывая прогресс в чате администратора, и отправляет файл."""
+    title, attr = REPORT_TYPES[report_type]
+    status = await bot.send_message(admin_id, f"⏳ Формирую отчет «{title}»...")
+
+    async def progress(sheet: str, written: int, total: int) -> None:
+        await bot.edit_message_text(
+            f"⏳ Отчет «{title}»: лист «{sheet}», {written} из {total} строк",
+            chat_id=admin_id, message_id=status.message_id
+        )
+
+    try:
+        filepath = await getattr(report_generator, attr)(progress=progress)
+    except Exception as e:
+        await bot.edit_message_text(
+            f"❌ Ошибка формирования отчета «{title}»: {e}", chat_id=admin_id, message_id=status.message_id
+        )
+        return
+    try:
+        await bot.delete_message(admin_id, status.message_id)
+    except Exception as e:
+        logger.debug(f"Не удалось удалить сообщение о прогрессе отчета: {e}")
+    await send_report_to_admin(bot, admin_id, filepath, title)
+
+REPORT_TYPES = {
+    'users': ('Пользователи', 'create_users_report'),
+    'activity': ('Активность', 'create_activity_report'),
+    'payments': ('Платежи', 'create_payments_report'),
+    'referrals': ('Рефералы', 'create_referrals_report'),
+}
+
 # Создаем экземпляр генератора отчетов
 report_generator = ReportGenerator()
@@ -0,0 +1,65 @@
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Any, Dict, Mapping, Optional, Union
+
+from config import TARIFFS
+
+Amount = Union[int, float, str, Decimal]
+
+
+def to_kopecks(amount: Amount) -> int:
+    """Сумма в рублях (число или строка из API YooKassa) в целых копейках."""
+    return int((Decimal(str(amount)) * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+
+class TariffRegistry:
+    """Реестр тарифов с индексами по сумме (в копейках) и по callback_data.
+
+    Строится один раз при импорте; поиск тарифа по сумме платежа или по
+    нажатой кнопке — обращение к словарю, без перебора TARIFFS и сравнения
+    float. Суммы и callback_data тарифов обязаны быть уникальными.
+    """
+
+    def __init__(self, tariffs: Mapping[str, Mapping[str, Any]]):
+        self.tariffs = tariffs
+        self._by_kopecks: Dict[int, str] = {}
+        self._by_callback: Dict[str, str] = {}
+        for key, tariff in tariffs.items():
+            kopecks = to_kopecks(tariff['amount'])
+            if kopecks in self._by_kopecks:
+                raise ValueError(f"Тарифы '{self._by_kopecks[kopecks]}' и '{key}' имеют одинаковую сумму {tariff['amount']}")
+            self._by_kopecks[kopecks] = key
+            callback = tariff.get('callback')
+            if callback:
+                if callback in self._by_callback:
+                    raise ValueError(f"Тарифы '{self._by_callback[callback]}' и '{key}' имеют одинаковый callback '{callback}'")
+                self._by_callback[callback] = key
+
+    def get(self, key: Optional[str]) -> Optional[Mapping[str, Any]]:
+        return self.tariffs.get(key) if key else None
+
+    def key_for_amount(self, amount: Optional[Amount]) -> Optional[str]:
+        """Ключ тарифа по сумме платежа или None."""
+        if amount is None or amount == '':
+            return None
+        try:
+            return self._by_kopecks.get(to_kopecks(amount))
+        except (ArithmeticError, ValueError):
+            return None
+
+    def key_for_callback(self, callback_data: Optional[str]) -> Optional[str]:
+        """Ключ тарифа по callback_data кнопки ('pay_399') или None."""
+        return self._by_callback.get(callback_data) if callback_data else None
+
+    def callback_for(self, key: str) -> Optional[str]:
+        """callback_data кнопки оплаты тарифа."""
+        tariff = self.tariffs.get(key)
+        return tariff.get('callback') if tariff else None
+
+    def display_name(self, key: Optional[str], amount: Optional[Amount] = None) -> str:
+        """Название тарифа для отчётов; неизвестный ключ уточняется по сумме платежа."""
+        if key not in self.tariffs:
+            key = self.key_for_amount(amount) or key
+        return key.capitalize() if key else 'N/A'
+
+
+tariff_registry = TariffRegistry(TARIFFS)
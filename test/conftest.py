@@ -0,0 +1,35 @@
+"""Общие настройки тестов: окружение для config и временная база данных."""
+
+import importlib
+import os
+import sys
+import tempfile
+
+import pytest_asyncio
+
+_TEST_DIR = tempfile.mkdtemp(prefix='bot-tests-')
+
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:TEST')
+os.environ.setdefault('REPLICATE_API_TOKEN', 'test')
+os.environ.setdefault('YOOKASSA_SHOP_ID', 'test')
+os.environ['DATABASE_PATH'] = os.path.join(_TEST_DIR, 'users.db')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Настоящие модули загружаются до тестов, подменяющих sys.modules['config']
+for _module in ('config', 'database', 'payment_queue'):
+    importlib.import_module(_module)
+
+
+@pytest_asyncio.fixture
+async def db(tmp_path):
+    """Общий пул на чистой базе с полной схемой; кэш пользователей сбрасывается."""
+    database = sys.modules['database']
+    database.db_pool.db_path = str(tmp_path / 'users.db')
+    database.user_cache.clear_local()
+    database.user_cache._local_versions.clear()
+    await database.init_db()
+    yield database
+    await database.analytics_buffer.stop()
+    database.analytics_buffer._stopping = False
+    await database.db_pool.close()
@@ -0,0 +1,61 @@
+import pytest
+import pytest_asyncio
+
+from analytics_buffer import AnalyticsBuffer
+from db_pool import SQLitePool
+
+GOOD = "INSERT INTO events (name) VALUES (?)"
+BAD = "INSERT INTO missing_table (name) VALUES (?)"
+
+
+@pytest_asyncio.fixture
+async def pool(tmp_path):
+    pool = SQLitePool(str(tmp_path / 'analytics.db'), readers=1)
+    async with pool.writer() as conn:
+        await conn.execute("CREATE TABLE events (name TEXT)")
+        await conn.commit()
+    yield pool
+    await pool.close()
+
+
+async def _names(pool):
+    async with pool.reader() as conn:
+        cursor = await conn.execute("SELECT name FROM events ORDER BY rowid")
+        return [row[0] for row in await cursor.fetchall()]
+
+
+class TestAnalyticsBuffer:
+    """Тесты буфера аналитики"""
+
+    @pytest.mark.asyncio
+    async def test_failed_rows_are_requeued_then_dropped(self, pool):
+        """Неудачные события возвращаются в буфер, удачные пишутся; после max_attempts событие отбрасывается"""
+        buffer = AnalyticsBuffer(pool, flush_interval=3600, max_attempts=2)
+        buffer.record(GOOD, ('a',))
+        buffer.record(BAD, ('lost',))
+
+        assert await buffer.flush() == 1
+        assert await _names(pool) == ['a']
+        stats = buffer.get_stats()
+        assert (stats['pending'], stats['requeued'], stats['failed']) == (1, 1, 0)
+
+        assert await buffer.flush() == 0
+        stats = buffer.get_stats()
+        assert (stats['pending'], stats['failed']) == (0, 1)
+        await buffer.stop()
+
+    @pytest.mark.asyncio
+    async def test_requeue_respects_capacity(self, pool):
+        """Возврат в буфер не превышает max_pending"""
+        buffer = AnalyticsBuffer(pool, flush_interval=3600, max_pending=2, max_attempts=5)
+        buffer.record(BAD, ('x',))
+        buffer.record(BAD, ('y',))
+        events = list(buffer._pending)
+        buffer._pending.clear()
+        buffer.record(GOOD, ('new',))
+
+        buffer._requeue(events)
+
+        assert [event[1] for event in buffer._pending] == [('x',), ('new',)]
+        assert buffer.get_stats()['failed'] == 1
+        await buffer.stop()
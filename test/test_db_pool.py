@@ -0,0 +1,138 @@
+import asyncio
+import sqlite3
+
+import pytest
+import pytest_asyncio
+
+from db_pool import SQLitePool
+
+
+@pytest_asyncio.fixture
+async def pool(tmp_path):
+    pool = SQLitePool(str(tmp_path / 'pool.db'), readers=2, acquire_timeout=1.0)
+    async with pool.writer() as conn:
+        await conn.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, value TEXT)")
+        await conn.commit()
+    yield pool
+    await pool.close()
+
+
+def _insert(value):
+    async def job(conn):
+        cursor = await conn.execute("INSERT INTO items (value) VALUES (?)", (value,))
+        return cursor.lastrowid
+    return job
+
+
+async def _values(pool):
+    async with pool.reader() as conn:
+        cursor = await conn.execute("SELECT value FROM items ORDER BY id")
+        return [row[0] for row in await cursor.fetchall()]
+
+
+class TestSQLitePool:
+    """Тесты пула соединений и очереди записи"""
+
+    @pytest.mark.asyncio
+    async def test_reentrant_lease_in_same_task(self, pool):
+        """Повторный вход в writer()/reader() в той же задаче отдаёт то же соединение"""
+        async with pool.writer() as outer:
+            async with pool.writer() as inner:
+                assert inner is outer
+            assert pool.holds_writer()
+        assert not pool.holds_writer()
+
+        async with pool.reader() as outer:
+            async with pool.reader() as inner:
+                assert inner is outer
+
+    @pytest.mark.asyncio
+    async def test_child_task_cannot_take_parent_writer(self, pool):
+        """Дочерняя задача не ждёт writer родителя до таймаута, а сразу получает ошибку"""
+        async def child_writer():
+            async with pool.writer():
+                pass
+
+        async def child_submit():
+            await pool.submit_write(_insert('child'))
+
+        async with pool.writer():
+            with pytest.raises(RuntimeError):
+                await asyncio.create_task(child_writer())
+            with pytest.raises(RuntimeError):
+                await asyncio.create_task(child_submit())
+
+        # После освобождения writer дочерние задачи работают как обычно
+        await asyncio.create_task(child_submit())
+        assert await _values(pool) == ['child']
+
+    @pytest.mark.asyncio
+    async def test_submit_write_inline_when_holding_writer(self, pool):
+        """submit_write внутри writer() выполняется в транзакции вызывающего кода"""
+        async with pool.writer() as conn:
+            await pool.submit_write(_insert('inline'))
+            await conn.rollback()
+        assert await _values(pool) == []
+
+    @pytest.mark.asyncio
+    async def test_batch_isolates_failed_job(self, pool):
+        """Ошибка одного задания не откатывает остальные задания пачки"""
+        async def failing(conn):
+            await conn.execute("INSERT INTO items (value) VALUES ('lost')")
+            raise ValueError('boom')
+
+        results = await asyncio.gather(
+            pool.submit_write(_insert('a')),
+            pool.submit_write(failing),
+            pool.submit_write(_insert('b')),
+            return_exceptions=True,
+        )
+
+        assert isinstance(results[1], ValueError)
+        assert await _values(pool) == ['a', 'b']
+        stats = pool.get_stats()
+        assert stats['write_jobs_failed'] == 1
+        assert stats['write_batches'] == 1
+        assert stats['write_batch_max'] == 3
+
+    @pytest.mark.asyncio
+    async def test_batch_failure_counts_only_failed_futures(self, pool):
+        """При ошибке всей пачки в счётчик попадают только задания, получившие исключение"""
+        async def failing(conn):
+            raise ValueError('boom')
+
+        original = pool._execute_write_batch
+
+        async def execute(batch):
+            await original(batch[:1])
+            raise RuntimeError('commit failed')
+
+        pool._execute_write_batch = execute
+        results = await asyncio.gather(
+            pool.submit_write(failing),
+            pool.submit_write(_insert('a')),
+            pool.submit_write(_insert('b')),
+            return_exceptions=True,
+        )
+
+        assert isinstance(results[0], ValueError)
+        assert isinstance(results[1], RuntimeError)
+        assert isinstance(results[2], RuntimeError)
+        assert pool.get_stats()['write_jobs_failed'] == 3
+
+    @pytest.mark.asyncio
+    async def test_locked_batch_is_retried(self, pool, tmp_path):
+        """Пачка, упёршаяся в блокировку другого процесса, повторяется"""
+        async with pool.writer() as conn:
+            await conn.execute("PRAGMA busy_timeout = 50")
+
+        other = sqlite3.connect(str(tmp_path / 'pool.db'))
+        other.execute("BEGIN IMMEDIATE")
+        task = asyncio.create_task(pool.submit_write(_insert('late')))
+        await asyncio.sleep(0.2)
+        other.rollback()
+        other.close()
+
+        await task
+        assert await _values(pool) == ['late']
+        assert pool.get_stats()['write_lock_retries'] >= 1
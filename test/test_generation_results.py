@@ -0,0 +1,83 @@
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import BufferedInputFile, Message, PhotoSize
+
+from generation import images, results
+
+
+def _photo_message(file_id):
+    return Message.model_construct(photo=[PhotoSize.model_construct(file_id=file_id)])
+
+
+@pytest.fixture
+def sender(monkeypatch):
+    """Бот, который не принимает ссылки, но принимает загруженные файлы"""
+    bot = MagicMock()
+
+    async def send_photo(chat_id, photo, **kwargs):
+        if isinstance(photo, str):
+            raise TelegramBadRequest(method=MagicMock(), message='Bad Request: wrong file identifier/HTTP URL specified')
+        return _photo_message('uploaded')
+
+    bot.send_photo = AsyncMock(side_effect=send_photo)
+    bot.get_me = AsyncMock(return_value=MagicMock(id=0))
+    downloaded = BufferedInputFile(b'png', filename='result.png')
+    download = AsyncMock(return_value=[downloaded])
+    saved = AsyncMock()
+    monkeypatch.setattr(images, 'download_images_parallel', download)
+    monkeypatch.setattr(images, 'create_rating_keyboard', AsyncMock(return_value=None))
+    monkeypatch.setattr(images, 'save_result', saved)
+    return bot, downloaded, download, saved
+
+
+class TestSendGenerationResults:
+    """Тесты отправки результатов генерации"""
+
+    @pytest.mark.asyncio
+    async def test_rejected_url_falls_back_to_download(self, sender):
+        """Если Telegram не скачал ссылку, результат скачивается и отправляется файлом"""
+        bot, downloaded, download, saved = sender
+        state = MagicMock(get_data=AsyncMock(return_value={}), clear=AsyncMock(), update_data=AsyncMock())
+        url = 'https://replicate.delivery/result.png'
+
+        await images.send_generation_results(
+            bot, 1, 1, [url], 1.0, '1:1', 'with_avatar', 'flux-trained', state, generation_id='gen1'
+        )
+
+        download.assert_awaited_once_with([url], 1)
+        # Ссылка не повторяется: одна попытка и повтор без разметки внутри send_photo_with_retry
+        sent_photos = [call.kwargs['photo'] for call in bot.send_photo.await_args_list]
+        assert sent_photos.count(url) == 2
+        assert sent_photos[-1] is downloaded
+        saved.assert_awaited_once()
+        assert saved.await_args.args == ('gen1', ['uploaded'])
+
+    @pytest.mark.asyncio
+    async def test_false_from_retry_is_failed_send(self, monkeypatch):
+        """False от retry-обёртки — неудачная отправка: результат не сохраняется, пользователь получает ошибку"""
+        saved = AsyncMock()
+        error_message = AsyncMock()
+        monkeypatch.setattr(images, 'send_photo_with_retry', AsyncMock(return_value=False))
+        monkeypatch.setattr(images, 'create_rating_keyboard', AsyncMock(return_value=None))
+        monkeypatch.setattr(images, 'create_main_menu_keyboard', AsyncMock(return_value=None))
+        monkeypatch.setattr(images, 'send_message_with_fallback', error_message)
+        monkeypatch.setattr(images, 'save_result', saved)
+        state = MagicMock(get_data=AsyncMock(return_value={}), clear=AsyncMock(), update_data=AsyncMock())
+
+        await images.send_generation_results(
+            MagicMock(), 1, 1, [BufferedInputFile(b'png', filename='result.png')], 1.0, '1:1',
+            'with_avatar', 'flux-trained', state, generation_id='gen2'
+        )
+
+        saved.assert_not_awaited()
+        error_message.assert_awaited_once()
+
+
+def test_file_ids_from_unexpected_response():
+    """Ответ, не являющийся сообщением или списком сообщений, не даёт file_id"""
+    assert results.file_ids_from_messages(False) == []
+    assert results.file_ids_from_messages(None) == []
+    assert results.file_ids_from_messages(_photo_message('a')) == ['a']
+    assert results.file_ids_from_messages((_photo_message('a'), _photo_message('b'))) == ['a', 'b']
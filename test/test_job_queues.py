@@ -0,0 +1,116 @@
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from handlers.user import onboarding
+
+
+async def _job_row(db, job_id):
+    async with db.db_pool.reader() as conn:
+        cursor = await conn.execute("SELECT status, attempts, run_at, last_error FROM onboarding_jobs WHERE id = ?", (job_id,))
+        return await cursor.fetchone()
+
+
+async def _job_ids(db):
+    async with db.db_pool.reader() as conn:
+        cursor = await conn.execute("SELECT id FROM onboarding_jobs ORDER BY id")
+        return [row[0] for row in await cursor.fetchall()]
+
+
+class TestOnboardingJobs:
+    """Тесты очереди отложенных сообщений онбординга"""
+
+    @pytest.mark.asyncio
+    async def test_enqueue_is_idempotent_and_claim_once(self, db):
+        """Повторная постановка игнорируется, задание выдаётся только один раз"""
+        now = datetime(2026, 1, 1, 12, 0, 0)
+        assert await db.enqueue_onboarding_job(1, 'welcome', now - timedelta(minutes=1))
+        assert not await db.enqueue_onboarding_job(1, 'welcome', now)
+        assert not await db.claim_due_onboarding_jobs(now - timedelta(hours=1))
+
+        jobs = await db.claim_due_onboarding_jobs(now)
+        assert [(job['user_id'], job['message_type'], job['attempts']) for job in jobs] == [(1, 'welcome', 1)]
+        assert await db.claim_due_onboarding_jobs(now) == []
+
+    @pytest.mark.asyncio
+    async def test_sent_job_is_done(self, db, monkeypatch):
+        """Успешно отправленное сообщение отмечается done"""
+        monkeypatch.setattr(onboarding, 'send_onboarding_message', AsyncMock(return_value=True))
+        await db.enqueue_onboarding_job(2, 'welcome', datetime(2020, 1, 1))
+
+        await onboarding.process_onboarding_jobs(MagicMock())
+
+        job_id = (await _job_ids(db))[0]
+        assert (await _job_row(db, job_id))[0] == 'done'
+
+    @pytest.mark.asyncio
+    async def test_failed_send_is_rescheduled_then_failed(self, db, monkeypatch):
+        """Неудачная отправка переносится с задержкой, после последней попытки — failed"""
+        monkeypatch.setattr(onboarding, 'send_onboarding_message', AsyncMock(return_value=False))
+        monkeypatch.setattr(onboarding, 'ONBOARDING_JOB_MAX_ATTEMPTS', 2)
+        await db.enqueue_onboarding_job(3, 'welcome', datetime(2020, 1, 1))
+        job_id = (await _job_ids(db))[0]
+
+        await onboarding.process_onboarding_jobs(MagicMock())
+        status, attempts, run_at, error = await _job_row(db, job_id)
+        assert (status, attempts) == ('pending', 1)
+        assert run_at > '2020-01-01 00:00:00'
+        assert error
+
+        # Следующая попытка: срок переносим в прошлое, чтобы задание снова было выдано
+        async with db.db_pool.writer() as conn:
+            await conn.execute("UPDATE onboarding_jobs SET run_at = '2020-01-01 00:00:00' WHERE id = ?", (job_id,))
+            await conn.commit()
+        await onboarding.process_onboarding_jobs(MagicMock())
+        assert (await _job_row(db, job_id))[:2] == ('failed', 2)
+
+
+async def _photos_left(db, user_id):
+    async with db.db_pool.reader() as conn:
+        cursor = await conn.execute("SELECT generations_left FROM users WHERE user_id = ?", (user_id,))
+        return (await cursor.fetchone())[0]
+
+
+async def _enqueue_generation(db, user_id, max_depth=10):
+    return await db.enqueue_generation_job(user_id, user_id, (1, user_id, user_id), {'prompt': 'тест'}, 1, 1, max_depth)
+
+
+class TestGenerationJobs:
+    """Тесты очереди заданий генерации"""
+
+    @pytest.mark.asyncio
+    async def test_enqueue_respects_max_depth(self, db):
+        """Переполненная очередь отклоняет новое задание"""
+        assert await _enqueue_generation(db, 1, max_depth=2) == (1, 1)
+        assert await _enqueue_generation(db, 2, max_depth=2) == (2, 2)
+        assert await _enqueue_generation(db, 3, max_depth=2) is None
+
+    @pytest.mark.asyncio
+    async def test_claim_one_job_per_user(self, db):
+        """Пользователю выдаётся следующее задание только после завершения текущего"""
+        first, _ = await _enqueue_generation(db, 1)
+        second, _ = await _enqueue_generation(db, 1)
+        other, _ = await _enqueue_generation(db, 2)
+
+        assert [job['id'] for job in await db.claim_generation_jobs(10)] == [first, other]
+        assert await db.claim_generation_jobs(10) == []
+
+        await db.finish_generation_job(first)
+        assert [job['id'] for job in await db.claim_generation_jobs(10)] == [second]
+
+    @pytest.mark.asyncio
+    async def test_debit_and_refund_once(self, db):
+        """Повторный запуск задания не списывает и не возвращает фото повторно"""
+        await db.add_user_without_subscription(5, 'user5', 'Тест')
+        await db.credit_user_resources(5, photos=5)
+        before = await _photos_left(db, 5)
+        job_id, _ = await _enqueue_generation(db, 5)
+
+        assert await db.debit_generation_job(job_id, 5, 2) is not None
+        assert await db.debit_generation_job(job_id, 5, 2) is not None
+        assert await _photos_left(db, 5) == before - 2
+
+        assert await db.refund_generation_job(job_id)
+        assert not await db.refund_generation_job(job_id)
+        assert await _photos_left(db, 5) == before
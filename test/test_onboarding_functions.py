@@ -308,6 +308,15 @@ class TestPriceValidation:
             # Проверяем, что текст содержит правильную цену
             assert f"{expected_price}₽" in message_data["text"]
 
+    def test_payment_callbacks_match_tariffs(self):
+        """Тест, что кнопки оплаты ведут на тариф из конфигурации дня"""
+        from tariffs import tariff_registry
+
+        for day in range(2, 6):
+            config = get_day_config(day)
+            message_data = get_message_text(config["message_type"], "Тест")
+            assert tariff_registry.key_for_callback(message_data["callback_data"]) == config["tariff_key"]
+
     def test_welcome_no_price(self):
         """Тест, что welcome сообщение не содержит конкретную цену"""
         day1_config = get_day_config(1)
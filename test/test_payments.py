@@ -0,0 +1,85 @@
+import asyncio
+import json
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from payment_queue import PaymentEventQueue, PaymentEventRejected
+
+
+async def _create_user(db, user_id, referrer_id=None):
+    await db.add_user_without_subscription(user_id, f'user{user_id}', 'Тест', referrer_id=referrer_id)
+
+
+async def _balance(db, user_id):
+    async with db.db_pool.reader() as conn:
+        cursor = await conn.execute("SELECT generations_left, avatar_left FROM users WHERE user_id = ?", (user_id,))
+        return tuple(await cursor.fetchone())
+
+
+async def _count(db, sql, params=()):
+    async with db.db_pool.reader() as conn:
+        cursor = await conn.execute(sql, params)
+        return (await cursor.fetchone())[0]
+
+
+class TestApplyPayment:
+    """Тесты идемпотентного проведения платежа"""
+
+    @pytest.mark.asyncio
+    async def test_repeated_payment_credited_once(self, db):
+        """Повтор того же payment_id ничего не начисляет и возвращает None"""
+        await _create_user(db, 1)
+        before = await _balance(db, 1)
+
+        first = await db.apply_payment(1, 'мини', 399.0, 'pay-1')
+        second = await db.apply_payment(1, 'мини', 399.0, 'pay-1')
+
+        assert first is not None and first['is_first_purchase']
+        assert second is None
+        assert await _balance(db, 1) == (before[0] + 10, before[1] + 1)
+        assert await _count(db, "SELECT COUNT(*) FROM payments WHERE payment_id = ?", ('pay-1',)) == 1
+        assert await _count(db, "SELECT total_payments FROM user_payment_stats WHERE user_id = ?", (1,)) == 1
+
+    @pytest.mark.asyncio
+    async def test_concurrent_duplicates_credited_once(self, db):
+        """Одновременные webhook'и одного платежа проводятся один раз"""
+        await _create_user(db, 2)
+        before = await _balance(db, 2)
+
+        results = await asyncio.gather(*(db.apply_payment(2, 'лайт', 599.0, 'pay-2') for _ in range(5)))
+
+        assert sum(result is not None for result in results) == 1
+        assert await _balance(db, 2) == (before[0] + 30, before[1] + 1)
+
+    @pytest.mark.asyncio
+    async def test_referral_bonus_paid_once(self, db):
+        """Реферальный бонус начисляется только при первом проведении"""
+        await _create_user(db, 3)
+        await _create_user(db, 4, referrer_id=3)
+        referrer_before = await _balance(db, 3)
+
+        await db.apply_payment(4, 'лайт', 599.0, 'pay-4')
+        await db.apply_payment(4, 'лайт', 599.0, 'pay-4')
+
+        assert await _balance(db, 3) == (referrer_before[0] + 3, referrer_before[1])
+        assert await _count(db, "SELECT COUNT(*) FROM referral_rewards WHERE referred_user_id = ?", (4,)) == 1
+
+
+class TestPaymentEventQueue:
+    """Тесты учёта событий в очереди оплаты"""
+
+    @pytest.mark.asyncio
+    async def test_rejected_event_counted_failed(self, db):
+        """Отклонённое обработчиком событие — failed без повторов, а не done"""
+        queue = PaymentEventQueue(batch_size=1, max_attempts=3)
+        queue._bot = MagicMock()
+        queue._handler = AsyncMock(side_effect=PaymentEventRejected('Unknown tariff plan or user'))
+        await db.save_payment_event('pay-5', 'payment.succeeded', json.dumps({'object': {}}))
+        event = (await db.claim_payment_events(1))[0]
+
+        await queue._run_event(event)
+
+        stats = queue.get_stats()
+        assert (stats['done'], stats['failed'], stats['retried']) == (0, 1, 0)
+        assert await _count(db, "SELECT COUNT(*) FROM payment_events WHERE payment_id = ? AND status = 'failed'", ('pay-5',)) == 1
@@ -0,0 +1,80 @@
+import asyncio
+import io
+import zipfile
+from unittest.mock import MagicMock
+
+import pytest
+
+from generation.photo_ingest import TrainingPhotoIngest
+
+
+@pytest.fixture
+def ingest(monkeypatch):
+    """Подготовка фото без пула процессов: байты фото — это его file_id"""
+    ingest = TrainingPhotoIngest(workers=1, max_side=1024, min_side=256)
+    gates = {}
+
+    async def prepare(data):
+        gate = gates.get(data.decode())
+        if gate is not None:
+            await gate.wait()
+        return data
+
+    monkeypatch.setattr(ingest, '_prepare', prepare)
+    yield ingest, gates
+    ingest.shutdown()
+
+
+def _bot():
+    bot = MagicMock()
+
+    async def download(file_id):
+        return io.BytesIO(file_id.encode())
+
+    bot.download = download
+    return bot
+
+
+def _photos(data):
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        return sorted(archive.read(name).decode() for name in archive.namelist())
+
+
+class TestTrainingPhotoIngest:
+    """Тесты сборки архива фото для обучения"""
+
+    @pytest.mark.asyncio
+    async def test_empty_set_is_clear_error(self, ingest):
+        """Пустой набор фото — понятная ошибка, а не KeyError"""
+        ingest, _ = ingest
+        with pytest.raises(ValueError, match='Нет фото'):
+            await ingest.build(_bot(), 1, [])
+
+    @pytest.mark.asyncio
+    async def test_previous_set_in_flight_not_archived(self, ingest):
+        """Недокачанное фото прошлого набора не попадает в новый архив"""
+        ingest, gates = ingest
+        bot = _bot()
+        gates['old'] = asyncio.Event()
+        stale = ingest.add(bot, 2, 'old')
+        await asyncio.sleep(0)
+
+        data, count = await ingest.build(bot, 2, ['a', 'b'])
+
+        assert (count, _photos(data)) == (2, ['a', 'b'])
+        assert stale.cancelled()
+
+    @pytest.mark.asyncio
+    async def test_photo_added_during_build_not_archived(self, ingest):
+        """Фото, присланное во время сборки, не попадает в архив"""
+        ingest, gates = ingest
+        bot = _bot()
+        gates['a'] = asyncio.Event()
+        build = asyncio.create_task(ingest.build(bot, 3, ['a']))
+        await asyncio.sleep(0)
+        await ingest.add(bot, 3, 'late')
+        gates['a'].set()
+
+        data, count = await build
+
+        assert (count, _photos(data)) == (1, ['a'])
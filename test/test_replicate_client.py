@@ -0,0 +1,63 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import time
+from unittest.mock import AsyncMock
+
+import pytest
+
+from replicate_client import AsyncReplicateClient, Prediction
+
+SECRET = 'whsec_' + base64.b64encode(b'test-secret').decode()
+
+
+def _signed_headers(body: bytes, secret: str = SECRET):
+    webhook_id, timestamp = 'msg_1', str(int(time.time()))
+    key = base64.b64decode(secret.split('_', 1)[-1])
+    signature = base64.b64encode(hmac.new(key, f"{webhook_id}.{timestamp}.".encode() + body, hashlib.sha256).digest()).decode()
+    return {'webhook-id': webhook_id, 'webhook-timestamp': timestamp, 'webhook-signature': f"v1,{signature}"}
+
+
+class TestReplicateWebhooks:
+    """Тесты webhook клиента Replicate"""
+
+    def test_webhooks_require_secret(self):
+        """Без секрета webhook не включаются и не принимаются"""
+        client = AsyncReplicateClient('token', webhook_url='https://bot/replicate/webhook')
+        assert client.webhook_url is None
+        assert not client.verify_webhook(_signed_headers(b'{}'), b'{}')
+
+    def test_signature_checked(self):
+        """Подпись проверяется по секрету"""
+        client = AsyncReplicateClient('token', webhook_url='https://bot/replicate/webhook', webhook_secret=SECRET)
+        body = b'{"id": "p1", "status": "succeeded"}'
+        assert client.verify_webhook(_signed_headers(body), body)
+        assert not client.verify_webhook(_signed_headers(body), b'{"id": "p1", "status": "failed"}')
+        assert not client.verify_webhook(_signed_headers(body, 'whsec_' + base64.b64encode(b'other').decode()), body)
+
+    @pytest.mark.asyncio
+    async def test_early_webhook_is_not_lost(self):
+        """Webhook, пришедший до wait(), сразу завершает ожидание без опроса"""
+        client = AsyncReplicateClient('token', poll_max_interval=60,
+                                      webhook_url='https://bot/replicate/webhook', webhook_secret=SECRET)
+        client.get_prediction = AsyncMock(side_effect=AssertionError('опрос не нужен'))
+
+        assert not client.handle_webhook({'id': 'p1', 'status': 'succeeded', 'output': ['url']})
+        result = await asyncio.wait_for(client.wait(Prediction(id='p1', status='starting')), timeout=1)
+
+        assert result.output == ['url']
+        assert client.get_stats()['early_buffered'] == 0
+
+    @pytest.mark.asyncio
+    async def test_webhook_wakes_waiter(self):
+        """Webhook после регистрации будит wait()"""
+        client = AsyncReplicateClient('token', poll_max_interval=60,
+                                      webhook_url='https://bot/replicate/webhook', webhook_secret=SECRET)
+        client.get_prediction = AsyncMock(side_effect=AssertionError('опрос не нужен'))
+
+        task = asyncio.create_task(client.wait(Prediction(id='p2', status='starting')))
+        await asyncio.sleep(0)
+        assert client.handle_webhook({'id': 'p2', 'status': 'failed', 'error': 'boom'})
+
+        assert (await asyncio.wait_for(task, timeout=1)).error == 'boom'
@@ -0,0 +1,32 @@
+import pytest
+
+import report
+
+
+class TestReportSheets:
+    """Тесты выгрузки листов отчетов"""
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize('sheets', [
+        report.USERS_SHEETS, report.ACTIVITY_SHEETS, report.PAYMENTS_SHEETS, report.REFERRALS_SHEETS
+    ])
+    async def test_count_matches_written_rows(self, db, tmp_path, monkeypatch, sheets):
+        """Запрос count каждого листа совпадает с числом выгруженных строк"""
+        await db.add_user_without_subscription(1, 'user1', 'Тест')
+        await db.add_user_without_subscription(2, 'user2', 'Тест', referrer_id=1)
+        await db.apply_payment(2, 'мини', 399.0, 'pay-1')
+        await db.analytics_buffer.flush()
+
+        progress = {}
+        monkeypatch.setattr(
+            report, '_report_progress',
+            lambda job_id, sheet, total, written: progress.__setitem__(sheet, (written, total))
+        )
+        rows = report._write_report(db.db_pool.db_path, str(tmp_path / 'report.xlsx'), sheets, 'job',
+                                    page_size=1, sample_rows=1)
+
+        assert set(progress) == {sheet['title'] for sheet in sheets}
+        for written, total in progress.values():
+            assert written == total
+        assert rows == sum(written for written, _ in progress.values())
+        assert rows > 0
@@ -0,0 +1,96 @@
+import asyncio
+
+import pytest
+
+
+async def _create_user(db, user_id, photos=0, avatars=0):
+    await db.add_user_without_subscription(user_id, f'user{user_id}', 'Тест')
+    async with db.db_pool.writer() as conn:
+        await conn.execute(
+            "UPDATE users SET generations_left = ?, avatar_left = ? WHERE user_id = ?",
+            (photos, avatars, user_id)
+        )
+        await conn.commit()
+    await db.refresh_user_cache(user_id)
+
+
+async def _balance(db, user_id):
+    async with db.db_pool.reader() as conn:
+        cursor = await conn.execute("SELECT generations_left, avatar_left FROM users WHERE user_id = ?", (user_id,))
+        return tuple(await cursor.fetchone())
+
+
+class TestResourceDebitCredit:
+    """Тесты атомарного списания и начисления ресурсов"""
+
+    @pytest.mark.asyncio
+    async def test_debit_returns_new_balance(self, db):
+        """Списание возвращает остаток и меняет строку в базе"""
+        await _create_user(db, 1, photos=10, avatars=2)
+
+        assert await db.debit_user_resources(1, photos=3, avatars=1) == (7, 1)
+        assert await _balance(db, 1) == (7, 1)
+
+    @pytest.mark.asyncio
+    async def test_debit_insufficient_keeps_balance(self, db):
+        """При нехватке ресурсов ничего не списывается"""
+        await _create_user(db, 2, photos=2)
+
+        assert await db.debit_user_resources(2, photos=3) is None
+        assert await db.debit_user_resources(2, avatars=1) is None
+        assert await _balance(db, 2) == (2, 0)
+
+    @pytest.mark.asyncio
+    async def test_concurrent_debits_never_overdraw(self, db):
+        """Одновременные списания не уводят баланс в минус"""
+        await _create_user(db, 3, photos=3)
+
+        results = await asyncio.gather(*(db.debit_user_resources(3, photos=1) for _ in range(5)))
+
+        assert sum(result is not None for result in results) == 3
+        assert await _balance(db, 3) == (0, 0)
+
+    @pytest.mark.asyncio
+    async def test_credit_adds_resources(self, db):
+        """Начисление увеличивает баланс; неизвестному пользователю не начисляется"""
+        await _create_user(db, 4, photos=1)
+
+        assert await db.credit_user_resources(4, photos=2, avatars=1) == (3, 1)
+        assert await _balance(db, 4) == (3, 1)
+        assert await db.credit_user_resources(404, photos=1) is None
+
+    @pytest.mark.asyncio
+    async def test_negative_debit_rejected(self, db):
+        """Отрицательное списание — ошибка вызывающего кода"""
+        with pytest.raises(ValueError):
+            await db.debit_user_resources(5, photos=-1)
+
+    @pytest.mark.asyncio
+    async def test_cache_follows_last_change(self, db):
+        """Кэш после параллельных списаний и начислений совпадает с базой"""
+        await _create_user(db, 6, photos=5)
+
+        await asyncio.gather(*(
+            db.debit_user_resources(6, photos=1) if i % 2 else db.credit_user_resources(6, photos=2)
+            for i in range(10)
+        ))
+
+        cached = await db.user_cache.get(6)
+        assert (cached.generations_left, cached.avatar_left) == await _balance(db, 6)
+        snapshot = await db.check_database_user(6)
+        assert snapshot.username == 'user6'
+
+    @pytest.mark.asyncio
+    async def test_snapshot_keeps_completed_first_purchase(self, db):
+        """first_purchase = 0 сохраняется в снимке после списания и обновления кэша"""
+        await _create_user(db, 7, photos=3)
+        async with db.db_pool.writer() as conn:
+            await conn.execute("UPDATE users SET first_purchase = 0 WHERE user_id = ?", (7,))
+            await conn.commit()
+        await db.refresh_user_cache(7)
+        assert (await db.check_database_user(7)).first_purchase == 0
+
+        await db.debit_user_resources(7, photos=1)
+
+        assert (await db.user_cache.get(7)).first_purchase == 0
+        assert (await db.check_database_user(7)).first_purchase == 0
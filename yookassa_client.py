@@ -0,0 +1,136 @@
+import asyncio
+from typing import Any, Dict, Optional
+
+import aiohttp
+
+from config import (
+    YOOKASSA_SHOP_ID, SECRET_KEY, YOOKASSA_HTTP_CONNECTIONS, YOOKASSA_MAX_CONCURRENCY, YOOKASSA_TIMEOUT_SECONDS
+)
+from logger import get_logger
+
+logger = get_logger('payments')
+
+# По документации YooKassa такие ответы означают «результат ещё не известен»:
+# запрос повторяется с тем же ключом идемпотентности
+RETRY_STATUSES = (202, 429, 500, 502, 503, 504)
+
+
+class YooKassaAPIError(Exception):
+    """Ошибка HTTP API YooKassa."""
+
+    def __init__(self, message: str, status: Optional[int] = None, code: Optional[str] = None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.code = code
+
+    def __str__(self) -> str:
+        return self.message
+
+
+class AsyncYooKassaClient:
+    """Асинхронный клиент YooKassa поверх общей aiohttp-сессии.
+
+    Соединения переиспользуются (keep-alive), число одновременных запросов
+    ограничено семафором, на каждый запрос действует таймаут. В отличие от
+    SDK yookassa event loop не блокируется и глобальная конфигурация не
+    переприсваивается на каждый платёж.
+    """
+
+    BASE_URL = "https://api.yookassa.ru/v3"
+
+    def __init__(self, shop_id: Optional[str], secret_key: Optional[str], max_connections: int = 20,
+                 max_concurrency: int = 10, timeout: float = 30, max_attempts: int = 3):
+        self.shop_id = shop_id
+        self.secret_key = secret_key
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._session_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stats = {'requests': 0, 'retries': 0, 'errors': 0, 'payments_created': 0}
+
+    @property
+    def configured(self) -> bool:
+        return bool(self.shop_id and self.secret_key)
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop is not loop:
+            self._session_loop = loop
+            self._session = aiohttp.ClientSession(
+                auth=aiohttp.BasicAuth(str(self.shop_id), str(self.secret_key)),
+                connector=aiohttp.TCPConnector(limit=self.max_connections, ttl_dns_cache=300, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=self.timeout, connect=10),
+            )
+        return self._session
+
+    async def _request(self, method: str, path: str, idempotency_key: Optional[str] = None, **kwargs) -> Dict[str, Any]:
+        """HTTP-запрос к API; неопределённые ответы и сетевые сбои повторяются с тем же ключом."""
+        session = await self._get_session()
+        headers = {'Idempotence-Key': idempotency_key} if idempotency_key else {}
+        for attempt in range(self.max_attempts):
+            if attempt:
+                self._stats['retries'] += 1
+            try:
+                async with self._semaphore:
+                    self._stats['requests'] += 1
+                    async with session.request(method, f"{self.BASE_URL}/{path}", headers=headers, **kwargs) as response:
+                        if response.status in RETRY_STATUSES and attempt + 1 < self.max_attempts:
+                            delay = float(response.headers.get('Retry-After') or 2 ** attempt)
+                            logger.warning(f"YooKassa {method} {path}: HTTP {response.status}, повтор через {delay} сек")
+                        elif response.status >= 400:
+                            self._stats['errors'] += 1
+                            try:
+                                body = await response.json(content_type=None)
+                            except Exception:
+                                body = {'description': await response.text()}
+                            raise YooKassaAPIError(
+                                f"YooKassa API {method} {path}: HTTP {response.status} - {body.get('description') or body}",
+                                status=response.status, code=body.get('code')
+                            )
+                        else:
+                            return await response.json(content_type=None)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                # Без ключа идемпотентности повтор POST может создать дубликат
+                if (method != 'GET' and not idempotency_key) or attempt + 1 >= self.max_attempts:
+                    self._stats['errors'] += 1
+                    raise YooKassaAPIError(f"YooKassa API {method} {path}: {e!r}")
+                delay = 2 ** attempt
+                logger.warning(f"YooKassa {method} {path}: {e!r}, повтор через {delay} сек")
+            await asyncio.sleep(delay)
+        self._stats['errors'] += 1
+        raise YooKassaAPIError(f"YooKassa API {method} {path}: результат не получен за {self.max_attempts} попытки")
+
+    async def create_payment(self, payment_data: Dict[str, Any], idempotency_key: str) -> Dict[str, Any]:
+        """Создаёт платёж; возвращает объект платежа из ответа API."""
+        payment = await self._request('POST', 'payments', idempotency_key=idempotency_key, json=payment_data)
+        self._stats['payments_created'] += 1
+        return payment
+
+    async def get_payment(self, payment_id: str) -> Dict[str, Any]:
+        return await self._request('GET', f"payments/{payment_id}")
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Счётчики запросов к YooKassa."""
+        return dict(self._stats)
+
+
+yookassa_client = AsyncYooKassaClient(
+    YOOKASSA_SHOP_ID,
+    SECRET_KEY,
+    max_connections=YOOKASSA_HTTP_CONNECTIONS,
+    max_concurrency=YOOKASSA_MAX_CONCURRENCY,
+    timeout=YOOKASSA_TIMEOUT_SECONDS,
+)
+
+
+def get_yookassa_stats() -> Dict[str, Any]:
+    """Метрики клиента YooKassa."""
+    return yookassa_client.get_stats()